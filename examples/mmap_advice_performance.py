@@ -0,0 +1,120 @@
+#
+# This example measures the effect of the memory map
+# access hints (madvise, populate, and huge pages) on
+# random block reads from BlockStorageMMap and on Path
+# ORAM accesses through a top-cached heap. Page fault
+# counts are reported where the resource module is
+# available. The effect of readahead is largest when the
+# storage file is not already in the page cache (e.g.,
+# after dropping caches or for files larger than RAM).
+#
+
+import os
+import random
+import time
+
+import pyoram
+from pyoram.util.misc import MemorySize
+from pyoram.storage.block_storage_mmap import \
+    BlockStorageMMap
+from pyoram.oblivious_storage.tree.path_oram import \
+    PathORAM
+
+try:
+    import resource
+except ImportError:                                    # pragma: no cover
+    resource = None                                    # pragma: no cover
+
+pyoram.config.SHOW_PROGRESS_BAR = False
+
+# Set the storage location and size
+storage_name = "heap.bin"
+# 4KB block size
+block_size = 4000
+# 16 MB of raw block storage
+block_count = 2**12
+# the number of random block reads
+# (or Path ORAM accesses) per test
+test_count = 1000
+
+def page_faults():
+    if resource is None:
+        return (0, 0)                                  # pragma: no cover
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return (usage.ru_minflt, usage.ru_majflt)
+
+def report(label, start_time, stop_time, faults_before):
+    faults_after = page_faults()
+    print("%-28s %8.2f us/access %8d minor %6d major page faults"
+          % (label,
+             (stop_time-start_time)/float(test_count)*1.0e6,
+             faults_after[0]-faults_before[0],
+             faults_after[1]-faults_before[1]))
+
+def main():
+
+    print("Storage Name: %s" % (storage_name))
+    print("Block Count: %s" % (block_count))
+    print("Block Size: %s" % (MemorySize(block_size)))
+    print("Total Memory: %s"
+          % (MemorySize(block_size*block_count)))
+    print("")
+
+    BlockStorageMMap.setup(storage_name,
+                           block_size,
+                           block_count,
+                           ignore_existing=True).close()
+
+    print("Random Block Reads")
+    indices = [random.randint(0, block_count-1)
+               for t in range(test_count)]
+    for label, kwds in (("default", {}),
+                        ("madvise=random", {'madvise': 'random'}),
+                        ("madvise=sequential", {'madvise': 'sequential'}),
+                        ("populate", {'populate': True}),
+                        ("madvise=random, huge_pages", {'madvise': 'random',
+                                                        'huge_pages': True})):
+        faults_before = page_faults()
+        start_time = time.time()
+        with BlockStorageMMap(storage_name, **kwds) as f:
+            for i in indices:
+                f.read_block(i)
+        stop_time = time.time()
+        report(label, start_time, stop_time, faults_before)
+    print("")
+    os.remove(storage_name)
+
+    print("Path ORAM Accesses (3 cached levels)")
+    oram_block_count = 2**(8+1)-1
+    with PathORAM.setup(storage_name,
+                        block_size,
+                        oram_block_count,
+                        storage_type='mmap',
+                        ignore_existing=True) as f:
+        stash = f.stash
+        position_map = f.position_map
+        key = f.key
+    for label, kwds in (("default", {}),
+                        ("madvise=random", {'madvise': 'random'}),
+                        ("cache_populate", {'cache_populate': True}),
+                        ("cache_huge_pages", {'cache_huge_pages': True})):
+        faults_before = page_faults()
+        start_time = time.time()
+        with PathORAM(storage_name,
+                      stash,
+                      position_map,
+                      key=key,
+                      storage_type='mmap',
+                      cached_levels=3,
+                      **kwds) as f:
+            for t in range(test_count):
+                f.read_block(random.randint(0, f.block_count-1))
+        stop_time = time.time()
+        report(label, start_time, stop_time, faults_before)
+    print("")
+
+    # cleanup because this is a test example
+    os.remove(storage_name)
+
+if __name__ == "__main__":
+    main()                                             # pragma: no cover
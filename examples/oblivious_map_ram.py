@@ -0,0 +1,72 @@
+#
+# This example measures the performance of an oblivious
+# sorted map (an AVL tree stored in a pointer-addressed
+# tree ORAM, which needs no position map) when storage is
+# accessed through RAM.
+#
+
+import os
+import random
+import struct
+import time
+
+import pyoram
+from pyoram.util.misc import MemorySize
+from pyoram.oblivious_data_structures.avl_map import \
+    ObliviousAVLMap
+
+import tqdm
+
+pyoram.config.SHOW_PROGRESS_BAR = True
+
+# Set the storage location and size
+storage_name = "heap.bin"
+# 8 byte keys (big-endian integers sort numerically)
+key_size = 8
+# 100 byte values
+value_size = 100
+# the largest number of items in the map
+capacity = 2**10
+
+def main():
+
+    print("Storage Name: %s" % (storage_name))
+    print("Capacity: %s" % (capacity))
+    print("Key Size: %s" % (MemorySize(key_size)))
+    print("Value Size: %s" % (MemorySize(value_size)))
+    print("Actual Storage Required: %s"
+          % (MemorySize(
+              ObliviousAVLMap.compute_storage_size(
+                  key_size,
+                  value_size,
+                  capacity,
+                  storage_type='ram'))))
+    print("")
+
+    test_count = 20
+    with ObliviousAVLMap.setup(storage_name, # RAM storage ignores this argument
+                               key_size,
+                               value_size,
+                               capacity,
+                               storage_type='ram',
+                               ignore_existing=True) as m:
+        print("Path Accesses Per Operation: %s"
+              % (m.accesses_per_operation))
+        keys = [struct.pack("!Q", random.randint(0, 2**64-1))
+                for i in range(test_count)]
+        start_time = time.time()
+        for key in tqdm.tqdm(keys, desc="Inserting Items"):
+            m[key] = os.urandom(value_size)
+        for key in tqdm.tqdm(keys, desc="Looking Up Items"):
+            m[key]
+        stop_time = time.time()
+        print("Current Stash Size: %s"
+              % len(m.stash))
+        print("Operation Avg. Latency: %.2f ms"
+              % ((stop_time-start_time)/float(2*test_count)*1000))
+        print("Smallest Key: %s"
+              % (struct.unpack("!Q", m.min_item()[0])[0]))
+        print("")
+
+if __name__ == "__main__":
+    main()                                             # pragma: no cover
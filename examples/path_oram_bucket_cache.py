@@ -0,0 +1,123 @@
+#
+# This example compares two ways of spending a fixed
+# memory budget on caching Path ORAM heap buckets when
+# storage is accessed over a simulated network link:
+#
+#   (1) caching the top levels of the heap
+#       (TopCachedEncryptedHeapStorage), and
+#   (2) caching the most recently used buckets from
+#       anywhere in the heap (LRUCachedEncryptedHeapStorage).
+#
+# The number of buckets transferred, the data transmitted,
+# and the latency per access are reported for each.
+#
+
+import os
+import random
+import time
+
+import pyoram
+from pyoram.util.misc import MemorySize
+from pyoram.encrypted_storage.encrypted_heap_storage import \
+    EncryptedHeapStorage
+from pyoram.encrypted_storage.top_cached_encrypted_heap_storage import \
+    TopCachedEncryptedHeapStorage
+from pyoram.encrypted_storage.lru_cached_encrypted_heap_storage import \
+    LRUCachedEncryptedHeapStorage
+from pyoram.oblivious_storage.tree.path_oram import \
+    PathORAM
+
+import tqdm
+
+pyoram.config.SHOW_PROGRESS_BAR = True
+
+# Set the storage location and size
+storage_name = "heap.bin"
+# 4KB block size
+block_size = 4000
+# the number of blocks stored in the ORAM
+block_count = 2**(7+1)-1
+# enough memory for 31 buckets (the top 5
+# levels of the heap)
+cache_buckets = 31
+# the simulated link: 1 ms round trip
+# time and 100 MB/s of bandwidth
+link_kwds = {'storage_type': 'simulated_link',
+             'wrapped_storage_type': 'file',
+             'latency': 0.001,
+             'bandwidth': 100 * 1000**2}
+# the number of Path ORAM accesses per test
+# (after the same number of warm up accesses)
+test_count = 100
+
+def run_test(heap, stash, position_map, label):
+    with PathORAM(heap, stash, position_map) as f:
+        bucket_size = heap.bucket_storage.raw_storage.block_size
+        # warm up the cache before measuring
+        for t in range(test_count):
+            f.read_block(random.randint(0,f.block_count-1))
+        heap.flush()
+        bytes_before = heap.bytes_sent + heap.bytes_received
+        start_time = time.time()
+        for t in tqdm.tqdm(list(range(test_count)),
+                           desc="Running I/O Performance Test (%s)" % (label)):
+            f.read_block(random.randint(0,f.block_count-1))
+        heap.flush()
+        stop_time = time.time()
+        transmitted = heap.bytes_sent + heap.bytes_received - bytes_before
+        print("Access Block Avg. Buckets Transferred: %.2f"
+              % (transmitted/float(bucket_size)/float(test_count)))
+        print("Access Block Avg. Data Transmitted: %s"
+              % (MemorySize(transmitted/float(test_count))))
+        print("Access Block Avg. Latency: %.2f ms"
+              % ((stop_time-start_time)/float(test_count)*1000))
+        print("")
+        return f.stash, f.position_map
+
+def main():
+
+    print("Storage Name: %s" % (storage_name))
+    print("Block Count: %s" % (block_count))
+    print("Block Size: %s" % (MemorySize(block_size)))
+    print("Total Memory: %s"
+          % (MemorySize(block_size*block_count)))
+    print("")
+
+    print("Setting Up Path ORAM Storage")
+    with PathORAM.setup(storage_name,
+                        block_size,
+                        block_count,
+                        ignore_existing=True,
+                        **link_kwds) as f:
+        stash = f.stash
+        position_map = f.position_map
+        key = f.key
+        bucket_size = f.heap_storage.bucket_size
+    budget = MemorySize(cache_buckets * bucket_size)
+    print("")
+    print("Cache Memory Budget: %s" % (budget))
+    print("")
+
+    heap = TopCachedEncryptedHeapStorage(
+        EncryptedHeapStorage(storage_name, key=key, **link_kwds),
+        cache_memory_budget=budget)
+    stash, position_map = run_test(heap, stash, position_map,
+                                   "top-level cache")
+    heap.close()
+
+    heap = LRUCachedEncryptedHeapStorage(
+        EncryptedHeapStorage(storage_name, key=key, **link_kwds),
+        cache_memory_budget=budget)
+    stash, position_map = run_test(heap, stash, position_map,
+                                   "LRU cache")
+    print("LRU Cache Hit Rate: %.1f%%"
+          % (100.0 * heap.hit_count / \
+             float(heap.hit_count + heap.miss_count)))
+    print("")
+    heap.close()
+
+    # cleanup because this is a test example
+    os.remove(storage_name)
+
+if __name__ == "__main__":
+    main()                                             # pragma: no cover
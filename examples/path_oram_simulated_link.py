@@ -0,0 +1,98 @@
+#
+# This example measures the performance of Path ORAM
+# when storage is accessed over a simulated network link
+# (a local file wrapped with configurable latency and
+# bandwidth). This makes it possible to see the effect
+# of round trips and caching without a remote server.
+#
+
+import os
+import random
+import time
+
+import pyoram
+from pyoram.util.misc import MemorySize
+from pyoram.oblivious_storage.tree.path_oram import \
+    PathORAM
+
+import tqdm
+
+pyoram.config.SHOW_PROGRESS_BAR = True
+
+# Set the storage location and size
+storage_name = "heap.bin"
+# 4KB block size
+block_size = 4000
+# one block per bucket in the
+# storage heap of height 6
+block_count = 2**(6+1)-1
+# the simulated link: 2 ms round trip
+# time with up to 1 ms of jitter and
+# 100 MB/s of bandwidth
+link_kwds = {'wrapped_storage_type': 'file',
+             'latency': 0.002,
+             'jitter': 0.001,
+             'bandwidth': 100 * 1000**2,
+             'seed': 0}
+
+def main():
+
+    print("Storage Name: %s" % (storage_name))
+    print("Block Count: %s" % (block_count))
+    print("Block Size: %s" % (MemorySize(block_size)))
+    print("Total Memory: %s"
+          % (MemorySize(block_size*block_count)))
+    print("Link Latency: %.1f ms (+ up to %.1f ms jitter)"
+          % (link_kwds['latency']*1000, link_kwds['jitter']*1000))
+    print("Link Bandwidth: %s/s"
+          % (MemorySize(link_kwds['bandwidth'])))
+    print("")
+
+    print("Setting Up Path ORAM Storage")
+    with PathORAM.setup(storage_name,
+                        block_size,
+                        block_count,
+                        storage_type='simulated_link',
+                        ignore_existing=True,
+                        **link_kwds) as f:
+        stash = f.stash
+        position_map = f.position_map
+        key = f.key
+    print("")
+
+    for cached_levels in (1, 3):
+        # We close the device and reopen it to reset
+        # the bytes sent and bytes received stats.
+        with PathORAM(storage_name,
+                      stash,
+                      position_map,
+                      key=key,
+                      storage_type='simulated_link',
+                      cached_levels=cached_levels,
+                      **link_kwds) as f:
+
+            link = f.heap_storage.bucket_storage.raw_storage
+            requests_before = link.request_count
+            test_count = 50
+            start_time = time.time()
+            for t in tqdm.tqdm(list(range(test_count)),
+                               desc=("Running I/O Performance Test "
+                                     "(%s cached levels)"
+                                     % (cached_levels))):
+                f.read_block(random.randint(0,f.block_count-1))
+            f.flush()
+            stop_time = time.time()
+            print("Access Block Avg. Data Transmitted: %s (%.3fx)"
+                  % (MemorySize((f.bytes_sent + f.bytes_received)/float(test_count)),
+                     (f.bytes_sent + f.bytes_received)/float(test_count)/float(block_size)))
+            print("Access Block Avg. Requests: %.2f"
+                  % ((link.request_count - requests_before)/float(test_count)))
+            print("Access Block Avg. Latency: %.2f ms"
+                  % ((stop_time-start_time)/float(test_count)*1000))
+            print("")
+
+    # cleanup because this is a test example
+    os.remove(storage_name)
+
+if __name__ == "__main__":
+    main()                                             # pragma: no cover
@@ -0,0 +1,65 @@
+#
+# This example uses the metadata-only Path ORAM simulator
+# to compare the stash size, the blocks moved per access,
+# and the buckets transferred per access for several
+# bucket capacities and heap bases. No block data is
+# stored and nothing is encrypted, so much larger block
+# and access counts than those used here can be simulated
+# in minutes (e.g., 2**24 blocks and millions of
+# accesses).
+#
+
+import time
+
+from pyoram.simulation.path_oram_simulator import \
+    parameter_study
+
+# the number of blocks stored in the ORAM
+block_count = 2**12
+# the number of accesses that are measured (after
+# the same number of warm up accesses)
+access_count = 10000
+# the number of top heap levels cached locally
+cached_levels = 3
+
+def main():
+
+    print("Block Count: %s" % (block_count))
+    print("Access Count: %s" % (access_count))
+    print("Cached Levels: %s" % (cached_levels))
+    print("")
+
+    start_time = time.time()
+    print("%4s %4s %10s %6s %10s %10s %10s %10s %10s"
+          % ("k", "Z", "workload", "levels",
+             "max stash", "mean stash", "99% stash",
+             "moved", "buckets"))
+    for result in parameter_study(block_count,
+                                  access_count,
+                                  bucket_capacity=(2, 3, 4, 5),
+                                  heap_base=(2, 3),
+                                  workload=('uniform', 'sequential'),
+                                  cached_levels=cached_levels):
+        histogram = result['stash_size_histogram']
+        total = 0
+        for quantile99, count in enumerate(histogram):
+            total += count
+            if total >= 0.99 * result['access_count']:
+                break
+        print("%4s %4s %10s %6s %10s %10.2f %10s %10.2f %10.2f"
+              % (result['heap_base'],
+                 result['bucket_capacity'],
+                 result['workload'],
+                 result['heap_levels'],
+                 result['max_stash_size'],
+                 result['mean_stash_size'],
+                 quantile99,
+                 result['blocks_moved_per_access'],
+                 result['buckets_read_per_access'] + \
+                 result['buckets_written_per_access']))
+    stop_time = time.time()
+    print("")
+    print("Total Simulation Time: %.2f s" % (stop_time-start_time))
+
+if __name__ == "__main__":
+    main()                                             # pragma: no cover
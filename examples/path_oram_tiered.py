@@ -0,0 +1,113 @@
+#
+# This example migrates the heap storage of an existing
+# Path ORAM into three tiers: the top levels are kept in
+# RAM, the middle levels in a local memory-mapped file,
+# and the leaf levels on a (simulated) remote device. The
+# performance of Path ORAM over the original storage and
+# over the tiered storage is then compared.
+#
+
+import os
+import random
+import time
+
+import pyoram
+from pyoram.util.misc import MemorySize
+from pyoram.encrypted_storage.encrypted_heap_storage import \
+    EncryptedHeapStorage
+from pyoram.encrypted_storage.tiered_heap_storage import \
+    TieredHeapStorage
+from pyoram.oblivious_storage.tree.path_oram import \
+    PathORAM
+
+import tqdm
+
+pyoram.config.SHOW_PROGRESS_BAR = True
+
+# Set the storage location and size
+storage_name = "heap.bin"
+# 4KB block size
+block_size = 4000
+# one block per bucket in the
+# storage heap of height 6
+block_count = 2**(6+1)-1
+# the simulated link: 2 ms round trip
+# time and 100 MB/s of bandwidth
+link_kwds = {'wrapped_storage_type': 'file',
+             'latency': 0.002,
+             'bandwidth': 100 * 1000**2}
+
+def run_test(f, label):
+    test_count = 50
+    start_time = time.time()
+    for t in tqdm.tqdm(list(range(test_count)),
+                       desc="Running I/O Performance Test (%s)" % (label)):
+        f.read_block(random.randint(0,f.block_count-1))
+    f.flush()
+    stop_time = time.time()
+    print("Access Block Avg. Data Transmitted: %s (%.3fx)"
+          % (MemorySize((f.bytes_sent + f.bytes_received)/float(test_count)),
+             (f.bytes_sent + f.bytes_received)/float(test_count)/float(block_size)))
+    print("Access Block Avg. Latency: %.2f ms"
+          % ((stop_time-start_time)/float(test_count)*1000))
+    print("")
+
+def main():
+
+    print("Storage Name: %s" % (storage_name))
+    print("Block Count: %s" % (block_count))
+    print("Block Size: %s" % (MemorySize(block_size)))
+    print("Total Memory: %s"
+          % (MemorySize(block_size*block_count)))
+    print("")
+
+    print("Setting Up Path ORAM Storage")
+    with PathORAM.setup(storage_name,
+                        block_size,
+                        block_count,
+                        storage_type='simulated_link',
+                        ignore_existing=True,
+                        **link_kwds) as f:
+        stash = f.stash
+        position_map = f.position_map
+        key = f.key
+        heap_levels = f.heap_storage.virtual_heap.levels
+    print("")
+
+    with PathORAM(storage_name,
+                  stash,
+                  position_map,
+                  key=key,
+                  storage_type='simulated_link',
+                  cached_levels=0,
+                  **link_kwds) as f:
+        run_test(f, "original")
+        stash = f.stash
+        position_map = f.position_map
+
+    # the top 3 levels in RAM, the middle levels in a
+    # memory-mapped file, and the last 2 levels on the
+    # simulated remote device
+    tiers = [((0, 3), None, {'storage_type': 'ram'}),
+             ((3, heap_levels-2), storage_name+".middle",
+              {'storage_type': 'mmap'}),
+             ((heap_levels-2, heap_levels), storage_name+".leaves",
+              dict(link_kwds, storage_type='simulated_link'))]
+    print("Migrating Heap Storage Into Tiers")
+    with EncryptedHeapStorage(storage_name, key=key) as heap:
+        tiered = TieredHeapStorage.migrate(heap,
+                                           tiers,
+                                           ignore_existing=True)
+    print("")
+
+    with PathORAM(tiered, stash, position_map) as f:
+        run_test(f, "tiered")
+    tiered.close()
+
+    # cleanup because this is a test example
+    os.remove(storage_name)
+    os.remove(storage_name+".middle")
+    os.remove(storage_name+".leaves")
+
+if __name__ == "__main__":
+    main()                                             # pragma: no cover
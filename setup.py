@@ -67,7 +67,8 @@ setup(
     packages=find_packages(where="src", exclude=["_cffi_src", "_cffi_src.*"]),
     setup_requires=setup_requirements,
     install_requires=requirements,
-    cffi_modules=["src/_cffi_src/virtual_heap_helper_build.py:ffi"],
+    cffi_modules=["src/_cffi_src/virtual_heap_helper_build.py:ffi",
+                  "src/_cffi_src/path_oram_simulator_build.py:ffi"],
     # use MANIFEST.in
     include_package_data=True,
     test_suite='nose2.collector.collector',
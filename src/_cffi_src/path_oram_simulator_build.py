@@ -0,0 +1,389 @@
+import cffi
+
+#
+# C functions that simulate the block placement of
+# Path ORAM on block ids and leaves only (no block
+# data, no encryption, and no storage), so that stash
+# and bandwidth statistics can be measured quickly at
+# large scale. The eviction logic mirrors
+# TreeORAMStorage.push_down_path and
+# TreeORAMStorage.fill_path_from_stash.
+#
+
+ffi = cffi.FFI()
+ffi.cdef(
+"""
+#define PATH_ORAM_SIM_EMPTY ...
+#define PATH_ORAM_SIM_STASH_OVERFLOW ...
+
+typedef struct {
+    unsigned int k;
+    unsigned int Z;
+    unsigned int levels;
+    unsigned int cached_levels;
+    unsigned int block_count;
+    unsigned long long first_leaf;
+    unsigned long long leaf_count;
+    unsigned int *buckets;
+    unsigned long long *position_map;
+    unsigned int *stash;
+    unsigned long long stash_size;
+    unsigned long long stash_capacity;
+    unsigned long long *stash_histogram;
+    unsigned long long rng_state;
+    unsigned long long *path_buckets;
+    unsigned int *path_ids;
+    int *path_levels;
+    int *stash_levels;
+    unsigned long long previous_leaf;
+    int has_previous;
+    unsigned long long access_count;
+    unsigned long long max_stash_size;
+    unsigned long long blocks_moved;
+    unsigned long long buckets_read;
+    unsigned long long buckets_written;
+} path_oram_sim;
+
+unsigned long long path_oram_sim_random_leaf(path_oram_sim *sim);
+int path_oram_sim_access(path_oram_sim *sim,
+                         unsigned int id);
+int path_oram_sim_access_many(path_oram_sim *sim,
+                              const unsigned int *ids,
+                              unsigned long long n);
+int path_oram_sim_access_random(path_oram_sim *sim,
+                                unsigned long long n);
+void path_oram_sim_level_occupancy(path_oram_sim *sim,
+                                   unsigned long long *counts);
+""")
+
+ffi.set_source("pyoram.simulation._path_oram_simulator",
+"""
+#include <string.h>
+
+#define PATH_ORAM_SIM_EMPTY 0xFFFFFFFFU
+#define PATH_ORAM_SIM_STASH_OVERFLOW -2
+
+typedef struct {
+    unsigned int k;
+    unsigned int Z;
+    unsigned int levels;
+    unsigned int cached_levels;
+    unsigned int block_count;
+    unsigned long long first_leaf;
+    unsigned long long leaf_count;
+    /* bucket_count * Z block ids */
+    unsigned int *buckets;
+    /* block_count leaf buckets */
+    unsigned long long *position_map;
+    /* stash_capacity block ids (in insertion order) */
+    unsigned int *stash;
+    unsigned long long stash_size;
+    unsigned long long stash_capacity;
+    /* stash_capacity + 1 counts */
+    unsigned long long *stash_histogram;
+    unsigned long long rng_state;
+    /* scratch space: levels, levels * Z, levels * Z,
+       and stash_capacity entries */
+    unsigned long long *path_buckets;
+    unsigned int *path_ids;
+    int *path_levels;
+    int *stash_levels;
+    unsigned long long previous_leaf;
+    int has_previous;
+    unsigned long long access_count;
+    unsigned long long max_stash_size;
+    unsigned long long blocks_moved;
+    unsigned long long buckets_read;
+    unsigned long long buckets_written;
+} path_oram_sim;
+
+static int calculate_bucket_level(unsigned int k,
+                                  unsigned long long b)
+{
+   unsigned int h;
+   unsigned long long pow;
+   if (k == 2) {
+      h = 0;
+      b += 1;
+      while (b >>= 1) {++h;}
+      return h;
+   }
+   b = (k - 1) * (b + 1) + 1;
+   h = 0;
+   pow = k;
+   while (pow < b) {++h; pow *= k;}
+   return h;
+}
+
+static int calculate_last_common_level(unsigned int k,
+                                       unsigned long long b1,
+                                       unsigned long long b2)
+{
+   int level1, level2;
+   level1 = calculate_bucket_level(k, b1);
+   level2 = calculate_bucket_level(k, b2);
+   while (level1 > level2) {
+      b1 = (b1 - 1)/k;
+      --level1;
+   }
+   while (level2 > level1) {
+      b2 = (b2 - 1)/k;
+      --level2;
+   }
+   while (b1 != b2) {
+      b1 = (b1 - 1)/k;
+      b2 = (b2 - 1)/k;
+      --level1;
+   }
+   return level1;
+}
+
+/* xorshift64* */
+static unsigned long long sim_random(path_oram_sim *sim)
+{
+   unsigned long long x = sim->rng_state;
+   x ^= x >> 12;
+   x ^= x << 25;
+   x ^= x >> 27;
+   sim->rng_state = x;
+   return x * 0x2545F4914F6CDD1DULL;
+}
+
+static unsigned long long sim_random_below(path_oram_sim *sim,
+                                           unsigned long long n)
+{
+   /* rejection sampling avoids modulo bias */
+   unsigned long long limit = ~0ULL - (~0ULL % n);
+   unsigned long long r;
+   do {
+      r = sim_random(sim);
+   } while (r >= limit);
+   return r % n;
+}
+
+unsigned long long path_oram_sim_random_leaf(path_oram_sim *sim)
+{
+   return sim->first_leaf + sim_random_below(sim, sim->leaf_count);
+}
+
+static long new_write_pos(const int *path_levels, long current)
+{
+   --current;
+   while ((current >= 0) && (path_levels[current] != -1)) {--current;}
+   return current;
+}
+
+static long new_read_pos(const int *path_levels, long current)
+{
+   --current;
+   while ((current >= 0) && (path_levels[current] == -1)) {--current;}
+   return current;
+}
+
+int path_oram_sim_access(path_oram_sim *sim,
+                         unsigned int id)
+{
+   const unsigned int k = sim->k;
+   const unsigned int Z = sim->Z;
+   const unsigned int levels = sim->levels;
+   const long path_size = (long)levels * Z;
+   unsigned int *path_ids = sim->path_ids;
+   int *path_levels = sim->path_levels;
+   unsigned long long leaf, b, i;
+   unsigned int l, j, read_level_start, io_level_start;
+   long pos, write_pos, read_pos;
+   int write_level, found;
+
+   if (id >= sim->block_count) {
+      return -1;
+   }
+   leaf = sim->position_map[id];
+
+   /* load the path (see TreeORAMStorage.load_path) */
+   read_level_start = 0;
+   if (sim->has_previous) {
+      read_level_start =
+         calculate_last_common_level(k, sim->previous_leaf, leaf);
+   }
+   b = leaf;
+   for (l = levels; l-- > 0;) {
+      sim->path_buckets[l] = b;
+      if (l > 0) {b = (b - 1)/k;}
+   }
+   found = 0;
+   for (l = 0, pos = 0; l < levels; ++l) {
+      for (j = 0; j < Z; ++j, ++pos) {
+         path_ids[pos] = sim->buckets[sim->path_buckets[l]*Z + j];
+         if (path_ids[pos] == PATH_ORAM_SIM_EMPTY) {
+            path_levels[pos] = -1;
+         }
+         else if (path_ids[pos] == id) {
+            /* extract the accessed block */
+            path_ids[pos] = PATH_ORAM_SIM_EMPTY;
+            path_levels[pos] = -1;
+            found = 1;
+         }
+         else {
+            path_levels[pos] = calculate_last_common_level(
+               k, leaf, sim->position_map[path_ids[pos]]);
+         }
+      }
+   }
+
+   /* place the accessed block in the stash (it keeps
+      its place if it is already there). Nothing but the
+      scratch space has been modified yet, so the state is
+      unchanged when the stash is full. */
+   if (!found) {
+      for (i = 0; i < sim->stash_size; ++i) {
+         if (sim->stash[i] == id) {found = 2; break;}
+      }
+   }
+   if ((found != 2) && (sim->stash_size == sim->stash_capacity)) {
+      return PATH_ORAM_SIM_STASH_OVERFLOW;
+   }
+   /* the accessed block was extracted from the path, so
+      its old leaf is not needed to load the path */
+   sim->position_map[id] = path_oram_sim_random_leaf(sim);
+   if (found != 2) {
+      sim->stash[sim->stash_size++] = id;
+   }
+
+   /* see TreeORAMStorage.push_down_path */
+   write_pos = new_write_pos(path_levels, path_size);
+   while (write_pos >= 0) {
+      write_level = (int)(write_pos / Z);
+      read_pos = new_read_pos(path_levels, write_pos);
+      if (read_pos < 0) {
+         break;
+      }
+      while (((read_pos / Z) == write_level) ||
+             (write_level > path_levels[read_pos])) {
+         read_pos = new_read_pos(path_levels, read_pos);
+         if (read_pos < 0) {
+            break;
+         }
+      }
+      if (read_pos >= 0) {
+         path_ids[write_pos] = path_ids[read_pos];
+         path_levels[write_pos] = path_levels[read_pos];
+         path_ids[read_pos] = PATH_ORAM_SIM_EMPTY;
+         path_levels[read_pos] = -1;
+         ++sim->blocks_moved;
+      }
+      else {
+         /* no block can be evicted to this level */
+         write_pos = Z * (write_pos / Z);
+      }
+      write_pos = new_write_pos(path_levels, write_pos);
+   }
+
+   /* see TreeORAMStorage.fill_path_from_stash */
+   for (i = 0; i < sim->stash_size; ++i) {
+      sim->stash_levels[i] = -2;
+   }
+   for (write_pos = path_size - 1; write_pos >= 0; --write_pos) {
+      if (path_ids[write_pos] != PATH_ORAM_SIM_EMPTY) {
+         continue;
+      }
+      write_level = (int)(write_pos / Z);
+      for (i = 0; i < sim->stash_size; ++i) {
+         if (sim->stash_levels[i] == -2) {
+            sim->stash_levels[i] = calculate_last_common_level(
+               k, leaf, sim->position_map[sim->stash[i]]);
+         }
+         if (write_level <= sim->stash_levels[i]) {
+            path_ids[write_pos] = sim->stash[i];
+            path_levels[write_pos] = sim->stash_levels[i];
+            memmove(sim->stash + i,
+                    sim->stash + i + 1,
+                    (sim->stash_size - i - 1) * sizeof(unsigned int));
+            memmove(sim->stash_levels + i,
+                    sim->stash_levels + i + 1,
+                    (sim->stash_size - i - 1) * sizeof(int));
+            --sim->stash_size;
+            ++sim->blocks_moved;
+            break;
+         }
+      }
+   }
+
+   /* write the path back */
+   for (l = 0, pos = 0; l < levels; ++l) {
+      for (j = 0; j < Z; ++j, ++pos) {
+         sim->buckets[sim->path_buckets[l]*Z + j] = path_ids[pos];
+      }
+   }
+
+   io_level_start = sim->cached_levels;
+   if (read_level_start > io_level_start) {
+      io_level_start = read_level_start;
+   }
+   if (io_level_start < levels) {
+      sim->buckets_read += levels - io_level_start;
+   }
+   if (sim->cached_levels < levels) {
+      sim->buckets_written += levels - sim->cached_levels;
+   }
+   sim->previous_leaf = leaf;
+   sim->has_previous = 1;
+   ++sim->access_count;
+   ++sim->stash_histogram[sim->stash_size];
+   if (sim->stash_size > sim->max_stash_size) {
+      sim->max_stash_size = sim->stash_size;
+   }
+   return 0;
+}
+
+int path_oram_sim_access_many(path_oram_sim *sim,
+                              const unsigned int *ids,
+                              unsigned long long n)
+{
+   unsigned long long i;
+   int ret;
+   for (i = 0; i < n; ++i) {
+      ret = path_oram_sim_access(sim, ids[i]);
+      if (ret != 0) {return ret;}
+   }
+   return 0;
+}
+
+int path_oram_sim_access_random(path_oram_sim *sim,
+                                unsigned long long n)
+{
+   unsigned long long i;
+   int ret;
+   for (i = 0; i < n; ++i) {
+      ret = path_oram_sim_access(
+         sim,
+         (unsigned int)sim_random_below(sim, sim->block_count));
+      if (ret != 0) {return ret;}
+   }
+   return 0;
+}
+
+void path_oram_sim_level_occupancy(path_oram_sim *sim,
+                                   unsigned long long *counts)
+{
+   unsigned long long b, first, stop;
+   unsigned long long width = 1;
+   unsigned int l, j;
+   first = 0;
+   for (l = 0; l < sim->levels; ++l) {
+      counts[l] = 0;
+      stop = first + width;
+      for (b = first; b < stop; ++b) {
+         for (j = 0; j < sim->Z; ++j) {
+            if (sim->buckets[b*sim->Z + j] != PATH_ORAM_SIM_EMPTY) {
+               ++counts[l];
+            }
+         }
+      }
+      first = stop;
+      width *= sim->k;
+   }
+}
+""")
+
+if __name__ == "__main__":
+    ffi.compile()
@@ -14,6 +14,25 @@ int calculate_bucket_level(unsigned int k,
 int calculate_last_common_level(unsigned int k,
                                 unsigned long long b1,
                                 unsigned long long b2);
+int calculate_bucket_path(unsigned int k,
+                          unsigned long long b,
+                          int level_start,
+                          void *out,
+                          int out_size,
+                          int out_length);
+unsigned long long calculate_blocked_bucket_index(unsigned int k,
+                                                  int levels,
+                                                  int subtree_levels,
+                                                  unsigned long long b);
+size_t sample_uniform_integers(const void *random_bytes,
+                               size_t offset,
+                               size_t nbytes,
+                               unsigned long long a,
+                               unsigned long long max_offset,
+                               void *out,
+                               int out_size,
+                               size_t count,
+                               size_t *bytes_used);
 """)
 
 ffi.set_source("pyoram.util._virtual_heap_helper",
@@ -68,6 +87,130 @@ int calculate_last_common_level(unsigned int k,
    }
    return level1;
 }
+
+// Fills out (an array of out_length unsigned integers
+// that are out_size bytes wide) with the buckets on the
+// path from the root to bucket b, skipping the first
+// level_start levels. Returns the number of buckets
+// written, or -1 if they do not fit in out.
+int calculate_bucket_path(unsigned int k,
+                          unsigned long long b,
+                          int level_start,
+                          void *out,
+                          int out_size,
+                          int out_length)
+{
+   int level, count;
+   level = calculate_bucket_level(k, b);
+   if (level < level_start) {
+      return 0;
+   }
+   count = level - level_start + 1;
+   if ((count > out_length) ||
+       ((out_size == 4) && (b > 0xFFFFFFFFULL))) {
+      return -1;
+   }
+   while (level >= level_start) {
+      if (out_size == 4) {
+         ((unsigned int *)out)[level - level_start] = (unsigned int)b;
+      }
+      else {
+         ((unsigned long long *)out)[level - level_start] = b;
+      }
+      b = (b - 1)/k;
+      --level;
+   }
+   return count;
+}
+
+// Returns the position of bucket b in a heap with the
+// given number of levels when the heap is stored as
+// blocks of subtrees that each span subtree_levels levels
+// (the subtrees in the last band of levels may be
+// shorter). Bands are stored in order from the root, the
+// subtrees of a band in order of their root bucket, and
+// the buckets of a subtree in level order.
+unsigned long long calculate_blocked_bucket_index(unsigned int k,
+                                                  int levels,
+                                                  int subtree_levels,
+                                                  unsigned long long b)
+{
+   int level, depth, band_levels, i;
+   unsigned long long root, pow, band_first, subtree_size, offset;
+   level = calculate_bucket_level(k, b);
+   depth = level % subtree_levels;
+   root = b;
+   pow = 1;
+   for (i = 0; i < depth; ++i) {
+      root = (root - 1)/k;
+      pow *= k;
+   }
+   // the offset of b within its subtree
+   offset = (pow - 1)/(k - 1) + (b - (root*pow + (pow - 1)/(k - 1)));
+   band_levels = levels - (level - depth);
+   if (band_levels > subtree_levels) {
+      band_levels = subtree_levels;
+   }
+   subtree_size = 1;
+   pow = 1;
+   for (i = 1; i < band_levels; ++i) {
+      pow *= k;
+      subtree_size += pow;
+   }
+   // the first bucket at the top level of the band is
+   // also the number of buckets stored before the band
+   pow = 1;
+   band_first = 0;
+   for (i = 0; i < level - depth; ++i) {
+      band_first += pow;
+      pow *= k;
+   }
+   return band_first + (root - band_first)*subtree_size + offset;
+}
+
+size_t sample_uniform_integers(const void *random_bytes,
+                               size_t offset,
+                               size_t nbytes,
+                               unsigned long long a,
+                               unsigned long long max_offset,
+                               void *out,
+                               int out_size,
+                               size_t count,
+                               size_t *bytes_used)
+{
+   const unsigned char *bytes = (const unsigned char *)random_bytes + offset;
+   unsigned long long mask = max_offset;
+   unsigned long long r;
+   unsigned int width = 0, i;
+   size_t pos = 0, produced = 0;
+   mask |= mask >> 1;
+   mask |= mask >> 2;
+   mask |= mask >> 4;
+   mask |= mask >> 8;
+   mask |= mask >> 16;
+   mask |= mask >> 32;
+   r = max_offset;
+   while (r) {++width; r >>= 8;}
+   while ((produced < count) && (pos + width <= nbytes)) {
+      r = 0;
+      for (i = 0; i < width; ++i) {
+         r = (r << 8) | bytes[pos + i];
+      }
+      pos += width;
+      r &= mask;
+      if (r <= max_offset) {
+         if (out_size == 4) {
+            ((unsigned int *)out)[produced] = (unsigned int)(a + r);
+         }
+         else {
+            ((unsigned long long *)out)[produced] = a + r;
+         }
+         ++produced;
+      }
+   }
+   *bytes_used = pos;
+   return produced;
+}
 """)
 
 if __name__ == "__main__":
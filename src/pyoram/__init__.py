@@ -53,3 +53,5 @@ import pyoram.crypto
 import pyoram.storage
 import pyoram.encrypted_storage
 import pyoram.oblivious_storage
+import pyoram.oblivious_data_structures
+import pyoram.simulation
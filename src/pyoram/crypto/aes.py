@@ -10,6 +10,12 @@ _cipher = cryptography.hazmat.primitives.ciphers.Cipher
 _ctrmode = cryptography.hazmat.primitives.ciphers.modes.CTR
 _gcmmode = cryptography.hazmat.primitives.ciphers.modes.GCM
 
+def _tobytes(data):
+    # on Python 2, bytes(memoryview) returns its repr
+    if isinstance(data, memoryview):
+        return data.tobytes()
+    return bytes(data)
+
 class AES(object):
 
     key_sizes = [k//8 for k in sorted(_aes.key_sizes)]
@@ -26,9 +32,15 @@ class AES(object):
         cipher = _cipher(_aes(key), _ctrmode(iv), backend=_backend).encryptor()
         return iv + cipher.update(plaintext) + cipher.finalize()
 
+    #
+    # The decryption methods accept any bytes-like
+    # ciphertext (e.g., a memoryview returned by a
+    # zero-copy read) and always return bytes.
+    #
+
     @staticmethod
     def CTRDec(key, ciphertext):
-        iv = ciphertext[:AES.block_size]
+        iv = _tobytes(ciphertext[:AES.block_size])
         cipher = _cipher(_aes(key), _ctrmode(iv), backend=_backend).decryptor()
         return cipher.update(ciphertext[AES.block_size:]) + \
                cipher.finalize()
@@ -41,8 +53,8 @@ class AES(object):
 
     @staticmethod
     def GCMDec(key, ciphertext):
-        iv = ciphertext[:AES.block_size]
-        tag = ciphertext[-AES.block_size:]
+        iv = _tobytes(ciphertext[:AES.block_size])
+        tag = _tobytes(ciphertext[-AES.block_size:])
         cipher = _cipher(_aes(key), _gcmmode(iv, tag), backend=_backend).decryptor()
         return cipher.update(ciphertext[AES.block_size:-AES.block_size]) + \
                cipher.finalize()
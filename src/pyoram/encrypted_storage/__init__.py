@@ -1,3 +1,5 @@
 import pyoram.encrypted_storage.encrypted_block_storage
 import pyoram.encrypted_storage.encrypted_heap_storage
 import pyoram.encrypted_storage.top_cached_encrypted_heap_storage
+import pyoram.encrypted_storage.tiered_heap_storage
+import pyoram.encrypted_storage.lru_cached_encrypted_heap_storage
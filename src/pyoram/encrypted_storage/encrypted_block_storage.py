@@ -297,6 +297,31 @@ class EncryptedBlockStorage(EncryptedBlockStorageInterface):
                 self._encrypt_block_func(self._key, b))
         self._storage.write_blocks(indices, enc_blocks, *args, **kwds)
 
+    def flush(self):
+        self._storage.flush()
+
+    def grow(self, block_count, initialize=None):
+        if initialize is None:
+            zeros = bytes(bytearray(self.block_size))
+            initialize = lambda i: zeros
+        self._storage.grow(
+            block_count,
+            initialize=lambda i: self._encrypt_block_func(self._key,
+                                                          initialize(i)))
+        # the index digest covers the block count
+        self._verify_digest = hmac.HMAC(
+            key=self.key,
+            msg=struct.pack(self._verify_struct_string,
+                            self._storage.block_size,
+                            self._storage.block_count,
+                            len(self._storage.header_data)),
+            digestmod=hashlib.sha384).digest()
+        header_data = bytearray(AES.GCMDec(self._key,
+                                           self._storage.header_data))
+        header_data[:len(self._verify_digest)] = self._verify_digest
+        self._storage.update_header_data(
+            AES.GCMEnc(self._key, bytes(header_data)))
+
     @property
     def bytes_sent(self):
         return self._storage.bytes_sent
@@ -1,7 +1,5 @@
 __all__ = ('EncryptedHeapStorage',)
 
-import struct
-
 from pyoram.util.virtual_heap import SizedVirtualHeap
 from pyoram.storage.heap_storage import \
     (HeapStorageInterface,
@@ -65,12 +63,16 @@ class EncryptedHeapStorage(HeapStorage,
                              blocks_per_bucket=1,
                              heap_base=2,
                              ignore_header=False,
+                             layout_subtree_levels=None,
                              **kwds):
         assert (block_size > 0) and (block_size == int(block_size))
         assert heap_height >= 0
         assert blocks_per_bucket >= 1
         assert heap_base >= 2
         assert 'block_count' not in kwds
+        # the bucket layout does not change the storage size
+        assert (layout_subtree_levels is None) or \
+            (layout_subtree_levels >= 1)
         vheap = SizedVirtualHeap(
             heap_base,
             heap_height,
@@ -96,6 +98,7 @@ class EncryptedHeapStorage(HeapStorage,
               heap_height,
               blocks_per_bucket=1,
               heap_base=2,
+              layout_subtree_levels=None,
               **kwds):
         if 'block_count' in kwds:
             raise ValueError("'block_count' keyword is not accepted")
@@ -116,18 +119,7 @@ class EncryptedHeapStorage(HeapStorage,
             heap_base,
             heap_height,
             blocks_per_bucket=blocks_per_bucket)
-
-        user_header_data = kwds.pop('header_data', bytes())
-        if type(user_header_data) is not bytes:
-            raise TypeError(
-                "'header_data' must be of type bytes. "
-                "Invalid type: %s" % (type(user_header_data)))
-        kwds['header_data'] = \
-            struct.pack(cls._header_struct_string,
-                        heap_base,
-                        heap_height,
-                        blocks_per_bucket) + \
-            user_header_data
+        cls._prepare_setup(vheap, layout_subtree_levels, kwds)
 
         return EncryptedHeapStorage(
             EncryptedBlockStorage.setup(
@@ -0,0 +1,270 @@
+__all__ = ('LRUCachedEncryptedHeapStorage',)
+
+import logging
+import itertools
+import collections
+
+from pyoram.util.misc import MemorySize
+from pyoram.encrypted_storage.encrypted_heap_storage import \
+    (EncryptedHeapStorageInterface,
+     EncryptedHeapStorage)
+
+log = logging.getLogger("pyoram")
+
+class LRUCachedEncryptedHeapStorage(EncryptedHeapStorageInterface):
+    """
+    An encrypted heap storage device that keeps the most
+    recently read or written buckets (from anywhere in the
+    heap) in local memory. Reads of cached buckets are served
+    locally, and written buckets are kept in the cache until
+    they are evicted (least recently used first), the device
+    is flushed, or the device is closed, at which point the
+    modified buckets are written back to external storage in
+    a single batch.
+
+    The size of the cache is set with either the 'cache_size'
+    keyword (a number of buckets) or the
+    'cache_memory_budget' keyword (a MemorySize or a number
+    of bytes). For tree ORAMs that access uniformly random
+    paths, the buckets that miss the cache depend only on the
+    previously accessed paths, so the external I/O remains
+    oblivious.
+
+    Like TopCachedEncryptedHeapStorage, this class wraps an
+    existing encrypted heap storage device, which should not
+    be used directly while it is wrapped and which is closed
+    when this device is closed.
+    """
+
+    def __init__(self,
+                 heap_storage,
+                 cache_size=None,
+                 cache_memory_budget=None):
+        assert isinstance(heap_storage, EncryptedHeapStorage)
+        if (cache_size is None) == (cache_memory_budget is None):
+            raise ValueError(
+                "Exactly one of the 'cache_size' or "
+                "'cache_memory_budget' keywords is required")
+        if cache_memory_budget is not None:
+            if not isinstance(cache_memory_budget, MemorySize):
+                if cache_memory_budget < 0:
+                    raise ValueError(
+                        "Cache memory budget must be non-negative: %s"
+                        % (cache_memory_budget))
+                cache_memory_budget = MemorySize(cache_memory_budget)
+            cache_size = int(cache_memory_budget.B) // \
+                         heap_storage.bucket_size
+        if cache_size < 1:
+            raise ValueError(
+                "The cache must hold at least one bucket. "
+                "Invalid cache size: %s" % (cache_size))
+        self._heap_storage = heap_storage
+        self._cache_size = min(cache_size, heap_storage.bucket_count)
+        # maps bucket index to bucket data, ordered from
+        # least to most recently used
+        self._cache = collections.OrderedDict()
+        self._dirty = set()
+        self._hit_count = 0
+        self._miss_count = 0
+        log.info("%s: Caching up to %s of %s heap buckets (%s)"
+                 % (self.__class__.__name__,
+                    self._cache_size,
+                    heap_storage.bucket_count,
+                    MemorySize(self._cache_size * heap_storage.bucket_size)))
+
+    def _touch(self, bb, bucket):
+        # (re)insert a bucket as the most recently used
+        self._cache.pop(bb, None)
+        self._cache[bb] = bucket
+
+    def _write_back(self, buckets):
+        buckets = sorted(bb for bb in buckets if bb in self._dirty)
+        if len(buckets) > 0:
+            self._heap_storage.bucket_storage.write_blocks(
+                buckets, [self._cache[bb] for bb in buckets])
+            self._dirty.difference_update(buckets)
+
+    def _evict(self):
+        excess = len(self._cache) - self._cache_size
+        if excess > 0:
+            evicted = list(itertools.islice(self._cache, excess))
+            self._write_back(evicted)
+            for bb in evicted:
+                del self._cache[bb]
+
+    def _read_buckets(self, buckets):
+        # buckets is a sorted list of distinct bucket indices
+        missing = [bb for bb in buckets if bb not in self._cache]
+        self._miss_count += len(missing)
+        self._hit_count += len(buckets) - len(missing)
+        data = {}
+        for bb in buckets:
+            if bb in self._cache:
+                data[bb] = self._cache[bb]
+        if len(missing) > 0:
+            data.update(zip(missing,
+                            self._heap_storage.bucket_storage.\
+                            read_blocks(missing)))
+        return data
+
+    def _path_buckets(self, b, level_start):
+        vheap = self._heap_storage.virtual_heap
+        assert 0 <= b < vheap.bucket_count()
+        assert 0 <= level_start
+        bucket_list = vheap.path_buckets(b, level_start)
+        assert len(bucket_list) > 0
+        return bucket_list
+
+    #
+    # Add some methods specific to LRUCachedEncryptedHeapStorage
+    #
+
+    @property
+    def cache_size(self):
+        """The maximum number of cached buckets"""
+        return self._cache_size
+
+    @property
+    def cached_bucket_count(self):
+        """The number of buckets currently cached"""
+        return len(self._cache)
+
+    @property
+    def dirty_cached_bucket_count(self):
+        """
+        The number of cached buckets modified since they
+        were last written back
+        """
+        return len(self._dirty)
+
+    @property
+    def hit_count(self):
+        """The number of bucket reads served by the cache"""
+        return self._hit_count
+
+    @property
+    def miss_count(self):
+        """The number of bucket reads sent to external storage"""
+        return self._miss_count
+
+    #
+    # Define EncryptedHeapStorageInterface Methods
+    #
+
+    @property
+    def key(self):
+        return self._heap_storage.key
+
+    @property
+    def raw_storage(self):
+        return self._heap_storage.raw_storage
+
+    #
+    # Define HeapStorageInterface Methods
+    #
+
+    def clone_device(self, *args, **kwds):
+        raise NotImplementedError(                     # pragma: no cover
+            "Class is not designed for cloning")       # pragma: no cover
+
+    @classmethod
+    def compute_storage_size(cls, *args, **kwds):
+        return EncryptedHeapStorage.compute_storage_size(*args, **kwds)
+
+    @classmethod
+    def setup(cls, *args, **kwds):
+        raise NotImplementedError(                     # pragma: no cover
+            "Class is not designed to setup storage")  # pragma: no cover
+
+    @property
+    def header_data(self):
+        return self._heap_storage.header_data
+
+    @property
+    def bucket_count(self):
+        return self._heap_storage.bucket_count
+
+    @property
+    def bucket_size(self):
+        return self._heap_storage.bucket_size
+
+    @property
+    def blocks_per_bucket(self):
+        return self._heap_storage.blocks_per_bucket
+
+    @property
+    def storage_name(self):
+        return self._heap_storage.storage_name
+
+    @property
+    def virtual_heap(self):
+        return self._heap_storage.virtual_heap
+
+    @property
+    def bucket_storage(self):
+        return self._heap_storage.bucket_storage
+
+    def update_header_data(self, new_header_data):
+        self._heap_storage.update_header_data(new_header_data)
+
+    def close(self):
+        log.info("%s: Closing (%s cache hits, %s cache misses)"
+                 % (self.__class__.__name__,
+                    self._hit_count,
+                    self._miss_count))
+        self._write_back(list(self._dirty))
+        self._cache.clear()
+        self._heap_storage.close()
+
+    def read_path(self, b, level_start=0):
+        bucket_list = self._path_buckets(b, level_start)
+        data = self._read_buckets(sorted(bucket_list))
+        for bb in bucket_list:
+            self._touch(bb, data[bb])
+        self._evict()
+        return [data[bb] for bb in bucket_list]
+
+    def write_path(self, b, buckets, level_start=0):
+        bucket_list = self._path_buckets(b, level_start)
+        buckets = list(buckets)
+        assert len(buckets) == len(bucket_list)
+        for bb, bucket in zip(bucket_list, buckets):
+            self._touch(bb, bytes(bucket))
+            self._dirty.add(bb)
+        self._evict()
+
+    def read_paths(self, bs, level_start=0):
+        # buckets shared by more than one path are
+        # only read once
+        bucket_lists = [self._path_buckets(b, level_start) for b in bs]
+        data = self._read_buckets(
+            sorted(set(bb for bucket_list in bucket_lists
+                       for bb in bucket_list)))
+        for bucket_list in bucket_lists:
+            for bb in bucket_list:
+                self._touch(bb, data[bb])
+        self._evict()
+        return [[data[bb] for bb in bucket_list]
+                for bucket_list in bucket_lists]
+
+    def write_paths(self, bs, buckets_list, level_start=0):
+        # when paths share a bucket, the data given
+        # for the last of them is written
+        for b, buckets in zip(bs, buckets_list):
+            self.write_path(b, buckets, level_start=level_start)
+
+    def flush(self):
+        self._write_back(list(self._dirty))
+        self._heap_storage.flush()
+
+    def grow(self, heap_height, initialize=None):
+        # buckets keep their index, so the cache is unaffected
+        self._heap_storage.grow(heap_height, initialize=initialize)
+
+    @property
+    def bytes_sent(self):
+        return self._heap_storage.bytes_sent
+
+    @property
+    def bytes_received(self):
+        return self._heap_storage.bytes_received
@@ -0,0 +1,612 @@
+__all__ = ('TieredHeapStorage',)
+
+import struct
+import logging
+from multiprocessing.pool import ThreadPool
+
+from pyoram.crypto.aes import AES
+from pyoram.util.virtual_heap import SizedVirtualHeap
+from pyoram.storage.block_storage import BlockStorageInterface
+from pyoram.encrypted_storage.encrypted_block_storage import \
+    (EncryptedBlockStorageInterface,
+     EncryptedBlockStorage)
+from pyoram.encrypted_storage.encrypted_heap_storage import \
+    EncryptedHeapStorageInterface
+
+log = logging.getLogger("pyoram")
+
+class _TieredBucketStorage(BlockStorageInterface):
+    """
+    Presents the tiers of a TieredHeapStorage as a single
+    device indexed by bucket, so that the layers built on
+    top of the heap storage do not need to know which tier
+    stores a bucket.
+    """
+
+    def __init__(self, heap_storage):
+        self._heap_storage = heap_storage
+
+    def _tier_runs(self, indices):
+        # Splits indices into runs of consecutive entries
+        # stored on the same tier. Yields the (levels,
+        # device, offset) entry of the tier along with the
+        # indices in each run.
+        heap_storage = self._heap_storage
+        vheap = heap_storage.virtual_heap
+        level_tier = heap_storage._level_tier
+        t, run = None, []
+        for i in indices:
+            ti = level_tier[vheap.bucket_level(i)]
+            if (ti != t) and (len(run) > 0):
+                yield heap_storage._tiers[t], run
+                run = []
+            t = ti
+            run.append(i)
+        if len(run) > 0:
+            yield heap_storage._tiers[t], run
+
+    @property
+    def header_data(self):
+        return self._heap_storage._tiers[0][1].header_data
+
+    @property
+    def block_count(self):
+        return self._heap_storage.bucket_count
+
+    @property
+    def block_size(self):
+        return self._heap_storage.bucket_size
+
+    @property
+    def storage_name(self):
+        return self._heap_storage.storage_name
+
+    def close(self):
+        self._heap_storage.close()
+
+    def read_blocks(self, indices):
+        indices = list(indices)
+        data = self._heap_storage._read_buckets(set(indices))
+        return [data[i] for i in indices]
+
+    def yield_blocks(self, indices):
+        for (levels, device, offset), run in self._tier_runs(indices):
+            for block in device.yield_blocks([i - offset for i in run]):
+                yield block
+
+    def read_block(self, i):
+        return self.read_blocks((i,))[0]
+
+    def write_blocks(self, indices, blocks, callback=None):
+        blocks = iter(blocks)
+        for (levels, device, offset), run in self._tier_runs(indices):
+            local_callback = None
+            if callback is not None:
+                local_callback = \
+                    lambda i, offset=offset: callback(i + offset)
+            device.write_blocks([i - offset for i in run],
+                                [next(blocks) for i in run],
+                                callback=local_callback)
+
+    def write_block(self, i, block):
+        self.write_blocks((i,), (block,))
+
+    def flush(self):
+        self._heap_storage.flush()
+
+    @property
+    def bytes_sent(self):
+        return self._heap_storage.bytes_sent
+
+    @property
+    def bytes_received(self):
+        return self._heap_storage.bytes_received
+
+class TieredHeapStorage(EncryptedHeapStorageInterface):
+    """
+    An encrypted heap storage device that stores consecutive
+    ranges of heap levels on separate block storage devices
+    (tiers). For example, the top levels can be kept in RAM,
+    the middle levels on a local disk, and the leaf levels
+    on a remote device.
+
+    This class is initialized with a list of (levels,
+    device) pairs, where levels is a (start, stop) tuple
+    naming the heap levels stored on the device (stop is
+    not included), and device is an encrypted block storage
+    device created by the setup or migrate methods of this
+    class (or the raw storage device underneath one, in
+    which case the 'key' keyword is required). The level
+    ranges must cover every level of the heap without
+    overlap. Every tier stores a copy of the heap header,
+    which is checked for consistency when the devices are
+    opened.
+
+    Path I/O is split by level, and the I/O for each tier
+    accessed by an operation is issued concurrently (using a
+    thread pool with one thread per tier). The storage_name
+    and raw_storage properties describe the first tier; the
+    devices of every tier are available through the tiers
+    property. The bucket_storage property presents all tiers
+    as a single device indexed by bucket. Closing this
+    device closes all tiers.
+    """
+
+    _header_struct_string = "!LLLLL"
+    _header_offset = struct.calcsize(_header_struct_string)
+
+    def __init__(self, tiers, key=None):
+        self._tiers = []
+        self._tier_pool = None
+        self._bucket_storage = _TieredBucketStorage(self)
+        devices = []
+        try:
+            for levels, device in tiers:
+                if not isinstance(device, EncryptedBlockStorageInterface):
+                    if not isinstance(device, BlockStorageInterface):
+                        raise TypeError(
+                            "Tier devices must be block storage devices. "
+                            "Invalid type: %s" % (type(device)))
+                    device = EncryptedBlockStorage(device, key=key)
+                devices.append((tuple(levels), device))
+        except:
+            for levels, device in devices:
+                device.close()
+            raise
+        if len(devices) == 0:
+            raise ValueError("At least one tier is required")
+        devices.sort(key=lambda tier: tier[0])
+        try:
+            self._init_tiers(devices)
+        except:
+            for levels, device in devices:
+                device.close()
+            raise
+
+    def _init_tiers(self, devices):
+        levels, device = devices[0]
+        heap_base, heap_height, blocks_per_bucket, _, _ = \
+            struct.unpack(
+                self._header_struct_string,
+                device.header_data[:self._header_offset])
+        self._vheap = SizedVirtualHeap(
+            heap_base,
+            heap_height,
+            blocks_per_bucket=blocks_per_bucket)
+        self._level_tier = []
+        for levels, device in devices:
+            tier_header = struct.pack(self._header_struct_string,
+                                      heap_base,
+                                      heap_height,
+                                      blocks_per_bucket,
+                                      levels[0],
+                                      levels[1])
+            if device.header_data[:self._header_offset] != tier_header:
+                raise ValueError(
+                    "The header of the tier storing levels %s does not "
+                    "match the expected heap shape and level range"
+                    % (levels,))
+            if device.header_data[self._header_offset:] != \
+               devices[0][1].header_data[self._header_offset:]:
+                raise ValueError(
+                    "The user header data of the tier storing levels "
+                    "%s does not match that of the first tier"
+                    % (levels,))
+            if device.key != devices[0][1].key:
+                raise ValueError(
+                    "The tier storing levels %s uses a different key "
+                    "than the first tier" % (levels,))
+            if device.block_size != devices[0][1].block_size:
+                raise ValueError(
+                    "The tier storing levels %s has a different "
+                    "bucket size than the first tier" % (levels,))
+            if levels[0] != len(self._level_tier):
+                raise ValueError(
+                    "Tier level ranges must be contiguous and start "
+                    "at level 0. Invalid range: %s" % (levels,))
+            if device.block_count != \
+               (self._vheap.first_bucket_at_level(levels[1]) - \
+                self._vheap.first_bucket_at_level(levels[0])):
+                raise ValueError(
+                    "The tier storing levels %s does not have the "
+                    "expected number of buckets" % (levels,))
+            self._level_tier.extend([len(self._tiers)] * \
+                                    (levels[1] - levels[0]))
+            self._tiers.append(
+                (levels,
+                 device,
+                 self._vheap.first_bucket_at_level(levels[0])))
+        if len(self._level_tier) != self._vheap.levels:
+            raise ValueError(
+                "Tier level ranges do not cover all %s levels of "
+                "the heap" % (self._vheap.levels))
+
+    @staticmethod
+    def _check_tier_levels(tier_levels, heap_height):
+        start = 0
+        for levels in sorted(tuple(levels) for levels in tier_levels):
+            if (levels[0] != start) or (levels[1] <= levels[0]):
+                raise ValueError(
+                    "Tier level ranges must be non-empty, contiguous, "
+                    "and start at level 0. Invalid range: %s"
+                    % (levels,))
+            start = levels[1]
+        if start != heap_height + 1:
+            raise ValueError(
+                "Tier level ranges do not cover all %s levels of "
+                "the heap" % (heap_height + 1))
+
+    def _group_buckets(self, buckets):
+        # Returns a dictionary that maps the index of each
+        # tier to the sorted list of buckets it stores
+        groups = {}
+        for bb in buckets:
+            t = self._level_tier[self._vheap.bucket_level(bb)]
+            groups.setdefault(t, []).append(bb)
+        for t in groups:
+            groups[t].sort()
+        return groups
+
+    def _apply_to_tiers(self, func, groups):
+        # Calls func(device, local_buckets, offset) for each
+        # tier in groups, in parallel when there is more than
+        # one. Returns a dictionary mapping the tier index to
+        # the result.
+        args = {}
+        for t in groups:
+            levels, device, offset = self._tiers[t]
+            args[t] = (device, [bb - offset for bb in groups[t]], offset)
+        if len(args) <= 1:
+            return dict((t, func(*args[t])) for t in args)
+        if self._tier_pool is None:
+            self._tier_pool = ThreadPool(len(self._tiers))
+        results = dict((t, self._tier_pool.apply_async(func, args[t]))
+                       for t in args)
+        return dict((t, results[t].get()) for t in results)
+
+    def _read_buckets(self, buckets):
+        groups = self._group_buckets(buckets)
+        results = self._apply_to_tiers(
+            lambda device, local, offset: device.read_blocks(local),
+            groups)
+        data = {}
+        for t in groups:
+            data.update(zip(groups[t], results[t]))
+        return data
+
+    def _write_buckets(self, data):
+        def _write(device, local, offset):
+            device.write_blocks(local,
+                                [data[bb + offset] for bb in local])
+        self._apply_to_tiers(_write, self._group_buckets(data))
+
+    def _path_buckets(self, b, level_start):
+        assert 0 <= b < self._vheap.bucket_count()
+        assert 0 <= level_start
+        bucket_list = self._vheap.path_buckets(b, level_start)
+        assert len(bucket_list) > 0
+        return bucket_list
+
+    #
+    # Add some methods specific to TieredHeapStorage
+    #
+
+    @property
+    def tiers(self):
+        """
+        A list of (levels, device) pairs describing the
+        tiers of this storage, ordered by level.
+        """
+        return [(levels, device) for levels, device, _ in self._tiers]
+
+    @classmethod
+    def migrate(cls,
+                heap_storage,
+                tiers,
+                **kwds):
+        """
+        Copy the buckets and header data of an existing
+        encrypted heap storage device into a new tiered
+        storage that uses the same encryption key. The tiers
+        argument and any additional keywords are the same as
+        for the setup method (the heap shape, key, and
+        header data are taken from heap_storage). The
+        original device is not modified or closed.
+        """
+        for name in ('block_size', 'heap_height', 'blocks_per_bucket',
+                     'heap_base', 'key', 'key_size', 'header_data',
+                     'initialize'):
+            if name in kwds:
+                raise ValueError(
+                    "'%s' keyword is not accepted when migrating"
+                    % (name))
+        vheap = heap_storage.virtual_heap
+        source = heap_storage.bucket_storage
+        log.info("Migrating %s buckets from heap storage %s into "
+                 "%s tiers" % (vheap.bucket_count(),
+                               heap_storage.storage_name,
+                               len(tiers)))
+        return cls.setup(
+            tiers,
+            heap_storage.bucket_size // vheap.blocks_per_bucket,
+            vheap.height,
+            blocks_per_bucket=vheap.blocks_per_bucket,
+            heap_base=vheap.k,
+            key=heap_storage.key,
+            header_data=heap_storage.header_data,
+            initialize=source.read_block,
+            **kwds)
+
+    #
+    # Define EncryptedHeapStorageInterface Methods
+    #
+
+    @property
+    def key(self):
+        return self._tiers[0][1].key
+
+    @property
+    def raw_storage(self):
+        return self._tiers[0][1].raw_storage
+
+    #
+    # Define HeapStorageInterface Methods
+    #
+
+    def clone_device(self):
+        return TieredHeapStorage(
+            [(levels, device.clone_device())
+             for levels, device, _ in self._tiers])
+
+    @classmethod
+    def compute_storage_size(cls,
+                             tiers,
+                             block_size,
+                             heap_height,
+                             blocks_per_bucket=1,
+                             heap_base=2,
+                             ignore_header=False,
+                             **kwds):
+        """
+        Returns a list with the storage size of each tier. The
+        tiers argument has the same form as for the setup
+        method.
+        """
+        assert (block_size > 0) and (block_size == int(block_size))
+        assert heap_height >= 0
+        assert blocks_per_bucket >= 1
+        assert heap_base >= 2
+        assert 'block_count' not in kwds
+        cls._check_tier_levels([tier[0] for tier in tiers], heap_height)
+        vheap = SizedVirtualHeap(
+            heap_base,
+            heap_height,
+            blocks_per_bucket=blocks_per_bucket)
+        sizes = []
+        for levels, storage_name, tier_kwds in tiers:
+            tier_kwds = dict(kwds, **tier_kwds)
+            size = EncryptedBlockStorage.compute_storage_size(
+                vheap.blocks_per_bucket * block_size,
+                vheap.first_bucket_at_level(levels[1]) - \
+                vheap.first_bucket_at_level(levels[0]),
+                ignore_header=ignore_header,
+                **tier_kwds)
+            if not ignore_header:
+                size += cls._header_offset
+            sizes.append(size)
+        return sizes
+
+    @classmethod
+    def setup(cls,
+              tiers,
+              block_size,
+              heap_height,
+              blocks_per_bucket=1,
+              heap_base=2,
+              key_size=None,
+              key=None,
+              initialize=None,
+              **kwds):
+        """
+        Set up the storage for each tier and return a
+        TieredHeapStorage over them. The tiers argument is a
+        list of (levels, storage_name, tier_kwds) tuples, where
+        tier_kwds is a dictionary of keywords for setting up
+        that tier's storage device (e.g., 'storage_type').
+        Additional keywords are used for every tier, unless
+        overridden by tier_kwds. The initialize function (if
+        given) is called with the heap index of each bucket.
+        """
+        if 'block_count' in kwds:
+            raise ValueError("'block_count' keyword is not accepted")
+        if heap_height < 0:
+            raise ValueError(
+                "heap height must be 0 or greater. Invalid value: %s"
+                % (heap_height))
+        if blocks_per_bucket < 1:
+            raise ValueError(
+                "blocks_per_bucket must be 1 or greater. "
+                "Invalid value: %s" % (blocks_per_bucket))
+        if heap_base < 2:
+            raise ValueError(
+                "heap base must be 2 or greater. Invalid value: %s"
+                % (heap_base))
+        cls._check_tier_levels([tier[0] for tier in tiers], heap_height)
+        if (key is not None) and (key_size is not None):
+            raise ValueError(
+                "Only one of 'key' or 'keysize' keywords can "
+                "be specified at a time")
+        if key is None:
+            # all tiers must share the same key
+            if key_size is None:
+                key_size = 32
+            if key_size not in AES.key_sizes:
+                raise ValueError(
+                    "Invalid key size: %s" % (key_size))
+            key = AES.KeyGen(key_size)
+
+        vheap = SizedVirtualHeap(
+            heap_base,
+            heap_height,
+            blocks_per_bucket=blocks_per_bucket)
+
+        user_header_data = kwds.pop('header_data', bytes())
+        if type(user_header_data) is not bytes:
+            raise TypeError(
+                "'header_data' must be of type bytes. "
+                "Invalid type: %s" % (type(user_header_data)))
+
+        devices = []
+        try:
+            for levels, storage_name, tier_kwds in tiers:
+                levels = tuple(levels)
+                offset = vheap.first_bucket_at_level(levels[0])
+                tier_kwds = dict(kwds, **tier_kwds)
+                tier_kwds['header_data'] = \
+                    struct.pack(cls._header_struct_string,
+                                heap_base,
+                                heap_height,
+                                blocks_per_bucket,
+                                levels[0],
+                                levels[1]) + \
+                    user_header_data
+                if initialize is not None:
+                    tier_kwds['initialize'] = \
+                        (lambda offset: \
+                         lambda i: initialize(i + offset))(offset)
+                devices.append(
+                    (levels,
+                     EncryptedBlockStorage.setup(
+                         storage_name,
+                         vheap.blocks_per_bucket * block_size,
+                         vheap.first_bucket_at_level(levels[1]) - offset,
+                         key=key,
+                         **tier_kwds)))
+        except:
+            for levels, device in devices:
+                device.close()
+            raise
+
+        return TieredHeapStorage(devices)
+
+    @property
+    def header_data(self):
+        return self._tiers[0][1].header_data[self._header_offset:]
+
+    @property
+    def bucket_count(self):
+        return self._vheap.bucket_count()
+
+    @property
+    def bucket_size(self):
+        return self._tiers[0][1].block_size
+
+    @property
+    def blocks_per_bucket(self):
+        return self._vheap.blocks_per_bucket
+
+    @property
+    def storage_name(self):
+        return self._tiers[0][1].storage_name
+
+    @property
+    def virtual_heap(self):
+        return self._vheap
+
+    @property
+    def bucket_storage(self):
+        return self._bucket_storage
+
+    def update_header_data(self, new_header_data):
+        for levels, device, _ in self._tiers:
+            device.update_header_data(
+                device.header_data[:self._header_offset] + \
+                new_header_data)
+
+    def close(self):
+        if self._tier_pool is not None:
+            self._tier_pool.close()
+            self._tier_pool.join()
+            self._tier_pool = None
+        for levels, device, _ in self._tiers:
+            device.close()
+
+    def read_path(self, b, level_start=0):
+        bucket_list = self._path_buckets(b, level_start)
+        data = self._read_buckets(bucket_list)
+        return [data[bb] for bb in bucket_list]
+
+    def write_path(self, b, buckets, level_start=0):
+        bucket_list = self._path_buckets(b, level_start)
+        buckets = list(buckets)
+        assert len(buckets) == len(bucket_list)
+        self._write_buckets(dict(zip(bucket_list, buckets)))
+
+    def read_paths(self, bs, level_start=0):
+        # buckets shared by more than one path are
+        # only read once
+        bucket_lists = [self._path_buckets(b, level_start) for b in bs]
+        data = self._read_buckets(set(bb for bucket_list in bucket_lists
+                                      for bb in bucket_list))
+        return [[data[bb] for bb in bucket_list]
+                for bucket_list in bucket_lists]
+
+    def write_paths(self, bs, buckets_list, level_start=0):
+        # when paths share a bucket, the data given
+        # for the last of them is written
+        data = {}
+        for b, buckets in zip(bs, buckets_list):
+            bucket_list = self._path_buckets(b, level_start)
+            buckets = list(buckets)
+            assert len(buckets) == len(bucket_list)
+            data.update(zip(bucket_list, buckets))
+        self._write_buckets(data)
+
+    def flush(self):
+        for levels, device, _ in self._tiers:
+            device.flush()
+
+    def grow(self, heap_height, initialize=None):
+        """
+        Add levels to the bottom of the heap (see
+        HeapStorage.grow). The new levels are stored on the
+        last tier, whose level range is extended.
+        """
+        if (heap_height < self._vheap.height) or \
+           (heap_height != int(heap_height)):
+            raise ValueError(
+                "The new heap height must be an integer that is "
+                "at least the current heap height (%s): %s"
+                % (self._vheap.height, heap_height))
+        vheap = SizedVirtualHeap(
+            self._vheap.k,
+            heap_height,
+            blocks_per_bucket=self._vheap.blocks_per_bucket)
+        levels, device, offset = self._tiers[-1]
+        local_initialize = None
+        if initialize is not None:
+            local_initialize = lambda i: initialize(i + offset)
+        device.grow(vheap.bucket_count() - offset,
+                    initialize=local_initialize)
+        self._tiers[-1] = ((levels[0], vheap.levels), device, offset)
+        self._level_tier.extend([len(self._tiers) - 1] * \
+                                (vheap.levels - self._vheap.levels))
+        self._vheap = vheap
+        user_header_data = self.header_data
+        for levels, device, _ in self._tiers:
+            device.update_header_data(
+                struct.pack(self._header_struct_string,
+                            vheap.k,
+                            vheap.height,
+                            vheap.blocks_per_bucket,
+                            levels[0],
+                            levels[1]) + \
+                user_header_data)
+
+    @property
+    def bytes_sent(self):
+        return sum(device.bytes_sent for _, device, _ in self._tiers)
+
+    @property
+    def bytes_received(self):
+        return sum(device.bytes_received for _, device, _ in self._tiers)
@@ -1,11 +1,26 @@
 __all__ = ('TopCachedEncryptedHeapStorage',)
 
+import os
+import hmac
+import struct
+import hashlib
 import logging
 import tempfile
 import mmap
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
 import pyoram
+from pyoram.crypto.aes import AES
+from pyoram.util.misc import MemorySize
 from pyoram.util.virtual_heap import SizedVirtualHeap
+from pyoram.storage.block_storage_s3 import BlockStorageS3
+from pyoram.storage.block_storage_sftp import BlockStorageSFTP
+from pyoram.storage.block_storage_simulated_link import \
+    BlockStorageSimulatedLink
+from pyoram.storage.block_storage_mmap import \
+    (_map_file,
+     _advise_mmap)
 from pyoram.encrypted_storage.encrypted_heap_storage import \
     (EncryptedHeapStorageInterface,
      EncryptedHeapStorage)
@@ -16,6 +31,15 @@ from six.moves import xrange
 
 log = logging.getLogger("pyoram")
 
+# os.replace is not available on Python 2
+_replace = getattr(os, 'replace', os.rename)
+
+# storage devices accessed over a network, which benefit
+# from a separate device (connection) per subheap
+_remote_storage_types = (BlockStorageS3,
+                         BlockStorageSFTP,
+                         BlockStorageSimulatedLink)
+
 class TopCachedEncryptedHeapStorage(EncryptedHeapStorageInterface):
     """
     An encrypted block storage device for accessing memory
@@ -54,23 +78,94 @@ class TopCachedEncryptedHeapStorage(EncryptedHeapStorageInterface):
     Values for 'cached_levels' and 'concurrency_level' will
     be automatically reduced when they are larger than what
     is allowed by the heap size.
+
+    The cached buckets are stored in a memory map over a
+    temporary file. Setting the 'cache_populate' keyword to
+    True pre-faults this memory map after the download so
+    that the first accesses to the cache do not each trigger
+    a page fault. Setting the 'cache_huge_pages' keyword to
+    True instead stores the cached buckets in anonymous
+    memory that requests transparent huge pages (where
+    supported), which reduces TLB misses for large caches.
+
+    Only cached buckets modified by write_path are uploaded
+    when the device is closed (or when
+    upload_cached_buckets() is called). This does not affect
+    obliviousness for tree ORAMs, as every path access
+    writes the cached root, so the set of modified buckets
+    reveals only which top-level buckets were on an
+    accessed path.
+
+    The 'cache_file' keyword names a local file used to keep
+    the cached buckets between sessions. When the device is
+    closed, the cached buckets are written to this file
+    (encrypted and authenticated with the storage key) along
+    with a version number and an epoch stamp. The stamp is a
+    digest of the storage header and the ciphertext of the
+    root bucket, which is re-encrypted with a fresh IV
+    whenever a session modifies any cached bucket. When the
+    device is opened again, the cached buckets are loaded
+    from this file instead of being downloaded, unless the
+    version, stamp, cache size, or checksum does not match,
+    in which case the cache is downloaded in full. Modified
+    cached buckets are still uploaded at close, so the
+    storage can always be opened without the cache file.
+
+    Instead of a fixed number of cached levels, the
+    'cache_memory_budget' keyword (a MemorySize or a number
+    of bytes) can be used to cache the largest number of
+    levels that fits in the budget. Unless it is given, the
+    'concurrency_level' is then chosen based on the storage
+    type (see choose_cache_levels).
+
+    The read_paths and write_paths methods access many paths
+    at once. They group the external buckets on those paths
+    by subheap device and access the devices concurrently
+    (using a thread pool of up to _max_path_threads
+    threads), so the cloned devices can work in parallel.
     """
 
+    _cache_file_magic = b"PYORAMTC"
+    _cache_file_version = 1
+    _cache_file_struct_string = "!8sLLL32s"
+    _cache_file_header_size = struct.calcsize(_cache_file_struct_string)
+    _max_path_threads = 32
+
     def __new__(cls, *args, **kwds):
+        chosen = None
+        if kwds.get("cache_memory_budget", None) is not None:
+            assert len(args) == 1
+            chosen = cls.choose_cache_levels(args[0],
+                                             kwds["cache_memory_budget"])
+            if chosen[0] == 0:
+                kwds = dict(kwds)
+                kwds["cached_levels"] = 0
         if kwds.get("cached_levels", 1) == 0:
             assert len(args) == 1
             storage = args[0]
             storage.cached_bucket_data = bytes()
             return storage
         else:
-            return super(TopCachedEncryptedHeapStorage, cls).\
+            self = super(TopCachedEncryptedHeapStorage, cls).\
                 __new__(cls)
+            # used by __init__ to avoid choosing twice
+            self._chosen_cache_levels = chosen
+            return self
 
     def __init__(self,
                  heap_storage,
                  cached_levels=1,
-                 concurrency_level=None):
+                 concurrency_level=None,
+                 cache_populate=False,
+                 cache_huge_pages=False,
+                 cache_file=None,
+                 cache_memory_budget=None):
         assert isinstance(heap_storage, EncryptedHeapStorage)
+        if cache_memory_budget is not None:
+            cached_levels, chosen_concurrency_level = \
+                self._chosen_cache_levels
+            if concurrency_level is None:
+                concurrency_level = chosen_concurrency_level
         assert cached_levels != 0
         vheap = heap_storage.virtual_heap
         if cached_levels < 0:
@@ -92,23 +187,63 @@ class TopCachedEncryptedHeapStorage(EncryptedHeapStorageInterface):
             {vheap.first_bucket_at_level(0): self._root_device.clone_device()}
 
         self._cached_bucket_count = total_buckets
-        self._cached_buckets_tempfile = tempfile.TemporaryFile()
-        self._cached_buckets_tempfile.seek(0)
-        with tqdm.tqdm(desc=("Downloading %s Cached Heap Buckets"
-                             % (self._cached_bucket_count)),
-                       total=self._cached_bucket_count*self._root_device.bucket_size,
-                       unit="B",
-                       unit_scale=True,
-                       disable=not pyoram.config.SHOW_PROGRESS_BAR) as progress_bar:
-            for b, bucket in enumerate(
-                    self._root_device.bucket_storage.yield_blocks(
-                        xrange(vheap.first_bucket_at_level(cached_levels)))):
-                self._cached_buckets_tempfile.write(bucket)
-                progress_bar.update(self._root_device.bucket_size)
-        self._cached_buckets_tempfile.flush()
-        self._cached_buckets_mmap = mmap.mmap(
-            self._cached_buckets_tempfile.fileno(), 0)
-
+        # flags for the cached buckets modified since
+        # they were last uploaded
+        self._cached_buckets_dirty = bytearray(total_buckets)
+        self._cached_buckets_tempfile = None
+        self._cache_file = cache_file
+        self._cache_file_stale = True
+        if cache_huge_pages:
+            # transparent huge pages only back anonymous (and
+            # tmpfs) memory, so the cache is not file-backed
+            out = mmap.mmap(-1, total_buckets*self._root_device.bucket_size)
+            _advise_mmap(out, huge_pages=True)
+        else:
+            self._cached_buckets_tempfile = tempfile.TemporaryFile()
+            self._cached_buckets_tempfile.seek(0)
+            out = self._cached_buckets_tempfile
+        if (cache_file is not None) and \
+           self._load_cache_file(cache_file, out):
+            log.info("%s: Loaded %s cached heap buckets from %s"
+                     % (self.__class__.__name__,
+                        self._cached_bucket_count,
+                        cache_file))
+            self._cache_file_stale = False
+        else:
+            out.seek(0)
+            with tqdm.tqdm(desc=("Downloading %s Cached Heap Buckets"
+                                 % (self._cached_bucket_count)),
+                           total=self._cached_bucket_count*self._root_device.bucket_size,
+                           unit="B",
+                           unit_scale=True,
+                           disable=not pyoram.config.SHOW_PROGRESS_BAR) as progress_bar:
+                for b, bucket in enumerate(
+                        self._root_device.bucket_storage.yield_blocks(
+                            xrange(vheap.first_bucket_at_level(cached_levels)))):
+                    out.write(bucket)
+                    progress_bar.update(self._root_device.bucket_size)
+        if self._cached_buckets_tempfile is None:
+            self._cached_buckets_mmap = out
+        else:
+            self._cached_buckets_tempfile.flush()
+            self._cached_buckets_mmap = _map_file(
+                self._cached_buckets_tempfile.fileno(),
+                populate=cache_populate)
+            _advise_mmap(self._cached_buckets_mmap,
+                         populate=cache_populate)
+
+        self._concurrency_level = concurrency_level
+        self._retired_bytes_sent = 0
+        self._retired_bytes_received = 0
+        self._path_pool = None
+        self._clone_subheap_devices()
+
+    def _clone_subheap_devices(self):
+        # Clones a device for each bucket at the concurrency
+        # level and maps each bucket at the external level to
+        # the device for the subheap containing it
+        vheap = self.virtual_heap
+        concurrency_level = self._concurrency_level
         log.info("%s: Cloning %s sub-heap devices"
                  % (self.__class__.__name__, vheap.bucket_count_at_level(concurrency_level)))
         # Avoid cloning devices when the cache line is at the root
@@ -145,10 +280,182 @@ class TopCachedEncryptedHeapStorage(EncryptedHeapStorageInterface):
     # Additional Methods
     #
 
+    @staticmethod
+    def choose_cache_levels(heap_storage,
+                            cache_memory_budget,
+                            threads=None):
+        """
+        Choose the number of cached levels and the
+        concurrency level for a heap storage device given a
+        memory budget for the cache (a MemorySize or a number
+        of bytes). The deepest cache line whose buckets fit
+        in the budget is chosen (0 means nothing fits). The
+        concurrency level is the deepest level at or above
+        the cache line with at most 'threads' buckets. For
+        storage accessed over a network, 'threads' defaults
+        to min(32, cpu_count + 4). For local storage it
+        defaults to 1, so that no devices are cloned.
+
+        Returns a tuple (cached_levels, concurrency_level).
+        """
+        if not isinstance(cache_memory_budget, MemorySize):
+            if cache_memory_budget < 0:
+                raise ValueError(
+                    "Cache memory budget must be non-negative: %s"
+                    % (cache_memory_budget))
+            cache_memory_budget = MemorySize(cache_memory_budget)
+        vheap = heap_storage.virtual_heap
+        remote = isinstance(heap_storage.raw_storage,
+                            _remote_storage_types)
+        if threads is None:
+            if remote:
+                threads = min(32, multiprocessing.cpu_count() + 4)
+            else:
+                threads = 1
+        cached_levels = 0
+        cached_buckets = 0
+        while cached_levels < vheap.levels:
+            level_buckets = vheap.bucket_count_at_level(cached_levels)
+            if (cached_buckets + level_buckets) * \
+               heap_storage.bucket_size > cache_memory_budget.B:
+                break
+            cached_buckets += level_buckets
+            cached_levels += 1
+        concurrency_level = 0
+        while (concurrency_level + 1 < min(cached_levels + 1,
+                                           vheap.levels)) and \
+              (vheap.bucket_count_at_level(concurrency_level + 1) <= \
+               threads):
+            concurrency_level += 1
+        log.info("%s: Cache memory budget %s: caching %s of %s heap "
+                 "levels (%s buckets, %s) with concurrency level %s "
+                 "(%s %s devices). Expected external buckets per "
+                 "path access: %s"
+                 % (TopCachedEncryptedHeapStorage.__name__,
+                    cache_memory_budget,
+                    cached_levels,
+                    vheap.levels,
+                    cached_buckets,
+                    MemorySize(cached_buckets * heap_storage.bucket_size),
+                    concurrency_level,
+                    vheap.bucket_count_at_level(concurrency_level),
+                    "remote" if remote else "local",
+                    vheap.levels - cached_levels))
+        return cached_levels, concurrency_level
+
     @property
     def cached_bucket_data(self):
         return self._cached_buckets_mmap
 
+    @property
+    def dirty_cached_bucket_count(self):
+        """The number of cached buckets that have been
+        modified since they were last uploaded."""
+        return self._cached_buckets_dirty.count(b"\x01")
+
+    def _cache_stamp(self):
+        # A digest of the storage header and the root
+        # bucket ciphertext, which changes whenever a
+        # session modifies the cached buckets
+        raw_storage = self._root_device.raw_storage
+        stamp = hashlib.sha256()
+        stamp.update(raw_storage.header_data)
+        stamp.update(raw_storage.read_block(0))
+        return stamp.digest()
+
+    def _cache_file_header(self, stamp):
+        return struct.pack(self._cache_file_struct_string,
+                           self._cache_file_magic,
+                           self._cache_file_version,
+                           self._cached_bucket_count,
+                           self.bucket_size,
+                           stamp)
+
+    def _load_cache_file(self, cache_file, out):
+        # Copies the cached buckets stored in the cache file
+        # to out. Returns False (possibly after writing some
+        # buckets to out) when the file is missing or does
+        # not match the storage.
+        try:
+            f = open(cache_file, 'rb')
+        except (IOError, OSError):
+            return False
+        with f:
+            header = f.read(self._cache_file_header_size)
+            if header != self._cache_file_header(self._cache_stamp()):
+                log.info("%s: Cache file %s does not match the storage"
+                         % (self.__class__.__name__, cache_file))
+                return False
+            mac = hmac.HMAC(key=self.key,
+                            msg=header,
+                            digestmod=hashlib.sha256)
+            ciphertext_size = self.bucket_size + AES.block_size
+            for b in xrange(self._cached_bucket_count):
+                ciphertext = f.read(ciphertext_size)
+                if len(ciphertext) != ciphertext_size:
+                    return False
+                mac.update(ciphertext)
+                out.write(AES.CTRDec(self.key, ciphertext))
+            if not hmac.compare_digest(f.read(), mac.digest()):
+                log.warning("%s: Checksum of cache file %s does not match"
+                            % (self.__class__.__name__, cache_file))
+                return False
+        return True
+
+    def _save_cache_file(self, cache_file):
+        tmp_name = cache_file + ".tmp"
+        with open(tmp_name, 'wb') as f:
+            header = self._cache_file_header(self._cache_stamp())
+            mac = hmac.HMAC(key=self.key,
+                            msg=header,
+                            digestmod=hashlib.sha256)
+            f.write(header)
+            for b in xrange(self._cached_bucket_count):
+                ciphertext = AES.CTREnc(
+                    self.key,
+                    self._cached_buckets_mmap[(b*self.bucket_size):
+                                              ((b+1)*self.bucket_size)])
+                mac.update(ciphertext)
+                f.write(ciphertext)
+            f.write(mac.digest())
+        _replace(tmp_name, cache_file)
+
+    def _dirty_cached_bucket_runs(self):
+        # Returns a list of [first_bucket, count] pairs
+        # for the runs of adjacent dirty cached buckets
+        runs = []
+        dirty = self._cached_buckets_dirty
+        b = dirty.find(b"\x01")
+        while b != -1:
+            stop = dirty.find(b"\x00", b)
+            if stop == -1:
+                stop = len(dirty)
+            runs.append([b, stop - b])
+            b = dirty.find(b"\x01", stop)
+        return runs
+
+    def upload_cached_buckets(self, callback=None):
+        """
+        Upload the cached buckets that have been modified
+        since they were last uploaded, in runs of adjacent
+        buckets. The optional callback is called with the
+        index of each bucket that is written.
+        """
+        if self.dirty_cached_bucket_count > 0:
+            # always re-encrypt the root bucket so that the
+            # stamp of any cache file is invalidated
+            self._cached_buckets_dirty[0] = 1
+            self._cache_file_stale = True
+        for first, count in self._dirty_cached_bucket_runs():
+            self.bucket_storage.write_blocks(
+                xrange(first, first + count),
+                (self._cached_buckets_mmap[(b*self.bucket_size):
+                                           ((b+1)*self.bucket_size)]
+                 for b in xrange(first, first + count)),
+                callback=callback)
+            self._cached_buckets_dirty[first:first+count] = \
+                bytearray(count)
+
     #
     # Define EncryptedHeapStorageInterface Methods
     #
@@ -210,21 +517,24 @@ class TopCachedEncryptedHeapStorage(EncryptedHeapStorageInterface):
         self._root_device.update_header_data(new_header_data)
 
     def close(self):
-        log.info("%s: Uploading %s cached bucket data before closing"
-                 % (self.__class__.__name__, self._cached_bucket_count))
+        dirty_count = self.dirty_cached_bucket_count
+        log.info("%s: Uploading %s modified cached buckets (of %s) "
+                 "before closing"
+                 % (self.__class__.__name__,
+                    dirty_count,
+                    self._cached_bucket_count))
         with tqdm.tqdm(desc=("Uploading %s Cached Heap Buckets"
-                             % (self._cached_bucket_count)),
-                       total=self._cached_bucket_count*self.bucket_size,
+                             % (dirty_count)),
+                       total=dirty_count*self.bucket_size,
                        unit="B",
                        unit_scale=True,
                        disable=not pyoram.config.SHOW_PROGRESS_BAR) as progress_bar:
-            self.bucket_storage.\
-                write_blocks(
-                    xrange(self._cached_bucket_count),
-                    (self._cached_buckets_mmap[(b*self.bucket_size):
-                                               ((b+1)*self.bucket_size)]
-                     for b in xrange(self._cached_bucket_count)),
-                    callback=lambda i: progress_bar.update(self._root_device.bucket_size))
+            self.upload_cached_buckets(
+                callback=lambda i: progress_bar.update(self._root_device.bucket_size))
+            if (self._cache_file is not None) and \
+               self._cache_file_stale:
+                self._root_device.flush()
+                self._save_cache_file(self._cache_file)
             for b in self._concurrent_devices:
                 self._concurrent_devices[b].close()
             self._root_device.close()
@@ -233,12 +543,17 @@ class TopCachedEncryptedHeapStorage(EncryptedHeapStorageInterface):
             # the the mininterval time
             progress_bar.mininterval = 0
 
+        if self._path_pool is not None:
+            self._path_pool.close()
+            self._path_pool.join()
+            self._path_pool = None
         self._cached_buckets_mmap.close()
-        self._cached_buckets_tempfile.close()
+        if self._cached_buckets_tempfile is not None:
+            self._cached_buckets_tempfile.close()
 
     def read_path(self, b, level_start=0):
         assert 0 <= b < self.virtual_heap.bucket_count()
-        bucket_list = self.virtual_heap.Node(b).bucket_path_from_root()
+        bucket_list = self.virtual_heap.path_buckets(b)
         if len(bucket_list) <= self._external_level:
             return [self._cached_buckets_mmap[(bb*self.bucket_size):
                                               ((bb+1)*self.bucket_size)]
@@ -263,11 +578,12 @@ class TopCachedEncryptedHeapStorage(EncryptedHeapStorageInterface):
 
     def write_path(self, b, buckets, level_start=0):
         assert 0 <= b < self.virtual_heap.bucket_count()
-        bucket_list = self.virtual_heap.Node(b).bucket_path_from_root()
+        bucket_list = self.virtual_heap.path_buckets(b)
         if len(bucket_list) <= self._external_level:
             for bb, bucket in zip(bucket_list[level_start:], buckets):
                 self._cached_buckets_mmap[(bb*self.bucket_size):
                                           ((bb+1)*self.bucket_size)] = bucket
+                self._cached_buckets_dirty[bb] = 1
         elif level_start >= self._external_level:
             self._subheap_storage[bucket_list[self._external_level]].\
                 bucket_storage.write_blocks(bucket_list[level_start:], buckets)
@@ -280,16 +596,135 @@ class TopCachedEncryptedHeapStorage(EncryptedHeapStorageInterface):
             for ndx, bb in enumerate(local_buckets[level_start:]):
                 self._cached_buckets_mmap[(bb*self.bucket_size):
                                           ((bb+1)*self.bucket_size)] = buckets[ndx]
+                self._cached_buckets_dirty[bb] = 1
             if len(external_buckets) > 0:
                 self._subheap_storage[external_buckets[0]].\
                     bucket_storage.write_blocks(external_buckets,
                                                 buckets[(ndx+1):])
+
+    def _group_paths(self, bs, level_start):
+        # Returns the list of buckets on each path and a
+        # dictionary that maps the id of each subheap device
+        # to the device and the set of external buckets on
+        # the paths that it accesses
+        vheap = self.virtual_heap
+        bucket_lists = []
+        groups = {}
+        for b in bs:
+            assert 0 <= b < vheap.bucket_count()
+            bucket_list = vheap.path_buckets(b)
+            assert 0 <= level_start < len(bucket_list)
+            if len(bucket_list) > self._external_level:
+                device = self._subheap_storage[
+                    bucket_list[self._external_level]]
+                if id(device) not in groups:
+                    groups[id(device)] = (device, set())
+                groups[id(device)][1].update(
+                    bucket_list[max(level_start, self._external_level):])
+            bucket_lists.append(bucket_list[level_start:])
+        return bucket_lists, groups
+
+    def _apply_to_devices(self, func, groups):
+        # Calls func(device, buckets) for each group, in
+        # parallel when there is more than one device.
+        # Returns the results in the order of the groups.
+        if len(groups) <= 1:
+            return [func(*groups[key]) for key in groups]
+        if self._path_pool is None:
+            devices = set(id(device) for device
+                          in self._subheap_storage.values())
+            self._path_pool = ThreadPool(
+                min(len(devices), self._max_path_threads))
+        results = [self._path_pool.apply_async(func, groups[key])
+                   for key in groups]
+        return [result.get() for result in results]
+
+    def read_paths(self, bs, level_start=0):
+        """
+        Read the buckets on the paths from the root to each of
+        the buckets in bs (starting at level_start). Returns a
+        list with the result of read_path for each bucket.
+        """
+        bucket_lists, groups = self._group_paths(bs, level_start)
+        for key in groups:
+            device, buckets = groups[key]
+            groups[key] = (device, sorted(buckets))
+        data = {}
+        for (device, buckets), blocks in zip(
+                (groups[key] for key in groups),
+                self._apply_to_devices(
+                    lambda device, buckets: \
+                        device.bucket_storage.read_blocks(buckets),
+                    groups)):
+            data.update(zip(buckets, blocks))
+        return [[(self._cached_buckets_mmap[(bb*self.bucket_size):
+                                            ((bb+1)*self.bucket_size)]
+                  if bb < self._cached_bucket_count else data[bb])
+                 for bb in bucket_list]
+                for bucket_list in bucket_lists]
+
+    def write_paths(self, bs, buckets_list, level_start=0):
+        """
+        Write the buckets on the paths from the root to each
+        of the buckets in bs (starting at level_start). When
+        paths share a bucket, the data given for the last of
+        them is written.
+        """
+        bs = list(bs)
+        bucket_lists, groups = self._group_paths(bs, level_start)
+        data = {}
+        for bucket_list, buckets in zip(bucket_lists, buckets_list):
+            buckets = list(buckets)
+            assert len(buckets) == len(bucket_list)
+            for bb, bucket in zip(bucket_list, buckets):
+                if bb < self._cached_bucket_count:
+                    self._cached_buckets_mmap[(bb*self.bucket_size):
+                                              ((bb+1)*self.bucket_size)] = \
+                        bucket
+                    self._cached_buckets_dirty[bb] = 1
+                else:
+                    data[bb] = bucket
+        def _write(device, buckets):
+            buckets = sorted(buckets)
+            device.bucket_storage.write_blocks(
+                buckets, [data[bb] for bb in buckets])
+        self._apply_to_devices(_write, groups)
+
+    def flush(self):
+        # the cached buckets are only uploaded at close
+        # (or by upload_cached_buckets)
+        for device in self._concurrent_devices.values():
+            device.flush()
+        self._root_device.flush()
+
+    def grow(self, heap_height, initialize=None):
+        """
+        Add levels to the bottom of the heap (see
+        HeapStorage.grow). The cached levels do not change.
+        The subheap devices are cloned again so that they
+        can access the new buckets.
+        """
+        self.flush()
+        # keep the transfer totals of the devices closed here
+        self._retired_bytes_sent = self.bytes_sent
+        self._retired_bytes_received = self.bytes_received
+        for device in self._concurrent_devices.values():
+            device.close()
+        self._concurrent_devices = {}
+        self._subheap_storage = {}
+        self._root_device.grow(heap_height, initialize=initialize)
+        self._concurrent_devices[self.virtual_heap.first_bucket_at_level(0)] = \
+            self._root_device.clone_device()
+        self._clone_subheap_devices()
+
     @property
     def bytes_sent(self):
-        return sum(device.bytes_sent for device
-                   in self._concurrent_devices.values())
+        return self._retired_bytes_sent + \
+            sum(device.bytes_sent for device
+                in self._concurrent_devices.values())
 
     @property
     def bytes_received(self):
-        return sum(device.bytes_received for device
-                   in self._concurrent_devices.values())
+        return self._retired_bytes_received + \
+            sum(device.bytes_received for device
+                in self._concurrent_devices.values())
@@ -0,0 +1,2 @@
+import pyoram.oblivious_data_structures.avl_map
+import pyoram.oblivious_data_structures.priority_queue
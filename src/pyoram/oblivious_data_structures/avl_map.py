@@ -0,0 +1,482 @@
+__all__ = ('ObliviousAVLMap',
+           'calculate_max_avl_height')
+
+import struct
+import logging
+
+from pyoram.oblivious_storage.tree.pointer_tree_oram import \
+    PointerTreeORAM
+
+from six.moves import xrange
+
+log = logging.getLogger("pyoram")
+
+def calculate_max_avl_height(node_count):
+    """
+    Returns the largest height of an AVL tree with at most
+    node_count nodes.
+    """
+    assert node_count >= 0
+    # the fewest nodes in an AVL tree of height h is
+    # N(h) = N(h-1) + N(h-2) + 1, with N(0) = 0 and N(1) = 1
+    h, n_h, n_next = 0, 0, 1
+    while n_next <= node_count:
+        h += 1
+        n_h, n_next = n_next, n_h + n_next + 1
+    return h
+
+class _AVLNode(object):
+    __slots__ = ("key", "value", "child", "child_leaf", "child_height")
+
+    def __init__(self, key, value, child, child_leaf, child_height):
+        self.key = key
+        self.value = value
+        # indexed by direction (0 = left, 1 = right)
+        self.child = child
+        self.child_leaf = child_leaf
+        self.child_height = child_height
+
+    @property
+    def height(self):
+        return 1 + max(self.child_height)
+
+class ObliviousAVLMap(object):
+    """
+    A sorted map from fixed-size byte string keys to
+    fixed-size byte string values, stored as an AVL tree in
+    a PointerTreeORAM. Keys are ordered by comparing their
+    bytes (so big-endian packed integers sort numerically).
+    Each node stores the ids, leaf buckets, and heights of
+    its children, and the id, leaf bucket, and height of
+    the root are kept locally (and saved in the header when
+    the map is closed).
+
+    During an operation, the nodes that are read are kept
+    in a local cache (they are removed from the ORAM when
+    read). When the operation completes, each cached node
+    is given a new random leaf, the child pointers to it
+    are updated, and it is written back. Every operation is
+    padded with dummy accesses to accesses_per_operation
+    path accesses (which is determined by the largest
+    height of an AVL tree with capacity nodes), so the
+    storage server learns nothing about the operation type,
+    the key, or the shape of the tree.
+    """
+
+    _header_struct_string = "!LLLLLB"
+    _header_offset = struct.calcsize(_header_struct_string)
+    _node_pointer_struct_string = "LLB"
+
+    def __init__(self, storage, stash, **kwds):
+        self._oram = PointerTreeORAM(storage, stash, **kwds)
+        (self._key_size,
+         self._value_size,
+         self._size,
+         self._root,
+         self._root_leaf,
+         self._root_height) = struct.unpack(
+             self._header_struct_string,
+             self._oram.header_data[:self._header_offset])
+        self._node_struct = struct.Struct(
+            self._node_struct_string(self._key_size, self._value_size))
+        assert self._node_struct.size == self._oram.block_size
+        max_height = calculate_max_avl_height(self._oram.block_count)
+        # Searches read at most one node per level. Deleting a
+        # node (or the smallest node) can also require reading
+        # up to two nodes off the search path per level to
+        # rebalance the tree. All of the nodes that are read
+        # are written back, along with at most one new node.
+        self._max_reads = 3 * max_height
+        self._max_writes = 3 * max_height + 1
+        self._cache = None
+        self._read_count = 0
+
+    @classmethod
+    def _node_struct_string(cls, key_size, value_size):
+        return "!%ds%ds" % (key_size, value_size) + \
+            (2 * cls._node_pointer_struct_string)
+
+    def _pack_node(self, node):
+        return self._node_struct.pack(
+            node.key,
+            node.value,
+            node.child[0], node.child_leaf[0], node.child_height[0],
+            node.child[1], node.child_leaf[1], node.child_height[1])
+
+    def _unpack_node(self, block):
+        (key, value,
+         left, left_leaf, left_height,
+         right, right_leaf, right_height) = \
+            self._node_struct.unpack(bytes(block))
+        return _AVLNode(key,
+                        value,
+                        [left, right],
+                        [left_leaf, right_leaf],
+                        [left_height, right_height])
+
+    def _check_item(self, key, value=None):
+        if len(key) != self._key_size:
+            raise ValueError(
+                "Key must have size %s. Invalid size: %s"
+                % (self._key_size, len(key)))
+        if (value is not None) and \
+           (len(value) != self._value_size):
+            raise ValueError(
+                "Value must have size %s. Invalid size: %s"
+                % (self._value_size, len(value)))
+        return bytes(key)
+
+    #
+    # Each operation runs through _run, which writes back
+    # the cached nodes and pads the operation with dummy
+    # accesses (even when the operation raises an
+    # exception). Subtrees are referred to by (id, leaf,
+    # height) tuples, where the leaf is None for cached
+    # nodes because they receive a new leaf when they are
+    # written back.
+    #
+
+    def _run(self, op, *args):
+        assert self._cache is None
+        self._cache = {}
+        self._read_count = 0
+        try:
+            return op(*args)
+        finally:
+            self._write_back()
+
+    def _write_back(self):
+        oram = self._oram
+        cache = self._cache
+        self._cache = None
+        leaves = dict((id_, oram.random_leaf()) for id_ in cache)
+        for node in cache.values():
+            for d in (0, 1):
+                if node.child[d] in leaves:
+                    node.child_leaf[d] = leaves[node.child[d]]
+        if self._root in leaves:
+            self._root_leaf = leaves[self._root]
+        assert len(cache) <= self._max_writes
+        for id_ in cache:
+            oram.write_block(id_, leaves[id_], self._pack_node(cache[id_]))
+        for i in xrange((self._max_reads - self._read_count) + \
+                        (self._max_writes - len(cache))):
+            oram.dummy_access()
+
+    def _fetch(self, id_, leaf):
+        assert id_ != PointerTreeORAM.null_id
+        node = self._cache.get(id_, None)
+        if node is None:
+            assert self._read_count < self._max_reads
+            node = self._cache[id_] = \
+                self._unpack_node(self._oram.read_block(id_, leaf))
+            self._read_count += 1
+        return node
+
+    def _fetch_child(self, node, d):
+        return self._fetch(node.child[d], node.child_leaf[d])
+
+    @staticmethod
+    def _get_child(node, d):
+        return (node.child[d], node.child_leaf[d], node.child_height[d])
+
+    @staticmethod
+    def _set_child(node, d, ref):
+        node.child[d], node.child_leaf[d], node.child_height[d] = ref
+
+    def _set_root(self, ref):
+        self._root, self._root_leaf, self._root_height = ref
+
+    def _rotate(self, id_, node, d):
+        # the child on side d becomes the root of the subtree
+        child_id = node.child[d]
+        child = self._fetch_child(node, d)
+        self._set_child(node, d, self._get_child(child, 1-d))
+        self._set_child(child, 1-d, (id_, None, node.height))
+        return (child_id, None, child.height)
+
+    def _rebalance(self, id_, node):
+        balance = node.child_height[0] - node.child_height[1]
+        if -1 <= balance <= 1:
+            return (id_, None, node.height)
+        # the taller side
+        d = 0 if (balance > 1) else 1
+        child = self._fetch_child(node, d)
+        if child.child_height[1-d] > child.child_height[d]:
+            self._set_child(node, d, self._rotate(node.child[d], child, 1-d))
+        return self._rotate(id_, node, d)
+
+    def _find(self, key):
+        id_, leaf = self._root, self._root_leaf
+        while id_ != PointerTreeORAM.null_id:
+            node = self._fetch(id_, leaf)
+            if key == node.key:
+                return node
+            d = int(key > node.key)
+            id_, leaf = node.child[d], node.child_leaf[d]
+        return None
+
+    def _get(self, key):
+        node = self._find(key)
+        if node is None:
+            raise KeyError(key)
+        return node.value
+
+    def _min_item(self):
+        id_, leaf = self._root, self._root_leaf
+        if id_ == PointerTreeORAM.null_id:
+            raise KeyError("The map is empty")
+        node = self._fetch(id_, leaf)
+        while node.child[0] != PointerTreeORAM.null_id:
+            node = self._fetch_child(node, 0)
+        return node.key, node.value
+
+    def _insert(self, id_, leaf, key, value):
+        if id_ == PointerTreeORAM.null_id:
+            if self._size >= self._oram.block_count:
+                raise ValueError(
+                    "The map is full (capacity %s)"
+                    % (self._oram.block_count))
+            new_id = self._oram.allocate_id()
+            self._cache[new_id] = _AVLNode(
+                key,
+                value,
+                [PointerTreeORAM.null_id, PointerTreeORAM.null_id],
+                [0, 0],
+                [0, 0])
+            self._size += 1
+            return (new_id, None, 1)
+        node = self._fetch(id_, leaf)
+        if key == node.key:
+            node.value = value
+            return (id_, None, node.height)
+        d = int(key > node.key)
+        self._set_child(node, d, self._insert(node.child[d],
+                                              node.child_leaf[d],
+                                              key,
+                                              value))
+        return self._rebalance(id_, node)
+
+    def _remove(self, id_, node):
+        # remove a cached node from the tree and return the
+        # subtree that replaces it
+        del self._cache[id_]
+        self._size -= 1
+        if node.child[0] == PointerTreeORAM.null_id:
+            return self._get_child(node, 1)
+        if node.child[1] == PointerTreeORAM.null_id:
+            return self._get_child(node, 0)
+        # replace the node with the smallest node in its
+        # right subtree
+        right, min_id, min_node = self._detach_min(node.child[1],
+                                                   node.child_leaf[1])
+        self._set_child(min_node, 0, self._get_child(node, 0))
+        self._set_child(min_node, 1, right)
+        return self._rebalance(min_id, min_node)
+
+    def _detach_min(self, id_, leaf):
+        # returns the subtree without its smallest node, and
+        # the id of the smallest node along with the (cached)
+        # node itself
+        node = self._fetch(id_, leaf)
+        if node.child[0] == PointerTreeORAM.null_id:
+            return self._get_child(node, 1), id_, node
+        left, min_id, min_node = self._detach_min(node.child[0],
+                                                  node.child_leaf[0])
+        self._set_child(node, 0, left)
+        return self._rebalance(id_, node), min_id, min_node
+
+    def _delete(self, id_, leaf, key):
+        # returns the new subtree and the value that was removed
+        if id_ == PointerTreeORAM.null_id:
+            raise KeyError(key)
+        node = self._fetch(id_, leaf)
+        if key == node.key:
+            return self._remove(id_, node), node.value
+        d = int(key > node.key)
+        child, value = self._delete(node.child[d],
+                                    node.child_leaf[d],
+                                    key)
+        self._set_child(node, d, child)
+        return self._rebalance(id_, node), value
+
+    def _pop_min(self):
+        if self._root == PointerTreeORAM.null_id:
+            raise KeyError("The map is empty")
+        root, min_id, min_node = self._detach_min(self._root,
+                                                  self._root_leaf)
+        self._set_root(root)
+        del self._cache[min_id]
+        self._size -= 1
+        return min_node.key, min_node.value
+
+    #
+    # Define ObliviousAVLMap Methods
+    #
+
+    @property
+    def oram(self):
+        return self._oram
+
+    @property
+    def stash(self):
+        return self._oram.stash
+
+    @property
+    def key_size(self):
+        return self._key_size
+
+    @property
+    def value_size(self):
+        return self._value_size
+
+    @property
+    def capacity(self):
+        """The largest number of items the map can hold"""
+        return self._oram.block_count
+
+    @property
+    def accesses_per_operation(self):
+        """The number of paths accessed by every operation"""
+        return self._max_reads + self._max_writes
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, key):
+        key = self._check_item(key)
+        return self._run(self._find, key) is not None
+
+    def __getitem__(self, key):
+        key = self._check_item(key)
+        return self._run(self._get, key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        key = self._check_item(key, value)
+        value = bytes(value)
+        self._run(lambda: self._set_root(
+            self._insert(self._root, self._root_leaf, key, value)))
+
+    def pop(self, key):
+        """Remove a key and return its value."""
+        key = self._check_item(key)
+        def op():
+            root, value = self._delete(self._root, self._root_leaf, key)
+            self._set_root(root)
+            return value
+        return self._run(op)
+
+    def __delitem__(self, key):
+        self.pop(key)
+
+    def min_item(self):
+        """Return the (key, value) pair with the smallest key."""
+        return self._run(self._min_item)
+
+    def pop_min(self):
+        """Remove and return the (key, value) pair with the
+        smallest key."""
+        return self._run(self._pop_min)
+
+    @classmethod
+    def compute_storage_size(cls,
+                             key_size,
+                             value_size,
+                             capacity,
+                             ignore_header=False,
+                             **kwds):
+        size = PointerTreeORAM.compute_storage_size(
+            struct.calcsize(cls._node_struct_string(key_size, value_size)),
+            capacity,
+            ignore_header=ignore_header,
+            **kwds)
+        if not ignore_header:
+            size += cls._header_offset
+        return size
+
+    @classmethod
+    def setup(cls,
+              storage_name,
+              key_size,
+              value_size,
+              capacity,
+              **kwds):
+        """
+        Set up an empty map that holds up to capacity
+        items. Other keywords are passed to
+        PointerTreeORAM.setup.
+        """
+        if (key_size <= 0) or (key_size != int(key_size)):
+            raise ValueError(
+                "Key size (bytes) must be a positive integer: %s"
+                % (key_size))
+        if (value_size < 0) or (value_size != int(value_size)):
+            raise ValueError(
+                "Value size (bytes) must be a nonnegative integer: %s"
+                % (value_size))
+        user_header_data = kwds.pop('header_data', bytes())
+        if type(user_header_data) is not bytes:
+            raise TypeError(
+                "'header_data' must be of type bytes. "
+                "Invalid type: %s" % (type(user_header_data)))
+        kwds['header_data'] = struct.pack(cls._header_struct_string,
+                                          key_size,
+                                          value_size,
+                                          0,
+                                          PointerTreeORAM.null_id,
+                                          0,
+                                          0) + \
+                              user_header_data
+        oram = PointerTreeORAM.setup(
+            storage_name,
+            struct.calcsize(cls._node_struct_string(key_size, value_size)),
+            capacity,
+            **kwds)
+        return cls(oram.heap_storage, oram.stash)
+
+    @property
+    def header_data(self):
+        return self._oram.header_data[self._header_offset:]
+
+    def update_header_data(self, new_header_data):
+        self._oram.update_header_data(
+            self._oram.header_data[:self._header_offset] + \
+            new_header_data)
+
+    @property
+    def key(self):
+        return self._oram.key
+
+    @property
+    def raw_storage(self):
+        return self._oram.raw_storage
+
+    @property
+    def storage_name(self):
+        return self._oram.storage_name
+
+    def close(self):
+        log.info("%s: Closing" % (self.__class__.__name__))
+        try:
+            self._oram.update_header_data(
+                struct.pack(self._header_struct_string,
+                            self._key_size,
+                            self._value_size,
+                            self._size,
+                            self._root,
+                            self._root_leaf,
+                            self._root_height) + \
+                self.header_data)
+        finally:
+            self._oram.close()
+
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        self.close()
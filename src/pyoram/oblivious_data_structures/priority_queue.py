@@ -0,0 +1,171 @@
+__all__ = ('ObliviousPriorityQueue',)
+
+import struct
+import logging
+
+from pyoram.oblivious_data_structures.avl_map import \
+    ObliviousAVLMap
+
+log = logging.getLogger("pyoram")
+
+class ObliviousPriorityQueue(object):
+    """
+    A min-priority queue of fixed-size byte string values
+    with fixed-size byte string priorities (compared by
+    their bytes), stored in an ObliviousAVLMap. Each item
+    is keyed by its priority followed by a sequence number,
+    so items with equal priorities are popped in the order
+    they were pushed. Every operation accesses the same
+    number of paths (see
+    ObliviousAVLMap.accesses_per_operation).
+    """
+
+    _header_struct_string = "!Q"
+    _header_offset = struct.calcsize(_header_struct_string)
+    _sequence_struct_string = "!Q"
+    _sequence_size = struct.calcsize(_sequence_struct_string)
+
+    def __init__(self, storage, stash, **kwds):
+        self._map = ObliviousAVLMap(storage, stash, **kwds)
+        (self._next_sequence,) = struct.unpack(
+            self._header_struct_string,
+            self._map.header_data[:self._header_offset])
+        self._priority_size = self._map.key_size - self._sequence_size
+
+    #
+    # Define ObliviousPriorityQueue Methods
+    #
+
+    @property
+    def map(self):
+        return self._map
+
+    @property
+    def stash(self):
+        return self._map.stash
+
+    @property
+    def priority_size(self):
+        return self._priority_size
+
+    @property
+    def value_size(self):
+        return self._map.value_size
+
+    @property
+    def capacity(self):
+        return self._map.capacity
+
+    @property
+    def accesses_per_operation(self):
+        return self._map.accesses_per_operation
+
+    def __len__(self):
+        return len(self._map)
+
+    def push(self, priority, value):
+        """Add a value to the queue."""
+        if len(priority) != self._priority_size:
+            raise ValueError(
+                "Priority must have size %s. Invalid size: %s"
+                % (self._priority_size, len(priority)))
+        key = bytes(priority) + \
+              struct.pack(self._sequence_struct_string,
+                          self._next_sequence)
+        self._map[key] = value
+        self._next_sequence += 1
+
+    def peek(self):
+        """Return the (priority, value) pair with the
+        smallest priority."""
+        key, value = self._map.min_item()
+        return key[:self._priority_size], value
+
+    def pop(self):
+        """Remove and return the (priority, value) pair with
+        the smallest priority."""
+        key, value = self._map.pop_min()
+        return key[:self._priority_size], value
+
+    @classmethod
+    def compute_storage_size(cls,
+                             priority_size,
+                             value_size,
+                             capacity,
+                             ignore_header=False,
+                             **kwds):
+        size = ObliviousAVLMap.compute_storage_size(
+            priority_size + cls._sequence_size,
+            value_size,
+            capacity,
+            ignore_header=ignore_header,
+            **kwds)
+        if not ignore_header:
+            size += cls._header_offset
+        return size
+
+    @classmethod
+    def setup(cls,
+              storage_name,
+              priority_size,
+              value_size,
+              capacity,
+              **kwds):
+        """
+        Set up an empty queue that holds up to capacity
+        items. Other keywords are passed to
+        ObliviousAVLMap.setup.
+        """
+        if (priority_size <= 0) or (priority_size != int(priority_size)):
+            raise ValueError(
+                "Priority size (bytes) must be a positive integer: %s"
+                % (priority_size))
+        user_header_data = kwds.pop('header_data', bytes())
+        if type(user_header_data) is not bytes:
+            raise TypeError(
+                "'header_data' must be of type bytes. "
+                "Invalid type: %s" % (type(user_header_data)))
+        kwds['header_data'] = struct.pack(cls._header_struct_string, 0) + \
+                              user_header_data
+        m = ObliviousAVLMap.setup(storage_name,
+                                  priority_size + cls._sequence_size,
+                                  value_size,
+                                  capacity,
+                                  **kwds)
+        return cls(m.oram.heap_storage, m.stash)
+
+    @property
+    def header_data(self):
+        return self._map.header_data[self._header_offset:]
+
+    def update_header_data(self, new_header_data):
+        self._map.update_header_data(
+            self._map.header_data[:self._header_offset] + \
+            new_header_data)
+
+    @property
+    def key(self):
+        return self._map.key
+
+    @property
+    def raw_storage(self):
+        return self._map.raw_storage
+
+    @property
+    def storage_name(self):
+        return self._map.storage_name
+
+    def close(self):
+        log.info("%s: Closing" % (self.__class__.__name__))
+        try:
+            self._map.update_header_data(
+                struct.pack(self._header_struct_string,
+                            self._next_sequence) + \
+                self.header_data)
+        finally:
+            self._map.close()
+
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        self.close()
@@ -1,2 +1,3 @@
 import pyoram.oblivious_storage.tree.tree_oram_helper
 import pyoram.oblivious_storage.tree.path_oram
+import pyoram.oblivious_storage.tree.pointer_tree_oram
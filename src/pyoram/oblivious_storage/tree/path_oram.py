@@ -1,7 +1,6 @@
 import hashlib
 import hmac
 import struct
-import array
 import logging
 
 import pyoram
@@ -50,11 +49,19 @@ class PathORAM(EncryptedBlockStorageInterface):
         else:
             cached_levels = kwds.pop('cached_levels', 3)
             concurrency_level = kwds.pop('concurrency_level', None)
+            cache_populate = kwds.pop('cache_populate', False)
+            cache_huge_pages = kwds.pop('cache_huge_pages', False)
+            cache_file = kwds.pop('cache_file', None)
+            cache_memory_budget = kwds.pop('cache_memory_budget', None)
             close_storage_heap = True
             storage_heap = TopCachedEncryptedHeapStorage(
                 EncryptedHeapStorage(storage, **kwds),
                 cached_levels=cached_levels,
-                concurrency_level=concurrency_level)
+                concurrency_level=concurrency_level,
+                cache_populate=cache_populate,
+                cache_huge_pages=cache_huge_pages,
+                cache_file=cache_file,
+                cache_memory_budget=cache_memory_budget)
 
         (self._block_count,) = struct.unpack(
             self._header_struct_string,
@@ -102,8 +109,17 @@ class PathORAM(EncryptedBlockStorageInterface):
 
     @classmethod
     def _init_position_map(cls, vheap, block_count):
-        return array.array("L", [vheap.random_leaf_bucket()
-                                 for i in xrange(block_count)])
+        return vheap.random_leaf_buckets(block_count, typecode="L")
+
+    @classmethod
+    def _init_empty_bucket(cls, oram_block_size, bucket_capacity):
+        empty_bucket = bytearray(oram_block_size * bucket_capacity)
+        empty_bucket_view = memoryview(empty_bucket)
+        for i in xrange(bucket_capacity):
+            TreeORAMStorageManagerExplicitAddressing.tag_block_as_empty(
+                empty_bucket_view[(i*oram_block_size):\
+                                  ((i+1)*oram_block_size)])
+        return bytes(empty_bucket)
 
     def _init_oram_block(self, id_, block):
         oram_block = bytearray(self.block_size)
@@ -161,11 +177,19 @@ class PathORAM(EncryptedBlockStorageInterface):
 
     def access(self, id_, write_block=None):
         assert 0 <= id_ <= self.block_count
+        vheap = self._oram.storage_heap.virtual_heap
         bucket = self.position_map[id_]
-        bucket_level = self._oram.storage_heap.virtual_heap.Node(bucket).level
+        bucket_level = vheap.bucket_level(bucket)
+        if bucket_level < vheap.last_level:
+            # The heap has grown since this block was last
+            # accessed. Load the path to a random leaf below its
+            # position (which passes through it) so that every
+            # access reads a full-length path, and remap the
+            # block to the new leaf level.
+            bucket = vheap.random_leaf_bucket_below(bucket)
+            bucket_level = vheap.last_level
         self.position_map[id_] = \
-            self._oram.storage_heap.virtual_heap.\
-            random_bucket_at_level(bucket_level)
+            vheap.random_bucket_at_level(bucket_level)
         self._oram.load_path(bucket)
         block = self._oram.extract_block_from_path(id_)
         if block is None:
@@ -183,6 +207,97 @@ class PathORAM(EncryptedBlockStorageInterface):
     def heap_storage(self):
         return self._oram.storage_heap
 
+    def grow(self, block_count, initialize=None):
+        """
+        Increase the number of blocks stored in the ORAM to
+        block_count without rebuilding it. When more heap levels
+        are needed, the new levels are appended to the storage
+        heap with the new blocks placed in them, and existing
+        blocks are moved down to the new leaf level the next
+        time they are accessed. Otherwise, the new blocks are
+        inserted with one path access each. The optional
+        initialize callback is called with the id of each new
+        block and should return its contents.
+        """
+        if (block_count < self.block_count) or \
+           (block_count != int(block_count)):
+            raise ValueError(
+                "Block count can only be increased. Invalid "
+                "value: %s" % (block_count))
+        if block_count == self.block_count:
+            return
+        if initialize is None:
+            zeros = bytes(bytearray(self.block_size))
+            initialize = lambda i: zeros
+        storage_heap = self._oram.storage_heap
+        vheap = storage_heap.virtual_heap
+        heap_height = max(vheap.height,
+                          calculate_necessary_heap_height(vheap.k,
+                                                          block_count))
+        new_ids = xrange(self.block_count, block_count)
+        if heap_height > vheap.height:
+            log.info("%s: growing storage heap from height %s to %s"
+                     % (self.__class__.__name__,
+                        vheap.height,
+                        heap_height))
+            new_vheap = SizedVirtualHeap(
+                vheap.k,
+                heap_height,
+                blocks_per_bucket=vheap.blocks_per_bucket)
+            first_new_bucket = vheap.bucket_count()
+            new_buckets = {}
+            self.position_map.extend(
+                new_vheap.random_leaf_buckets(len(new_ids),
+                                              typecode="L"))
+            for id_ in new_ids:
+                bucket = self.position_map[id_]
+                block = self._init_oram_block(id_, initialize(id_))
+                # place the block in the deepest bucket on its
+                # path (within the new levels) with room for it
+                node = new_vheap.Node(bucket)
+                while node.bucket >= first_new_bucket:
+                    blocks = new_buckets.setdefault(node.bucket, [])
+                    if len(blocks) < vheap.blocks_per_bucket:
+                        blocks.append(block)
+                        break
+                    node = node.parent_node()
+                else:
+                    self.stash[id_] = block
+            oram_block_size = self._oram.block_size
+            empty_bucket = self._init_empty_bucket(
+                oram_block_size,
+                vheap.blocks_per_bucket)
+            def initialize_bucket(b):
+                blocks = new_buckets.pop(b, None)
+                if blocks is None:
+                    return empty_bucket
+                bucket = bytearray(empty_bucket)
+                for i, block in enumerate(blocks):
+                    bucket[(i*oram_block_size):\
+                           ((i+1)*oram_block_size)] = block
+                return bytes(bucket)
+            storage_heap.grow(heap_height, initialize=initialize_bucket)
+            # the path buffers are sized by the number of heap levels
+            self._oram = TreeORAMStorageManagerExplicitAddressing(
+                storage_heap,
+                self.stash,
+                self.position_map)
+        else:
+            for id_ in new_ids:
+                bucket = vheap.random_leaf_bucket()
+                self.position_map.append(vheap.random_leaf_bucket())
+                self._oram.load_path(bucket)
+                self._oram.push_down_path()
+                self.stash[id_] = self._init_oram_block(id_,
+                                                        initialize(id_))
+                self._oram.fill_path_from_stash()
+                self._oram.evict_path()
+        self._block_count = block_count
+        header_data = bytearray(storage_heap.header_data)
+        header_data[2*hashlib.sha384().digest_size:\
+                    self._header_offset] = struct.pack("!L", block_count)
+        storage_heap.update_header_data(bytes(header_data))
+
     #
     # Define EncryptedBlockStorageInterface Methods
     #
@@ -243,6 +358,10 @@ class PathORAM(EncryptedBlockStorageInterface):
               heap_base=2,
               cached_levels=3,
               concurrency_level=None,
+              cache_populate=False,
+              cache_huge_pages=False,
+              cache_file=None,
+              cache_memory_budget=None,
               **kwds):
         if 'heap_height' in kwds:
             raise ValueError("'heap_height' keyword is not accepted")
@@ -290,14 +409,8 @@ class PathORAM(EncryptedBlockStorageInterface):
             cls._header_struct_string,
             block_count)
         kwds['header_data'] = bytes(header_data) + user_header_data
-        empty_bucket = bytearray(oram_block_size * bucket_capacity)
-        empty_bucket_view = memoryview(empty_bucket)
-        for i in xrange(bucket_capacity):
-            TreeORAMStorageManagerExplicitAddressing.tag_block_as_empty(
-                empty_bucket_view[(i*oram_block_size):\
-                                  ((i+1)*oram_block_size)])
-        empty_bucket = bytes(empty_bucket)
-
+        empty_bucket = cls._init_empty_bucket(oram_block_size,
+                                              bucket_capacity)
         kwds['initialize'] = lambda i: empty_bucket
         f = None
         try:
@@ -309,11 +422,16 @@ class PathORAM(EncryptedBlockStorageInterface):
                                            heap_base=heap_base,
                                            blocks_per_bucket=bucket_capacity,
                                            **kwds)
-            if cached_levels != 0:
+            if (cached_levels != 0) or \
+               (cache_memory_budget is not None):
                 f = TopCachedEncryptedHeapStorage(
                     f,
                     cached_levels=cached_levels,
-                    concurrency_level=concurrency_level)
+                    concurrency_level=concurrency_level,
+                    cache_populate=cache_populate,
+                    cache_huge_pages=cache_huge_pages,
+                    cache_file=cache_file,
+                    cache_memory_budget=cache_memory_budget)
             elif concurrency_level is not None:
                 raise ValueError(                      # pragma: no cover
                     "'concurrency_level' keyword is "  # pragma: no cover
@@ -335,7 +453,7 @@ class PathORAM(EncryptedBlockStorageInterface):
                     initialize(i)[:]
 
                 bucket = oram.position_map[i]
-                bucket_level = vheap.Node(bucket).level
+                bucket_level = vheap.bucket_level(bucket)
                 oram.position_map[i] = \
                     oram.storage_heap.virtual_heap.\
                     random_bucket_at_level(bucket_level)
@@ -438,6 +556,9 @@ class PathORAM(EncryptedBlockStorageInterface):
     def write_block(self, i, block):
         self.access(i, write_block=block)
 
+    def flush(self):
+        self._oram.storage_heap.flush()
+
     @property
     def bytes_sent(self):
         return self._oram.storage_heap.bytes_sent
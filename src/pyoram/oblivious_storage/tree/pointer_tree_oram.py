@@ -0,0 +1,399 @@
+__all__ = ('PointerTreeORAM',)
+
+import hashlib
+import hmac
+import struct
+import logging
+
+from pyoram.oblivious_storage.tree.tree_oram_helper import \
+    TreeORAMStorageManagerPointerAddressing
+from pyoram.oblivious_storage.tree.path_oram import \
+    PathORAM
+from pyoram.encrypted_storage.encrypted_heap_storage import \
+    (EncryptedHeapStorage,
+     EncryptedHeapStorageInterface)
+from pyoram.encrypted_storage.top_cached_encrypted_heap_storage import \
+    TopCachedEncryptedHeapStorage
+from pyoram.util.virtual_heap import \
+    calculate_necessary_heap_height
+
+from six.moves import xrange
+
+log = logging.getLogger("pyoram")
+
+class PointerTreeORAM(object):
+    """
+    A Path ORAM without a position map, meant to be used
+    as the storage layer of oblivious data structures
+    (e.g., ObliviousAVLMap). Each block stores the leaf
+    bucket it is mapped to, and the caller is responsible
+    for remembering that leaf (typically in the block that
+    points to it), so no position map (and no recursion
+    over smaller ORAMs to store it) is needed.
+
+    Reading a block with read_block removes it from the
+    tree, and the block must be returned with write_block
+    (under a fresh leaf from random_leaf) or discarded. Each
+    call to read_block, write_block, and dummy_access loads
+    and evicts exactly one path, and write_block evicts
+    along the path to a random leaf (not the new leaf of
+    the block), so all of these calls look alike to the
+    storage server. Block ids are allocated with
+    allocate_id, starting from 1, so that 0 can be used as
+    a null pointer.
+    """
+
+    null_id = 0
+
+    _header_struct_string = "!"+("x"*hashlib.sha384().digest_size)+"LL"
+    _header_offset = struct.calcsize(_header_struct_string)
+    _max_id = 2**32 - 1
+
+    def __init__(self, storage, stash, **kwds):
+
+        self._oram = None
+        self._block_count = None
+        self._next_id = None
+        self._access_count = 0
+
+        if isinstance(storage, EncryptedHeapStorageInterface):
+            storage_heap = storage
+            close_storage_heap = False
+            if len(kwds):
+                raise ValueError(
+                    "Keywords not used when initializing "
+                    "with a storage device: %s"
+                    % (str(kwds)))
+        else:
+            cached_levels = kwds.pop('cached_levels', 3)
+            concurrency_level = kwds.pop('concurrency_level', None)
+            cache_memory_budget = kwds.pop('cache_memory_budget', None)
+            close_storage_heap = True
+            storage_heap = TopCachedEncryptedHeapStorage(
+                EncryptedHeapStorage(storage, **kwds),
+                cached_levels=cached_levels,
+                concurrency_level=concurrency_level,
+                cache_memory_budget=cache_memory_budget)
+
+        (self._block_count, self._next_id) = struct.unpack(
+            self._header_struct_string,
+            storage_heap.header_data[:self._header_offset])
+        stashdigest = storage_heap.\
+                      header_data[:hashlib.sha384().digest_size]
+
+        try:
+            if stashdigest != \
+               PathORAM.stash_digest(
+                   stash,
+                   digestmod=hmac.HMAC(key=storage_heap.key,
+                                       digestmod=hashlib.sha384)):
+                raise ValueError(
+                    "Stash HMAC does not match that saved with "
+                    "storage heap %s" % (storage_heap.storage_name,))
+        except:
+            if close_storage_heap:
+                storage_heap.close()
+            raise
+
+        self._oram = TreeORAMStorageManagerPointerAddressing(
+            storage_heap,
+            stash)
+
+    @classmethod
+    def _init_empty_bucket(cls, oram_block_size, bucket_capacity):
+        empty_bucket = bytearray(oram_block_size * bucket_capacity)
+        empty_bucket_view = memoryview(empty_bucket)
+        for i in xrange(bucket_capacity):
+            TreeORAMStorageManagerPointerAddressing.tag_block_as_empty(
+                empty_bucket_view[(i*oram_block_size):\
+                                  ((i+1)*oram_block_size)])
+        return bytes(empty_bucket)
+
+    def _check_leaf(self, leaf):
+        vheap = self._oram.storage_heap.virtual_heap
+        if not (vheap.first_leaf_bucket() <= leaf < vheap.bucket_count()):
+            raise ValueError(
+                "Invalid leaf bucket: %s" % (leaf))
+
+    def _check_id(self, id_):
+        if not (1 <= id_ < self._next_id):
+            raise ValueError(
+                "Invalid block id: %s" % (id_))
+
+    def _access_path(self, leaf, id_=None):
+        oram = self._oram
+        oram.load_path(leaf)
+        block = None
+        if id_ is not None:
+            block = oram.extract_block_from_path(id_)
+            if block is None:
+                block = self.stash.pop(id_, None)
+        oram.push_down_path()
+        oram.fill_path_from_stash()
+        oram.evict_path()
+        self._access_count += 1
+        return block
+
+    #
+    # Define PointerTreeORAM Methods
+    #
+
+    @property
+    def stash(self):
+        return self._oram.stash
+
+    @property
+    def heap_storage(self):
+        return self._oram.storage_heap
+
+    @property
+    def access_count(self):
+        """The number of paths accessed since the ORAM was opened"""
+        return self._access_count
+
+    @property
+    def next_id(self):
+        """The id that allocate_id will return next"""
+        return self._next_id
+
+    def allocate_id(self):
+        """Return a block id that has not been used before."""
+        if self._next_id > self._max_id:
+            raise RuntimeError(
+                "All %s block ids have been allocated"
+                % (self._max_id))
+        id_ = self._next_id
+        self._next_id += 1
+        return id_
+
+    def random_leaf(self):
+        """Return a leaf bucket chosen uniformly at random."""
+        return self._oram.storage_heap.virtual_heap.random_leaf_bucket()
+
+    def read_block(self, id_, leaf):
+        """
+        Remove the block with the given id from the path to
+        its leaf bucket and return its contents.
+        """
+        self._check_id(id_)
+        self._check_leaf(leaf)
+        block = self._access_path(leaf, id_=id_)
+        if block is None:
+            raise KeyError(
+                "Block %s was not found on the path to "
+                "leaf bucket %s" % (id_, leaf))
+        assert self._oram.get_block_info(block) == (id_, leaf)
+        return block[self._oram.block_info_storage_size:]
+
+    def write_block(self, id_, leaf, block):
+        """
+        Store a block that is not in the tree (it was
+        removed with read_block or its id was just
+        allocated), mapping it to the given leaf bucket.
+        """
+        self._check_id(id_)
+        self._check_leaf(leaf)
+        if len(block) != self.block_size:
+            raise ValueError(
+                "Block must have size %s. Invalid size: %s"
+                % (self.block_size, len(block)))
+        oram_block = bytearray(self._oram.block_size)
+        oram_block[self._oram.block_info_storage_size:] = block[:]
+        self._oram.tag_block_with_id_and_address(oram_block, id_, leaf)
+        self.stash[id_] = oram_block
+        self._access_path(self.random_leaf())
+
+    def dummy_access(self):
+        """Access the path to a random leaf bucket."""
+        self._access_path(self.random_leaf())
+
+    @property
+    def key(self):
+        return self._oram.storage_heap.key
+
+    @property
+    def raw_storage(self):
+        return self._oram.storage_heap.raw_storage
+
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        self.close()
+
+    @classmethod
+    def compute_storage_size(cls,
+                             block_size,
+                             block_count,
+                             bucket_capacity=4,
+                             heap_base=2,
+                             ignore_header=False,
+                             **kwds):
+        assert (block_size > 0) and (block_size == int(block_size))
+        assert (block_count > 0) and (block_count == int(block_count))
+        assert bucket_capacity >= 1
+        assert heap_base >= 2
+        assert 'heap_height' not in kwds
+        heap_height = calculate_necessary_heap_height(heap_base,
+                                                      block_count)
+        block_size += TreeORAMStorageManagerPointerAddressing.\
+                      block_info_storage_size
+        size = EncryptedHeapStorage.compute_storage_size(
+            block_size,
+            heap_height,
+            blocks_per_bucket=bucket_capacity,
+            heap_base=heap_base,
+            ignore_header=ignore_header,
+            **kwds)
+        if not ignore_header:
+            size += cls._header_offset
+        return size
+
+    @classmethod
+    def setup(cls,
+              storage_name,
+              block_size,
+              block_count,
+              bucket_capacity=4,
+              heap_base=2,
+              cached_levels=3,
+              concurrency_level=None,
+              cache_memory_budget=None,
+              **kwds):
+        """
+        Set up an empty tree that is sized to hold
+        block_count blocks of block_size bytes.
+        """
+        if 'heap_height' in kwds:
+            raise ValueError("'heap_height' keyword is not accepted")
+        if 'initialize' in kwds:
+            raise ValueError("'initialize' keyword is not accepted")
+        if (bucket_capacity <= 0) or \
+           (bucket_capacity != int(bucket_capacity)):
+            raise ValueError(
+                "Bucket capacity must be a positive integer: %s"
+                % (bucket_capacity))
+        if (block_size <= 0) or (block_size != int(block_size)):
+            raise ValueError(
+                "Block size (bytes) must be a positive integer: %s"
+                % (block_size))
+        if (block_count <= 0) or (block_count != int(block_count)):
+            raise ValueError(
+                "Block count must be a positive integer: %s"
+                % (block_count))
+        if heap_base < 2:
+            raise ValueError(
+                "heap base must be 2 or greater. Invalid value: %s"
+                % (heap_base))
+
+        heap_height = calculate_necessary_heap_height(heap_base,
+                                                      block_count)
+        oram_block_size = block_size + \
+                          TreeORAMStorageManagerPointerAddressing.\
+                          block_info_storage_size
+
+        user_header_data = kwds.pop('header_data', bytes())
+        if type(user_header_data) is not bytes:
+            raise TypeError(
+                "'header_data' must be of type bytes. "
+                "Invalid type: %s" % (type(user_header_data)))
+
+        stash = {}
+        header_data = bytearray(struct.pack(cls._header_struct_string,
+                                            block_count,
+                                            cls.null_id + 1))
+        empty_bucket = cls._init_empty_bucket(oram_block_size,
+                                              bucket_capacity)
+        kwds['header_data'] = bytes(header_data) + user_header_data
+        kwds['initialize'] = lambda i: empty_bucket
+        f = None
+        try:
+            log.info("%s: setting up encrypted heap storage"
+                     % (cls.__name__))
+            f = EncryptedHeapStorage.setup(storage_name,
+                                           oram_block_size,
+                                           heap_height,
+                                           heap_base=heap_base,
+                                           blocks_per_bucket=bucket_capacity,
+                                           **kwds)
+            if (cached_levels != 0) or \
+               (cache_memory_budget is not None):
+                f = TopCachedEncryptedHeapStorage(
+                    f,
+                    cached_levels=cached_levels,
+                    concurrency_level=concurrency_level,
+                    cache_memory_budget=cache_memory_budget)
+            elif concurrency_level is not None:
+                raise ValueError(                      # pragma: no cover
+                    "'concurrency_level' keyword is "  # pragma: no cover
+                    "not used when no heap levels "    # pragma: no cover
+                    "are cached")                      # pragma: no cover
+            stash_digest = PathORAM.stash_digest(
+                stash,
+                digestmod=hmac.HMAC(key=f.key,
+                                    digestmod=hashlib.sha384))
+            header_data[:len(stash_digest)] = stash_digest[:]
+            f.update_header_data(bytes(header_data) + user_header_data)
+            return PointerTreeORAM(f, stash)
+        except:
+            if f is not None:
+                f.close()                              # pragma: no cover
+            raise
+
+    @property
+    def header_data(self):
+        return self._oram.storage_heap.\
+            header_data[self._header_offset:]
+
+    @property
+    def block_count(self):
+        """The number of blocks the tree is sized to hold"""
+        return self._block_count
+
+    @property
+    def block_size(self):
+        return self._oram.block_size - self._oram.block_info_storage_size
+
+    @property
+    def storage_name(self):
+        return self._oram.storage_heap.storage_name
+
+    def update_header_data(self, new_header_data):
+        self._oram.storage_heap.update_header_data(
+            self._oram.storage_heap.header_data[:self._header_offset] + \
+            new_header_data)
+
+    def close(self):
+        log.info("%s: Closing" % (self.__class__.__name__))
+        if self._oram is not None:
+            try:
+                stashdigest = \
+                    PathORAM.stash_digest(
+                        self._oram.stash,
+                        digestmod=hmac.HMAC(key=self._oram.storage_heap.key,
+                                            digestmod=hashlib.sha384))
+                new_header_data = \
+                    bytearray(struct.pack(self._header_struct_string,
+                                          self._block_count,
+                                          self._next_id))
+                new_header_data[:len(stashdigest)] = stashdigest
+                self._oram.storage_heap.update_header_data(
+                    bytes(new_header_data) + self.header_data)
+            except:                                                # pragma: no cover
+                log.error(                                         # pragma: no cover
+                    "%s: Failed to update header data with "       # pragma: no cover
+                    "current stash state"                          # pragma: no cover
+                    % (self.__class__.__name__))                   # pragma: no cover
+                raise
+            finally:
+                self._oram.storage_heap.close()
+
+    def flush(self):
+        self._oram.storage_heap.flush()
+
+    @property
+    def bytes_sent(self):
+        return self._oram.storage_heap.bytes_sent
+
+    @property
+    def bytes_received(self):
+        return self._oram.storage_heap.bytes_received
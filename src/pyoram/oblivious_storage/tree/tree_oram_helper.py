@@ -320,6 +320,19 @@ class TreeORAMStorageManagerPointerAddressing(
             __init__(storage_heap, stash)
         self.position_map = None
 
+    @staticmethod
+    def tag_block_with_id_and_address(block, id_, addr):
+        assert id_ >= 0
+        assert addr >= 0
+        struct.pack_into(
+            TreeORAMStorageManagerPointerAddressing.\
+            block_info_storage_string,
+            block,
+            0,
+            True,
+            id_,
+            addr)
+
     def get_block_info(self, block):
         real, id_, addr = struct.unpack_from(
             self.block_info_storage_string, block)
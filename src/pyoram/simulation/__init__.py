@@ -0,0 +1 @@
+import pyoram.simulation.path_oram_simulator
@@ -0,0 +1,350 @@
+__all__ = ('PathORAMSimulator',
+           'parameter_study')
+
+import array
+import random
+import itertools
+import logging
+
+from pyoram.util.virtual_heap import \
+    (SizedVirtualHeap,
+     calculate_necessary_heap_height)
+from pyoram.simulation._path_oram_simulator import \
+    (ffi as _ffi,
+     lib as _clib)
+
+import six
+from six.moves import xrange
+
+log = logging.getLogger("pyoram")
+
+class PathORAMSimulator(object):
+    """
+    Simulates the block placement of Path ORAM using only
+    block ids and leaf positions. No block data is stored
+    and nothing is encrypted, so millions of accesses can
+    be simulated per minute. The heap is sized the same way
+    as PathORAM.setup, and the eviction logic (implemented
+    in C) follows TreeORAMStorage.push_down_path and
+    TreeORAMStorage.fill_path_from_stash, so the reported
+    stash sizes match what Path ORAM would see.
+
+    All blocks are inserted when the simulator is created
+    (as in PathORAM.setup), after which the statistics are
+    reset. The statistics can be reset again at any time
+    with reset_statistics (e.g., after a warm up period).
+
+    The 'cached_levels' keyword only changes the bucket
+    transfer counts, which exclude the buckets in the top
+    cached levels of the heap (see
+    TopCachedEncryptedHeapStorage). A RuntimeError is raised
+    when the stash grows beyond 'stash_capacity' blocks. The
+    access that would overflow the stash is not performed,
+    so the simulator is left in a consistent state.
+    """
+
+    workloads = ('uniform', 'sequential')
+
+    def __init__(self,
+                 block_count,
+                 bucket_capacity=4,
+                 heap_base=2,
+                 cached_levels=0,
+                 stash_capacity=1000,
+                 seed=None):
+        if (block_count <= 0) or \
+           (block_count != int(block_count)) or \
+           (block_count >= _clib.PATH_ORAM_SIM_EMPTY):
+            raise ValueError(
+                "Block count must be a positive integer less "
+                "than %s: %s" % (_clib.PATH_ORAM_SIM_EMPTY, block_count))
+        if (bucket_capacity <= 0) or \
+           (bucket_capacity != int(bucket_capacity)):
+            raise ValueError(
+                "Bucket capacity must be a positive integer: %s"
+                % (bucket_capacity))
+        if heap_base < 2:
+            raise ValueError(
+                "heap base must be 2 or greater. Invalid value: %s"
+                % (heap_base))
+        if cached_levels < 0:
+            raise ValueError(
+                "Cached levels must be non-negative: %s"
+                % (cached_levels))
+        if stash_capacity < 1:
+            raise ValueError(
+                "Stash capacity must be a positive integer: %s"
+                % (stash_capacity))
+        self._vheap = SizedVirtualHeap(
+            heap_base,
+            calculate_necessary_heap_height(heap_base, block_count),
+            blocks_per_bucket=bucket_capacity)
+        vheap = self._vheap
+        levels = vheap.levels
+        Z = bucket_capacity
+        self._rng = random.Random(seed)
+        self._next_sequential_id = 0
+
+        # keep references to all of the memory
+        # used by the C structure
+        self._sim = _ffi.new("path_oram_sim *")
+        self._buckets = _ffi.new("unsigned int[]", vheap.bucket_count() * Z)
+        self._position_map = _ffi.new("unsigned long long[]", block_count)
+        self._stash = _ffi.new("unsigned int[]", stash_capacity)
+        self._stash_histogram = _ffi.new("unsigned long long[]",
+                                         stash_capacity + 1)
+        self._path_buckets = _ffi.new("unsigned long long[]", levels)
+        self._path_ids = _ffi.new("unsigned int[]", levels * Z)
+        self._path_levels = _ffi.new("int[]", levels * Z)
+        self._stash_levels = _ffi.new("int[]", stash_capacity)
+
+        sim = self._sim
+        sim.k = vheap.k
+        sim.Z = Z
+        sim.levels = levels
+        sim.cached_levels = min(cached_levels, levels)
+        sim.block_count = block_count
+        sim.first_leaf = vheap.first_leaf_bucket()
+        sim.leaf_count = vheap.leaf_bucket_count()
+        sim.buckets = self._buckets
+        sim.position_map = self._position_map
+        sim.stash = self._stash
+        sim.stash_size = 0
+        sim.stash_capacity = stash_capacity
+        sim.stash_histogram = self._stash_histogram
+        # xorshift requires a nonzero state
+        sim.rng_state = self._rng.getrandbits(64) | 1
+        sim.path_buckets = self._path_buckets
+        sim.path_ids = self._path_ids
+        sim.path_levels = self._path_levels
+        sim.stash_levels = self._stash_levels
+        sim.has_previous = 0
+
+        _ffi.memmove(self._buckets,
+                     b"\xff" * (_ffi.sizeof(self._buckets)),
+                     _ffi.sizeof(self._buckets))
+        for i in xrange(block_count):
+            self._position_map[i] = _clib.path_oram_sim_random_leaf(sim)
+        log.info("%s: inserting %s blocks into a heap with %s levels"
+                 % (self.__class__.__name__, block_count, levels))
+        self.access(xrange(block_count))
+        self.reset_statistics()
+
+    def _check(self, ret):
+        if ret == _clib.PATH_ORAM_SIM_STASH_OVERFLOW:
+            raise RuntimeError(
+                "The stash grew beyond its capacity of %s blocks"
+                % (self._sim.stash_capacity))
+        elif ret != 0:
+            raise ValueError(
+                "Block ids must be in the range [0, %s)"
+                % (self.block_count))
+
+    def access(self, ids, chunk_size=2**16):
+        """Simulate an access of each block id in ids."""
+        ids = iter(ids)
+        while True:
+            chunk = array.array('I', itertools.islice(ids, chunk_size))
+            if len(chunk) == 0:
+                break
+            self._check(_clib.path_oram_sim_access_many(
+                self._sim,
+                _ffi.cast("unsigned int *", _ffi.from_buffer(chunk)),
+                len(chunk)))
+
+    def run(self, access_count, workload='uniform'):
+        """
+        Simulate access_count accesses for a workload:
+
+          - 'uniform': block ids chosen uniformly at random
+          - 'sequential': block ids in order (wrapping
+            around after the last block)
+        """
+        if workload == 'uniform':
+            self._check(_clib.path_oram_sim_access_random(self._sim,
+                                                          access_count))
+        elif workload == 'sequential':
+            start = self._next_sequential_id
+            self._next_sequential_id = \
+                (start + access_count) % self.block_count
+            self.access(i % self.block_count
+                        for i in xrange(start, start + access_count))
+        else:
+            raise ValueError(
+                "Unknown workload '%s'. Choices are: %s"
+                % (workload, ", ".join(self.workloads)))
+
+    def reset_statistics(self):
+        """Clear all of the access statistics."""
+        sim = self._sim
+        sim.access_count = 0
+        sim.max_stash_size = sim.stash_size
+        sim.blocks_moved = 0
+        sim.buckets_read = 0
+        sim.buckets_written = 0
+        _ffi.memmove(self._stash_histogram,
+                     bytes(bytearray(_ffi.sizeof(self._stash_histogram))),
+                     _ffi.sizeof(self._stash_histogram))
+
+    @property
+    def virtual_heap(self):
+        return self._vheap
+
+    @property
+    def block_count(self):
+        return self._sim.block_count
+
+    @property
+    def bucket_capacity(self):
+        return self._vheap.blocks_per_bucket
+
+    @property
+    def heap_base(self):
+        return self._vheap.k
+
+    @property
+    def cached_levels(self):
+        return self._sim.cached_levels
+
+    @property
+    def access_count(self):
+        """The number of accesses since the statistics were reset"""
+        return self._sim.access_count
+
+    @property
+    def stash(self):
+        """The ids of the blocks in the stash"""
+        return [self._stash[i] for i in xrange(self._sim.stash_size)]
+
+    @property
+    def stash_size(self):
+        return self._sim.stash_size
+
+    @property
+    def max_stash_size(self):
+        return self._sim.max_stash_size
+
+    @property
+    def stash_size_histogram(self):
+        """
+        A list whose i-th entry is the number of accesses
+        after which the stash held i blocks
+        """
+        return [self._stash_histogram[i]
+                for i in xrange(self._sim.max_stash_size + 1)]
+
+    @property
+    def mean_stash_size(self):
+        if self.access_count == 0:
+            return 0.0
+        return sum(i * c for i, c in enumerate(self.stash_size_histogram)) / \
+            float(self.access_count)
+
+    def stash_size_quantile(self, q):
+        """
+        The smallest stash size s such that the stash held at
+        most s blocks after a fraction q of the accesses
+        """
+        assert 0 <= q <= 1
+        target = q * self.access_count
+        total = 0
+        for i, c in enumerate(self.stash_size_histogram):
+            total += c
+            if total >= target:
+                return i
+        return self.max_stash_size                     # pragma: no cover
+
+    def _per_access(self, count):
+        if self.access_count == 0:
+            return 0.0
+        return count / float(self.access_count)
+
+    @property
+    def blocks_moved_per_access(self):
+        """
+        The average number of blocks placed in a new slot on
+        the path (pushed down the path or evicted from the
+        stash) per access
+        """
+        return self._per_access(self._sim.blocks_moved)
+
+    @property
+    def buckets_read_per_access(self):
+        """
+        The average number of buckets read from external
+        storage per access (buckets shared with the previous
+        path and buckets in the cached levels are not read)
+        """
+        return self._per_access(self._sim.buckets_read)
+
+    @property
+    def buckets_written_per_access(self):
+        """
+        The average number of buckets written to external
+        storage per access
+        """
+        return self._per_access(self._sim.buckets_written)
+
+    def position(self, id_):
+        """The leaf bucket currently assigned to a block"""
+        assert 0 <= id_ < self.block_count
+        return self._position_map[id_]
+
+    def bucket(self, b):
+        """The ids of the blocks stored in a bucket"""
+        assert 0 <= b < self._vheap.bucket_count()
+        Z = self.bucket_capacity
+        return [self._buckets[b*Z + j] for j in xrange(Z)
+                if self._buckets[b*Z + j] != _clib.PATH_ORAM_SIM_EMPTY]
+
+    def bucket_occupancy_by_level(self):
+        """
+        Returns a list with the average number of blocks
+        stored in a bucket at each level of the heap
+        """
+        vheap = self._vheap
+        counts = _ffi.new("unsigned long long[]", vheap.levels)
+        _clib.path_oram_sim_level_occupancy(self._sim, counts)
+        return [counts[l] / float(vheap.bucket_count_at_level(l))
+                for l in xrange(vheap.levels)]
+
+def parameter_study(block_count,
+                    access_count,
+                    bucket_capacity=(2, 3, 4, 5),
+                    heap_base=(2,),
+                    workload=('uniform',),
+                    warmup_count=None,
+                    **kwds):
+    """
+    Run the simulator for every combination of the given
+    bucket capacities, heap bases, and workloads. Each
+    simulation runs warmup_count accesses (access_count by
+    default) before the statistics are collected over
+    access_count accesses. Other keywords are passed to the
+    PathORAMSimulator constructor. Yields a dictionary of
+    results for each combination.
+    """
+    if warmup_count is None:
+        warmup_count = access_count
+    for Z, k, w in itertools.product(bucket_capacity,
+                                     heap_base,
+                                     workload):
+        sim = PathORAMSimulator(block_count,
+                                bucket_capacity=Z,
+                                heap_base=k,
+                                **kwds)
+        sim.run(warmup_count, workload=w)
+        sim.reset_statistics()
+        sim.run(access_count, workload=w)
+        yield {'bucket_capacity': Z,
+               'heap_base': k,
+               'workload': w,
+               'heap_levels': sim.virtual_heap.levels,
+               'access_count': sim.access_count,
+               'max_stash_size': sim.max_stash_size,
+               'mean_stash_size': sim.mean_stash_size,
+               'stash_size_histogram': sim.stash_size_histogram,
+               'blocks_moved_per_access': sim.blocks_moved_per_access,
+               'buckets_read_per_access': sim.buckets_read_per_access,
+               'buckets_written_per_access': sim.buckets_written_per_access,
+               'bucket_occupancy_by_level': sim.bucket_occupancy_by_level()}
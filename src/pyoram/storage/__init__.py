@@ -2,6 +2,9 @@ import pyoram.storage.block_storage
 import pyoram.storage.block_storage_file
 import pyoram.storage.block_storage_mmap
 import pyoram.storage.block_storage_ram
+import pyoram.storage.block_storage_shared_memory
 import pyoram.storage.block_storage_sftp
 import pyoram.storage.block_storage_s3
+import pyoram.storage.block_storage_striped
+import pyoram.storage.block_storage_simulated_link
 import pyoram.storage.heap_storage
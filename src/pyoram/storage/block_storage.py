@@ -1,6 +1,7 @@
 __all__ = ('BlockStorageTypeFactory',)
 
 import logging
+import collections
 
 log = logging.getLogger("pyoram")
 
@@ -26,6 +27,90 @@ def _register_device(name, type_):
     BlockStorageTypeFactory._registered_devices[name] = type_
 BlockStorageTypeFactory.register_device = _register_device
 
+# the offset of the block count within the index
+# shared by the file, mmap, and RAM storage formats
+_block_count_offset = 4
+
+def _check_grow(block_count, new_block_count):
+    if (new_block_count < block_count) or \
+       (new_block_count != int(new_block_count)):
+        raise ValueError(
+            "The new block count must be an integer that is "
+            "at least the current block count (%s): %s"
+            % (block_count, new_block_count))
+
+class _PendingWrites(object):
+    """
+    A bounded queue of in-flight asynchronous write
+    batches together with an index of the blocks they
+    contain. Reads of a pending block can be served from
+    this index without waiting on the write, and reads of
+    any other block do not need to wait at all.
+
+    Each batch is represented by an object with the
+    ready() and get() methods of
+    multiprocessing.pool.AsyncResult. A new batch that
+    overlaps with a pending batch causes all pending
+    batches to be drained first, so the storage always
+    observes writes to the same block in order.
+    """
+
+    def __init__(self, max_batches):
+        assert max_batches >= 1
+        self._max_batches = max_batches
+        self._batches = collections.deque()
+        self._blocks = {}
+        self._next_id = 0
+
+    def __len__(self):
+        return len(self._batches)
+
+    def __contains__(self, i):
+        return i in self._blocks
+
+    def get(self, i):
+        return self._blocks[i][1]
+
+    def reserve(self, indices):
+        """Wait on pending batches until a batch that
+        writes the given indices can be queued."""
+        if any(i in self._blocks for i in indices):
+            self.drain()
+        while len(self._batches) >= self._max_batches:
+            self._pop()
+
+    def push(self, result, indices, blocks, callback=None):
+        """Queue a batch. The optional callback is called
+        with the batch result once it is reaped."""
+        batch_id = self._next_id
+        self._next_id += 1
+        for i, block in zip(indices, blocks):
+            self._blocks[i] = (batch_id, block)
+        self._batches.append((batch_id, result, indices, callback))
+
+    def _pop(self):
+        batch_id, result, indices, callback = self._batches.popleft()
+        try:
+            value = result.get()
+        finally:
+            for i in indices:
+                entry = self._blocks.get(i)
+                if (entry is not None) and (entry[0] == batch_id):
+                    del self._blocks[i]
+        if callback is not None:
+            callback(value)
+
+    def reap(self):
+        """Remove completed batches (raising any exception
+        they encountered) without blocking."""
+        while len(self._batches) and self._batches[0][1].ready():
+            self._pop()
+
+    def drain(self):
+        """Wait on all pending batches."""
+        while len(self._batches):
+            self._pop()
+
 class BlockStorageInterface(object):
 
     def __enter__(self):
@@ -74,6 +159,10 @@ class BlockStorageInterface(object):
         raise NotImplementedError                      # pragma: no cover
     def write_block(self, *args, **kwds):
         raise NotImplementedError                      # pragma: no cover
+    def flush(self, *args, **kwds):
+        raise NotImplementedError                      # pragma: no cover
+    def grow(self, *args, **kwds):
+        raise NotImplementedError                      # pragma: no cover
 
     @property
     def bytes_sent(self):
@@ -4,12 +4,19 @@ import os
 import struct
 import logging
 import errno
+import mmap
+import threading
 from multiprocessing.pool import ThreadPool
 
 import pyoram
+from pyoram.util.misc import (intdivceil,
+                              chunkiter)
 from pyoram.storage.block_storage import \
     (BlockStorageInterface,
-     BlockStorageTypeFactory)
+     BlockStorageTypeFactory,
+     _PendingWrites,
+     _block_count_offset,
+     _check_grow)
 
 import tqdm
 import six
@@ -22,19 +29,102 @@ class default_filesystem(object):
     remove = os.remove
     stat = os.stat
 
+try:
+    _iov_max = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):  # pragma: no cover
+    _iov_max = -1                                 # pragma: no cover
+if _iov_max <= 0:                                 # pragma: no cover
+    _iov_max = 1024                               # pragma: no cover
+
+def _align(n, alignment):
+    """Round n up to the nearest multiple of alignment."""
+    return intdivceil(n, alignment) * alignment
+
+def _pwritev_all(fd, bufs, offset):
+    """Write the buffers to fd starting at offset, retrying
+    after partial writes until every byte is written."""
+    bufs = [memoryview(buf) for buf in bufs]
+    while len(bufs):
+        count = os.pwritev(fd, bufs, offset)
+        if count <= 0:
+            raise IOError(
+                "Write of %s bytes at offset %s made no progress"
+                % (sum(len(buf) for buf in bufs), offset))
+        offset += count
+        while len(bufs) and (len(bufs[0]) <= count):
+            count -= len(bufs.pop(0))
+        if count:
+            bufs[0] = bufs[0][count:]
+
+class _AlignedBufferPool(object):
+    """
+    A thread-safe pool of reusable, page-aligned buffers
+    (anonymous memory maps) suitable for use with O_DIRECT
+    file I/O.
+    """
+
+    def __init__(self, buffer_size):
+        self._buffer_size = buffer_size
+        self._lock = threading.Lock()
+        self._free = []
+
+    def get(self):
+        with self._lock:
+            if len(self._free):
+                return self._free.pop()
+        return mmap.mmap(-1, self._buffer_size)
+
+    def put(self, buf):
+        with self._lock:
+            self._free.append(buf)
+
+    def close(self):
+        with self._lock:
+            for buf in self._free:
+                buf.close()
+            self._free = []
+
 class BlockStorageFile(BlockStorageInterface):
     """
     A class implementing the block storage interface
     using a local file.
+
+    When set up with the 'direct_io' keyword, the user
+    header and each block are padded to a multiple of
+    _direct_io_alignment bytes so that the file can be
+    accessed with O_DIRECT (bypassing the kernel page
+    cache). Opening such a file with 'direct_io=True'
+    performs block I/O through a pool of reusable aligned
+    buffers. If the platform or filesystem does not
+    support O_DIRECT, the device falls back to normal
+    buffered I/O over the same (padded) storage
+    layout. The padded layout is recorded in the storage
+    index, so these files can also be opened without
+    'direct_io' or through BlockStorageMMap.
+
+    When a thread pool is used, up to 'max_pending_writes'
+    batches of block writes may be in flight at once.
+    Reads of blocks with a pending write are served from
+    memory, and flush() waits for all pending writes.
     """
 
     _index_struct_string = "!LLL?"
     _index_offset = struct.calcsize(_index_struct_string)
+    # the upper bit of the user header size index field
+    # marks the padded layout created by setup(direct_io=True)
+    _aligned_layout_flag = 1 << 31
+    _direct_io_alignment = 4096
+    # the largest contiguous range (in bytes) sent to the
+    # file in a single write call (or, for sftp, in a single
+    # readv extent)
+    _max_io_run_bytes = 1 << 22
 
     def __init__(self,
                  storage_name,
                  threadpool_size=None,
                  ignore_lock=False,
+                 direct_io=False,
+                 max_pending_writes=4,
                  _filesystem=default_filesystem):
 
         self._bytes_sent = 0
@@ -42,9 +132,19 @@ class BlockStorageFile(BlockStorageInterface):
         self._filesystem = _filesystem
         self._ignore_lock = ignore_lock
         self._f = None
+        self._direct_fd = None
+        self._direct_buffers = None
         self._pool = None
         self._close_pool = True
-        self._async_write = None
+        if max_pending_writes < 1:
+            raise ValueError(
+                "max_pending_writes must be a positive integer: %s"
+                % (max_pending_writes))
+        self._pending = _PendingWrites(max_pending_writes)
+        # serializes use of the file object between the
+        # caller and the thread pool
+        self._io_lock = threading.Lock()
+        self._io_mode = None
         self._storage_name = storage_name
         self._f = self._filesystem.open(self.storage_name, "r+b")
         self._f.seek(0)
@@ -52,6 +152,9 @@ class BlockStorageFile(BlockStorageInterface):
             struct.unpack(
                 BlockStorageFile._index_struct_string,
                 self._f.read(BlockStorageFile._index_offset))
+        self._aligned_layout = \
+            bool(user_header_size & BlockStorageFile._aligned_layout_flag)
+        user_header_size &= ~BlockStorageFile._aligned_layout_flag
 
         if locked and (not self._ignore_lock):
             self._f.close()
@@ -67,6 +170,28 @@ class BlockStorageFile(BlockStorageInterface):
                 self._f.read(user_header_size)
         self._header_offset = BlockStorageFile._index_offset + \
                               len(self._user_header_data)
+        self._block_stride = self._block_size
+        if self._aligned_layout:
+            self._header_offset = \
+                _align(self._header_offset,
+                       BlockStorageFile._direct_io_alignment)
+            self._block_stride = \
+                _align(self._block_size,
+                       BlockStorageFile._direct_io_alignment)
+        size = self._filesystem.stat(self.storage_name).st_size
+        if size != self._header_offset + \
+                   self._block_stride * self.block_count:
+            self._f.close()
+            self._f = None
+            raise ValueError(
+                "The size of storage '%s' (%s bytes) does not match "
+                "the %s block layout recorded in its index (%s "
+                "bytes expected)"
+                % (self.storage_name,
+                   size,
+                   "padded" if self._aligned_layout else "unpadded",
+                   self._header_offset + \
+                   self._block_stride * self.block_count))
 
         # TODO: Figure out why this is required for Python3
         #       in order to prevent issues with the
@@ -83,44 +208,201 @@ class BlockStorageFile(BlockStorageInterface):
         if not self._ignore_lock:
             # turn on the locked flag
             self._f.seek(0)
-            self._f.write(
-                struct.pack(BlockStorageFile._index_struct_string,
-                            self.block_size,
-                            self.block_count,
-                            len(self._user_header_data),
-                            True))
+            self._f.write(self._pack_index(True))
             self._f.flush()
 
+        if direct_io:
+            self._open_direct_io()
+
         if threadpool_size != 0:
             self._pool = ThreadPool(threadpool_size)
 
+    def _pack_index(self, locked):
+        user_header_size = len(self._user_header_data)
+        if self._aligned_layout:
+            user_header_size |= BlockStorageFile._aligned_layout_flag
+        return struct.pack(BlockStorageFile._index_struct_string,
+                           self.block_size,
+                           self.block_count,
+                           user_header_size,
+                           locked)
+
+    def _open_direct_io(self):
+        alignment = BlockStorageFile._direct_io_alignment
+        if (self._header_offset % alignment) or \
+           (self._block_stride % alignment):
+            log.warning(
+                "%s: Storage '%s' does not use an aligned block "
+                "layout (use 'direct_io=True' during setup). "
+                "Falling back to buffered I/O."
+                % (self.__class__.__name__, self.storage_name))
+            return
+        if (self._filesystem is not default_filesystem) or \
+           (not hasattr(os, "O_DIRECT")) or \
+           (not hasattr(os, "preadv")):
+            log.info(
+                "%s: O_DIRECT is not supported for storage '%s'. "
+                "Falling back to buffered I/O."
+                % (self.__class__.__name__, self.storage_name))
+            return
+        buffers = _AlignedBufferPool(self._block_stride)
+        fd = None
+        try:
+            fd = os.open(self.storage_name, os.O_RDWR | os.O_DIRECT)
+            # Some filesystems accept the open flag but
+            # reject the I/O, so probe with a read.
+            buf = buffers.get()
+            try:
+                os.preadv(fd, [buf], self._header_offset)
+            finally:
+                buffers.put(buf)
+        except (OSError, IOError) as e:
+            log.info(
+                "%s: O_DIRECT I/O failed for storage '%s' (%s). "
+                "Falling back to buffered I/O."
+                % (self.__class__.__name__, self.storage_name, e))
+            if fd is not None:
+                os.close(fd)
+            buffers.close()
+            return
+        self._direct_fd = fd
+        self._direct_buffers = buffers
+
+    def _close_direct_io(self):
+        if self._direct_fd is not None:
+            os.close(self._direct_fd)
+            self._direct_fd = None
+            self._direct_buffers.close()
+            self._direct_buffers = None
+
+    def _read_block(self, i):
+        assert 0 <= i < self.block_count
+        self._bytes_received += self.block_size
+        if i in self._pending:
+            return self._pending.get(i)
+        if self._direct_fd is not None:
+            buf = self._direct_buffers.get()
+            try:
+                offset = self._header_offset + i * self._block_stride
+                count = os.preadv(self._direct_fd, [buf], offset)
+                if count != self._block_stride:
+                    # the buffer still holds data from an
+                    # earlier read
+                    raise IOError(
+                        "Short read of block %s: expected %s bytes "
+                        "at offset %s, got %s"
+                        % (i, self._block_stride, offset, count))
+                return buf[:self.block_size]
+            finally:
+                self._direct_buffers.put(buf)
+        with self._io_lock:
+            self._set_io_mode("r")
+            self._f.seek(self._header_offset + i * self._block_stride)
+            return self._f.read(self.block_size)
+
     def _check_async(self):
-        if self._async_write is not None:
-            self._async_write.get()
-            self._async_write = None
+        self._pending.drain()
+        self._sync_file()
+
+    def _set_io_mode(self, mode):
+        # Reads and writes on the buffered file object may be
+        # issued from different threads. Flush when switching
+        # between the two so that neither observes the other's
+        # buffer state.
+        if self._io_mode != mode:
+            self._f.flush()
+            self._io_mode = mode
+
+    def _sync_file(self):
         # TODO: Figure out why tests fail on Python3 without this
+        #       (flushing also discards any read-ahead data
+        #       buffered by this file object, which may be stale
+        #       if a cloned device wrote to the file)
         if six.PY3:
-            if self._f is None:
-                return
-            self._f.flush()
+            with self._io_lock:
+                if self._f is None:
+                    return
+                self._f.flush()
 
     def _schedule_async_write(self, args, callback=None):
-        assert self._async_write is None
         if self._pool is not None:
-            self._async_write = \
-                self._pool.apply_async(self._writev, (args, callback))
+            indices = [i for i, _ in args]
+            self._pending.reserve(indices)
+            self._pending.push(
+                self._pool.apply_async(self._writev, (args, callback)),
+                indices,
+                [block for _, block in args])
         else:
             self._writev(args, callback)
 
+    def _coalesce_writes(self, chunks):
+        """
+        Sort the (index, block) pairs by offset, keep only the
+        last write to any index, and group adjacent indices
+        into runs of at most min(_max_io_run_bytes //
+        _block_stride, _iov_max) blocks.
+        Returns a list of (first_index, blocks) pairs and a
+        dict mapping each index to the number of times it
+        appeared in chunks.
+        """
+        latest = {}
+        counts = {}
+        for i, block in chunks:
+            latest[i] = block
+            counts[i] = counts.get(i, 0) + 1
+        max_run = max(1, min(self._max_io_run_bytes // self._block_stride,
+                             _iov_max))
+        runs = []
+        for i in sorted(latest):
+            if (len(runs) == 0) or \
+               (runs[-1][0] + len(runs[-1][1]) != i) or \
+               (len(runs[-1][1]) >= max_run):
+                runs.append((i, []))
+            runs[-1][1].append(latest[i])
+        return runs, counts
+
     # This method is usually executed in another thread, so
     # do not attempt to handle exceptions because it will
     # not work.
     def _writev(self, chunks, callback):
-        for i, block in chunks:
-            self._f.seek(self._header_offset + i * self.block_size)
-            self._f.write(block)
-            if callback is not None:
-                callback(i)
+        runs, counts = self._coalesce_writes(chunks)
+        if self._direct_fd is not None:
+            padding = bytes(bytearray(self._block_stride - self.block_size))
+            for start, blocks in runs:
+                bufs = []
+                try:
+                    for block in blocks:
+                        buf = self._direct_buffers.get()
+                        bufs.append(buf)
+                        buf[:self.block_size] = block
+                        buf[self.block_size:] = padding
+                    _pwritev_all(self._direct_fd,
+                                 bufs,
+                                 self._header_offset + \
+                                 start * self._block_stride)
+                finally:
+                    for buf in bufs:
+                        self._direct_buffers.put(buf)
+                self._run_callbacks(start, len(blocks), counts, callback)
+            return
+        padding = bytes(bytearray(self._block_stride - self.block_size))
+        for start, blocks in runs:
+            with self._io_lock:
+                self._set_io_mode("w")
+                self._f.seek(self._header_offset + start * self._block_stride)
+                if len(padding):
+                    self._f.write(padding.join(blocks))
+                else:
+                    self._f.write(b"".join(blocks))
+            self._run_callbacks(start, len(blocks), counts, callback)
+        self._sync_file()
+
+    @staticmethod
+    def _run_callbacks(start, count, counts, callback):
+        if callback is not None:
+            for i in xrange(start, start + count):
+                for _ in xrange(counts[i]):
+                    callback(i)
 
     def _prep_for_close(self):
         self._check_async()
@@ -132,13 +414,9 @@ class BlockStorageFile(BlockStorageInterface):
             if not self._ignore_lock:
                 # turn off the locked flag
                 self._f.seek(0)
-                self._f.write(
-                    struct.pack(BlockStorageFile._index_struct_string,
-                                self.block_size,
-                                self.block_count,
-                                len(self._user_header_data),
-                                False))
+                self._f.write(self._pack_index(False))
                 self._f.flush()
+        self._close_direct_io()
 
     #
     # Define BlockStorageInterface Methods
@@ -147,7 +425,9 @@ class BlockStorageFile(BlockStorageInterface):
     def clone_device(self):
         f = BlockStorageFile(self.storage_name,
                              threadpool_size=0,
-                             ignore_lock=True)
+                             ignore_lock=True,
+                             direct_io=(self._direct_fd is not None),
+                             max_pending_writes=self._pending._max_batches)
         f._pool = self._pool
         f._close_pool = False
         return f
@@ -157,16 +437,22 @@ class BlockStorageFile(BlockStorageInterface):
                              block_size,
                              block_count,
                              header_data=None,
-                             ignore_header=False):
+                             ignore_header=False,
+                             direct_io=False):
         assert (block_size > 0) and (block_size == int(block_size))
         assert (block_count > 0) and (block_count == int(block_count))
         if header_data is None:
             header_data = bytes()
+        header_size = BlockStorageFile._index_offset + len(header_data)
+        if direct_io:
+            block_size = _align(block_size,
+                                BlockStorageFile._direct_io_alignment)
+            header_size = _align(header_size,
+                                 BlockStorageFile._direct_io_alignment)
         if ignore_header:
             return block_size * block_count
         else:
-            return BlockStorageFile._index_offset + \
-                   len(header_data) + \
+            return header_size + \
                    block_size * block_count
 
     @classmethod
@@ -178,6 +464,8 @@ class BlockStorageFile(BlockStorageInterface):
               header_data=None,
               ignore_existing=False,
               threadpool_size=None,
+              direct_io=False,
+              max_pending_writes=4,
               _filesystem=default_filesystem):
 
         if (not ignore_existing):
@@ -208,39 +496,57 @@ class BlockStorageFile(BlockStorageInterface):
         if initialize is None:
             zeros = bytes(bytearray(block_size))
             initialize = lambda i: zeros
+        if header_data is None:
+            header_data = bytes()
+        user_header_size = len(header_data)
+        header_padding = bytes()
+        block_padding = bytes()
+        if direct_io:
+            user_header_size |= BlockStorageFile._aligned_layout_flag
+            header_size = BlockStorageFile._index_offset + \
+                          len(header_data)
+            header_padding = bytes(bytearray(
+                _align(header_size, BlockStorageFile._direct_io_alignment) - \
+                header_size))
+            block_padding = bytes(bytearray(
+                _align(block_size, BlockStorageFile._direct_io_alignment) - \
+                block_size))
         try:
             with _filesystem.open(storage_name, "wb") as f:
                 # create_index
-                if header_data is None:
-                    f.write(struct.pack(BlockStorageFile._index_struct_string,
-                                        block_size,
-                                        block_count,
-                                        0,
-                                        False))
-                else:
-                    f.write(struct.pack(BlockStorageFile._index_struct_string,
-                                        block_size,
-                                        block_count,
-                                        len(header_data),
-                                        False))
-                    f.write(header_data)
+                f.write(struct.pack(BlockStorageFile._index_struct_string,
+                                    block_size,
+                                    block_count,
+                                    user_header_size,
+                                    False))
+                f.write(header_data)
+                f.write(header_padding)
                 with tqdm.tqdm(total=block_count*block_size,
                                desc="Initializing File Block Storage Space",
                                unit="B",
                                unit_scale=True,
                                disable=not pyoram.config.SHOW_PROGRESS_BAR) as progress_bar:
-                    for i in xrange(block_count):
-                        block = initialize(i)
-                        assert len(block) == block_size, \
-                            ("%s != %s" % (len(block), block_size))
-                        f.write(block)
-                        progress_bar.update(n=block_size)
+                    # write the blocks in large contiguous runs
+                    run = max(1, BlockStorageFile._max_io_run_bytes // \
+                              (block_size + len(block_padding)))
+                    for indices in chunkiter(xrange(block_count), n=run):
+                        blocks = []
+                        for i in indices:
+                            block = initialize(i)
+                            assert len(block) == block_size, \
+                                ("%s != %s" % (len(block), block_size))
+                            blocks.append(block)
+                            blocks.append(block_padding)
+                        f.write(b"".join(blocks))
+                        progress_bar.update(n=block_size*len(indices))
         except:                                        # pragma: no cover
             _filesystem.remove(storage_name)           # pragma: no cover
             raise                                      # pragma: no cover
 
         return BlockStorageFile(storage_name,
                                 threadpool_size=threadpool_size,
+                                direct_io=direct_io,
+                                max_pending_writes=max_pending_writes,
                                 _filesystem=_filesystem)
 
     @property
@@ -270,6 +576,9 @@ class BlockStorageFile(BlockStorageInterface):
         self._user_header_data = bytes(new_header_data)
         self._f.seek(BlockStorageFile._index_offset)
         self._f.write(self._user_header_data)
+        # devices cloned after this call read the header
+        # from the file
+        self._f.flush()
 
     def close(self):
         self._prep_for_close()
@@ -281,47 +590,77 @@ class BlockStorageFile(BlockStorageInterface):
             self._f = None
 
     def read_blocks(self, indices):
-        self._check_async()
-        blocks = []
-        for i in indices:
-            assert 0 <= i < self.block_count
-            self._bytes_received += self.block_size
-            self._f.seek(self._header_offset + i * self.block_size)
-            blocks.append(self._f.read(self.block_size))
-        return blocks
+        self._pending.reap()
+        self._sync_file()
+        return [self._read_block(i) for i in indices]
 
     def yield_blocks(self, indices):
-        self._check_async()
+        self._pending.reap()
+        self._sync_file()
         for i in indices:
-            assert 0 <= i < self.block_count
-            self._bytes_received += self.block_size
-            self._f.seek(self._header_offset + i * self.block_size)
-            yield self._f.read(self.block_size)
+            yield self._read_block(i)
 
     def read_block(self, i):
-        self._check_async()
-        assert 0 <= i < self.block_count
-        self._bytes_received += self.block_size
-        self._f.seek(self._header_offset + i * self.block_size)
-        return self._f.read(self.block_size)
+        self._pending.reap()
+        self._sync_file()
+        return self._read_block(i)
 
     def write_blocks(self, indices, blocks, callback=None):
-        self._check_async()
+        self._pending.reap()
         chunks = []
         for i, block in zip(indices, blocks):
             assert 0 <= i < self.block_count
             assert len(block) == self.block_size, \
                 ("%s != %s" % (len(block), self.block_size))
             self._bytes_sent += self.block_size
+            # pending blocks may be handed back to readers
+            if type(block) is not bytes:
+                block = bytes(block)
             chunks.append((i, block))
         self._schedule_async_write(chunks, callback=callback)
 
     def write_block(self, i, block):
+        self.write_blocks((i,), (block,))
+
+    def flush(self):
         self._check_async()
-        assert 0 <= i < self.block_count
-        assert len(block) == self.block_size
-        self._bytes_sent += self.block_size
-        self._schedule_async_write(((i, block),))
+
+    def grow(self, block_count, initialize=None):
+        """
+        Increase the number of blocks to block_count by
+        appending blocks to the end of the storage. The
+        initialize function (if given) is called with the
+        index of each new block. Devices cloned before this
+        call do not see the new blocks.
+        """
+        _check_grow(self.block_count, block_count)
+        if initialize is None:
+            zeros = bytes(bytearray(self.block_size))
+            initialize = lambda i: zeros
+        self._check_async()
+        padding = bytes(bytearray(self._block_stride - self.block_size))
+        with self._io_lock:
+            self._set_io_mode("w")
+            self._f.seek(self._header_offset + \
+                         self.block_count * self._block_stride)
+            run = max(1, BlockStorageFile._max_io_run_bytes // \
+                      self._block_stride)
+            for indices in chunkiter(xrange(self.block_count,
+                                            block_count),
+                                     n=run):
+                blocks = []
+                for i in indices:
+                    block = initialize(i)
+                    assert len(block) == self.block_size, \
+                        ("%s != %s" % (len(block), self.block_size))
+                    blocks.append(block)
+                    blocks.append(padding)
+                self._f.write(b"".join(blocks))
+                self._bytes_sent += self.block_size * len(indices)
+            self._f.seek(_block_count_offset)
+            self._f.write(struct.pack("!L", block_count))
+            self._f.flush()
+        self._block_count = block_count
 
     @property
     def bytes_sent(self):
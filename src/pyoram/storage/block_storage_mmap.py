@@ -1,61 +1,151 @@
 __all__ = ('BlockStorageMMap',)
 
+import struct
 import logging
 import mmap
 
 from pyoram.storage.block_storage import \
-    BlockStorageTypeFactory
+    (BlockStorageTypeFactory,
+     _block_count_offset,
+     _check_grow)
 from pyoram.storage.block_storage_file import \
     BlockStorageFile
 
+from six.moves import xrange
+
 log = logging.getLogger("pyoram")
 
+def _readonly_view(buf):
+    view = memoryview(buf)
+    # memoryview.toreadonly was added in Python 3.8
+    if hasattr(view, 'toreadonly'):
+        view = view.toreadonly()
+    return view
+
+_madvise_options = ('normal', 'random', 'sequential', 'willneed')
+
+def _check_madvise(advice):
+    if (advice is not None) and (advice not in _madvise_options):
+        raise ValueError(
+            "'madvise' must be None or one of %s. Invalid value: %s"
+            % (", ".join(repr(a) for a in _madvise_options), advice))
+
+def _map_file(fileno, populate=False):
+    # MAP_POPULATE (Linux) pre-faults the mapping in a
+    # single call rather than one page fault at a time
+    if populate and hasattr(mmap, 'MAP_POPULATE'):
+        return mmap.mmap(fileno, 0,
+                         flags=mmap.MAP_SHARED | mmap.MAP_POPULATE)
+    return mmap.mmap(fileno, 0)
+
+def _advise_mmap(mm, advice=None, populate=False, huge_pages=False):
+    # these are only hints to the kernel, so they are skipped
+    # on platforms that do not support them
+    names = []
+    if advice is not None:
+        names.append('MADV_' + advice.upper())
+    if populate and (not hasattr(mmap, 'MAP_POPULATE')):
+        names.append('MADV_WILLNEED')
+    if huge_pages:
+        names.append('MADV_HUGEPAGE')
+    if (len(names) == 0) or (not hasattr(mm, 'madvise')):
+        return
+    for name in names:
+        option = getattr(mmap, name, None)
+        if option is None:
+            log.debug("mmap.%s is not available" % (name))
+            continue
+        try:
+            mm.madvise(option)
+        except (OSError, ValueError) as e:
+            log.debug("madvise(%s) failed: %s" % (name, e))
+
 class _BlockStorageMemoryImpl(object):
     """
     This class implementents the BlockStorageInterface read/write
     methods for classes with a private attribute _f that can be
-    accessed using __getslice__/__setslice__ notation.
+    accessed using __getslice__/__setslice__ notation. When the
+    private attribute _view is not None, reads slice it rather than
+    _f (e.g., to return memoryviews instead of copies).
     """
 
+    _view = None
+
+    def _read(self, i):
+        assert 0 <= i < self.block_count
+        self._bytes_received += self.block_size
+        pos_start = self._header_offset + i * self._block_stride
+        pos_stop = pos_start + self.block_size
+        if self._view is not None:
+            return self._view[pos_start:pos_stop]
+        return self._f[pos_start:pos_stop]
+
     def read_blocks(self, indices):
-        blocks = []
-        for i in indices:
-            assert 0 <= i < self.block_count
-            self._bytes_received += self.block_size
-            pos_start = self._header_offset + i * self.block_size
-            pos_stop = pos_start + self.block_size
-            blocks.append(self._f[pos_start:pos_stop])
-        return blocks
+        return [self._read(i) for i in indices]
 
     def yield_blocks(self, indices):
         for i in indices:
-            assert 0 <= i < self.block_count
-            self._bytes_received += self.block_size
-            pos_start = self._header_offset + i * self.block_size
-            pos_stop = pos_start + self.block_size
-            yield self._f[pos_start:pos_stop]
+            yield self._read(i)
 
     def read_block(self, i):
-        assert 0 <= i < self.block_count
-        self._bytes_received += self.block_size
-        pos_start = self._header_offset + i * self.block_size
-        pos_stop = pos_start + self.block_size
-        return self._f[pos_start:pos_stop]
+        return self._read(i)
 
     def write_blocks(self, indices, blocks, callback=None):
         for i, block in zip(indices, blocks):
             assert 0 <= i < self.block_count
             self._bytes_sent += self.block_size
-            pos_start = self._header_offset + i * self.block_size
+            pos_start = self._header_offset + i * self._block_stride
             pos_stop = pos_start + self.block_size
             self._f[pos_start:pos_stop] = block
             if callback is not None:
                 callback(i)
 
+    def flush(self):
+        # writes are applied immediately
+        pass
+
+    def _resize(self, size):
+        raise NotImplementedError(
+            "%s does not support growing the storage space"
+            % (self.__class__.__name__))
+
+    def grow(self, block_count, initialize=None):
+        """
+        Increase the number of blocks to block_count by
+        appending blocks to the end of the storage. The
+        initialize function (if given) is called with the
+        index of each new block. Devices cloned before this
+        call do not see the new blocks.
+        """
+        _check_grow(self.block_count, block_count)
+        if initialize is None:
+            zeros = bytes(bytearray(self.block_size))
+            initialize = lambda i: zeros
+        zero_copy = self._view is not None
+        # the storage can not be resized while our
+        # own view of it is alive
+        self._view = None
+        try:
+            self._resize(self._header_offset + \
+                         block_count * self._block_stride)
+        finally:
+            if zero_copy:
+                self._view = _readonly_view(self._f)
+        for i in xrange(self.block_count, block_count):
+            block = initialize(i)
+            assert len(block) == self.block_size, \
+                ("%s != %s" % (len(block), self.block_size))
+            self._bytes_sent += self.block_size
+            pos_start = self._header_offset + i * self._block_stride
+            self._f[pos_start:pos_start+self.block_size] = block
+        self._f[_block_count_offset:_block_count_offset+4] = \
+            struct.pack("!L", block_count)
+        self._block_count = block_count
+
     def write_block(self, i, block):
         assert 0 <= i < self.block_count
         self._bytes_sent += self.block_size
-        pos_start = self._header_offset + i * self.block_size
+        pos_start = self._header_offset + i * self._block_stride
         pos_stop = pos_start + self.block_size
         self._f[pos_start:pos_stop] = block
 
@@ -68,19 +158,60 @@ class BlockStorageMMap(_BlockStorageMemoryImpl,
     created using this class and then, after saving the raw storage
     data to disk, reopened with any other class compatible with
     BlockStorageFile (and visa versa).
+
+    When initialized with the 'zero_copy' keyword set to True, reads
+    return read-only memoryviews into the memory map rather than
+    copies of the block data. A view always reflects the current
+    contents of the storage, so it must be consumed (or copied using
+    bytes()) before the same block is written by this device or any
+    of its clones. The encryption layer satisfies this rule, as it
+    decrypts each block into a new buffer as soon as it is
+    read. Closing the device while views are still alive leaves the
+    memory map in place until the last of them is released.
+
+    The following keywords pass access hints to the kernel for the
+    memory map. They are ignored on platforms that do not support
+    them and are not inherited by (or applied again for) clones.
+
+      - 'madvise': One of 'normal', 'random', 'sequential', or
+        'willneed'. Use 'random' to disable readahead when blocks
+        are accessed in random order (e.g., the leaf paths of an
+        ORAM heap).
+      - 'populate': Pre-fault the entire mapping when it is
+        created (MAP_POPULATE, or MADV_WILLNEED when that is
+        unavailable) rather than one page fault at a time.
+      - 'huge_pages': Request transparent huge pages
+        (MADV_HUGEPAGE). Most kernels only back file mappings on
+        tmpfs with huge pages.
     """
 
     def __init__(self, *args, **kwds):
+        if kwds.pop('direct_io', False):
+            raise ValueError(
+                "BlockStorageMMap does not support the 'direct_io' "
+                "keyword. Storage set up with 'direct_io=True' can "
+                "be opened without it.")
+        zero_copy = kwds.pop('zero_copy', False)
+        advice = kwds.pop('madvise', None)
+        populate = kwds.pop('populate', False)
+        huge_pages = kwds.pop('huge_pages', False)
+        _check_madvise(advice)
         mm = kwds.pop('mm', None)
         self._mmap_owned = True
         super(BlockStorageMMap, self).__init__(*args, **kwds)
         if mm is None:
             self._f.flush()
-            mm = mmap.mmap(self._f.fileno(), 0)
+            mm = _map_file(self._f.fileno(), populate=populate)
+            _advise_mmap(mm,
+                         advice=advice,
+                         populate=populate,
+                         huge_pages=huge_pages)
         else:
             self._mmap_owned = False
         self._f.close()
         self._f = mm
+        if zero_copy:
+            self._view = _readonly_view(self._f)
 
     #
     # Define BlockStorageInterface Methods
@@ -94,7 +225,8 @@ class BlockStorageMMap(_BlockStorageMemoryImpl,
         f =  BlockStorageMMap(self.storage_name,
                               threadpool_size=0,
                               mm=self._f,
-                              ignore_lock=True)
+                              ignore_lock=True,
+                              zero_copy=(self._view is not None))
         f._pool = self._pool
         f._close_pool = False
         return f
@@ -104,22 +236,46 @@ class BlockStorageMMap(_BlockStorageMemoryImpl,
               storage_name,
               block_size,
               block_count,
+              zero_copy=False,
+              madvise=None,
+              populate=False,
+              huge_pages=False,
               **kwds):
+        _check_madvise(madvise)
         f = BlockStorageFile.setup(storage_name,
                                    block_size,
                                    block_count,
                                    **kwds)
         f.close()
-        return BlockStorageMMap(storage_name)
+        return BlockStorageMMap(storage_name,
+                                zero_copy=zero_copy,
+                                madvise=madvise,
+                                populate=populate,
+                                huge_pages=huge_pages)
 
     #def update_header_data(...)
 
+    def _resize(self, size):
+        if not self._mmap_owned:
+            raise ValueError(
+                "A cloned memory map device can not grow the "
+                "storage space")
+        self._f.resize(size)
+
+    #def grow(...)
+
     def close(self):
         self._prep_for_close()
         if self._f is not None:
+            self._view = None
             if self._mmap_owned:
                 try:
                     self._f.close()
+                except BufferError:
+                    # memoryviews returned by reads are still
+                    # alive, so the memory map is released along
+                    # with the last of them
+                    pass
                 except OSError:                        # pragma: no cover
                     pass                               # pragma: no cover
             self._f = None
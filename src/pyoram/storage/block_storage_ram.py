@@ -12,7 +12,8 @@ from pyoram.storage.block_storage import \
      BlockStorageTypeFactory)
 from pyoram.storage.block_storage_mmap import \
     (BlockStorageMMap,
-     _BlockStorageMemoryImpl)
+     _BlockStorageMemoryImpl,
+     _readonly_view)
 
 import tqdm
 import six
@@ -29,15 +30,35 @@ class BlockStorageRAM(_BlockStorageMemoryImpl,
     this class and then, after saving the raw storage data to disk,
     reopened with any other class compatible with BlockStorageFile
     (and visa versa).
+
+    When initialized with the 'zero_copy' keyword set to True, reads
+    return read-only memoryviews into the bytearray rather than
+    copies of the block data. A view always reflects the current
+    contents of the storage, so it must be consumed (or copied using
+    bytes()) before the same block is written by this device or any
+    of its clones. The encryption layer satisfies this rule, as it
+    decrypts each block into a new buffer as soon as it is read.
+    The bytearray can not grow while any of these views (or an
+    open zero-copy clone) is alive, in which case grow() raises
+    BufferError.
     """
 
     _index_struct_string = BlockStorageMMap._index_struct_string
     _index_offset = struct.calcsize(_index_struct_string)
 
+    @staticmethod
+    def _check_layout(user_header_size):
+        if user_header_size & BlockStorageMMap._aligned_layout_flag:
+            raise ValueError(
+                "BlockStorageRAM does not support the padded block "
+                "layout created with 'direct_io=True'. Open the "
+                "storage with BlockStorageFile or BlockStorageMMap.")
+
     def __init__(self,
                  storage_data,
                  threadpool_size=None,
-                 ignore_lock=False):
+                 ignore_lock=False,
+                 zero_copy=False):
 
         self._bytes_sent = 0
         self._bytes_received = 0
@@ -55,6 +76,7 @@ class BlockStorageRAM(_BlockStorageMemoryImpl,
             struct.unpack(
                 BlockStorageRAM._index_struct_string,
                 self._f[:BlockStorageRAM._index_offset])
+        BlockStorageRAM._check_layout(user_header_size)
 
         if locked and (not self._ignore_lock):
             raise IOError(
@@ -70,6 +92,11 @@ class BlockStorageRAM(_BlockStorageMemoryImpl,
         assert len(self._user_header_data) == user_header_size
         self._header_offset = BlockStorageRAM._index_offset + \
                               len(self._user_header_data)
+        self._block_stride = self._block_size
+        if zero_copy:
+            # the bytearray can not be resized while this
+            # view (or any slice of it) is alive
+            self._view = _readonly_view(self._f)
 
         if not self._ignore_lock:
             # turn on the locked flag
@@ -92,7 +119,8 @@ class BlockStorageRAM(_BlockStorageMemoryImpl,
     @staticmethod
     def fromfile(file_,
                  threadpool_size=None,
-                 ignore_lock=False):
+                 ignore_lock=False,
+                 zero_copy=False):
         """
         Instantiate BlockStorageRAM device from a file saved in block
         storage format. The file_ argument can be a file object or a
@@ -112,6 +140,7 @@ class BlockStorageRAM(_BlockStorageMemoryImpl,
                 struct.unpack(
                     BlockStorageRAM._index_struct_string,
                     header_data)
+            BlockStorageRAM._check_layout(user_header_size)
             if locked and (not ignore_lock):
                 raise IOError(
                     "Can not open block storage device because it is "
@@ -130,7 +159,8 @@ class BlockStorageRAM(_BlockStorageMemoryImpl,
 
         return BlockStorageRAM(f,
                                threadpool_size=threadpool_size,
-                               ignore_lock=ignore_lock)
+                               ignore_lock=ignore_lock,
+                               zero_copy=zero_copy)
 
     def tofile(self, file_):
         """
@@ -163,7 +193,8 @@ class BlockStorageRAM(_BlockStorageMemoryImpl,
     def clone_device(self):
         f = BlockStorageRAM(self._f,
                             threadpool_size=0,
-                            ignore_lock=True)
+                            ignore_lock=True,
+                            zero_copy=(self._view is not None))
         f._pool = self._pool
         f._close_pool = False
         return f
@@ -180,7 +211,8 @@ class BlockStorageRAM(_BlockStorageMemoryImpl,
               initialize=None,
               header_data=None,
               ignore_existing=False,
-              threadpool_size=None):
+              threadpool_size=None,
+              zero_copy=False):
 
         # We ignore the 'storage_name' argument
         # We ignore the 'ignore_existing' flag
@@ -237,7 +269,9 @@ class BlockStorageRAM(_BlockStorageMemoryImpl,
             progress_bar.update(n=block_size)
         progress_bar.close()
 
-        return BlockStorageRAM(f, threadpool_size=threadpool_size)
+        return BlockStorageRAM(f,
+                               threadpool_size=threadpool_size,
+                               zero_copy=zero_copy)
 
     @property
     def header_data(self):
@@ -281,28 +315,52 @@ class BlockStorageRAM(_BlockStorageMemoryImpl,
                             len(self._user_header_data),
                             False)
             self._ignore_lock = True
+        # the bytearray can not be resized by other devices
+        # while this view is alive
+        self._view = None
 
     #
-    # We must cast from bytearray to bytes
-    # when reading from a bytearray so that this
-    # class works with the encryption layer.
+    # We must cast from bytearray to bytes when
+    # reading from a bytearray so that blocks are
+    # not modified by later writes (unless
+    # zero-copy reads were requested).
     #
 
     def read_blocks(self, indices):
-        return [bytes(block) for block
-                in super(BlockStorageRAM, self).read_blocks(indices)]
+        blocks = super(BlockStorageRAM, self).read_blocks(indices)
+        if self._view is not None:
+            return blocks
+        return [bytes(block) for block in blocks]
 
     def yield_blocks(self, indices):
         for block in super(BlockStorageRAM, self).yield_blocks(indices):
-            yield bytes(block)
+            if self._view is None:
+                block = bytes(block)
+            yield block
 
     def read_block(self, i):
-        return bytes(super(BlockStorageRAM, self).read_block(i))
+        block = super(BlockStorageRAM, self).read_block(i)
+        if self._view is None:
+            block = bytes(block)
+        return block
 
     #def write_blocks(...)
 
     #def write_block(...)
 
+    def _resize(self, size):
+        try:
+            self._f.extend(bytearray(size - len(self._f)))
+        except BufferError:
+            raise BufferError(
+                "The storage space can not grow while memoryviews "
+                "returned by zero_copy reads (or open zero_copy "
+                "clones of this device) are still alive. Release "
+                "them (or copy them using bytes()) before calling "
+                "grow().")
+
+    #def grow(...)
+
     @property
     def bytes_sent(self):
         return self._bytes_sent
@@ -1,14 +1,23 @@
 __all__ = ('BlockStorageS3',)
 
 import struct
+import hashlib
 import logging
+import threading
 from multiprocessing.pool import ThreadPool
 
 import pyoram
 from pyoram.storage.block_storage import \
     (BlockStorageInterface,
-     BlockStorageTypeFactory)
+     BlockStorageTypeFactory,
+     _PendingWrites)
 from pyoram.storage.boto3_s3_wrapper import Boto3S3Wrapper
+from pyoram.util.virtual_heap import \
+    (calculate_bucket_level,
+     calculate_necessary_heap_height,
+     calculate_bucket_count_in_heap_with_height,
+     calculate_subtree_root,
+     calculate_bucket_offset_in_subtree)
 
 import tqdm
 import six
@@ -16,15 +25,103 @@ from six.moves import xrange, map
 
 log = logging.getLogger("pyoram")
 
+def _subtree_roots(k, heap_height, subtree_levels):
+    # the root buckets of the subtrees in the packed
+    # layout, which live every subtree_levels levels
+    for l in xrange(0, heap_height+1, subtree_levels):
+        first = calculate_bucket_count_in_heap_with_height(k, l-1) \
+                if l > 0 else 0
+        for b in xrange(first, first + k**l):
+            yield b
+
+def _subtree_levels_at(k, heap_height, subtree_levels, root):
+    # subtrees in the last band of levels may be shorter
+    return min(subtree_levels,
+               heap_height + 1 - calculate_bucket_level(k, root))
+
+def _subtree_buckets(k, root, levels):
+    # the buckets of a subtree in level order
+    for d in xrange(levels):
+        first = root * (k**d) + ((k**d) - 1) // (k - 1)
+        for b in xrange(first, first + k**d):
+            yield b
+
+def _object_key(storage_name, kind, n, key_prefixes):
+    # objects are spread over key_prefixes hashed
+    # prefixes (below the storage name) so that S3
+    # can partition the request load
+    if key_prefixes is None:
+        return "%s/%s%d" % (storage_name, kind, n)
+    digest = hashlib.md5(str(n).encode('ascii')).hexdigest()
+    return "%s/%x/%s%d" % (storage_name,
+                           int(digest[:8], 16) % key_prefixes,
+                           kind,
+                           n)
+
+def _create_s3_wrapper(s3_wrapper,
+                       bucket_name,
+                       aws_access_key_id,
+                       aws_secret_access_key,
+                       region_name,
+                       max_pool_connections):
+    if not isinstance(s3_wrapper, six.class_types):
+        # an existing wrapper that is being shared
+        return s3_wrapper
+    kwds = {}
+    if max_pool_connections is not None:
+        kwds['max_pool_connections'] = max_pool_connections
+    return s3_wrapper(bucket_name,
+                      aws_access_key_id=aws_access_key_id,
+                      aws_secret_access_key=aws_secret_access_key,
+                      region_name=region_name,
+                      **kwds)
+
 class BlockStorageS3(BlockStorageInterface):
     """
     A block storage device for Amazon Simple
     Storage Service (S3).
+
+    When a thread pool is used, up to 'max_pending_writes'
+    batches of block uploads may be in flight at once.
+    Reads of blocks with a pending upload are served from
+    memory, and flush() waits for all pending uploads.
+
+    When the blocks are the buckets of a heap, the device
+    can be set up with the 'subtree_levels' and 'heap_base'
+    keywords to use a packed layout, where each subtree
+    spanning subtree_levels levels of the heap is stored as
+    a single object. Reading a path then costs one ranged
+    GET per subtree rather than one GET per bucket. Writes
+    that cover an entire subtree are a single PUT, and
+    other writes update the object in place (a GET followed
+    by a PUT).
+
+    S3 limits the request rate for each key prefix. Setting
+    up the device with the 'key_prefixes' keyword spreads
+    the objects over that many hashed prefixes (all below
+    the storage name) so that parallel requests are not
+    throttled. The key scheme and the packed layout are
+    recorded in the index object, so they do not need to be
+    given again when the device is opened.
+
+    The 's3_wrapper' keyword can be a wrapper class or an
+    existing wrapper object. Clones share the wrapper (and
+    its connections) of the device they were created from,
+    and the 'max_pool_connections' keyword sets the number
+    of connections each thread may open.
     """
 
     _index_name = "PyORAMBlockStorageS3_index.bin"
     _index_struct_string = "!LLL?"
     _index_offset = struct.calcsize(_index_struct_string)
+    # stored after the user header when the packed layout
+    # or hashed key prefixes are used (0 when not set):
+    # (subtree_levels, heap_base, key_prefixes)
+    _layout_struct_string = "!LLL"
+    _layout_size = struct.calcsize(_layout_struct_string)
+    # the number of locks that serialize in-place updates
+    # of packed objects (shared with clones)
+    _object_lock_count = 64
 
     def __init__(self,
                  storage_name,
@@ -34,6 +131,9 @@ class BlockStorageS3(BlockStorageInterface):
                  region_name=None,
                  ignore_lock=False,
                  threadpool_size=None,
+                 max_pending_writes=4,
+                 key_prefixes=None,
+                 max_pool_connections=None,
                  s3_wrapper=Boto3S3Wrapper):
 
         self._bytes_sent = 0
@@ -47,20 +147,26 @@ class BlockStorageS3(BlockStorageInterface):
         self._close_pool = True
         self._s3 = None
         self._ignore_lock = ignore_lock
-        self._async_write = None
-        self._async_write_callback = None
 
         if bucket_name is None:
             raise ValueError("'bucket_name' keyword is required")
+        if max_pending_writes < 1:
+            raise ValueError(
+                "max_pending_writes must be a positive integer: %s"
+                % (max_pending_writes))
+        self._pending = _PendingWrites(max_pending_writes)
 
         if threadpool_size != 0:
             self._pool = ThreadPool(threadpool_size)
 
-        self._s3 = s3_wrapper(bucket_name,
-                              aws_access_key_id=aws_access_key_id,
-                              aws_secret_access_key=aws_secret_access_key,
-                              region_name=region_name)
-        self._basename = self.storage_name+"/b%d"
+        self._s3 = _create_s3_wrapper(s3_wrapper,
+                                      bucket_name,
+                                      aws_access_key_id,
+                                      aws_secret_access_key,
+                                      region_name,
+                                      max_pool_connections)
+        self._object_locks = [threading.Lock() for _ in
+                              xrange(BlockStorageS3._object_lock_count)]
 
         index_data = self._s3.download(
             self._storage_name+"/"+BlockStorageS3._index_name)
@@ -68,6 +174,25 @@ class BlockStorageS3(BlockStorageInterface):
             struct.unpack(
                 BlockStorageS3._index_struct_string,
                 index_data[:BlockStorageS3._index_offset])
+        self._subtree_levels = None
+        self._heap_base = None
+        self._heap_height = None
+        self._key_prefixes = None
+        layout_offset = BlockStorageS3._index_offset + user_header_size
+        if len(index_data) == layout_offset + BlockStorageS3._layout_size:
+            self._subtree_levels, self._heap_base, self._key_prefixes = \
+                [(x if x else None) for x in struct.unpack(
+                    BlockStorageS3._layout_struct_string,
+                    index_data[layout_offset:])]
+            if self._subtree_levels is not None:
+                self._heap_height = calculate_necessary_heap_height(
+                    self._heap_base, self._block_count)
+        if (key_prefixes is not None) and \
+           (key_prefixes != self._key_prefixes):
+            raise ValueError(
+                "Storage was setup with %s key prefixes, which "
+                "does not match the value of the key_prefixes "
+                "keyword: %s" % (self._key_prefixes, key_prefixes))
         if locked and (not self._ignore_lock):
             raise IOError(
                 "Can not open block storage device because it is "
@@ -83,36 +208,167 @@ class BlockStorageS3(BlockStorageInterface):
         if not self._ignore_lock:
             # turn on the locked flag
             self._s3.upload((self._storage_name+"/"+BlockStorageS3._index_name,
-                             struct.pack(BlockStorageS3._index_struct_string,
-                                         self.block_size,
-                                         self.block_count,
-                                         len(self.header_data),
-                                         True) + \
-                             self.header_data))
+                             self._pack_index(self.block_size,
+                                              self.block_count,
+                                              self.header_data,
+                                              True,
+                                              self._layout())))
+
+    def _layout(self):
+        return (self._subtree_levels, self._heap_base, self._key_prefixes)
+
+    @staticmethod
+    def _pack_index(block_size,
+                    block_count,
+                    header_data,
+                    locked,
+                    layout):
+        index_data = struct.pack(BlockStorageS3._index_struct_string,
+                                 block_size,
+                                 block_count,
+                                 len(header_data),
+                                 locked) + \
+                     header_data
+        if any(x is not None for x in layout):
+            index_data += struct.pack(BlockStorageS3._layout_struct_string,
+                                      *[(x if (x is not None) else 0)
+                                        for x in layout])
+        return index_data
+
+    def _block_key(self, i):
+        return _object_key(self.storage_name, "b", i, self._key_prefixes)
+
+    def _subtree_key(self, root):
+        return _object_key(self.storage_name, "s", root, self._key_prefixes)
 
     def _check_async(self):
-        if self._async_write is not None:
-            for i in self._async_write:
-                if self._async_write_callback is not None:
-                    self._async_write_callback(i)
-            self._async_write = None
-            self._async_write_callback = None
-
-    def _schedule_async_write(self, arglist, callback=None):
-        assert self._async_write is None
+        self._pending.drain()
+
+    def _locate(self, i):
+        # the packed object holding a block and the
+        # position of the block inside of that object
+        root, depth = calculate_subtree_root(self._heap_base,
+                                             i,
+                                             self._subtree_levels)
+        return root, calculate_bucket_offset_in_subtree(self._heap_base,
+                                                        root,
+                                                        i,
+                                                        depth)
+
+    def _subtree_bucket_count(self, root):
+        levels = _subtree_levels_at(self._heap_base,
+                                    self._heap_height,
+                                    self._subtree_levels,
+                                    root)
+        return calculate_bucket_count_in_heap_with_height(self._heap_base,
+                                                          levels-1)
+
+    # This method is usually executed in another thread, so
+    # do not attempt to handle exceptions because it will
+    # not work.
+    def _upload(self, args):
+        i, block, callback = args
+        self._s3.upload((self._block_key(i), block))
+        if callback is not None:
+            callback(i)
+
+    # This method is usually executed in another thread, so
+    # do not attempt to handle exceptions because it will
+    # not work.
+    def _upload_subtree(self, args):
+        root, updates, callback = args
+        key = self._subtree_key(root)
+        lock = self._object_locks[root % len(self._object_locks)]
+        with lock:
+            if len(updates) == self._subtree_bucket_count(root):
+                self._s3.upload(
+                    (key, b"".join(block for _, _, block in sorted(updates))))
+            else:
+                data = bytearray(self._s3.download(key))
+                for offset, _, block in updates:
+                    data[offset*self.block_size:
+                         (offset+1)*self.block_size] = block
+                self._s3.upload((key, bytes(data)))
+        if callback is not None:
+            for _, i, _ in updates:
+                callback(i)
+
+    def _schedule_async_write(self, indices, blocks, callback=None):
+        if len(set(indices)) != len(indices):
+            # uploads within a batch are not ordered, so
+            # only keep the last write to each block
+            latest = dict(zip(indices, blocks))
+            indices = sorted(latest)
+            blocks = [latest[i] for i in indices]
+        if self._subtree_levels is None:
+            func = self._upload
+            arglist = [(i, block, callback)
+                       for i, block in zip(indices, blocks)]
+        else:
+            func = self._upload_subtree
+            updates = {}
+            for i, block in zip(indices, blocks):
+                root, offset = self._locate(i)
+                updates.setdefault(root, []).append((offset, i, block))
+            arglist = [(root, updates[root], callback)
+                       for root in sorted(updates)]
         if self._pool is not None:
-            self._async_write = \
-                self._pool.imap_unordered(self._s3.upload, arglist)
-            self._async_write_callback = callback
+            self._pending.reserve(indices)
+            self._pending.push(
+                self._pool.map_async(func, arglist),
+                indices,
+                blocks)
         else:
-            # Note: we are using six.map which always
-            #       behaves like imap
-            for i in map(self._s3.upload, arglist):
-                if callback is not None:
-                    callback(i)
+            for args in arglist:
+                func(args)
 
     def _download(self, i):
-        return self._s3.download(self._basename % i)
+        if self._subtree_levels is None:
+            return self._s3.download(self._block_key(i))
+        root, offset = self._locate(i)
+        return self._s3.download_range(self._subtree_key(root),
+                                       offset*self.block_size,
+                                       (offset+1)*self.block_size)
+
+    def _download_subtree_range(self, args):
+        root, first, last = args
+        return self._s3.download_range(self._subtree_key(root),
+                                       first*self.block_size,
+                                       (last+1)*self.block_size)
+
+    def _read_packed(self, indices, map_):
+        # S3 does not support multiple byte ranges in a
+        # single GET, so one range covering all of the
+        # requested buckets is fetched from each object
+        located = [self._locate(i) for i in indices]
+        ranges = {}
+        for root, offset in located:
+            if root in ranges:
+                first, last = ranges[root]
+                ranges[root] = (min(first, offset), max(last, offset))
+            else:
+                ranges[root] = (offset, offset)
+        roots = sorted(ranges)
+        data = dict(zip(roots,
+                        map_(self._download_subtree_range,
+                             [(root,) + ranges[root] for root in roots])))
+        for root, offset in located:
+            start = (offset - ranges[root][0]) * self.block_size
+            yield data[root][start:start+self.block_size]
+
+    def _read(self, indices, map_):
+        read_ = self._read_packed
+        if self._subtree_levels is None:
+            read_ = lambda indices_, map_: map_(self._download, indices_)
+        # blocks with a pending upload are served from memory
+        pending = dict((i, self._pending.get(i))
+                       for i in indices
+                       if i in self._pending)
+        if len(pending) == 0:
+            return read_(indices, map_)
+        blocks = read_([i for i in indices if i not in pending], map_)
+        return (pending[i] if (i in pending) else six.next(blocks)
+                for i in indices)
 
     #
     # Define BlockStorageInterface Methods
@@ -125,10 +381,12 @@ class BlockStorageS3(BlockStorageInterface):
                             aws_secret_access_key=self._aws_secret_access_key,
                             region_name=self._region_name,
                             threadpool_size=0,
-                            s3_wrapper=type(self._s3),
+                            max_pending_writes=self._pending._max_batches,
+                            s3_wrapper=self._s3,
                             ignore_lock=True)
         f._pool = self._pool
         f._close_pool = False
+        f._object_locks = self._object_locks
         return f
 
     @classmethod
@@ -136,7 +394,10 @@ class BlockStorageS3(BlockStorageInterface):
                              block_size,
                              block_count,
                              header_data=None,
-                             ignore_header=False):
+                             ignore_header=False,
+                             subtree_levels=None,
+                             heap_base=None,
+                             key_prefixes=None):
         assert (block_size > 0) and (block_size == int(block_size))
         assert (block_count > 0) and (block_count == int(block_count))
         if header_data is None:
@@ -144,8 +405,13 @@ class BlockStorageS3(BlockStorageInterface):
         if ignore_header:
             return block_size * block_count
         else:
+            layout_size = 0
+            if (subtree_levels is not None) or \
+               (key_prefixes is not None):
+                layout_size = BlockStorageS3._layout_size
             return BlockStorageS3._index_offset + \
                     len(header_data) + \
+                    layout_size + \
                     block_size * block_count
 
     @classmethod
@@ -161,6 +427,11 @@ class BlockStorageS3(BlockStorageInterface):
               initialize=None,
               threadpool_size=None,
               ignore_existing=False,
+              max_pending_writes=4,
+              subtree_levels=None,
+              heap_base=None,
+              key_prefixes=None,
+              max_pool_connections=None,
               s3_wrapper=Boto3S3Wrapper):
 
         if bucket_name is None:
@@ -178,15 +449,45 @@ class BlockStorageS3(BlockStorageInterface):
             raise TypeError(
                 "'header_data' must be of type bytes. "
                 "Invalid type: %s" % (type(header_data)))
+        heap_height = None
+        if subtree_levels is not None:
+            if (subtree_levels < 1) or \
+               (subtree_levels != int(subtree_levels)):
+                raise ValueError(
+                    "subtree_levels must be a positive integer: %s"
+                    % (subtree_levels))
+            if (heap_base is None) or (heap_base < 2):
+                raise ValueError(
+                    "heap base must be 2 or greater when using "
+                    "subtree_levels. Invalid value: %s" % (heap_base))
+            heap_height = calculate_necessary_heap_height(heap_base,
+                                                          block_count)
+            if block_count != \
+               calculate_bucket_count_in_heap_with_height(heap_base,
+                                                          heap_height):
+                raise ValueError(
+                    "Block count must be the number of buckets in a "
+                    "complete heap with base %s when using "
+                    "subtree_levels: %s" % (heap_base, block_count))
+        elif heap_base is not None:
+            raise ValueError(
+                "'heap_base' keyword is only used with 'subtree_levels'")
+        if (key_prefixes is not None) and \
+           ((key_prefixes < 1) or (key_prefixes != int(key_prefixes))):
+            raise ValueError(
+                "key_prefixes must be a positive integer: %s"
+                % (key_prefixes))
 
         pool = None
         if threadpool_size != 0:
             pool = ThreadPool(threadpool_size)
 
-        s3 = s3_wrapper(bucket_name,
-                        aws_access_key_id=aws_access_key_id,
-                        aws_secret_access_key=aws_secret_access_key,
-                        region_name=region_name)
+        s3 = _create_s3_wrapper(s3_wrapper,
+                                bucket_name,
+                                aws_access_key_id,
+                                aws_secret_access_key,
+                                region_name,
+                                max_pool_connections)
         exists = s3.exists(storage_name)
         if (not ignore_existing) and exists:
             raise IOError(
@@ -200,36 +501,53 @@ class BlockStorageS3(BlockStorageInterface):
             s3.clear(storage_name, threadpool=pool)
 
         if header_data is None:
-            s3.upload((storage_name+"/"+BlockStorageS3._index_name,
-                       struct.pack(BlockStorageS3._index_struct_string,
-                                  block_size,
-                                  block_count,
-                                  0,
-                                  False)))
-        else:
-            s3.upload((storage_name+"/"+BlockStorageS3._index_name,
-                       struct.pack(BlockStorageS3._index_struct_string,
-                                   block_size,
-                                   block_count,
-                                   len(header_data),
-                                   False) + \
-                       header_data))
+            header_data = bytes()
+        s3.upload((storage_name+"/"+BlockStorageS3._index_name,
+                   BlockStorageS3._pack_index(block_size,
+                                              block_count,
+                                              header_data,
+                                              False,
+                                              (subtree_levels,
+                                               heap_base,
+                                               key_prefixes))))
 
         if initialize is None:
             zeros = bytes(bytearray(block_size))
             initialize = lambda i: zeros
-        basename = storage_name+"/b%d"
         # NOTE: We will not be informed when a thread
         #       encounters an exception (e.g., when
         #       calling initialize(i). We must ensure
         #       that all iterations were processed
         #       by counting the results.
-        def init_blocks():
-            for i in xrange(block_count):
-                yield (basename % i, initialize(i))
+        if subtree_levels is None:
+            object_count = block_count
+            def init_blocks():
+                for i in xrange(block_count):
+                    yield (_object_key(storage_name, "b", i, key_prefixes),
+                           initialize(i))
+        else:
+            roots = list(_subtree_roots(heap_base,
+                                        heap_height,
+                                        subtree_levels))
+            object_count = len(roots)
+            def init_blocks():
+                for root in roots:
+                    levels = _subtree_levels_at(heap_base,
+                                                heap_height,
+                                                subtree_levels,
+                                                root)
+                    yield (_object_key(storage_name,
+                                       "s",
+                                       root,
+                                       key_prefixes),
+                           b"".join(initialize(i) for i in
+                                    _subtree_buckets(heap_base,
+                                                     root,
+                                                     levels)))
         def _do_upload(arg):
             try:
                 s3.upload(arg)
+                return len(arg[1])
             except Exception as e:                     # pragma: no cover
                 log.error(                             # pragma: no cover
                     "An exception occured during S3 "  # pragma: no cover
@@ -245,10 +563,10 @@ class BlockStorageS3(BlockStorageInterface):
                                  disable=not pyoram.config.SHOW_PROGRESS_BAR)
         if pool is not None:
             try:
-                for i,_ in enumerate(
+                for i, nbytes in enumerate(
                         pool.imap_unordered(_do_upload, init_blocks())):
                     total = i
-                    progress_bar.update(n=block_size)
+                    progress_bar.update(n=nbytes)
             except Exception as e:                     # pragma: no cover
                 s3.clear(storage_name)                 # pragma: no cover
                 raise                                  # pragma: no cover
@@ -258,17 +576,17 @@ class BlockStorageS3(BlockStorageInterface):
                 pool.join()
         else:
             try:
-                for i,_ in enumerate(
-                        map(s3.upload, init_blocks())):
+                for i, nbytes in enumerate(
+                        map(_do_upload, init_blocks())):
                     total = i
-                    progress_bar.update(n=block_size)
+                    progress_bar.update(n=nbytes)
             except Exception as e:                     # pragma: no cover
                 s3.clear(storage_name)                 # pragma: no cover
                 raise                                  # pragma: no cover
             finally:
                 progress_bar.close()
 
-        if total != block_count - 1:
+        if total != object_count - 1:
             s3.clear(storage_name)                     # pragma: no cover
             if pool is not None:                       # pragma: no cover
                 pool.close()                           # pragma: no cover
@@ -284,7 +602,8 @@ class BlockStorageS3(BlockStorageInterface):
                               aws_secret_access_key=aws_secret_access_key,
                               region_name=region_name,
                               threadpool_size=threadpool_size,
-                              s3_wrapper=s3_wrapper)
+                              max_pending_writes=max_pending_writes,
+                              s3_wrapper=s3)
 
     @property
     def header_data(self):
@@ -315,7 +634,9 @@ class BlockStorageS3(BlockStorageInterface):
         index_data = bytearray(self._s3.download(
             self._storage_name+"/"+BlockStorageS3._index_name))
         lenbefore = len(index_data)
-        index_data[BlockStorageS3._index_offset:] = new_header_data
+        index_data[BlockStorageS3._index_offset:
+                   (BlockStorageS3._index_offset+len(new_header_data))] = \
+            new_header_data
         assert lenbefore == len(index_data)
         self._s3.upload((self._storage_name+"/"+BlockStorageS3._index_name,
                          bytes(index_data)))
@@ -327,63 +648,74 @@ class BlockStorageS3(BlockStorageInterface):
                 # turn off the locked flag
                 self._s3.upload(
                     (self._storage_name+"/"+BlockStorageS3._index_name,
-                     struct.pack(BlockStorageS3._index_struct_string,
-                                 self.block_size,
-                                 self.block_count,
-                                 len(self.header_data),
-                                 False) + \
-                     self.header_data))
+                     self._pack_index(self.block_size,
+                                      self.block_count,
+                                      self.header_data,
+                                      False,
+                                      self._layout())))
         if self._close_pool and (self._pool is not None):
             self._pool.close()
             self._pool.join()
             self._pool = None
 
     def read_blocks(self, indices):
-        self._check_async()
+        self._pending.reap()
         # be sure not to exhaust this if it is an iterator
         # or generator
         indices = list(indices)
         assert all(0 <= i <= self.block_count for i in indices)
         self._bytes_received += self.block_size * len(indices)
         if self._pool is not None:
-            return self._pool.map(self._download, indices)
+            return list(self._read(indices, self._pool.imap))
         else:
-            return list(map(self._download, indices))
+            return list(self._read(indices, map))
 
     def yield_blocks(self, indices):
-        self._check_async()
+        self._pending.reap()
         # be sure not to exhaust this if it is an iterator
         # or generator
         indices = list(indices)
         assert all(0 <= i <= self.block_count for i in indices)
         self._bytes_received += self.block_size * len(indices)
         if self._pool is not None:
-            return self._pool.imap(self._download, indices)
+            return self._read(indices, self._pool.imap)
         else:
-            return map(self._download, indices)
+            return self._read(indices, map)
 
     def read_block(self, i):
-        self._check_async()
+        self._pending.reap()
         assert 0 <= i < self.block_count
         self._bytes_received += self.block_size
+        if i in self._pending:
+            return self._pending.get(i)
         return self._download(i)
 
     def write_blocks(self, indices, blocks, callback=None):
-        self._check_async()
+        self._pending.reap()
         # be sure not to exhaust this if it is an iterator
         # or generator
         indices = list(indices)
         assert all(0 <= i <= self.block_count for i in indices)
         self._bytes_sent += self.block_size * len(indices)
-        indices = (self._basename % i for i in indices)
-        self._schedule_async_write(zip(indices, blocks),
+        # pending blocks may be handed back to readers
+        blocks = [block if (type(block) is bytes) else bytes(block)
+                  for block in blocks]
+        self._schedule_async_write(indices,
+                                   blocks,
                                    callback=callback)
 
     def write_block(self, i, block):
-        self._check_async()
         assert 0 <= i < self.block_count
-        self._bytes_sent += self.block_size
-        self._schedule_async_write((((self._basename % i), block),))
+        self.write_blocks((i,), (block,))
+
+    def flush(self):
+        self._check_async()
+
+    @property
+    def connection_stats(self):
+        """Request and client reuse statistics for the S3
+        wrapper shared by this device and its clones."""
+        return self._s3.stats
 
     @property
     def bytes_sent(self):
@@ -1,6 +1,10 @@
-__all__ = ('BlockStorageSFTP',)
+__all__ = ('BlockStorageSFTP',
+           'SSHClientPool')
 
 import logging
+import threading
+
+from six.moves import xrange
 
 from pyoram.util.misc import chunkiter
 from pyoram.storage.block_storage import \
@@ -10,10 +14,86 @@ from pyoram.storage.block_storage_file import \
 
 log = logging.getLogger("pyoram")
 
+class SSHClientPool(object):
+    """
+    A pool of SSH connections (e.g., paramiko.SSHClient
+    objects) that can be used in place of a single SSH
+    client when creating an SFTP block storage device. Each
+    new SFTP session is opened on the next connection in
+    round-robin order, so a device and its clones spread
+    their I/O (and the SSH encryption work) over several
+    connections.
+
+    The pool does not take ownership of the connections
+    unless it was created using the connect() method.
+    """
+
+    def __init__(self, sshclients):
+        self._sshclients = list(sshclients)
+        if len(self._sshclients) == 0:
+            raise ValueError(
+                "An SSH client pool requires at least one client")
+        self._lock = threading.Lock()
+        self._next = 0
+        self._session_counts = [0] * len(self._sshclients)
+        self._owned = False
+
+    @classmethod
+    def connect(cls, connect, size):
+        """Create a pool of the given size by calling
+        connect() (which should return a connected SSH
+        client) once for each connection. The connections
+        are closed when the pool is closed."""
+        if size < 1:
+            raise ValueError(
+                "An SSH client pool requires at least one client")
+        pool = cls([connect() for _ in xrange(size)])
+        pool._owned = True
+        return pool
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self._sshclients)
+
+    @property
+    def session_counts(self):
+        """The number of SFTP sessions opened on each
+        connection."""
+        with self._lock:
+            return list(self._session_counts)
+
+    def open_sftp(self):
+        with self._lock:
+            index = self._next
+            self._next = (self._next + 1) % len(self._sshclients)
+            self._session_counts[index] += 1
+        return self._sshclients[index].open_sftp()
+
+    def close(self):
+        if self._owned:
+            for sshclient in self._sshclients:
+                sshclient.close()
+
 class BlockStorageSFTP(BlockStorageFile):
     """
     A block storage device for accessing file data through
     an SSH portal using Secure File Transfer Protocol (SFTP).
+
+    Block reads are submitted together using a single readv
+    request (adjacent blocks are merged into one read), so
+    reading a path costs a single round trip. The
+    yield_blocks method keeps the requests for the next
+    chunk of blocks in flight while the current chunk is
+    consumed.
+
+    The 'sshclient' keyword can be an SSHClientPool, in
+    which case the device and each of its clones open their
+    SFTP session on the next connection in the pool.
     """
 
     def __init__(self,
@@ -39,7 +119,8 @@ class BlockStorageSFTP(BlockStorageFile):
         f = BlockStorageSFTP(self.storage_name,
                              sshclient=self._sshclient,
                              threadpool_size=0,
-                             ignore_lock=True)
+                             ignore_lock=True,
+                             max_pending_writes=self._pending._max_batches)
         f._pool = self._pool
         f._close_pool = False
         return f
@@ -54,6 +135,7 @@ class BlockStorageSFTP(BlockStorageFile):
               block_count,
               sshclient=None,
               threadpool_size=None,
+              max_pending_writes=4,
               **kwds):
         if sshclient is None:
             raise ValueError(
@@ -65,13 +147,15 @@ class BlockStorageSFTP(BlockStorageFile):
                                     block_count,
                                     _filesystem=sshclient.open_sftp(),
                                     threadpool_size=threadpool_size,
+                                    max_pending_writes=max_pending_writes,
                                     **kwds) as f:
             pass
         f._filesystem.close()
 
         return BlockStorageSFTP(storage_name,
                                 sshclient=sshclient,
-                                threadpool_size=threadpool_size)
+                                threadpool_size=threadpool_size,
+                                max_pending_writes=max_pending_writes)
 
     #@property
     #def header_data(...)
@@ -91,24 +175,83 @@ class BlockStorageSFTP(BlockStorageFile):
         super(BlockStorageSFTP, self).close()
         self._filesystem.close()
 
+    def _coalesce_reads(self, indices):
+        """
+        Group the distinct indices into runs of adjacent
+        blocks (of at most _max_io_run_bytes bytes).
+        Returns a list of [first_index, count] pairs sorted
+        by offset.
+        """
+        max_run = max(1, self._max_io_run_bytes // self._block_stride)
+        runs = []
+        for i in sorted(set(indices)):
+            if (len(runs) == 0) or \
+               (runs[-1][0] + runs[-1][1] != i) or \
+               (runs[-1][1] >= max_run):
+                runs.append([i, 0])
+            runs[-1][1] += 1
+        return runs
+
+    def _readv(self, args):
+        with self._io_lock:
+            self._set_io_mode("r")
+            return list(self._f.readv(args))
+
+    def _start_readv(self, indices):
+        # Serve blocks with a pending write from memory and
+        # submit a single readv request for the rest (on the
+        # thread pool, when there is one, so that the caller
+        # does not wait on the reply). Returns a function
+        # that collects the blocks in order.
+        self._bytes_received += self.block_size * len(indices)
+        pending = dict((i, self._pending.get(i))
+                       for i in indices
+                       if i in self._pending)
+        runs = self._coalesce_reads([i for i in indices
+                                     if i not in pending])
+        args = [(self._header_offset + i * self._block_stride,
+                 (count - 1) * self._block_stride + self.block_size)
+                for i, count in runs]
+        result = None
+        if len(runs) and (self._pool is not None):
+            result = self._pool.apply_async(self._readv, (args,))
+        def _finish():
+            data = []
+            if result is not None:
+                data = result.get()
+            elif len(runs):
+                data = self._readv(args)
+            blocks = {}
+            for (first, count), run in zip(runs, data):
+                for j in xrange(count):
+                    start = j * self._block_stride
+                    blocks[first + j] = run[start:start+self.block_size]
+            return [pending[i] if (i in pending) else blocks[i]
+                    for i in indices]
+        return _finish
+
     def read_blocks(self, indices):
-        self._check_async()
-        args = []
-        for i in indices:
-            assert 0 <= i < self.block_count
-            self._bytes_received += self.block_size
-            args.append((self._header_offset + i * self.block_size,
-                         self.block_size))
-        return self._f.readv(args)
+        self._pending.reap()
+        self._sync_file()
+        indices = list(indices)
+        assert all(0 <= i < self.block_count for i in indices)
+        return self._start_readv(indices)()
 
     def yield_blocks(self, indices, chunksize=100):
+        self._pending.reap()
+        self._sync_file()
+        finish = None
         for chunk in chunkiter(indices, n=chunksize):
-            assert all(0 <= i <= self.block_count for i in chunk)
-            self._bytes_received += self.block_size * len(chunk)
-            args = [(self._header_offset + i * self.block_size,
-                     self.block_size)
-                    for i in chunk]
-            for block in self._f.readv(args):
+            assert all(0 <= i < self.block_count for i in chunk)
+            # prefetch this chunk before handing out the
+            # blocks of the previous one
+            next_finish = self._start_readv(chunk)
+            if finish is not None:
+                for block in finish():
+                    yield block
+            finish = next_finish
+        if finish is not None:
+            for block in finish():
                 yield block
 
     #def read_block(...)
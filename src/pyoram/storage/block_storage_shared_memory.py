@@ -0,0 +1,398 @@
+__all__ = ('BlockStorageSharedMemory',)
+
+import os
+import sys
+import struct
+import hashlib
+import logging
+from multiprocessing.pool import ThreadPool
+
+import pyoram
+from pyoram.storage.block_storage import \
+    (BlockStorageInterface,
+     BlockStorageTypeFactory)
+from pyoram.storage.block_storage_mmap import \
+    (BlockStorageMMap,
+     _BlockStorageMemoryImpl,
+     _readonly_view)
+
+import tqdm
+from six.moves import xrange
+
+try:
+    from multiprocessing import shared_memory
+    from multiprocessing import resource_tracker
+    shared_memory_available = True
+except ImportError:                                    # pragma: no cover
+    shared_memory_available = False                    # pragma: no cover
+
+# The resource tracker unlinks the shared memory segments a
+# process has created or attached to when the process exits,
+# which would remove a segment that other processes still
+# use. The segments are only removed by unlink, so they are
+# not tracked (using the 'track' keyword added in Python 3.13,
+# or by unregistering them on earlier versions of POSIX
+# systems, which are the only ones that track them).
+_track_keyword = sys.version_info >= (3, 13)
+_untrack = (not _track_keyword) and (os.name == "posix")
+
+log = logging.getLogger("pyoram")
+
+def _check_available():
+    if not shared_memory_available:
+        raise ImportError(                             # pragma: no cover
+            "multiprocessing.shared_memory is required "  # pragma: no cover
+            "to use BlockStorageSharedMemory")         # pragma: no cover
+
+def _segment_name(storage_name):
+    # shared memory segment names can not contain slashes,
+    # so storage names that do (e.g., file paths) are
+    # mapped to a segment name using a hash
+    if (storage_name is None) or ("/" not in storage_name.lstrip("/")):
+        return storage_name
+    return "pyoram_" + \
+        hashlib.sha1(storage_name.encode('utf-8')).hexdigest()[:20]
+
+def _tracker_name(shm):
+    return "/" + shm.name
+
+def _attach(storage_name, **kwds):
+    if _track_keyword:
+        kwds['track'] = False                          # pragma: no cover
+    shm = shared_memory.SharedMemory(name=_segment_name(storage_name),
+                                     **kwds)
+    if _untrack:
+        resource_tracker.unregister(_tracker_name(shm), "shared_memory")
+    return shm
+
+def _unlink(shm):
+    if _untrack:
+        # SharedMemory.unlink unregisters the segment
+        resource_tracker.register(_tracker_name(shm), "shared_memory")
+    shm.unlink()
+
+class BlockStorageSharedMemory(_BlockStorageMemoryImpl,
+                               BlockStorageInterface):
+    """
+    A class implementing the block storage interface where all data is
+    kept in a named shared memory segment, which other processes can
+    attach to (without copying) by opening the device with the same
+    storage name. This class uses the same storage format as
+    BlockStorageFile and BlockStorageRAM.
+
+    Reads return read-only memoryviews into the shared memory rather
+    than copies, so the contents of a block returned by a read change if
+    the block is later written. The device keeps track of these
+    memoryviews and releases them when it is closed, so they can not
+    be used afterwards (copy them with bytes() to keep the data).
+    Views derived from them (e.g., slices) must be released by the
+    caller before closing the device, as the segment can not be
+    unmapped from this process while they exist.
+
+    The segment persists after the device is closed, until the
+    unlink() method is called by any process using it. Storage names
+    that contain a slash (e.g., file paths) are mapped to a segment
+    name derived from a hash of the storage name.
+    """
+
+    _index_struct_string = BlockStorageMMap._index_struct_string
+    _index_offset = struct.calcsize(_index_struct_string)
+    # the number of tracked read views at which those that
+    # are no longer referenced elsewhere are dropped
+    _min_prune_size = 1024
+
+    def __init__(self,
+                 storage_name,
+                 threadpool_size=None,
+                 ignore_lock=False):
+        _check_available()
+
+        self._bytes_sent = 0
+        self._bytes_received = 0
+        self._ignore_lock = ignore_lock
+        self._shm = None
+        self._f = None
+        self._read_views = []
+        self._prune_size = self._min_prune_size
+        self._pool = None
+        self._close_pool = True
+        try:
+            self._shm = _attach(storage_name)
+        except (OSError, ValueError):
+            raise IOError(
+                "Shared memory segment does not exist: %s"
+                % (storage_name))
+        self._storage_name = storage_name
+        self._f = self._shm.buf
+        self._view = _readonly_view(self._f)
+        self._block_size, self._block_count, user_header_size, locked = \
+            struct.unpack(
+                BlockStorageSharedMemory._index_struct_string,
+                bytes(self._f[:BlockStorageSharedMemory._index_offset]))
+
+        if locked and (not self._ignore_lock):
+            self._release()
+            raise IOError(
+                "Can not open block storage device because it is "
+                "locked by another process. To ignore this check, "
+                "initialize this class with the keyword 'ignore_lock' "
+                "set to True.")
+        self._user_header_data = bytes()
+        if user_header_size > 0:
+            self._user_header_data = \
+                bytes(self._f[BlockStorageSharedMemory._index_offset:\
+                              (BlockStorageSharedMemory._index_offset + \
+                               user_header_size)])
+        assert len(self._user_header_data) == user_header_size
+        self._header_offset = BlockStorageSharedMemory._index_offset + \
+                              len(self._user_header_data)
+        self._block_stride = self._block_size
+
+        if not self._ignore_lock:
+            # turn on the locked flag
+            self._f[:BlockStorageSharedMemory._index_offset] = \
+                struct.pack(BlockStorageSharedMemory._index_struct_string,
+                            self.block_size,
+                            self.block_count,
+                            len(self._user_header_data),
+                            True)
+
+        # Although we do not use the threadpool we still
+        # create just in case we are the first
+        if threadpool_size != 0:
+            self._pool = ThreadPool(threadpool_size)
+
+    def _release(self):
+        # unmap the segment from this process
+        if self._shm is not None:
+            self._f = None
+            for view in self._read_views:
+                view.release()
+            self._read_views = []
+            if self._view is not None:
+                self._view.release()
+                self._view = None
+            try:
+                self._shm.close()
+            except BufferError:
+                raise BufferError(
+                    "The shared memory segment %s can not be unmapped "
+                    "from this process because views derived from "
+                    "the memoryviews returned by reads still exist. "
+                    "Release them and call close() again."
+                    % (self._storage_name))
+            self._shm = None
+
+    def _read(self, i):
+        view = super(BlockStorageSharedMemory, self)._read(i)
+        self._read_views.append(view)
+        if len(self._read_views) >= self._prune_size:
+            self._prune_read_views()
+        return view
+
+    def _prune_read_views(self):
+        if hasattr(sys, 'getrefcount'):
+            # a view that is only referenced by the list, the
+            # loop variable, and the getrefcount argument is
+            # not used by the caller
+            self._read_views = [view for view in self._read_views
+                                if sys.getrefcount(view) > 3]
+        self._prune_size = max(self._min_prune_size,
+                               2 * len(self._read_views))
+
+    #
+    # Add some methods specific to BlockStorageSharedMemory
+    #
+
+    @classmethod
+    def unlink(cls, storage_name):
+        """
+        Remove a shared memory segment. Processes that are
+        attached to it keep their mapping.
+        """
+        _check_available()
+        shm = _attach(storage_name)
+        try:
+            _unlink(shm)
+        finally:
+            shm.close()
+
+    def tofile(self, file_):
+        """
+        Dump all storage data to a file. The file_ argument can be a
+        file object or a string that represents a filename. If called
+        with a file object, it should be opened in binary mode, and
+        the caller is responsible for closing the file.
+        """
+        close_file = False
+        if not hasattr(file_, 'write'):
+            file_ = open(file_, 'wb')
+            close_file = True
+        file_.write(self._f[:self._header_offset + \
+                            self.block_size * self.block_count])
+        if close_file:
+            file_.close()
+
+    @property
+    def data(self):
+        """Access the raw shared memory as a memoryview"""
+        return self._f
+
+    #
+    # Define BlockStorageInterface Methods
+    #
+
+    def clone_device(self):
+        f = BlockStorageSharedMemory(self.storage_name,
+                                     threadpool_size=0,
+                                     ignore_lock=True)
+        f._pool = self._pool
+        f._close_pool = False
+        return f
+
+    @classmethod
+    def compute_storage_size(cls, *args, **kwds):
+        return BlockStorageMMap.compute_storage_size(*args, **kwds)
+
+    @classmethod
+    def setup(cls,
+              storage_name,
+              block_size,
+              block_count,
+              initialize=None,
+              header_data=None,
+              ignore_existing=False,
+              threadpool_size=None):
+        _check_available()
+        if (block_size <= 0) or (block_size != int(block_size)):
+            raise ValueError(
+                "Block size (bytes) must be a positive integer: %s"
+                % (block_size))
+        if (block_count <= 0) or (block_count != int(block_count)):
+            raise ValueError(
+                "Block count must be a positive integer: %s"
+                % (block_count))
+        if (header_data is not None) and \
+           (type(header_data) is not bytes):
+            raise TypeError(
+                "'header_data' must be of type bytes. "
+                "Invalid type: %s" % (type(header_data)))
+
+        if initialize is None:
+            zeros = bytes(bytearray(block_size))
+            initialize = lambda i: zeros
+        if header_data is None:
+            header_data = bytes()
+        index_data = struct.pack(BlockStorageSharedMemory._index_struct_string,
+                                 block_size,
+                                 block_count,
+                                 len(header_data),
+                                 False)
+        header_offset = len(index_data) + len(header_data)
+        size = header_offset + block_size * block_count
+
+        try:
+            shm = _attach(storage_name, create=True, size=size)
+        except FileExistsError:
+            if not ignore_existing:
+                raise IOError(
+                    "Storage location already exists: %s"
+                    % (storage_name))
+            cls.unlink(storage_name)
+            shm = _attach(storage_name, create=True, size=size)
+        if storage_name is None:
+            # use the name generated for the segment
+            storage_name = shm.name
+        try:
+            f = shm.buf
+            f[:header_offset] = index_data + header_data
+            progress_bar = tqdm.tqdm(total=block_count*block_size,
+                                     desc="Initializing Shared Memory "
+                                          "Block Storage Space",
+                                     unit="B",
+                                     unit_scale=True,
+                                     disable=not pyoram.config.SHOW_PROGRESS_BAR)
+            for i in xrange(block_count):
+                block = initialize(i)
+                assert len(block) == block_size, \
+                    ("%s != %s" % (len(block), block_size))
+                pos_start = header_offset + i * block_size
+                f[pos_start:pos_start+block_size] = block
+                progress_bar.update(n=block_size)
+            progress_bar.close()
+            del f
+        except:                                        # pragma: no cover
+            shm.close()                                # pragma: no cover
+            _unlink(shm)                               # pragma: no cover
+            raise                                      # pragma: no cover
+        shm.close()
+
+        return BlockStorageSharedMemory(storage_name,
+                                        threadpool_size=threadpool_size)
+
+    @property
+    def header_data(self):
+        return self._user_header_data
+
+    @property
+    def block_count(self):
+        return self._block_count
+
+    @property
+    def block_size(self):
+        return self._block_size
+
+    @property
+    def storage_name(self):
+        return self._storage_name
+
+    def update_header_data(self, new_header_data):
+        if len(new_header_data) != len(self.header_data):
+            raise ValueError(
+                "The size of header data can not change.\n"
+                "Original bytes: %s\n"
+                "New bytes: %s" % (len(self.header_data),
+                                   len(new_header_data)))
+        self._user_header_data = bytes(new_header_data)
+        self._f[BlockStorageSharedMemory._index_offset:\
+                (BlockStorageSharedMemory._index_offset + \
+                 len(new_header_data))] = \
+            self._user_header_data
+
+    def close(self):
+        if self._close_pool and (self._pool is not None):
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        if self._shm is not None:
+            if not self._ignore_lock:
+                # turn off the locked flag
+                self._f[:BlockStorageSharedMemory._index_offset] = \
+                    struct.pack(BlockStorageSharedMemory._index_struct_string,
+                                self.block_size,
+                                self.block_count,
+                                len(self._user_header_data),
+                                False)
+                self._ignore_lock = True
+            self._release()
+
+    #def read_blocks(...)
+
+    #def yield_blocks(...)
+
+    #def read_block(...)
+
+    #def write_blocks(...)
+
+    #def write_block(...)
+
+    @property
+    def bytes_sent(self):
+        return self._bytes_sent
+
+    @property
+    def bytes_received(self):
+        return self._bytes_received
+
+BlockStorageTypeFactory.register_device("shared_memory",
+                                        BlockStorageSharedMemory)
@@ -0,0 +1,346 @@
+__all__ = ('BlockStorageSimulatedLink',)
+
+import time
+import random
+import logging
+import threading
+import collections
+from multiprocessing.pool import ThreadPool
+
+from pyoram.storage.block_storage import \
+    (BlockStorageInterface,
+     BlockStorageTypeFactory)
+
+log = logging.getLogger("pyoram")
+
+# prefer a monotonic clock when one is available
+_clock = getattr(time, "monotonic", time.time)
+
+def _wrapped_type(wrapped_storage_type):
+    # accepts a device class or a registered type name
+    if isinstance(wrapped_storage_type, type) and \
+       issubclass(wrapped_storage_type, BlockStorageInterface):
+        return wrapped_storage_type
+    return BlockStorageTypeFactory(wrapped_storage_type)
+
+class _SimulatedLink(object):
+    """
+    The state of a simulated network link. A device and
+    all of its clones share a single link, so the
+    bandwidth cap and concurrency limit apply to their
+    combined traffic.
+    """
+
+    def __init__(self,
+                 latency=0.0,
+                 bandwidth=None,
+                 jitter=0.0,
+                 max_concurrency=None,
+                 seed=None):
+        if latency < 0:
+            raise ValueError(
+                "Latency (seconds) must be non-negative: %s"
+                % (latency))
+        if jitter < 0:
+            raise ValueError(
+                "Jitter (seconds) must be non-negative: %s"
+                % (jitter))
+        if (bandwidth is not None) and (bandwidth <= 0):
+            raise ValueError(
+                "Bandwidth (bytes/second) must be positive: %s"
+                % (bandwidth))
+        if (max_concurrency is not None) and \
+           ((max_concurrency < 1) or \
+            (max_concurrency != int(max_concurrency))):
+            raise ValueError(
+                "Max concurrency must be a positive integer: %s"
+                % (max_concurrency))
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.jitter = jitter
+        self.max_concurrency = max_concurrency
+        self._lock = threading.Lock()
+        self._random = random.Random(seed)
+        self._slots = None
+        if max_concurrency is not None:
+            self._slots = threading.BoundedSemaphore(max_concurrency)
+        # the time at which the link finishes the
+        # transfers scheduled so far
+        self._busy_until = 0.0
+        self.request_count = 0
+        self.bytes_transferred = 0
+        self.simulated_delay = 0.0
+
+    def _round_trip_time(self):
+        delay = self.latency
+        if self.jitter > 0:
+            with self._lock:
+                delay += self._random.uniform(0, self.jitter)
+        return delay
+
+    def _schedule_transfer(self, nbytes):
+        # transfers share the link bandwidth, so they are
+        # queued behind any transfer already in progress
+        with self._lock:
+            start = max(_clock(), self._busy_until)
+            self._busy_until = start + nbytes / float(self.bandwidth)
+            return self._busy_until
+
+    def request(self, nbytes):
+        """Block the calling thread for the time it takes
+        to issue a single request that moves nbytes over
+        the link."""
+        start = _clock()
+        if self._slots is not None:
+            self._slots.acquire()
+        try:
+            delay = self._round_trip_time()
+            if delay > 0:
+                time.sleep(delay)
+            if (self.bandwidth is not None) and (nbytes > 0):
+                remaining = self._schedule_transfer(nbytes) - _clock()
+                if remaining > 0:
+                    time.sleep(remaining)
+        finally:
+            if self._slots is not None:
+                self._slots.release()
+        with self._lock:
+            self.request_count += 1
+            self.bytes_transferred += nbytes
+            self.simulated_delay += _clock() - start
+
+class BlockStorageSimulatedLink(BlockStorageInterface):
+    """
+    A block storage device that wraps another block
+    storage device and simulates the cost of accessing it
+    over a network link. This allows the effect of round
+    trips on batching, prefetching, and caching to be
+    measured reproducibly using local storage.
+
+    Each call that reads or writes blocks is charged as a
+    single request: one round trip of 'latency' seconds
+    (plus a random delay of up to 'jitter' seconds), then
+    the transfer of the block data at 'bandwidth'
+    bytes/second. Transfers are serialized over the link,
+    and at most 'max_concurrency' requests can be in
+    progress at once. The 'seed' keyword makes the jitter
+    reproducible. The link is shared with all devices
+    created by clone_device().
+
+    Reads are charged in the calling thread. When a
+    thread pool is used, writes are charged in the thread
+    pool so that they can overlap later requests (as with
+    the asynchronous writes of the remote devices), and
+    flush() waits for them to complete.
+
+    When 'storage' is not a block storage device, it is
+    the storage name passed to the device type given by
+    the 'wrapped_storage_type' keyword (a device class or
+    the name of a registered device type), along with any
+    remaining keywords.
+    """
+
+    def __init__(self,
+                 storage,
+                 latency=0.0,
+                 bandwidth=None,
+                 jitter=0.0,
+                 max_concurrency=None,
+                 seed=None,
+                 threadpool_size=None,
+                 _link=None,
+                 **kwds):
+        if _link is None:
+            _link = _SimulatedLink(latency=latency,
+                                   bandwidth=bandwidth,
+                                   jitter=jitter,
+                                   max_concurrency=max_concurrency,
+                                   seed=seed)
+        if isinstance(storage, BlockStorageInterface):
+            if len(kwds):
+                raise ValueError(
+                    "Keywords not used when initializing "
+                    "with a storage device: %s"
+                    % (str(kwds)))
+        else:
+            wrapped_storage_type = kwds.pop('wrapped_storage_type', 'file')
+            storage = _wrapped_type(wrapped_storage_type)(storage, **kwds)
+        self._storage = storage
+        self._link = _link
+        self._pending = collections.deque()
+        self._pool = None
+        self._close_pool = True
+        if threadpool_size != 0:
+            self._pool = ThreadPool(threadpool_size)
+
+    def _reap(self, wait=False):
+        while len(self._pending) and \
+              (wait or self._pending[0].ready()):
+            self._pending.popleft().get()
+
+    def _charge_write(self, nbytes):
+        self._reap()
+        if self._pool is not None:
+            self._pending.append(
+                self._pool.apply_async(self._link.request, (nbytes,)))
+        else:
+            self._link.request(nbytes)
+
+    #
+    # Additional Methods
+    #
+
+    @property
+    def wrapped_storage(self):
+        return self._storage
+
+    @property
+    def request_count(self):
+        """The number of requests issued over the link by
+        this device and its clones."""
+        return self._link.request_count
+
+    @property
+    def simulated_delay(self):
+        """The total time (in seconds) that requests over
+        the link by this device and its clones have spent
+        waiting."""
+        return self._link.simulated_delay
+
+    #
+    # Define BlockStorageInterface Methods
+    #
+
+    def clone_device(self):
+        f = BlockStorageSimulatedLink(self._storage.clone_device(),
+                                      threadpool_size=0,
+                                      _link=self._link)
+        f._pool = self._pool
+        f._close_pool = False
+        return f
+
+    @classmethod
+    def compute_storage_size(cls,
+                             block_size,
+                             block_count,
+                             wrapped_storage_type='file',
+                             **kwds):
+        for name in ('latency', 'bandwidth', 'jitter',
+                     'max_concurrency', 'seed', 'threadpool_size'):
+            kwds.pop(name, None)
+        wrapped_storage_type = _wrapped_type(wrapped_storage_type)
+        return wrapped_storage_type.compute_storage_size(block_size,
+                                                         block_count,
+                                                         **kwds)
+
+    @classmethod
+    def setup(cls,
+              storage_name,
+              block_size,
+              block_count,
+              wrapped_storage_type='file',
+              latency=0.0,
+              bandwidth=None,
+              jitter=0.0,
+              max_concurrency=None,
+              seed=None,
+              threadpool_size=None,
+              **kwds):
+        # validate the link before creating any storage
+        link = _SimulatedLink(latency=latency,
+                              bandwidth=bandwidth,
+                              jitter=jitter,
+                              max_concurrency=max_concurrency,
+                              seed=seed)
+        wrapped_storage_type = _wrapped_type(wrapped_storage_type)
+        return BlockStorageSimulatedLink(
+            wrapped_storage_type.setup(storage_name,
+                                       block_size,
+                                       block_count,
+                                       **kwds),
+            threadpool_size=threadpool_size,
+            _link=link)
+
+    @property
+    def header_data(self):
+        return self._storage.header_data
+
+    @property
+    def block_count(self):
+        return self._storage.block_count
+
+    @property
+    def block_size(self):
+        return self._storage.block_size
+
+    @property
+    def storage_name(self):
+        return self._storage.storage_name
+
+    def update_header_data(self, new_header_data):
+        self._reap(wait=True)
+        self._link.request(len(new_header_data))
+        self._storage.update_header_data(new_header_data)
+
+    def grow(self, block_count, initialize=None):
+        self._reap(wait=True)
+        self._link.request(
+            max(0, block_count - self.block_count) * self.block_size)
+        self._storage.grow(block_count, initialize=initialize)
+
+    def close(self):
+        try:
+            self._reap(wait=True)
+        finally:
+            self._storage.close()
+            if self._close_pool and (self._pool is not None):
+                self._pool.close()
+                self._pool.join()
+                self._pool = None
+
+    def read_blocks(self, indices, *args, **kwds):
+        self._reap()
+        blocks = self._storage.read_blocks(indices, *args, **kwds)
+        self._link.request(self.block_size * len(blocks))
+        return blocks
+
+    def yield_blocks(self, indices, *args, **kwds):
+        self._reap()
+        # be sure not to exhaust this if it is an iterator
+        # or generator
+        indices = list(indices)
+        self._link.request(self.block_size * len(indices))
+        return self._storage.yield_blocks(indices, *args, **kwds)
+
+    def read_block(self, i):
+        self._reap()
+        block = self._storage.read_block(i)
+        self._link.request(self.block_size)
+        return block
+
+    def write_blocks(self, indices, blocks, *args, **kwds):
+        # be sure not to exhaust these if they are
+        # iterators or generators
+        indices = list(indices)
+        blocks = list(blocks)
+        self._storage.write_blocks(indices, blocks, *args, **kwds)
+        self._charge_write(self.block_size * len(indices))
+
+    def write_block(self, i, block):
+        self._storage.write_block(i, block)
+        self._charge_write(self.block_size)
+
+    def flush(self):
+        self._reap(wait=True)
+        self._storage.flush()
+
+    @property
+    def bytes_sent(self):
+        return self._storage.bytes_sent
+
+    @property
+    def bytes_received(self):
+        return self._storage.bytes_received
+
+BlockStorageTypeFactory.register_device("simulated_link",
+                                        BlockStorageSimulatedLink)
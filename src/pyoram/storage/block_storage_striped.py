@@ -0,0 +1,439 @@
+__all__ = ('BlockStorageStriped',)
+
+import os
+import struct
+import logging
+from multiprocessing.pool import ThreadPool
+
+from pyoram.util.misc import chunkiter
+from pyoram.storage.block_storage import \
+    (BlockStorageInterface,
+     BlockStorageTypeFactory)
+from pyoram.storage.block_storage_file import \
+    BlockStorageFile
+
+import six
+from six.moves import xrange
+
+log = logging.getLogger("pyoram")
+
+class BlockStorageStriped(BlockStorageInterface):
+    """
+    A class implementing the block storage interface by
+    striping blocks across several local files (e.g.,
+    files placed on different disks). Consecutive groups
+    of 'stripe_unit' blocks are assigned to the stripes in
+    round-robin order. Each stripe is an independent
+    BlockStorageFile with its own header and locked flag,
+    and multi-block requests are issued to the stripes in
+    parallel.
+
+    The 'storage_name' argument is either a list of file
+    names (one per stripe) or a single name, in which case
+    the stripes are stored in the files '<name>.0',
+    '<name>.1', etc.
+    """
+
+    _stripe_struct_string = "!LLLL"
+    _stripe_offset = struct.calcsize(_stripe_struct_string)
+
+    def __init__(self,
+                 storage_name,
+                 stripe_count=None,
+                 stripe_unit=None,
+                 threadpool_size=None,
+                 ignore_lock=False,
+                 _stripes=None):
+
+        self._bytes_sent = 0
+        self._bytes_received = 0
+        self._storage_name = storage_name
+        self._pool = None
+        self._close_pool = True
+        self._async_write = None
+
+        if _stripes is None:
+            names = self._stripe_names(storage_name, stripe_count)
+            _stripes = []
+            try:
+                _stripes.append(
+                    BlockStorageFile(names[0],
+                                     threadpool_size=0,
+                                     ignore_lock=ignore_lock))
+                if stripe_count is None:
+                    # the first stripe records the stripe count
+                    (_, stripe_count, _, _) = struct.unpack(
+                        self._stripe_struct_string,
+                        _stripes[0].header_data[:self._stripe_offset])
+                    names = self._stripe_names(storage_name,
+                                               stripe_count)
+                for name in names[1:]:
+                    _stripes.append(
+                        BlockStorageFile(name,
+                                         threadpool_size=0,
+                                         ignore_lock=ignore_lock))
+                self._stripes = _stripes
+                self._init_stripe_layout()
+                if (stripe_unit is not None) and \
+                   (stripe_unit != self._stripe_unit):
+                    raise ValueError(
+                        "Stripe unit (%s) does not match the stripe "
+                        "unit recorded in storage: %s"
+                        % (stripe_unit, self._stripe_unit))
+            except:
+                for stripe in _stripes:
+                    stripe.close()
+                raise
+        else:
+            self._stripes = _stripes
+            self._init_stripe_layout()
+
+        if threadpool_size != 0:
+            self._pool = ThreadPool(threadpool_size)
+
+    def _init_stripe_layout(self):
+        self._stripe_count = len(self._stripes)
+        self._block_size = self._stripes[0].block_size
+        (_, _, self._stripe_unit, self._block_count) = struct.unpack(
+            self._stripe_struct_string,
+            self._stripes[0].header_data[:self._stripe_offset])
+        counts = self._stripe_block_counts(self._block_count,
+                                           self._stripe_count,
+                                           self._stripe_unit)
+        for s, stripe in enumerate(self._stripes):
+            header = struct.unpack(
+                self._stripe_struct_string,
+                stripe.header_data[:self._stripe_offset])
+            if (header != (s,
+                           self._stripe_count,
+                           self._stripe_unit,
+                           self._block_count)) or \
+               (stripe.block_size != self._block_size) or \
+               (stripe.block_count != counts[s]):
+                raise ValueError(
+                    "Stripe %s (%s) does not belong to a striped "
+                    "block storage device with %s stripes"
+                    % (s, stripe.storage_name, self._stripe_count))
+
+    @staticmethod
+    def _stripe_names(storage_name, stripe_count):
+        if isinstance(storage_name, six.string_types):
+            if stripe_count is None:
+                # only the first stripe name can be
+                # determined until its header is read
+                stripe_count = 1
+            return ["%s.%d" % (storage_name, s)
+                    for s in xrange(stripe_count)]
+        names = list(storage_name)
+        if (stripe_count is not None) and \
+           (len(names) != stripe_count):
+            raise ValueError(
+                "The number of stripe names (%s) does not match "
+                "the stripe count: %s" % (len(names), stripe_count))
+        return names
+
+    @staticmethod
+    def _stripe_block_counts(block_count, stripe_count, stripe_unit):
+        units, remainder = divmod(block_count, stripe_unit)
+        counts = []
+        for s in xrange(stripe_count):
+            count = (units // stripe_count) * stripe_unit
+            if s < (units % stripe_count):
+                count += stripe_unit
+            elif (s == (units % stripe_count)) and remainder:
+                count += remainder
+            counts.append(count)
+        return counts
+
+    def _locate(self, i):
+        unit, offset = divmod(i, self._stripe_unit)
+        row, s = divmod(unit, self._stripe_count)
+        return s, row * self._stripe_unit + offset
+
+    def _global_index(self, s, j):
+        row, offset = divmod(j, self._stripe_unit)
+        return (row * self._stripe_count + s) * self._stripe_unit + offset
+
+    def _group_by_stripe(self, indices):
+        groups = {}
+        for pos, i in enumerate(indices):
+            assert 0 <= i < self.block_count
+            s, j = self._locate(i)
+            groups.setdefault(s, ([], []))
+            groups[s][0].append(pos)
+            groups[s][1].append(j)
+        return groups
+
+    def _map_stripes(self, func, args):
+        if (self._pool is not None) and (len(args) > 1):
+            return self._pool.map(func, args)
+        return list(map(func, args))
+
+    def _check_async(self):
+        if self._async_write is not None:
+            self._async_write.get()
+            self._async_write = None
+
+    # This method is usually executed in another thread, so
+    # do not attempt to handle exceptions because it will
+    # not work.
+    def _write_stripe(self, args):
+        s, local_indices, blocks, callback = args
+        stripe_callback = None
+        if callback is not None:
+            stripe_callback = \
+                lambda j: callback(self._global_index(s, j))
+        self._stripes[s].write_blocks(local_indices,
+                                      blocks,
+                                      callback=stripe_callback)
+
+    def _schedule_async_write(self, arglist):
+        assert self._async_write is None
+        if self._pool is not None:
+            self._async_write = \
+                self._pool.map_async(self._write_stripe, arglist)
+        else:
+            for args in arglist:
+                self._write_stripe(args)
+
+    #
+    # Define BlockStorageInterface Methods
+    #
+
+    def clone_device(self):
+        f = BlockStorageStriped(self.storage_name,
+                                threadpool_size=0,
+                                _stripes=[stripe.clone_device()
+                                          for stripe in self._stripes])
+        f._pool = self._pool
+        f._close_pool = False
+        return f
+
+    @classmethod
+    def compute_storage_size(cls,
+                             block_size,
+                             block_count,
+                             header_data=None,
+                             ignore_header=False,
+                             stripe_count=1,
+                             stripe_unit=1):
+        assert (block_size > 0) and (block_size == int(block_size))
+        assert (block_count > 0) and (block_count == int(block_count))
+        assert stripe_count >= 1
+        assert stripe_unit >= 1
+        if header_data is None:
+            header_data = bytes()
+        if ignore_header:
+            return block_size * block_count
+        else:
+            stripe_header_data = \
+                bytes(bytearray(cls._stripe_offset)) + header_data
+            return sum(BlockStorageFile.compute_storage_size(
+                           block_size,
+                           count,
+                           header_data=stripe_header_data)
+                       for count in cls._stripe_block_counts(block_count,
+                                                             stripe_count,
+                                                             stripe_unit))
+
+    @classmethod
+    def setup(cls,
+              storage_name,
+              block_size,
+              block_count,
+              stripe_count=None,
+              stripe_unit=1,
+              initialize=None,
+              header_data=None,
+              ignore_existing=False,
+              threadpool_size=None):
+
+        if isinstance(storage_name, six.string_types) and \
+           (stripe_count is None):
+            raise ValueError(
+                "The 'stripe_count' keyword is required when "
+                "the storage name is not a list of stripe names")
+        names = cls._stripe_names(storage_name, stripe_count)
+        stripe_count = len(names)
+        if stripe_count < 1:
+            raise ValueError(
+                "Stripe count must be a positive integer: %s"
+                % (stripe_count))
+        if (stripe_unit <= 0) or (stripe_unit != int(stripe_unit)):
+            raise ValueError(
+                "Stripe unit (blocks) must be a positive integer: %s"
+                % (stripe_unit))
+        if (block_count <= 0) or (block_count != int(block_count)):
+            raise ValueError(
+                "Block count must be a positive integer: %s"
+                % (block_count))
+        if (header_data is not None) and \
+           (type(header_data) is not bytes):
+            raise TypeError(
+                "'header_data' must be of type bytes. "
+                "Invalid type: %s" % (type(header_data)))
+        if block_count < stripe_count * stripe_unit:
+            raise ValueError(
+                "Block count (%s) is too small to fill %s stripes "
+                "with a stripe unit of %s blocks"
+                % (block_count, stripe_count, stripe_unit))
+        if header_data is None:
+            header_data = bytes()
+        if (not ignore_existing):
+            for name in names:
+                if os.path.exists(name):
+                    raise IOError(
+                        "Storage location already exists: %s"
+                        % (name))
+
+        if initialize is None:
+            zeros = bytes(bytearray(block_size))
+            initialize = lambda i: zeros
+        counts = cls._stripe_block_counts(block_count,
+                                          stripe_count,
+                                          stripe_unit)
+        def _stripe_initialize(s):
+            def _initialize(j):
+                row, offset = divmod(j, stripe_unit)
+                return initialize(
+                    (row * stripe_count + s) * stripe_unit + offset)
+            return _initialize
+        created = []
+        try:
+            for s, name in enumerate(names):
+                stripe_header_data = \
+                    struct.pack(cls._stripe_struct_string,
+                                s,
+                                stripe_count,
+                                stripe_unit,
+                                block_count) + \
+                    header_data
+                BlockStorageFile.setup(
+                    name,
+                    block_size,
+                    counts[s],
+                    initialize=_stripe_initialize(s),
+                    header_data=stripe_header_data,
+                    ignore_existing=ignore_existing,
+                    threadpool_size=0).close()
+                created.append(name)
+        except:
+            for name in created:                       # pragma: no cover
+                os.remove(name)                        # pragma: no cover
+            raise
+
+        return BlockStorageStriped(storage_name,
+                                   stripe_count=stripe_count,
+                                   threadpool_size=threadpool_size)
+
+    @property
+    def header_data(self):
+        return self._stripes[0].header_data[self._stripe_offset:]
+
+    @property
+    def block_count(self):
+        return self._block_count
+
+    @property
+    def block_size(self):
+        return self._block_size
+
+    @property
+    def storage_name(self):
+        return self._storage_name
+
+    @property
+    def stripe_count(self):
+        return self._stripe_count
+
+    @property
+    def stripe_unit(self):
+        return self._stripe_unit
+
+    def update_header_data(self, new_header_data):
+        self._check_async()
+        if len(new_header_data) != len(self.header_data):
+            raise ValueError(
+                "The size of header data can not change.\n"
+                "Original bytes: %s\n"
+                "New bytes: %s" % (len(self.header_data),
+                                   len(new_header_data)))
+        for stripe in self._stripes:
+            stripe.update_header_data(
+                stripe.header_data[:self._stripe_offset] + \
+                new_header_data)
+
+    def close(self):
+        self._check_async()
+        for stripe in self._stripes:
+            stripe.close()
+        if self._close_pool and (self._pool is not None):
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def read_blocks(self, indices):
+        self._check_async()
+        # be sure not to exhaust this if it is an iterator
+        # or generator
+        indices = list(indices)
+        groups = self._group_by_stripe(indices)
+        self._bytes_received += self.block_size * len(indices)
+        stripes = list(groups)
+        results = self._map_stripes(
+            lambda s: self._stripes[s].read_blocks(groups[s][1]),
+            stripes)
+        blocks = [None] * len(indices)
+        for s, stripe_blocks in zip(stripes, results):
+            for pos, block in zip(groups[s][0], stripe_blocks):
+                blocks[pos] = block
+        return blocks
+
+    def yield_blocks(self, indices, chunksize=100):
+        for chunk in chunkiter(indices, n=chunksize):
+            for block in self.read_blocks(chunk):
+                yield block
+
+    def read_block(self, i):
+        self._check_async()
+        assert 0 <= i < self.block_count
+        self._bytes_received += self.block_size
+        s, j = self._locate(i)
+        return self._stripes[s].read_block(j)
+
+    def write_blocks(self, indices, blocks, callback=None):
+        self._check_async()
+        # be sure not to exhaust this if it is an iterator
+        # or generator
+        indices = list(indices)
+        blocks = list(blocks)
+        assert len(indices) == len(blocks)
+        for block in blocks:
+            assert len(block) == self.block_size, \
+                ("%s != %s" % (len(block), self.block_size))
+        groups = self._group_by_stripe(indices)
+        self._bytes_sent += self.block_size * len(indices)
+        self._schedule_async_write(
+            [(s,
+              groups[s][1],
+              [blocks[pos] for pos in groups[s][0]],
+              callback)
+             for s in groups])
+
+    def write_block(self, i, block):
+        self.write_blocks([i], [block])
+
+    def flush(self):
+        self._check_async()
+        for stripe in self._stripes:
+            stripe.flush()
+
+    @property
+    def bytes_sent(self):
+        return self._bytes_sent
+
+    @property
+    def bytes_received(self):
+        return self._bytes_received
+
+BlockStorageTypeFactory.register_device("striped", BlockStorageStriped)
@@ -1,7 +1,11 @@
 __all__ = ("Boto3S3Wrapper",
            "MockBoto3S3Wrapper")
 import os
+import time
+import random
 import shutil
+import tempfile
+import threading
 
 import pyoram
 
@@ -9,6 +13,7 @@ import tqdm
 try:
     import boto3
     import botocore
+    import botocore.config
     boto3_available = True
 except:                                                # pragma: no cover
     boto3_available = False                            # pragma: no cover
@@ -16,30 +21,141 @@ except:                                                # pragma: no cover
 import six
 from six.moves import xrange, map
 
+# os.rename does not replace existing files on Windows
+_replace = getattr(os, "replace", os.rename)
+
+# error codes returned when requests are being throttled
+_throttling_error_codes = frozenset(["SlowDown",
+                                     "503",
+                                     "ServiceUnavailable",
+                                     "RequestLimitExceeded",
+                                     "Throttling",
+                                     "ThrottlingException",
+                                     "TooManyRequestsException"])
+
+def _is_throttling_error(e):
+    response = getattr(e, 'response', None)
+    if not isinstance(response, dict):
+        return False
+    if response.get('Error', {}).get('Code') in _throttling_error_codes:
+        return True
+    return response.get('ResponseMetadata', {}).\
+        get('HTTPStatusCode') == 503
+
+def _call_with_backoff(func,
+                       max_retries,
+                       backoff_base,
+                       backoff_max,
+                       _sleep=time.sleep,
+                       _random=random.random):
+    """Call func(), retrying with exponential backoff
+    (and full jitter) while the request is throttled."""
+    attempt = 0
+    while True:
+        try:
+            return func()
+        except Exception as e:
+            if (attempt >= max_retries) or \
+               (not _is_throttling_error(e)):
+                raise
+            _sleep(_random() * min(backoff_max,
+                                   backoff_base * (2**attempt)))
+            attempt += 1
+
+class _ClientPool(object):
+    """
+    A thread-safe pool of clients that gives each thread
+    its own client, which is created on first use by
+    calling create_client() and then reused for all later
+    requests from that thread.
+    """
+
+    def __init__(self, create_client):
+        self._create_client = create_client
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._clients_created = 0
+        self._requests = 0
+
+    def client(self):
+        client = getattr(self._local, 'client', None)
+        with self._lock:
+            self._requests += 1
+            if client is None:
+                # client creation (e.g., of a boto3 session)
+                # is not thread-safe
+                client = self._local.client = self._create_client()
+                self._clients_created += 1
+        return client
+
+    @property
+    def stats(self):
+        """A dictionary with the number of requests, the
+        number of clients created, and the number of
+        requests that reused an existing client."""
+        with self._lock:
+            return {'requests': self._requests,
+                    'clients_created': self._clients_created,
+                    'client_reuses': self._requests - self._clients_created}
+
 class Boto3S3Wrapper(object):
     """
     A wrapper class for the boto3 S3 service.
+
+    A wrapper is safe to share between threads (and between
+    a device and its clones). Each thread uses its own boto3
+    client, with up to max_pool_connections connections
+    (the botocore default when None).
+
+    Requests that are throttled by S3 (e.g., 503 SlowDown
+    errors) are retried up to max_retries times using
+    exponential backoff with jitter.
     """
 
+    max_retries = 8
+    backoff_base = 0.05
+    backoff_max = 5.0
+
     def __init__(self,
                  bucket_name,
                  aws_access_key_id=None,
                  aws_secret_access_key=None,
-                 region_name=None):
+                 region_name=None,
+                 max_pool_connections=None):
         if not boto3_available:
             raise ImportError(                         # pragma: no cover
                 "boto3 module is required to "         # pragma: no cover
                 "use BlockStorageS3 device")           # pragma: no cover
 
-        self._s3 = boto3.session.Session(
-            aws_access_key_id=aws_access_key_id,
-            aws_secret_access_key=aws_secret_access_key,
-            region_name=region_name).resource('s3')
-        self._bucket = self._s3.Bucket(bucket_name)
+        self._bucket_name = bucket_name
+        config = None
+        if max_pool_connections is not None:
+            config = botocore.config.Config(
+                max_pool_connections=max_pool_connections)
+        # boto3 sessions are not thread-safe, so each
+        # thread creates its client from its own session
+        self._clients = _ClientPool(
+            lambda: boto3.session.Session(
+                aws_access_key_id=aws_access_key_id,
+                aws_secret_access_key=aws_secret_access_key,
+                region_name=region_name).client('s3', config=config))
+
+    def _retry(self, func):
+        client = self._clients.client()
+        return _call_with_backoff(lambda: func(client),
+                                  self.max_retries,
+                                  self.backoff_base,
+                                  self.backoff_max)
+
+    @property
+    def stats(self):
+        return self._clients.stats
 
     def exists(self, key):
         try:
-            self._bucket.Object(key).load()
+            self._retry(lambda client: client.head_object(
+                Bucket=self._bucket_name,
+                Key=key))
         except botocore.exceptions.ClientError as e:
             if e.response['Error']['Code'] == "404":
                 pass
@@ -48,34 +164,56 @@ class Boto3S3Wrapper(object):
         else:
             return True
         # It's not a file. Check if it's a "directory".
-        for obj in self._bucket.objects.filter(
-                Prefix=key+"/"):
-            return True
-        return False
+        return self._retry(lambda client: client.list_objects_v2(
+            Bucket=self._bucket_name,
+            Prefix=key+"/",
+            MaxKeys=1)).get('KeyCount', 0) > 0
 
     def download(self, key):
         try:
-            return self._s3.meta.client.get_object(
-                Bucket=self._bucket.name,
-                Key=key)['Body'].read()
+            return self._retry(lambda client: client.get_object(
+                Bucket=self._bucket_name,
+                Key=key)['Body'].read())
+        except botocore.exceptions.ClientError:
+            raise IOError("Can not download key: %s"
+                          % (key))
+
+    def download_range(self, key, start, stop):
+        """Download bytes [start, stop) of an object."""
+        assert 0 <= start < stop
+        try:
+            return self._retry(lambda client: client.get_object(
+                Bucket=self._bucket_name,
+                Key=key,
+                Range="bytes=%d-%d" % (start, stop-1))['Body'].read())
         except botocore.exceptions.ClientError:
             raise IOError("Can not download key: %s"
                           % (key))
 
     def upload(self, key_block):
         key, block = key_block
-        self._bucket.put_object(Key=key, Body=block)
+        self._retry(lambda client: client.put_object(
+            Bucket=self._bucket_name,
+            Key=key,
+            Body=block))
+
+    def _keys(self, prefix):
+        paginator = self._clients.client().get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self._bucket_name,
+                                       Prefix=prefix):
+            for obj in page.get('Contents', ()):
+                yield obj['Key']
 
     # Chunk a streamed iterator of which we do not know
     # the size
-    def _chunks(self, objs, n=100):
+    def _chunks(self, keys, n=100):
         assert 1 <= n <= 1000 # required by boto3
-        objs = iter(objs)
+        keys = iter(keys)
         try:
             while (1):
                 chunk = []
                 while len(chunk) < n:
-                    chunk.append({'Key': six.next(objs).key})
+                    chunk.append({'Key': six.next(keys)})
                 yield {'Objects': chunk}
         except StopIteration:
             pass
@@ -83,11 +221,13 @@ class Boto3S3Wrapper(object):
             yield {'Objects': chunk}
 
     def _del(self, chunk):
-        self._bucket.delete_objects(Delete=chunk)
+        self._retry(lambda client: client.delete_objects(
+            Bucket=self._bucket_name,
+            Delete=chunk))
         return len(chunk['Objects'])
 
     def clear(self, key, threadpool=None):
-        objs = self._bucket.objects.filter(Prefix=key+"/")
+        objs = self._keys(key+"/")
         if threadpool is not None:
             deliter = threadpool.imap(self._del, self._chunks(objs))
         else:
@@ -114,10 +254,18 @@ class MockBoto3S3Wrapper(object):
                  bucket_name,
                  aws_access_key_id=None,
                  aws_secret_access_key=None,
-                 region_name=None):
+                 region_name=None,
+                 max_pool_connections=None):
 
         self._bucket_name = os.path.abspath(
             os.path.normpath(bucket_name))
+        # there are no connections to pool, but requests
+        # are counted the same way
+        self._clients = _ClientPool(object)
+
+    @property
+    def stats(self):
+        return self._clients.stats
 
     # called within upload to create directory
     # heirarchy on the fly
@@ -132,20 +280,41 @@ class MockBoto3S3Wrapper(object):
             os.path.join(self._bucket_name, key))
 
     def exists(self, key):
+        self._clients.client()
         return os.path.exists(
             os.path.join(self._bucket_name, key))
 
     def download(self, key):
+        self._clients.client()
         with open(os.path.join(self._bucket_name, key), 'rb') as f:
             return f.read()
 
+    def download_range(self, key, start, stop):
+        self._clients.client()
+        assert 0 <= start < stop
+        with open(os.path.join(self._bucket_name, key), 'rb') as f:
+            f.seek(start)
+            return f.read(stop - start)
+
     def upload(self, key_block):
+        self._clients.client()
         key, block = key_block
         self._makedirs_if_needed(key)
-        with open(os.path.join(self._bucket_name, key), 'wb') as f:
-            f.write(block)
+        # replace the object atomically (as S3 does) so
+        # that concurrent downloads never observe a
+        # partially written object
+        name = os.path.join(self._bucket_name, key)
+        fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(name))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(block)
+            _replace(tmpname, name)
+        except:                                        # pragma: no cover
+            os.remove(tmpname)                         # pragma: no cover
+            raise                                      # pragma: no cover
 
     def clear(self, key, threadpool=None):
+        self._clients.client()
         if os.path.exists(
                 os.path.join(self._bucket_name, key)):
             if os.path.isdir(
@@ -2,10 +2,14 @@ __all__ = ('HeapStorage',)
 
 import struct
 
-from pyoram.util.virtual_heap import SizedVirtualHeap
+from pyoram.util.virtual_heap import \
+    (SizedVirtualHeap,
+     calculate_blocked_bucket)
 from pyoram.storage.block_storage import (BlockStorageInterface,
                                           BlockStorageTypeFactory)
 
+from six.moves import xrange
+
 class HeapStorageInterface(object):
 
     def __enter__(self):
@@ -57,6 +61,14 @@ class HeapStorageInterface(object):
         raise NotImplementedError                      # pragma: no cover
     def write_path(self, *args, **kwds):
         raise NotImplementedError                      # pragma: no cover
+    def read_paths(self, *args, **kwds):
+        raise NotImplementedError                      # pragma: no cover
+    def write_paths(self, *args, **kwds):
+        raise NotImplementedError                      # pragma: no cover
+    def flush(self, *args, **kwds):
+        raise NotImplementedError                      # pragma: no cover
+    def grow(self, *args, **kwds):
+        raise NotImplementedError                      # pragma: no cover
 
     @property
     def bytes_sent(self):
@@ -65,10 +77,160 @@ class HeapStorageInterface(object):
     def bytes_received(self):
         raise NotImplementedError                      # pragma: no cover
 
+class _BlockedLayoutStorage(BlockStorageInterface):
+    """
+    Presents a device that stores the buckets of a heap in
+    a blocked subtree layout (see
+    calculate_blocked_bucket_index) as a device indexed by
+    bucket, so that the layout is invisible to the layers
+    built on top of the heap storage.
+    """
+
+    def __init__(self, storage, vheap, subtree_levels):
+        self._storage = storage
+        self._k = vheap.k
+        self._levels = vheap.levels
+        self._subtree_levels = subtree_levels
+        self._index = vheap.clib.calculate_blocked_bucket_index
+
+    def _positions(self, indices):
+        k, levels, subtree_levels = \
+            self._k, self._levels, self._subtree_levels
+        index = self._index
+        return [index(k, levels, subtree_levels, i) for i in indices]
+
+    @property
+    def header_data(self):
+        return self._storage.header_data
+
+    @property
+    def block_count(self):
+        return self._storage.block_count
+
+    @property
+    def block_size(self):
+        return self._storage.block_size
+
+    @property
+    def storage_name(self):
+        return self._storage.storage_name
+
+    def update_header_data(self, new_header_data):
+        self._storage.update_header_data(new_header_data)
+
+    def close(self):
+        self._storage.close()
+
+    def read_blocks(self, indices):
+        # request the blocks in storage order so that the
+        # device sees runs of nearby blocks
+        positions = self._positions(indices)
+        order = sorted(xrange(len(positions)), key=positions.__getitem__)
+        blocks = [None] * len(positions)
+        for j, block in zip(order,
+                            self._storage.read_blocks(
+                                [positions[j] for j in order])):
+            blocks[j] = block
+        return blocks
+
+    def yield_blocks(self, indices, *args, **kwds):
+        return self._storage.yield_blocks(self._positions(indices),
+                                          *args, **kwds)
+
+    def read_block(self, i):
+        return self._storage.read_block(self._positions((i,))[0])
+
+    def write_blocks(self, indices, blocks, *args, **kwds):
+        self._storage.write_blocks(self._positions(indices),
+                                   blocks,
+                                   *args, **kwds)
+
+    def write_block(self, i, block):
+        self._storage.write_block(self._positions((i,))[0], block)
+
+    def flush(self):
+        self._storage.flush()
+
+    @property
+    def bytes_sent(self):
+        return self._storage.bytes_sent
+
+    @property
+    def bytes_received(self):
+        return self._storage.bytes_received
+
 class HeapStorage(HeapStorageInterface):
 
     _header_struct_string = "!LLL"
     _header_offset = struct.calcsize(_header_struct_string)
+    # the upper bits of the heap base header field store
+    # the number of levels spanned by each subtree of a
+    # blocked layout (0 for the breadth-first layout)
+    _heap_base_bits = 16
+    # the number of bytes moved at a time when growing a
+    # heap with a blocked layout
+    _max_grow_chunk_bytes = 2**22
+
+    @classmethod
+    def _pack_header(cls, vheap, layout_subtree_levels):
+        return struct.pack(cls._header_struct_string,
+                           vheap.k | (layout_subtree_levels << \
+                                      cls._heap_base_bits),
+                           vheap.height,
+                           vheap.blocks_per_bucket)
+
+    @classmethod
+    def _unpack_header(cls, header_data):
+        heap_base, heap_height, blocks_per_bucket = \
+            struct.unpack(cls._header_struct_string,
+                          header_data[:cls._header_offset])
+        return (SizedVirtualHeap(
+                    heap_base & ((1 << cls._heap_base_bits) - 1),
+                    heap_height,
+                    blocks_per_bucket=blocks_per_bucket),
+                heap_base >> cls._heap_base_bits)
+
+    @classmethod
+    def _prepare_setup(cls, vheap, layout_subtree_levels, kwds):
+        # Stores the heap header in kwds and, for a blocked
+        # layout, maps the storage positions passed to the
+        # initialize function back to buckets
+        if layout_subtree_levels is None:
+            layout_subtree_levels = 0
+        elif (layout_subtree_levels < 1) or \
+             (layout_subtree_levels != int(layout_subtree_levels)) or \
+             (layout_subtree_levels >= \
+              (1 << (8 * struct.calcsize("!L") - cls._heap_base_bits))):
+            raise ValueError(
+                "layout_subtree_levels must be a positive integer: %s"
+                % (layout_subtree_levels))
+        elif kwds.get('subtree_levels', None) is not None:
+            raise ValueError(
+                "The 'layout_subtree_levels' and 'subtree_levels' "
+                "keywords can not be used together")
+        if vheap.k >= (1 << cls._heap_base_bits):
+            raise ValueError(
+                "heap base must be less than %s. Invalid value: %s"
+                % (1 << cls._heap_base_bits, vheap.k))
+
+        user_header_data = kwds.pop('header_data', bytes())
+        if type(user_header_data) is not bytes:
+            raise TypeError(
+                "'header_data' must be of type bytes. "
+                "Invalid type: %s" % (type(user_header_data)))
+        kwds['header_data'] = \
+            cls._pack_header(vheap, layout_subtree_levels) + \
+            user_header_data
+        if kwds.get('subtree_levels', None) is not None:
+            # the packed S3 layout needs the shape of the heap
+            kwds['heap_base'] = vheap.k
+        initialize = kwds.get('initialize', None)
+        if layout_subtree_levels and (initialize is not None):
+            k, levels = vheap.k, vheap.levels
+            kwds['initialize'] = \
+                lambda i: initialize(
+                    calculate_blocked_bucket(k, levels,
+                                             layout_subtree_levels, i))
 
     def _new_storage(self, storage, **kwds):
         storage_type = kwds.pop('storage_type', 'file')
@@ -87,14 +249,16 @@ class HeapStorage(HeapStorageInterface):
             self._storage = BlockStorageTypeFactory(storage_type)\
                             (storage, **kwds)
 
-        heap_base, heap_height, blocks_per_bucket = \
-            struct.unpack(
-                self._header_struct_string,
-                self._storage.header_data[:self._header_offset])
-        self._vheap = SizedVirtualHeap(
-            heap_base,
-            heap_height,
-            blocks_per_bucket=blocks_per_bucket)
+        self._vheap, self._layout_subtree_levels = \
+            self._unpack_header(self._storage.header_data)
+        self._bucket_storage = self._create_bucket_storage()
+
+    def _create_bucket_storage(self):
+        if self._layout_subtree_levels == 0:
+            return self._storage
+        return _BlockedLayoutStorage(self._storage,
+                                     self._vheap,
+                                     self._layout_subtree_levels)
 
     #
     # Define HeapStorageInterface Methods
@@ -111,12 +275,16 @@ class HeapStorage(HeapStorageInterface):
                              heap_base=2,
                              ignore_header=False,
                              storage_type='file',
+                             layout_subtree_levels=None,
                              **kwds):
         assert (block_size > 0) and (block_size == int(block_size))
         assert heap_height >= 0
         assert blocks_per_bucket >= 1
         assert heap_base >= 2
         assert 'block_count' not in kwds
+        # the bucket layout does not change the storage size
+        assert (layout_subtree_levels is None) or \
+            (layout_subtree_levels >= 1)
         vheap = SizedVirtualHeap(
             heap_base,
             heap_height,
@@ -145,7 +313,18 @@ class HeapStorage(HeapStorageInterface):
               blocks_per_bucket=1,
               heap_base=2,
               storage_type='file',
+              layout_subtree_levels=None,
               **kwds):
+        """
+        Create a new heap storage. By default, the buckets
+        are stored in breadth-first (heap) order. When
+        layout_subtree_levels is given, the heap is instead
+        stored as blocks of subtrees that each span that
+        many levels, so that the buckets on a path are
+        stored in a few small regions rather than spread
+        over the whole device. The layout is recorded in
+        the header.
+        """
         if 'block_count' in kwds:
             raise ValueError("'block_count' keyword is not accepted")
         if heap_height < 0:
@@ -165,18 +344,7 @@ class HeapStorage(HeapStorageInterface):
             heap_base,
             heap_height,
             blocks_per_bucket=blocks_per_bucket)
-
-        user_header_data = kwds.pop('header_data', bytes())
-        if type(user_header_data) is not bytes:
-            raise TypeError(
-                "'header_data' must be of type bytes. "
-                "Invalid type: %s" % (type(user_header_data)))
-        kwds['header_data'] = \
-            struct.pack(cls._header_struct_string,
-                        heap_base,
-                        heap_height,
-                        blocks_per_bucket) + \
-            user_header_data
+        cls._prepare_setup(vheap, layout_subtree_levels, kwds)
 
         return HeapStorage(
             BlockStorageTypeFactory(storage_type).setup(
@@ -211,7 +379,15 @@ class HeapStorage(HeapStorageInterface):
 
     @property
     def bucket_storage(self):
-        return self._storage
+        return self._bucket_storage
+
+    @property
+    def layout_subtree_levels(self):
+        """
+        The number of levels spanned by each subtree of a
+        blocked layout (None for the breadth-first layout)
+        """
+        return self._layout_subtree_levels or None
 
     def update_header_data(self, new_header_data):
         self._storage.update_header_data(
@@ -223,16 +399,133 @@ class HeapStorage(HeapStorageInterface):
 
     def read_path(self, b, level_start=0):
         assert 0 <= b < self._vheap.bucket_count()
-        bucket_list = self._vheap.Node(b).bucket_path_from_root()
-        assert 0 <= level_start < len(bucket_list)
-        return self._storage.read_blocks(bucket_list[level_start:])
+        assert 0 <= level_start
+        bucket_list = self._vheap.path_buckets(b, level_start)
+        assert len(bucket_list) > 0
+        return self._bucket_storage.read_blocks(bucket_list)
 
     def write_path(self, b, buckets, level_start=0):
         assert 0 <= b < self._vheap.bucket_count()
-        bucket_list = self._vheap.Node(b).bucket_path_from_root()
-        assert 0 <= level_start < len(bucket_list)
-        self._storage.write_blocks(bucket_list[level_start:],
-                                   buckets)
+        assert 0 <= level_start
+        bucket_list = self._vheap.path_buckets(b, level_start)
+        assert len(bucket_list) > 0
+        self._bucket_storage.write_blocks(bucket_list, buckets)
+
+    def read_paths(self, bs, level_start=0):
+        # buckets shared by more than one path are
+        # only read once
+        bucket_lists = []
+        for b in bs:
+            assert 0 <= b < self._vheap.bucket_count()
+            assert 0 <= level_start
+            bucket_list = self._vheap.path_buckets(b, level_start)
+            assert len(bucket_list) > 0
+            bucket_lists.append(bucket_list)
+        indices = sorted(set(bb for bucket_list in bucket_lists
+                             for bb in bucket_list))
+        data = dict(zip(indices, self._bucket_storage.read_blocks(indices)))
+        return [[data[bb] for bb in bucket_list]
+                for bucket_list in bucket_lists]
+
+    def write_paths(self, bs, buckets_list, level_start=0):
+        # when paths share a bucket, the data given
+        # for the last of them is written
+        data = {}
+        for b, buckets in zip(bs, buckets_list):
+            assert 0 <= b < self._vheap.bucket_count()
+            assert 0 <= level_start
+            bucket_list = self._vheap.path_buckets(b, level_start)
+            assert len(bucket_list) > 0
+            buckets = list(buckets)
+            assert len(buckets) == len(bucket_list)
+            data.update(zip(bucket_list, buckets))
+        indices = sorted(data)
+        self._bucket_storage.write_blocks(indices,
+                                          [data[bb] for bb in indices])
+
+    def flush(self):
+        self._storage.flush()
+
+    def grow(self, heap_height, initialize=None):
+        """
+        Add levels to the bottom of the heap (up to the new
+        heap height) by appending their buckets to the
+        storage. Buckets keep their index in the heap, so
+        existing buckets are not moved (except with a
+        blocked layout, where the subtrees in the last band
+        of levels are moved when they gain levels). The
+        initialize function (if given) is called with the
+        index of each new bucket.
+        """
+        if (heap_height < self._vheap.height) or \
+           (heap_height != int(heap_height)):
+            raise ValueError(
+                "The new heap height must be an integer that is "
+                "at least the current heap height (%s): %s"
+                % (self._vheap.height, heap_height))
+        vheap = SizedVirtualHeap(
+            self._vheap.k,
+            heap_height,
+            blocks_per_bucket=self._vheap.blocks_per_bucket)
+        if self._layout_subtree_levels == 0:
+            self._storage.grow(vheap.bucket_count(), initialize=initialize)
+        else:
+            self._grow_blocked(vheap, initialize)
+        self._storage.update_header_data(
+            self._pack_header(vheap, self._layout_subtree_levels) + \
+            self.header_data)
+        self._vheap = vheap
+        self._bucket_storage = self._create_bucket_storage()
+
+    def _grow_blocked(self, vheap, initialize):
+        k = vheap.k
+        subtree_levels = self._layout_subtree_levels
+        zeros = bytes(bytearray(self._storage.block_size))
+        if initialize is None:
+            initialize = lambda b: zeros
+        # Only the subtrees in the last band of levels of the
+        # old heap change size (when the band gains levels).
+        band_level = ((self._vheap.levels - 1) // subtree_levels) * \
+            subtree_levels
+        band_first = vheap.first_bucket_at_level(band_level)
+        root_count = vheap.bucket_count_at_level(band_level)
+        old_size = (self._vheap.bucket_count() - band_first) // root_count
+        new_size = (vheap.first_bucket_at_level(
+            min(band_level + subtree_levels, vheap.levels)) - band_first) // \
+            root_count
+        band_end = band_first + root_count * new_size
+        if old_size == new_size:
+            band_end = band_first
+        def _new_bucket(i):
+            if i < band_end:
+                # filled in when the band is moved below
+                return zeros
+            return initialize(calculate_blocked_bucket(
+                k, vheap.levels, subtree_levels, i))
+        self._storage.grow(vheap.bucket_count(), initialize=_new_bucket)
+        if band_end == band_first:
+            return
+        # The new position of each bucket in the band is at
+        # or after its old position, so the subtrees are
+        # moved starting from the last one.
+        group_size = max(1, self._max_grow_chunk_bytes // \
+                         (self._storage.block_size * new_size))
+        for stop in xrange(root_count, 0, -group_size):
+            start = max(0, stop - group_size)
+            blocks = self._storage.read_blocks(
+                list(xrange(band_first + start * old_size,
+                            band_first + stop * old_size)))
+            positions = list(xrange(band_first + start * new_size,
+                                    band_first + stop * new_size))
+            new_blocks = []
+            for r in xrange(stop - start):
+                new_blocks.extend(blocks[r*old_size:(r+1)*old_size])
+                new_blocks.extend(
+                    initialize(calculate_blocked_bucket(
+                        k, vheap.levels, subtree_levels, i))
+                    for i in positions[r*new_size+old_size:
+                                       (r+1)*new_size])
+            self._storage.write_blocks(positions, new_blocks)
 
     @property
     def bytes_sent(self):
@@ -33,6 +33,19 @@ class TestAES(unittest.TestCase):
             lambda i, size: bytes(bytearray([i]) * size),
             [16,24,32])
 
+    def test_Dec_buffer(self):
+        key = AES.KeyGen(16)
+        plaintext = bytes(bytearray(range(40)))
+        for enc_func, dec_func in ((AES.CTREnc, AES.CTRDec),
+                                   (AES.GCMEnc, AES.GCMDec)):
+            ciphertext = enc_func(key, plaintext)
+            for buf in (bytearray(ciphertext),
+                        memoryview(ciphertext),
+                        memoryview(b"xx" + ciphertext)[2:]):
+                decrypted = dec_func(key, buf)
+                self.assertIs(type(decrypted), bytes)
+                self.assertEqual(decrypted, plaintext)
+
     def _test_Enc_Dec(self,
                       enc_func,
                       dec_func,
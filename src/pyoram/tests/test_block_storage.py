@@ -1,24 +1,41 @@
 import os
+import sys
+import mmap
 import shutil
 import unittest
 import tempfile
 import struct
+import threading
 
 from pyoram.storage.block_storage import \
-    BlockStorageTypeFactory
+    (BlockStorageTypeFactory,
+     _PendingWrites)
 from pyoram.storage.block_storage_file import \
      BlockStorageFile
 from pyoram.storage.block_storage_mmap import \
-     BlockStorageMMap
+    (BlockStorageMMap,
+     _advise_mmap)
 from pyoram.storage.block_storage_ram import \
      BlockStorageRAM
+from pyoram.storage.block_storage_shared_memory import \
+    (BlockStorageSharedMemory,
+     shared_memory_available,
+     _attach)
 from pyoram.storage.block_storage_sftp import \
-     BlockStorageSFTP
+    (BlockStorageSFTP,
+     SSHClientPool)
 from pyoram.storage.block_storage_s3 import \
      BlockStorageS3
+from pyoram.storage.block_storage_striped import \
+     BlockStorageStriped
+from pyoram.storage.block_storage_simulated_link import \
+    (BlockStorageSimulatedLink,
+     _SimulatedLink)
 from pyoram.storage.boto3_s3_wrapper import \
     (Boto3S3Wrapper,
-     MockBoto3S3Wrapper)
+     MockBoto3S3Wrapper,
+     _ClientPool,
+     _call_with_backoff)
 
 import six
 from six.moves import xrange
@@ -46,6 +63,10 @@ class TestBlockStorageTypeFactory(unittest.TestCase):
         self.assertIs(BlockStorageTypeFactory('ram'),
                       BlockStorageRAM)
 
+    def test_shared_memory(self):
+        self.assertIs(BlockStorageTypeFactory('shared_memory'),
+                      BlockStorageSharedMemory)
+
     def test_sftp(self):
         self.assertIs(BlockStorageTypeFactory('sftp'),
                       BlockStorageSFTP)
@@ -54,6 +75,14 @@ class TestBlockStorageTypeFactory(unittest.TestCase):
         self.assertIs(BlockStorageTypeFactory('s3'),
                       BlockStorageS3)
 
+    def test_striped(self):
+        self.assertIs(BlockStorageTypeFactory('striped'),
+                      BlockStorageStriped)
+
+    def test_simulated_link(self):
+        self.assertIs(BlockStorageTypeFactory('simulated_link'),
+                      BlockStorageSimulatedLink)
+
     def test_invalid(self):
         with self.assertRaises(ValueError):
             BlockStorageTypeFactory(None)
@@ -68,10 +97,75 @@ class TestBlockStorageTypeFactory(unittest.TestCase):
             BlockStorageTypeFactory.register_device(
                 'new_str_type', str)
 
+class _fake_async_result(object):
+
+    def __init__(self, log, name):
+        self._log = log
+        self._name = name
+        self.done = False
+    def ready(self):
+        return self.done
+    def get(self):
+        self._log.append(self._name)
+        return self._name
+
+class TestPendingWrites(unittest.TestCase):
+
+    def test_overlay(self):
+        log = []
+        pending = _PendingWrites(2)
+        self.assertEqual(len(pending), 0)
+        a = _fake_async_result(log, 'a')
+        pending.reserve([0, 1])
+        pending.push(a, [0, 1], [b'x', b'y'])
+        self.assertEqual(len(pending), 1)
+        self.assertEqual(0 in pending, True)
+        self.assertEqual(2 in pending, False)
+        self.assertEqual(pending.get(1), b'y')
+        pending.reap()
+        self.assertEqual(len(pending), 1)
+        a.done = True
+        pending.reap()
+        self.assertEqual(len(pending), 0)
+        self.assertEqual(0 in pending, False)
+        self.assertEqual(log, ['a'])
+
+    def test_bounded(self):
+        log = []
+        results = []
+        pending = _PendingWrites(2)
+        for i in xrange(3):
+            results.append(_fake_async_result(log, i))
+            pending.reserve([i])
+            pending.push(results[-1], [i], [b'x'])
+        # the oldest batch was waited on to make room
+        self.assertEqual(log, [0])
+        self.assertEqual(len(pending), 2)
+        self.assertEqual(0 in pending, False)
+        pending.drain()
+        self.assertEqual(log, [0, 1, 2])
+        self.assertEqual(len(pending), 0)
+
+    def test_overlap_drains(self):
+        log = []
+        callbacks = []
+        pending = _PendingWrites(4)
+        pending.reserve([0, 1])
+        pending.push(_fake_async_result(log, 'a'), [0, 1], [b'x', b'y'],
+                     callback=callbacks.append)
+        pending.reserve([2])
+        pending.push(_fake_async_result(log, 'b'), [2], [b'z'])
+        self.assertEqual(log, [])
+        pending.reserve([1, 3])
+        self.assertEqual(log, ['a', 'b'])
+        self.assertEqual(callbacks, ['a'])
+        self.assertEqual(len(pending), 0)
+
 class _TestBlockStorage(object):
 
     _type = None
     _type_kwds = None
+    _can_grow = True
 
     @classmethod
     def _read_storage(cls, storage):
@@ -490,6 +584,63 @@ class _TestBlockStorage(object):
         with self._open_teststorage(ignore_lock=True) as f:
             pass
 
+    def test_flush(self):
+        data = [bytes(bytearray([self._block_count])*self._block_size)
+                for i in xrange(self._block_count)]
+        with self._open_teststorage() as f:
+            f.write_blocks(list(xrange(self._block_count)), data)
+            f.flush()
+            with f.clone_device() as g:
+                for i, block in enumerate(
+                        g.read_blocks(list(xrange(self._block_count)))):
+                    self.assertEqual(list(bytearray(block)),
+                                     list(bytearray(data[i])))
+            f.write_blocks(list(xrange(self._block_count)),
+                           [bytes(b) for b in self._blocks])
+            f.flush()
+            with f.clone_device() as g:
+                for i, block in enumerate(
+                        g.read_blocks(list(xrange(self._block_count)))):
+                    self.assertEqual(list(bytearray(block)),
+                                     list(self._blocks[i]))
+
+    def test_grow(self):
+        f = self._type.setup(
+            self._dummy_name,
+            block_size=self._block_size,
+            block_count=self._block_count,
+            initialize=lambda i: bytes(bytearray([i])*self._block_size),
+            header_data=b"user",
+            ignore_existing=True,
+            **self._type_kwds)
+        try:
+            if not self._can_grow:
+                with self.assertRaises(NotImplementedError):
+                    f.grow(self._block_count + 1)
+                return
+            with self.assertRaises(ValueError):
+                f.grow(self._block_count - 1)
+            bytes_sent = f.bytes_sent
+            f.grow(self._block_count + 3,
+                   initialize=lambda i: bytes(bytearray([i])*self._block_size))
+            self.assertEqual(f.bytes_sent - bytes_sent,
+                             3 * self._block_size)
+            f.grow(self._block_count + 4)
+            for t in xrange(2):
+                self.assertEqual(f.block_count, self._block_count + 4)
+                self.assertEqual(f.header_data, b"user")
+                for i in xrange(self._block_count + 3):
+                    self.assertEqual(list(bytearray(f.read_block(i))),
+                                     list(bytearray([i])*self._block_size))
+                self.assertEqual(
+                    list(bytearray(f.read_block(self._block_count + 3))),
+                    list(bytearray(self._block_size)))
+                f.close()
+                f = self._reopen_storage(f)
+        finally:
+            f.close()
+            self._remove_storage(self._dummy_name)
+
     def test_read_block_cloned(self):
         with self._open_teststorage() as forig:
             self.assertEqual(forig.bytes_sent, 0)
@@ -671,26 +822,443 @@ class _TestBlockStorage(object):
             self.assertEqual(forig.bytes_sent, 0)
             self.assertEqual(forig.bytes_received, 0)
 
-class TestBlockStorageFile(_TestBlockStorage,
+class _TestBlockStorageFileWrites(object):
+
+    def test_coalesce_writes(self):
+        with self._open_teststorage() as f:
+            runs, counts = f._coalesce_writes(
+                [(4, b'd'), (1, b'a'), (2, b'b'), (1, b'c'), (0, b'e')])
+            self.assertEqual(runs, [(0, [b'e', b'c', b'b']),
+                                    (4, [b'd'])])
+            self.assertEqual(counts, {0: 1, 1: 2, 2: 1, 4: 1})
+            f._max_io_run_bytes = 2 * f._block_stride
+            runs, counts = f._coalesce_writes(
+                [(i, b'') for i in xrange(5)])
+            self.assertEqual([(i, len(blocks)) for i, blocks in runs],
+                             [(0, 2), (2, 2), (4, 1)])
+
+    def test_write_blocks_unsorted(self):
+        indices = [3, 0, 4, 0, 1]
+        data = [bytes(bytearray([self._block_count + k])*self._block_size)
+                for k in xrange(len(indices))]
+        written = []
+        with self._open_teststorage() as f:
+            f.write_blocks(indices, data, callback=written.append)
+            new = f.read_blocks(list(xrange(self._block_count)))
+            # the last write to an index wins
+            self.assertEqual(list(bytearray(new[0])), list(data[3]))
+            self.assertEqual(list(bytearray(new[1])), list(data[4]))
+            self.assertEqual(list(bytearray(new[2])),
+                             list(self._blocks[2]))
+            self.assertEqual(list(bytearray(new[3])), list(data[0]))
+            self.assertEqual(list(bytearray(new[4])), list(data[2]))
+            f.flush()
+            self.assertEqual(sorted(written), sorted(indices))
+            self.assertEqual(f.bytes_sent,
+                             len(indices)*self._block_size)
+            f.write_blocks(list(xrange(self._block_count)),
+                           [bytes(b) for b in self._blocks])
+        with self._open_teststorage() as f:
+            orig = f.read_blocks(list(xrange(self._block_count)))
+            for i, block in enumerate(orig):
+                self.assertEqual(list(bytearray(block)),
+                                 list(self._blocks[i]))
+
+class _TestBlockStoragePendingWrites(object):
+
+    # the name of the method that performs a batch of
+    # writes in the thread pool
+    _write_method_name = None
+
+    def test_pending_writes(self):
+        data = [bytes(bytearray([self._block_count + 1])*self._block_size)
+                for i in xrange(2)]
+        with self._open_teststorage() as f:
+            self.assertIsNot(f._pool, None)
+            gate = threading.Event()
+            write = getattr(f, self._write_method_name)
+            def _blocked_write(*args):
+                gate.wait()
+                return write(*args)
+            setattr(f, self._write_method_name, _blocked_write)
+            try:
+                f.write_blocks([1, 0], data)
+                self.assertEqual(len(f._pending), 1)
+                # blocks with a pending write are served
+                # without waiting on the write
+                blocks = f.read_blocks([0, 1, 2])
+                self.assertEqual(list(bytearray(blocks[0])),
+                                 list(bytearray(data[1])))
+                self.assertEqual(list(bytearray(blocks[1])),
+                                 list(bytearray(data[0])))
+                self.assertEqual(list(bytearray(blocks[2])),
+                                 list(self._blocks[2]))
+                self.assertEqual(list(bytearray(f.read_block(1))),
+                                 list(bytearray(data[0])))
+                self.assertEqual(
+                    [list(bytearray(b)) for b in f.yield_blocks([2, 0])],
+                    [list(self._blocks[2]), list(bytearray(data[1]))])
+                self.assertEqual(len(f._pending), 1)
+            finally:
+                gate.set()
+            f.flush()
+            self.assertEqual(len(f._pending), 0)
+            f.write_blocks(list(xrange(self._block_count)),
+                           [bytes(b) for b in self._blocks])
+            self.assertEqual(f.bytes_received,
+                             self._block_size*6)
+
+    def test_max_pending_writes(self):
+        with self.assertRaises(ValueError):
+            self._open_teststorage(max_pending_writes=0)
+        with self._open_teststorage(max_pending_writes=2) as f:
+            for i in xrange(self._block_count):
+                f.write_block(i, bytes(self._blocks[i]))
+                self.assertEqual(len(f._pending) <= 2, True)
+            f.flush()
+            self.assertEqual(len(f._pending), 0)
+
+class TestBlockStorageFile(_TestBlockStoragePendingWrites,
+                           _TestBlockStorageFileWrites,
+                           _TestBlockStorage,
                            unittest.TestCase):
     _type = BlockStorageFile
     _type_kwds = {}
+    _write_method_name = '_writev'
 
-class TestBlockStorageFileNoThreadPool(_TestBlockStorage,
+class TestBlockStorageFileNoThreadPool(_TestBlockStorageFileWrites,
+                                       _TestBlockStorage,
                                        unittest.TestCase):
     _type = BlockStorageFile
     _type_kwds = {'threadpool_size': 0}
 
-class TestBlockStorageFileThreadPool(_TestBlockStorage,
+class TestBlockStorageFileThreadPool(_TestBlockStoragePendingWrites,
+                                     _TestBlockStorage,
                                      unittest.TestCase):
     _type = BlockStorageFile
     _type_kwds = {'threadpool_size': 1}
+    _write_method_name = '_writev'
+
+class TestBlockStorageFileDirectIO(_TestBlockStoragePendingWrites,
+                                   _TestBlockStorageFileWrites,
+                                   _TestBlockStorage,
+                                   unittest.TestCase):
+    _type = BlockStorageFile
+    _type_kwds = {'direct_io': True}
+    _write_method_name = '_writev'
+
+    #
+    # Override some of the test methods (the storage
+    # layout is padded when direct_io is used)
+    #
+
+    def test_setup(self):
+        fname = ".".join(self.id().split(".")[1:])
+        fname += ".bin"
+        fname = os.path.join(thisdir, fname)
+        self._remove_storage(fname)
+        bsize = 10
+        bcount = 11
+        fsetup = self._type.setup(fname, bsize, bcount, **self._type_kwds)
+        fsetup.close()
+        flen = len(self._read_storage(fsetup))
+        self.assertEqual(
+            flen,
+            self._type.compute_storage_size(bsize,
+                                            bcount,
+                                            direct_io=True))
+        self.assertEqual(
+            flen,
+            BlockStorageFile._direct_io_alignment * (bcount + 1))
+        self.assertEqual(
+            flen >
+            self._type.compute_storage_size(bsize,
+                                            bcount),
+            True)
+        with self._reopen_storage(fsetup) as f:
+            self.assertEqual(f.header_data, bytes())
+            self.assertEqual(f.block_size, bsize)
+            self.assertEqual(f.block_count, bcount)
+            self.assertEqual(f.storage_name, fname)
+        self._remove_storage(fname)
+
+    def test_setup_withdata(self):
+        fname = ".".join(self.id().split(".")[1:])
+        fname += ".bin"
+        fname = os.path.join(thisdir, fname)
+        self._remove_storage(fname)
+        bsize = 10
+        bcount = 11
+        header_data = bytes(bytearray([0,1,2]))
+        fsetup = self._type.setup(fname,
+                                  bsize,
+                                  bcount,
+                                  header_data=header_data,
+                                  **self._type_kwds)
+        fsetup.close()
+        flen = len(self._read_storage(fsetup))
+        self.assertEqual(
+            flen,
+            self._type.compute_storage_size(bsize,
+                                            bcount,
+                                            header_data=header_data,
+                                            direct_io=True))
+        with self._reopen_storage(fsetup) as f:
+            self.assertEqual(f.header_data, header_data)
+            self.assertEqual(f.block_size, bsize)
+            self.assertEqual(f.block_count, bcount)
+        self._remove_storage(fname)
+
+    def test_direct_io_enabled(self):
+        with self._open_teststorage() as f:
+            if hasattr(os, "O_DIRECT") and hasattr(os, "preadv"):
+                # the filesystem may still not support it
+                if f._direct_fd is None:
+                    self.skipTest("O_DIRECT is not supported "
+                                  "by this filesystem")
+            else:
+                self.assertEqual(f._direct_fd, None)  # pragma: no cover
+            self.assertEqual(
+                f._header_offset % BlockStorageFile._direct_io_alignment,
+                0)
+            self.assertEqual(
+                f._block_stride % BlockStorageFile._direct_io_alignment,
+                0)
+            with f.clone_device() as f1:
+                self.assertNotEqual(f1._direct_fd, None)
+
+    def test_direct_io_short_read(self):
+        preadv = os.preadv
+        def _short_preadv(fd, bufs, offset):
+            return preadv(fd, bufs, offset) - 1
+        with self._open_teststorage() as f:
+            if f._direct_fd is None:
+                self.skipTest("O_DIRECT is not supported")
+            self.assertEqual(list(bytearray(f.read_block(0))),
+                             list(self._blocks[0]))
+            os.preadv = _short_preadv
+            try:
+                with self.assertRaises(IOError):
+                    f.read_block(1)
+                with self.assertRaises(IOError):
+                    f.read_blocks([0, 1])
+            finally:
+                os.preadv = preadv
+
+    def test_direct_io_short_write(self):
+        pwritev = os.pwritev
+        calls = []
+        def _short_pwritev(fd, bufs, offset):
+            # write only the first buffer
+            calls.append(len(bufs))
+            return pwritev(fd, bufs[:1], offset)
+        with self._open_teststorage(threadpool_size=0) as f:
+            if f._direct_fd is None:
+                self.skipTest("O_DIRECT is not supported")
+            os.pwritev = _short_pwritev
+            try:
+                f.write_blocks([1, 2, 3],
+                               [bytes(self._blocks[i]) for i in [3, 1, 2]])
+            finally:
+                os.pwritev = pwritev
+            self.assertEqual(calls, [3, 2, 1])
+            self.assertEqual(
+                [list(bytearray(b)) for b in f.read_blocks([1, 2, 3])],
+                [list(self._blocks[i]) for i in [3, 1, 2]])
+            f.write_blocks([1, 2, 3],
+                           [bytes(self._blocks[i]) for i in [1, 2, 3]])
+            os.pwritev = lambda fd, bufs, offset: 0
+            try:
+                with self.assertRaises(IOError):
+                    f.write_block(1, bytes(self._blocks[1]))
+            finally:
+                os.pwritev = pwritev
+            self.assertEqual(
+                [list(bytearray(b)) for b in f.read_blocks([1, 2, 3])],
+                [list(self._blocks[i]) for i in [1, 2, 3]])
+
+    def test_open_without_direct_io(self):
+        with BlockStorageFile(self._testfname) as f:
+            self.assertEqual(f._direct_fd, None)
+            self.assertEqual(
+                f._block_stride,
+                BlockStorageFile._direct_io_alignment)
+            for i, block in enumerate(self._blocks):
+                self.assertEqual(list(bytearray(f.read_block(i))),
+                                 list(block))
+        with BlockStorageMMap(self._testfname) as f:
+            for i, block in enumerate(self._blocks):
+                self.assertEqual(list(bytearray(f.read_block(i))),
+                                 list(block))
+        with self.assertRaises(ValueError):
+            BlockStorageMMap(self._testfname, direct_io=True)
+
+    def test_fallback_unaligned_layout(self):
+        fname = ".".join(self.id().split(".")[1:])
+        fname += ".bin"
+        fname = os.path.join(thisdir, fname)
+        self._remove_storage(fname)
+        with BlockStorageFile.setup(fname, 10, 3) as f:
+            pass
+        with BlockStorageFile(fname, direct_io=True) as f:
+            self.assertEqual(f._direct_fd, None)
+            self.assertEqual(f._block_stride, 10)
+            f.write_block(1, bytes(bytearray([1])*10))
+            self.assertEqual(list(bytearray(f.read_block(1))),
+                             [1]*10)
+        self._remove_storage(fname)
+
+    def test_layout_size_mismatch(self):
+        fname = ".".join(self.id().split(".")[1:])
+        fname += ".bin"
+        fname = os.path.join(thisdir, fname)
+        self._remove_storage(fname)
+        alignment = BlockStorageFile._direct_io_alignment
+        for direct_io in (True, False):
+            with BlockStorageFile.setup(fname,
+                                        10,
+                                        3,
+                                        header_data=b"abc",
+                                        ignore_existing=True,
+                                        direct_io=direct_io) as f:
+                pass
+            with open(fname, 'rb') as f:
+                block_size, block_count, user_header_size, locked = \
+                    struct.unpack(
+                        BlockStorageFile._index_struct_string,
+                        f.read(BlockStorageFile._index_offset))
+            self.assertEqual(
+                user_header_size,
+                3 | (BlockStorageFile._aligned_layout_flag
+                     if direct_io else 0))
+            size = os.path.getsize(fname)
+            # an interrupted grow() appends blocks without
+            # updating the block count
+            with open(fname, 'ab') as f:
+                f.write(bytes(bytearray(alignment if direct_io else 10)))
+            for type_ in (BlockStorageFile, BlockStorageMMap):
+                with self.assertRaises(ValueError):
+                    type_(fname)
+            # a truncated copy
+            with open(fname, 'r+b') as f:
+                f.truncate(size - 1)
+            for type_ in (BlockStorageFile, BlockStorageMMap):
+                with self.assertRaises(ValueError):
+                    type_(fname)
+            with open(fname, 'r+b') as f:
+                f.truncate(size)
+            # a failed open does not leave the storage locked
+            with BlockStorageFile(fname) as f:
+                self.assertEqual(f.header_data, b"abc")
+                self.assertEqual(f._block_stride,
+                                 alignment if direct_io else 10)
+            if direct_io:
+                with self.assertRaises(ValueError):
+                    BlockStorageRAM.fromfile(fname)
+            else:
+                with BlockStorageRAM.fromfile(fname) as f:
+                    self.assertEqual(f.header_data, b"abc")
+        self._remove_storage(fname)
 
 class TestBlockStorageMMap(_TestBlockStorage,
                            unittest.TestCase):
     _type = BlockStorageMMap
     _type_kwds = {}
 
+class TestBlockStorageMMapAdvice(_TestBlockStorage,
+                                 unittest.TestCase):
+    _type = BlockStorageMMap
+    _type_kwds = {'madvise': 'random',
+                  'populate': True,
+                  'huge_pages': True}
+
+    def test_invalid_madvise(self):
+        with self.assertRaises(ValueError):
+            self._type.setup(self._dummy_name,
+                             block_size=1,
+                             block_count=1,
+                             madvise='dontneed')
+        self.assertEqual(self._check_exists(self._dummy_name), False)
+        with self.assertRaises(ValueError):
+            self._type(self._testfname, madvise='dontneed')
+        # the storage was not left locked
+        with self._open_teststorage() as f:
+            pass
+
+class _recording_mmap(object):
+    def __init__(self):
+        self.advice = []
+    def madvise(self, option):
+        self.advice.append(option)
+
+@unittest.skipIf(not hasattr(mmap, 'MADV_RANDOM'),
+                 "mmap.madvise is not available")
+class TestAdviseMMap(unittest.TestCase):
+
+    def test_advice(self):
+        mm = _recording_mmap()
+        _advise_mmap(mm)
+        self.assertEqual(mm.advice, [])
+        _advise_mmap(mm, advice='random')
+        self.assertEqual(mm.advice, [mmap.MADV_RANDOM])
+        mm = _recording_mmap()
+        _advise_mmap(mm, advice='willneed', huge_pages=True)
+        self.assertEqual(mm.advice[0], mmap.MADV_WILLNEED)
+        if hasattr(mmap, 'MADV_HUGEPAGE'):
+            self.assertEqual(mm.advice[1:], [mmap.MADV_HUGEPAGE])
+
+    def test_populate(self):
+        mm = _recording_mmap()
+        _advise_mmap(mm, populate=True)
+        if hasattr(mmap, 'MAP_POPULATE'):
+            # handled by the flags of the mapping
+            self.assertEqual(mm.advice, [])
+        else:
+            self.assertEqual(mm.advice,                # pragma: no cover
+                             [mmap.MADV_WILLNEED])     # pragma: no cover
+
+    def test_unsupported(self):
+        # hints are skipped when they can not be applied
+        _advise_mmap(object(), advice='random')
+        class _failing_mmap(object):
+            def madvise(self, option):
+                raise OSError("not supported")
+        _advise_mmap(_failing_mmap(), advice='random', huge_pages=True)
+
+class _TestBlockStorageZeroCopy(object):
+
+    def test_read_zero_copy(self):
+        with self._open_teststorage() as f:
+            block = f.read_block(1)
+            self.assertIs(type(block), memoryview)
+            self.assertEqual(block.readonly, True)
+            with self.assertRaises(TypeError):
+                block[0:1] = b"x"
+            self.assertEqual(list(bytearray(block)), list(self._blocks[1]))
+            copied = bytes(block)
+            blocks = f.read_blocks([0, 1])
+            self.assertTrue(all(type(b) is memoryview for b in blocks))
+            self.assertTrue(all(type(b) is memoryview
+                                for b in f.yield_blocks([0, 1])))
+            with f.clone_device() as f1:
+                self.assertIs(type(f1.read_block(1)), memoryview)
+            # views reflect later writes to the same block
+            f.write_block(1, bytes(bytearray([200])*self._block_size))
+            self.assertEqual(list(bytearray(block)),
+                             [200]*self._block_size)
+            self.assertEqual(list(bytearray(copied)),
+                             list(self._blocks[1]))
+            f.write_block(1, copied)
+        # views stay valid after the device is closed
+        self.assertEqual(list(bytearray(block)), list(self._blocks[1]))
+        self.assertEqual(list(bytearray(blocks[0])), list(self._blocks[0]))
+
+class TestBlockStorageMMapZeroCopy(_TestBlockStorageZeroCopy,
+                                   _TestBlockStorage,
+                                   unittest.TestCase):
+    _type = BlockStorageMMap
+    _type_kwds = {'zero_copy': True}
+
 class _TestBlockStorageRAM(_TestBlockStorage):
 
     @classmethod
@@ -816,7 +1384,211 @@ class TestBlockStorageRAM(_TestBlockStorageRAM,
     _type = BlockStorageRAM
     _type_kwds = {}
 
+class TestBlockStorageRAMZeroCopy(_TestBlockStorageZeroCopy,
+                                  _TestBlockStorageRAM,
+                                  unittest.TestCase):
+    _type = BlockStorageRAM
+    _type_kwds = {'zero_copy': True}
+
+    def test_grow_zero_copy(self):
+        f = BlockStorageRAM.setup(None,
+                                  self._block_size,
+                                  self._block_count,
+                                  zero_copy=True)
+        try:
+            # closed clones do not pin the bytearray
+            f.clone_device().close()
+            f.grow(self._block_count + 1)
+            self.assertEqual(f.block_count, self._block_count + 1)
+            # neither does a clone closed after a read
+            with f.clone_device() as f1:
+                f1.read_block(0)
+            f.grow(self._block_count + 2)
+            self.assertEqual(f.block_count, self._block_count + 2)
+            block = f.read_block(0)
+            with self.assertRaises(BufferError):
+                f.grow(self._block_count + 3)
+            self.assertEqual(f.block_count, self._block_count + 2)
+            del block
+            f.grow(self._block_count + 3)
+            self.assertEqual(f.block_count, self._block_count + 3)
+        finally:
+            f.close()
+
+def _shared_memory_worker(storage_name, indices, value):
+    # runs in a separate process
+    with BlockStorageSharedMemory(storage_name, ignore_lock=True) as f:
+        f.write_blocks(indices,
+                       [bytes(bytearray([value])*f.block_size)
+                        for i in indices])
+
+@unittest.skipIf(not shared_memory_available,
+                 "multiprocessing.shared_memory is not available")
+class TestBlockStorageSharedMemory(_TestBlockStorage,
+                                   unittest.TestCase):
+    _type = BlockStorageSharedMemory
+    _type_kwds = {}
+    _can_grow = False
+
+    @classmethod
+    def _read_storage(cls, storage):
+        shm = _attach(storage.storage_name)
+        try:
+            block_size, block_count, user_header_size, _ = \
+                struct.unpack(
+                    BlockStorageSharedMemory._index_struct_string,
+                    bytes(shm.buf[:BlockStorageSharedMemory._index_offset]))
+            return bytes(shm.buf[:BlockStorageSharedMemory._index_offset + \
+                                 user_header_size + \
+                                 block_size * block_count])
+        finally:
+            shm.close()
+
+    @classmethod
+    def _remove_storage(cls, name):
+        if cls._check_exists(name):
+            BlockStorageSharedMemory.unlink(name)
+
+    @classmethod
+    def _check_exists(cls, name):
+        try:
+            _attach(name).close()
+        except OSError:
+            return False
+        return True
+
+    @classmethod
+    def _get_empty_existing(cls):
+        return cls.__name__ + "_exists"
+
+    @classmethod
+    def _get_dummy_noexist(cls):
+        return cls.__name__ + "_noexist"
+
+    @classmethod
+    def setUpClass(cls):
+        _attach(cls._get_empty_existing(), create=True, size=1).close()
+        super(TestBlockStorageSharedMemory, cls).setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super(TestBlockStorageSharedMemory, cls).tearDownClass()
+        cls._remove_storage(cls._get_empty_existing())
+
+    def test_read_returns_memoryview(self):
+        with self._open_teststorage() as f:
+            block = f.read_block(1)
+            self.assertIs(type(block), memoryview)
+            self.assertEqual(block.readonly, True)
+            self.assertEqual(list(bytearray(block)), list(self._blocks[1]))
+            self.assertTrue(all(type(b) is memoryview
+                                for b in f.read_blocks([0, 1])))
+            # reads are views into the shared memory
+            f.write_block(1, bytes(bytearray([200])*self._block_size))
+            self.assertEqual(list(bytearray(block)),
+                             [200]*self._block_size)
+            f.write_block(1, bytes(self._blocks[1]))
+            copy = bytes(block)
+        # the views are released when the device is closed
+        with self.assertRaises(ValueError):
+            bytes(block)
+        self.assertEqual(list(bytearray(copy)), list(self._blocks[1]))
+
+    def test_close_with_derived_views(self):
+        f = self._open_teststorage()
+        view = f.read_block(1)[1:]
+        with self.assertRaises(BufferError):
+            f.close()
+        view.release()
+        f.close()
+        self.assertEqual(f._shm, None)
+
+    def test_prune_read_views(self):
+        with self._open_teststorage() as f:
+            f._min_prune_size = f._prune_size = 4
+            kept = f.read_blocks([0, 1])
+            for i in xrange(100):
+                f.read_block(2)
+            self.assertTrue(len(f._read_views) <= 8)
+            self.assertTrue(all(any(v is k for v in f._read_views)
+                                for k in kept))
+
+    def test_segment_outlives_creator(self):
+        # the segment must not be removed when the process
+        # that created it exits
+        import time
+        import subprocess
+        import multiprocessing
+        import pyoram
+        name = self.__class__.__name__ + "_creator"
+        self._remove_storage(name)
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(
+            [os.path.dirname(os.path.dirname(os.path.abspath(
+                pyoram.__file__)))] + \
+            ([env['PYTHONPATH']] if 'PYTHONPATH' in env else []))
+        subprocess.check_call(
+            [sys.executable,
+             "-c",
+             "from pyoram.storage.block_storage_shared_memory import "
+             "BlockStorageSharedMemory; "
+             "BlockStorageSharedMemory.setup(%r, 4, 5).close()" % (name)],
+            env=env)
+        try:
+            # the resource tracker of the creating process
+            # removes leaked segments shortly after it exits
+            for i in xrange(10):
+                self.assertEqual(self._check_exists(name), True)
+                time.sleep(0.05)
+            p = multiprocessing.Process(target=_shared_memory_worker,
+                                        args=(name, [2], 7))
+            p.start()
+            p.join()
+            self.assertEqual(p.exitcode, 0)
+            with BlockStorageSharedMemory(name) as f:
+                self.assertEqual(bytes(f.read_block(2)),
+                                 bytes(bytearray([7])*4))
+                self.assertEqual(bytes(f.read_block(1)),
+                                 bytes(bytearray(4)))
+            self.assertEqual(self._check_exists(name), True)
+        finally:
+            self._remove_storage(name)
+        self.assertEqual(self._check_exists(name), False)
+
+    def test_multiprocess(self):
+        import multiprocessing
+        with self._open_teststorage() as f:
+            p = multiprocessing.Process(target=_shared_memory_worker,
+                                        args=(f.storage_name, [0, 3], 100))
+            p.start()
+            p.join()
+            self.assertEqual(p.exitcode, 0)
+            self.assertEqual(
+                [list(bytearray(b)) for b in
+                 f.read_blocks(list(xrange(self._block_count)))],
+                [([100]*self._block_size if i in (0, 3) else
+                  list(self._blocks[i])) for i in xrange(self._block_count)])
+            f.write_blocks([0, 3], [bytes(self._blocks[0]),
+                                    bytes(self._blocks[3])])
+
+    def test_setup_generated_name(self):
+        with self._type.setup(None, 4, 2) as f:
+            name = f.storage_name
+            self.assertTrue(name is not None)
+            self.assertEqual(self._check_exists(name), True)
+        self._remove_storage(name)
+        self.assertEqual(self._check_exists(name), False)
+
+    def test_tofile(self):
+        with self._open_teststorage(ignore_lock=True) as f:
+            out = BytesIO()
+            f.tofile(out)
+            self.assertEqual(out.getvalue(),
+                             self._read_storage(f))
+
 class _dummy_sftp_file(object):
+    # the (offset, size) lists passed to readv
+    readv_requests = []
     def __init__(self, *args, **kwds):
         self._f = open(*args, **kwds)
     def __enter__(self):
@@ -824,11 +1596,13 @@ class _dummy_sftp_file(object):
     def __exit__(self, *args):
         self._f.close()
     def readv(self, chunks):
-        data = []
+        # like paramiko, requests are sent when the first
+        # block is retrieved
+        chunks = list(chunks)
+        _dummy_sftp_file.readv_requests.append(chunks)
         for offset, size in chunks:
             self._f.seek(offset)
-            data.append(self._f.read(size))
-        return data
+            yield self._f.read(size)
     def __getattr__(self, key):
         return getattr(self._f, key)
     def set_pipelined(self):
@@ -849,6 +1623,41 @@ class dummy_sshclient(object):
     def open_sftp():
         return dummy_sftp
 
+class _counting_sshclient(object):
+    def __init__(self):
+        self.sessions = 0
+        self.closed = False
+    def open_sftp(self):
+        self.sessions += 1
+        return dummy_sftp
+    def close(self):
+        self.closed = True
+
+class TestSSHClientPool(unittest.TestCase):
+
+    def test_init_fails(self):
+        with self.assertRaises(ValueError):
+            SSHClientPool([])
+        with self.assertRaises(ValueError):
+            SSHClientPool.connect(_counting_sshclient, 0)
+
+    def test_round_robin(self):
+        clients = [_counting_sshclient() for _ in range(3)]
+        with SSHClientPool(clients) as pool:
+            self.assertEqual(len(pool), 3)
+            for _ in range(7):
+                self.assertIs(pool.open_sftp(), dummy_sftp)
+            self.assertEqual(pool.session_counts, [3, 2, 2])
+            self.assertEqual([c.sessions for c in clients], [3, 2, 2])
+        # the pool does not own these clients
+        self.assertEqual([c.closed for c in clients], [False]*3)
+
+    def test_connect(self):
+        with SSHClientPool.connect(_counting_sshclient, 2) as pool:
+            self.assertEqual(len(pool), 2)
+            clients = pool._sshclients
+        self.assertEqual([c.closed for c in clients], [True]*2)
+
 class TestBlockStorageSFTP(_TestBlockStorage,
                            unittest.TestCase):
     _type = BlockStorageSFTP
@@ -883,10 +1692,407 @@ class TestBlockStorageSFTP(_TestBlockStorage,
         dataafter = self._read_storage(self._original_f)
         self.assertEqual(databefore, dataafter)
 
+    def test_read_blocks_readv(self):
+        requests = _dummy_sftp_file.readv_requests
+        with self._open_teststorage() as f:
+            offset = f._header_offset
+            del requests[:]
+            blocks = f.read_blocks([4, 0, 1, 2, 0])
+            self.assertEqual([list(bytearray(b)) for b in blocks],
+                             [list(self._blocks[i]) for i in [4, 0, 1, 2, 0]])
+            # a single request with adjacent blocks merged
+            self.assertEqual(
+                requests,
+                [[(offset, 3*self._block_size),
+                  (offset + 4*self._block_size, self._block_size)]])
+            self.assertEqual(f.bytes_received, 5*self._block_size)
+
+    def test_max_pending_writes(self):
+        fname = ".".join(self.id().split(".")[1:])
+        fname += ".bin"
+        fname = os.path.join(thisdir, fname)
+        self._remove_storage(fname)
+        with self._type.setup(fname,
+                              self._block_size,
+                              self._block_count,
+                              max_pending_writes=2,
+                              **self._type_kwds) as f:
+            self.assertEqual(f._pending._max_batches, 2)
+            with f.clone_device() as f1:
+                self.assertEqual(f1._pending._max_batches, 2)
+        with self._type(fname,
+                        max_pending_writes=3,
+                        **self._type_kwds) as f:
+            with f.clone_device() as f1:
+                self.assertEqual(f1._pending._max_batches, 3)
+        self._remove_storage(fname)
+
+    def test_clone_device_sshclient_pool(self):
+        clients = [_counting_sshclient() for _ in range(3)]
+        kwds = dict(self._type_kwds)
+        kwds['sshclient'] = SSHClientPool(clients)
+        with self._type(self._testfname, **kwds) as f:
+            clones = [f.clone_device() for _ in range(4)]
+            self.assertEqual([c.sessions for c in clients], [2, 2, 1])
+            for g in clones:
+                self.assertEqual(
+                    [list(bytearray(b)) for b in
+                     g.read_blocks(list(xrange(self._block_count)))],
+                    [list(b) for b in self._blocks])
+                g.close()
+
+    def test_yield_blocks_prefetch(self):
+        requests = _dummy_sftp_file.readv_requests
+        with self._open_teststorage() as f:
+            offset = f._header_offset
+            del requests[:]
+            # hold back the reply to the second request
+            sent = threading.Event()
+            reply = threading.Event()
+            readv = f._f.readv
+            def _readv(chunks):
+                if len(requests) == 1:
+                    sent.set()
+                    self.assertTrue(reply.wait(10))
+                return readv(chunks)
+            f._f.readv = _readv
+            blocks = f.yield_blocks([0, 2, 4, 3, 1], chunksize=2)
+            self.assertEqual(list(bytearray(six.next(blocks))),
+                             list(self._blocks[0]))
+            # the second chunk was requested before the
+            # blocks of the first were handed out, without
+            # waiting on its reply
+            self.assertTrue(sent.wait(10))
+            self.assertFalse(reply.is_set())
+            self.assertEqual(list(bytearray(six.next(blocks))),
+                             list(self._blocks[2]))
+            reply.set()
+            self.assertEqual([list(bytearray(b)) for b in blocks],
+                             [list(self._blocks[i]) for i in [4, 3, 1]])
+            self.assertEqual(
+                requests,
+                [[(offset, self._block_size),
+                  (offset + 2*self._block_size, self._block_size)],
+                 [(offset + 3*self._block_size, 2*self._block_size)],
+                 [(offset + self._block_size, self._block_size)]])
+
+class TestBlockStorageSFTPClientPool(TestBlockStorageSFTP):
+    _type_kwds = {'sshclient': SSHClientPool([dummy_sshclient]*2)}
+
+class _TestBlockStorageStriped(_TestBlockStorage):
+    _type = BlockStorageStriped
+    _type_kwds = {}
+    _can_grow = False
+
+    @classmethod
+    def _stripe_count(cls):
+        return cls._type_kwds['stripe_count']
+
+    @classmethod
+    def _layout_kwds(cls):
+        return dict((key, cls._type_kwds[key])
+                    for key in ('stripe_count', 'stripe_unit')
+                    if key in cls._type_kwds)
+
+    @classmethod
+    def _read_storage(cls, storage):
+        data = bytearray()
+        for s in xrange(storage.stripe_count):
+            with open("%s.%d" % (storage.storage_name, s), 'rb') as f:
+                data.extend(f.read())
+        return data
+
+    @classmethod
+    def _remove_storage(cls, name):
+        for s in xrange(cls._stripe_count()):
+            _TestBlockStorage._remove_storage("%s.%d" % (name, s))
+
+    @classmethod
+    def _check_exists(cls, name):
+        return os.path.exists(name + ".0")
+
+    @classmethod
+    def _get_empty_existing(cls):
+        return os.path.join(thisdir,
+                            "baselines",
+                            "exists")
+
+    @classmethod
+    def setUpClass(cls):
+        super(_TestBlockStorageStriped, cls).setUpClass()
+        # the first stripe name associated with
+        # _get_empty_existing()
+        with open(cls._get_empty_existing() + ".0", 'wb'):
+            pass
+
+    @classmethod
+    def tearDownClass(cls):
+        super(_TestBlockStorageStriped, cls).tearDownClass()
+        os.remove(cls._get_empty_existing() + ".0")
+
+    #
+    # Override some of the test methods (the storage
+    # size depends on the stripe layout)
+    #
+
+    def test_setup(self):
+        fname = ".".join(self.id().split(".")[1:])
+        fname += ".bin"
+        fname = os.path.join(thisdir, fname)
+        self._remove_storage(fname)
+        bsize = 10
+        bcount = 11
+        fsetup = self._type.setup(fname, bsize, bcount, **self._type_kwds)
+        fsetup.close()
+        flen = len(self._read_storage(fsetup))
+        self.assertEqual(
+            flen,
+            self._type.compute_storage_size(bsize,
+                                            bcount,
+                                            **self._layout_kwds()))
+        self.assertEqual(
+            flen >
+            self._type.compute_storage_size(bsize,
+                                            bcount,
+                                            ignore_header=True,
+                                            **self._layout_kwds()),
+            True)
+        with self._reopen_storage(fsetup) as f:
+            self.assertEqual(f.header_data, bytes())
+            self.assertEqual(f.block_size, bsize)
+            self.assertEqual(f.block_count, bcount)
+            self.assertEqual(f.storage_name, fname)
+            self.assertEqual(f.stripe_count, self._stripe_count())
+        # the stripe count is discovered from the first stripe
+        with BlockStorageStriped(fname) as f:
+            self.assertEqual(f.stripe_count, self._stripe_count())
+            self.assertEqual(f.block_count, bcount)
+        self._remove_storage(fname)
+
+    def test_setup_withdata(self):
+        fname = ".".join(self.id().split(".")[1:])
+        fname += ".bin"
+        fname = os.path.join(thisdir, fname)
+        self._remove_storage(fname)
+        bsize = 10
+        bcount = 11
+        header_data = bytes(bytearray([0,1,2]))
+        fsetup = self._type.setup(fname,
+                                  bsize,
+                                  bcount,
+                                  header_data=header_data,
+                                  **self._type_kwds)
+        fsetup.close()
+        flen = len(self._read_storage(fsetup))
+        self.assertEqual(
+            flen,
+            self._type.compute_storage_size(bsize,
+                                            bcount,
+                                            header_data=header_data,
+                                            **self._layout_kwds()))
+        with self._reopen_storage(fsetup) as f:
+            self.assertEqual(f.header_data, header_data)
+            self.assertEqual(f.block_size, bsize)
+            self.assertEqual(f.block_count, bcount)
+        self._remove_storage(fname)
+
+    def test_stripe_layout(self):
+        with self._open_teststorage() as f:
+            counts = [0] * f.stripe_count
+            for i in xrange(f.block_count):
+                s, j = f._locate(i)
+                self.assertEqual(f._global_index(s, j), i)
+                counts[s] += 1
+            self.assertEqual(
+                counts,
+                [stripe.block_count for stripe in f._stripes])
+            for s in xrange(f.stripe_count):
+                with BlockStorageFile(
+                        "%s.%d" % (self._testfname, s),
+                        ignore_lock=True) as stripe:
+                    for j in xrange(stripe.block_count):
+                        self.assertEqual(
+                            list(bytearray(stripe.read_block(j))),
+                            list(self._blocks[f._global_index(s, j)]))
+
+    def test_stripe_names(self):
+        fname = ".".join(self.id().split(".")[1:])
+        names = [os.path.join(thisdir, fname + "_%d.bin" % (s))
+                 for s in xrange(self._stripe_count())]
+        with self.assertRaises(ValueError):
+            self._type.setup(names,
+                             1,
+                             10,
+                             stripe_count=len(names)+1)
+        with self._type.setup(names, 1, 10) as f:
+            self.assertEqual(f.stripe_count, len(names))
+            f.write_blocks(list(xrange(10)),
+                           [bytes(bytearray([i])) for i in xrange(10)])
+        with self.assertRaises(ValueError):
+            self._type(list(reversed(names)))
+        with self._type(names) as f:
+            self.assertEqual(
+                [bytearray(b)[0] for b in f.read_blocks(xrange(10))],
+                list(xrange(10)))
+        for name in names:
+            os.remove(name)
+
+    def test_setup_too_few_blocks(self):
+        with self.assertRaises(ValueError):
+            self._type.setup(self._dummy_name,
+                             block_size=1,
+                             block_count=self._stripe_count() - 1,
+                             **self._type_kwds)
+        self.assertEqual(self._check_exists(self._dummy_name), False)
+
+class TestBlockStorageStriped(_TestBlockStorageStriped,
+                              unittest.TestCase):
+    _type_kwds = {'stripe_count': 3}
+
+class TestBlockStorageStripedNoThreadPool(_TestBlockStorageStriped,
+                                          unittest.TestCase):
+    _type_kwds = {'stripe_count': 2,
+                  'threadpool_size': 0}
+
+class TestBlockStorageStripedUnit(_TestBlockStorageStriped,
+                                  unittest.TestCase):
+    _type_kwds = {'stripe_count': 2,
+                  'stripe_unit': 2}
+
+class _TestBlockStorageSimulatedLink(_TestBlockStorage):
+    _type = BlockStorageSimulatedLink
+    _type_kwds = {}
+
+    def _open_link(self, **kwds):
+        # replace the link settings of this test class
+        for name in ('wrapped_storage_type', 'threadpool_size'):
+            if name in self._type_kwds:
+                kwds.setdefault(name, self._type_kwds[name])
+        return self._type(self._testfname, **kwds)
+
+    def test_wrap_device(self):
+        with BlockStorageFile(self._testfname) as raw:
+            with self.assertRaises(ValueError):
+                BlockStorageSimulatedLink(raw, threadpool_size=0,
+                                          wrapped_storage_type='file')
+        raw = BlockStorageFile(self._testfname)
+        with BlockStorageSimulatedLink(raw, threadpool_size=0) as f:
+            self.assertIs(f.wrapped_storage, raw)
+            self.assertEqual(f.block_size, raw.block_size)
+            self.assertEqual(f.block_count, raw.block_count)
+            self.assertEqual(list(bytearray(f.read_block(1))),
+                             list(self._blocks[1]))
+            self.assertEqual(f.request_count, 1)
+        self.assertEqual(raw._f, None)
+
+    def test_wrapped_storage_class(self):
+        self.assertEqual(
+            BlockStorageSimulatedLink.compute_storage_size(
+                10, 10, wrapped_storage_type=BlockStorageRAM),
+            BlockStorageRAM.compute_storage_size(10, 10))
+        with BlockStorageSimulatedLink.setup(
+                None, 10, 10,
+                wrapped_storage_type=BlockStorageRAM,
+                initialize=lambda i: bytes(bytearray([i])*10),
+                threadpool_size=0) as f:
+            self.assertIs(type(f.wrapped_storage), BlockStorageRAM)
+            self.assertEqual(list(bytearray(f.read_block(3))), [3]*10)
+        with BlockStorageSimulatedLink(self._testfname,
+                                       wrapped_storage_type=BlockStorageFile,
+                                       threadpool_size=0) as f:
+            self.assertIs(type(f.wrapped_storage), BlockStorageFile)
+        with self.assertRaises(ValueError):
+            BlockStorageSimulatedLink.compute_storage_size(
+                10, 10, wrapped_storage_type=int)
+
+    def test_latency(self):
+        with self._open_link(latency=0.01) as f:
+            f.read_block(0)
+            f.read_blocks(list(xrange(self._block_count)))
+            list(f.yield_blocks([1, 2]))
+            self.assertEqual(f.request_count, 3)
+            self.assertEqual(f.simulated_delay >= 0.03, True)
+            f.write_blocks([0], [bytes(self._blocks[0])])
+            f.write_block(1, bytes(self._blocks[1]))
+            f.flush()
+            self.assertEqual(f.request_count, 5)
+            self.assertEqual(f.simulated_delay >= 0.05, True)
+
+    def test_bandwidth(self):
+        # the link moves all blocks in 0.05 seconds
+        bandwidth = self._block_size * self._block_count * 20
+        with self._open_link(bandwidth=bandwidth) as f:
+            f.read_blocks(list(xrange(self._block_count)))
+            self.assertEqual(f.request_count, 1)
+            self.assertEqual(f.simulated_delay >= 0.05, True)
+            # clones share the link (and the bandwidth)
+            with f.clone_device() as g:
+                g.read_blocks(list(xrange(self._block_count)))
+                self.assertEqual(g.request_count, 2)
+                self.assertEqual(g.simulated_delay >= 0.1, True)
+            self.assertEqual(f.request_count, 2)
+
+    def test_max_concurrency(self):
+        with self._open_link(latency=0.01,
+                                    max_concurrency=1) as f:
+            clones = [f.clone_device() for i in xrange(3)]
+            threads = [threading.Thread(target=g.read_block, args=(0,))
+                       for g in clones]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            for g in clones:
+                g.close()
+            self.assertEqual(f.request_count, 3)
+            # requests wait on each other for a slot on the link
+            self.assertEqual(f.simulated_delay >= 0.06, True)
+
+    def test_jitter(self):
+        delays = []
+        for i in xrange(2):
+            link = _SimulatedLink(latency=1, jitter=0.5, seed=7)
+            delays.append([link._round_trip_time() for j in xrange(5)])
+        self.assertEqual(delays[0], delays[1])
+        self.assertEqual(all(1 <= d <= 1.5 for d in delays[0]), True)
+        self.assertEqual(len(set(delays[0])) > 1, True)
+
+    def test_invalid_link(self):
+        for kwds in ({'latency': -1},
+                     {'jitter': -1},
+                     {'bandwidth': 0},
+                     {'max_concurrency': 0}):
+            with self.assertRaises(ValueError):
+                self._open_link(**kwds)
+            with self.assertRaises(ValueError):
+                self._type.setup(self._dummy_name,
+                                 block_size=1,
+                                 block_count=1,
+                                 **kwds)
+            self.assertEqual(self._check_exists(self._dummy_name), False)
+
+class TestBlockStorageSimulatedLink(_TestBlockStorageSimulatedLink,
+                                    unittest.TestCase):
+    _type_kwds = {}
+
+class TestBlockStorageSimulatedLinkNoThreadPool(
+        _TestBlockStorageSimulatedLink,
+        unittest.TestCase):
+    _type_kwds = {'threadpool_size': 0,
+                  'latency': 0.0001,
+                  'jitter': 0.0001,
+                  'seed': 1}
+
+class TestBlockStorageSimulatedLinkMMap(_TestBlockStorageSimulatedLink,
+                                        unittest.TestCase):
+    _type_kwds = {'wrapped_storage_type': 'mmap',
+                  'bandwidth': 10**9,
+                  'max_concurrency': 2}
 
 class _TestBlockStorageS3Mock(_TestBlockStorage):
     _type = BlockStorageS3
     _type_kwds = {}
+    _can_grow = False
 
     @classmethod
     def _read_storage(cls, storage):
@@ -932,6 +2138,21 @@ class _TestBlockStorageS3Mock(_TestBlockStorage):
                              **kwds)
         self.assertEqual(self._check_exists(self._dummy_name), False)
 
+    def test_clone_device_shares_wrapper(self):
+        with self._open_teststorage() as f:
+            with f.clone_device() as g:
+                self.assertIs(g._s3, f._s3)
+                stats = f.connection_stats
+                g.read_blocks(list(xrange(self._block_count)))
+                self.assertEqual(g.connection_stats, f.connection_stats)
+                self.assertEqual(f.connection_stats['requests'],
+                                 stats['requests'] + self._block_count)
+        kwds = dict(self._type_kwds)
+        kwds['s3_wrapper'] = f._s3
+        kwds['max_pool_connections'] = 2
+        with self._type(self._testfname, **kwds) as h:
+            self.assertIs(h._s3, f._s3)
+
     def test_setup_ignore_existing(self):
         self.assertEqual(self._check_exists(self._dummy_name), False)
         with self._type.setup(self._dummy_name,
@@ -967,11 +2188,372 @@ class TestBlockStorageS3MockNoThreadPool(_TestBlockStorageS3Mock,
                   'bucket_name': '.',
                   'threadpool_size': 0}
 
-class TestBlockStorageS3MockThreadPool(_TestBlockStorageS3Mock,
+class TestBlockStorageS3MockThreadPool(_TestBlockStoragePendingWrites,
+                                       _TestBlockStorageS3Mock,
                                        unittest.TestCase):
     _type_kwds = {'s3_wrapper': MockBoto3S3Wrapper,
                   'bucket_name': '.',
                   'threadpool_size': 4}
+    _write_method_name = '_upload'
+
+class _CountingMockBoto3S3Wrapper(MockBoto3S3Wrapper):
+    """Records the number of GET and PUT requests."""
+
+    requests = {'GET': 0, 'PUT': 0}
+    _lock = threading.Lock()
+
+    @classmethod
+    def reset(cls):
+        with cls._lock:
+            cls.requests['GET'] = 0
+            cls.requests['PUT'] = 0
+
+    @classmethod
+    def _count(cls, kind):
+        with cls._lock:
+            cls.requests[kind] += 1
+
+    def download(self, key):
+        self._count('GET')
+        return MockBoto3S3Wrapper.download(self, key)
+
+    def download_range(self, key, start, stop):
+        self._count('GET')
+        return MockBoto3S3Wrapper.download_range(self, key, start, stop)
+
+    def upload(self, key_block):
+        self._count('PUT')
+        return MockBoto3S3Wrapper.upload(self, key_block)
+
+class _TestBlockStorageS3MockPacked(object):
+
+    _type_kwds = None
+
+    def setUp(self):
+        self._names = []
+
+    def tearDown(self):
+        for name in self._names:
+            if os.path.exists(name):
+                shutil.rmtree(name, ignore_errors=True)
+
+    def _setup(self, name, block_size, block_count, **kwds):
+        self._names.append(name)
+        kwds.update(self._type_kwds)
+        kwds['s3_wrapper'] = _CountingMockBoto3S3Wrapper
+        kwds['bucket_name'] = '.'
+        return BlockStorageS3.setup(name,
+                                    block_size,
+                                    block_count,
+                                    ignore_existing=True,
+                                    **kwds)
+
+    def _open(self, name):
+        return BlockStorageS3(name,
+                              s3_wrapper=_CountingMockBoto3S3Wrapper,
+                              bucket_name='.',
+                              **self._type_kwds)
+
+    def test_setup_fails(self):
+        name = self.__class__.__name__ + "_setup_fails"
+        with self.assertRaises(ValueError):
+            self._setup(name, 8, 7, subtree_levels=0, heap_base=2)
+        with self.assertRaises(ValueError):
+            self._setup(name, 8, 7, subtree_levels=2)
+        with self.assertRaises(ValueError):
+            self._setup(name, 8, 7, subtree_levels=2, heap_base=1)
+        with self.assertRaises(ValueError):
+            self._setup(name, 8, 6, subtree_levels=2, heap_base=2)
+        with self.assertRaises(ValueError):
+            self._setup(name, 8, 7, heap_base=2)
+        self.assertEqual(os.path.exists(name), False)
+
+    def test_read_write(self):
+        block_size = 3
+        for k in (2, 3):
+            for subtree_levels in (1, 2, 3):
+                for heap_height in xrange(4):
+                    name = "%s_%d_%d_%d" % (self.__class__.__name__,
+                                            k,
+                                            subtree_levels,
+                                            heap_height)
+                    block_count = (k**(heap_height+1) - 1) // (k - 1)
+                    header_data = bytes(bytearray([1,2]))
+                    self._setup(
+                        name,
+                        block_size,
+                        block_count,
+                        header_data=header_data,
+                        initialize=lambda i: bytes(bytearray([i])*block_size),
+                        subtree_levels=subtree_levels,
+                        heap_base=k).close()
+                    # one object per subtree
+                    objects = [obj for obj in os.listdir(name)
+                               if obj.startswith("s")]
+                    self.assertEqual(
+                        len(objects),
+                        sum(k**l for l in xrange(0,
+                                                 heap_height+1,
+                                                 subtree_levels)))
+                    size = sum(os.path.getsize(os.path.join(name, obj))
+                               for obj in os.listdir(name))
+                    self.assertEqual(
+                        size,
+                        BlockStorageS3.compute_storage_size(
+                            block_size,
+                            block_count,
+                            header_data=header_data,
+                            subtree_levels=subtree_levels,
+                            heap_base=k))
+                    indices = list(xrange(block_count))
+                    with self._open(name) as f:
+                        self.assertEqual(f.header_data, header_data)
+                        self.assertEqual(
+                            [list(bytearray(b))
+                             for b in f.read_blocks(indices)],
+                            [[i]*block_size for i in indices])
+                        self.assertEqual(
+                            [list(bytearray(b))
+                             for b in f.yield_blocks(reversed(indices))],
+                            [[i]*block_size for i in reversed(indices)])
+                        for i in indices:
+                            self.assertEqual(list(bytearray(f.read_block(i))),
+                                             [i]*block_size)
+                        f.write_blocks(
+                            indices[1::2],
+                            [bytes(bytearray([i+100])*block_size)
+                             for i in indices[1::2]])
+                        f.write_block(0, bytes(bytearray([200])*block_size))
+                        f.update_header_data(bytes(bytearray([3,4])))
+                    expected = [[i]*block_size for i in indices]
+                    for i in indices[1::2]:
+                        expected[i] = [i+100]*block_size
+                    expected[0] = [200]*block_size
+                    with self._open(name) as f:
+                        self.assertEqual(f.header_data,
+                                         bytes(bytearray([3,4])))
+                        self.assertEqual(f._subtree_levels, subtree_levels)
+                        self.assertEqual(f._heap_base, k)
+                        self.assertEqual(
+                            [list(bytearray(b))
+                             for b in f.read_blocks(indices)],
+                            expected)
+
+    def test_request_count(self):
+        name = self.__class__.__name__ + "_request_count"
+        # a height 5 binary heap packed into subtrees
+        # spanning 3 levels
+        self._setup(name, 4, 63, subtree_levels=3, heap_base=2).close()
+        path = [62, 30, 14, 6, 2, 0]
+        with self._open(name) as f:
+            _CountingMockBoto3S3Wrapper.reset()
+            blocks = f.read_blocks(path)
+            self.assertEqual(_CountingMockBoto3S3Wrapper.requests,
+                             {'GET': 2, 'PUT': 0})
+            # partial writes update each object in place
+            _CountingMockBoto3S3Wrapper.reset()
+            f.write_blocks(path, blocks)
+            f.flush()
+            self.assertEqual(_CountingMockBoto3S3Wrapper.requests,
+                             {'GET': 2, 'PUT': 2})
+            # writes covering an entire subtree are a single PUT
+            _CountingMockBoto3S3Wrapper.reset()
+            f.write_blocks([0, 1, 2, 3, 4, 5, 6],
+                           [bytes(bytearray(4))]*7)
+            f.flush()
+            self.assertEqual(_CountingMockBoto3S3Wrapper.requests,
+                             {'GET': 0, 'PUT': 1})
+
+    def test_clone_device(self):
+        name = self.__class__.__name__ + "_clone_device"
+        self._setup(name, 4, 15, subtree_levels=2, heap_base=2).close()
+        with self._open(name) as f:
+            with f.clone_device() as g:
+                self.assertIs(g._object_locks, f._object_locks)
+                g.write_blocks([3, 4], [bytes(bytearray([1])*4)]*2)
+                f.write_blocks([7, 8], [bytes(bytearray([2])*4)]*2)
+                g.flush()
+                f.flush()
+            self.assertEqual(
+                [list(bytearray(b)) for b in f.read_blocks([3, 4, 7, 8])],
+                [[1]*4, [1]*4, [2]*4, [2]*4])
+
+class TestBlockStorageS3MockPacked(_TestBlockStorageS3MockPacked,
+                                   unittest.TestCase):
+    _type_kwds = {}
+
+class TestBlockStorageS3MockPackedNoThreadPool(_TestBlockStorageS3MockPacked,
+                                               unittest.TestCase):
+    _type_kwds = {'threadpool_size': 0}
+
+class TestBlockStorageS3MockKeyPrefixes(unittest.TestCase):
+
+    def setUp(self):
+        self._name = self.__class__.__name__ + "_" + self._testMethodName
+
+    def tearDown(self):
+        shutil.rmtree(self._name, ignore_errors=True)
+
+    def _open(self, **kwds):
+        return BlockStorageS3(self._name,
+                              bucket_name='.',
+                              s3_wrapper=MockBoto3S3Wrapper,
+                              **kwds)
+
+    def _setup(self, block_size, block_count, **kwds):
+        return BlockStorageS3.setup(
+            self._name,
+            block_size,
+            block_count,
+            bucket_name='.',
+            s3_wrapper=MockBoto3S3Wrapper,
+            initialize=lambda i: bytes(bytearray([i])*block_size),
+            ignore_existing=True,
+            **kwds)
+
+    def _objects(self):
+        objects = []
+        for dirpath, _, filenames in os.walk(self._name):
+            for filename in filenames:
+                objects.append(os.path.relpath(
+                    os.path.join(dirpath, filename), self._name))
+        return objects
+
+    def test_setup_fails(self):
+        with self.assertRaises(ValueError):
+            self._setup(4, 8, key_prefixes=0)
+        with self.assertRaises(ValueError):
+            self._setup(4, 8, key_prefixes=1.5)
+        self.assertEqual(os.path.exists(self._name), False)
+
+    def test_read_write(self):
+        header_data = bytes(bytearray([1,2,3]))
+        self._setup(4, 40, key_prefixes=8, header_data=header_data).close()
+        objects = self._objects()
+        self.assertEqual(len(objects), 41)
+        prefixes = set(os.path.dirname(obj) for obj in objects
+                       if obj != BlockStorageS3._index_name)
+        self.assertTrue(1 < len(prefixes) <= 8)
+        self.assertEqual(
+            sum(os.path.getsize(os.path.join(self._name, obj))
+                for obj in objects),
+            BlockStorageS3.compute_storage_size(4,
+                                                40,
+                                                header_data=header_data,
+                                                key_prefixes=8))
+        with self.assertRaises(ValueError):
+            self._open(key_prefixes=4)
+        # the key scheme is read from the index
+        with self._open() as f:
+            self.assertEqual(f.header_data, header_data)
+            self.assertEqual(
+                [list(bytearray(b)) for b in f.read_blocks(range(40))],
+                [[i]*4 for i in range(40)])
+            with f.clone_device() as g:
+                g.write_blocks([3, 17], [bytes(bytearray([100])*4)]*2)
+            f.write_block(5, bytes(bytearray([101])*4))
+            f.update_header_data(bytes(bytearray([4,5,6])))
+        self.assertEqual(len(self._objects()), 41)
+        with self._open(key_prefixes=8) as f:
+            self.assertEqual(f.header_data, bytes(bytearray([4,5,6])))
+            self.assertEqual(
+                [list(bytearray(b)) for b in f.read_blocks([3, 5, 17, 39])],
+                [[100]*4, [101]*4, [100]*4, [39]*4])
+        MockBoto3S3Wrapper('.').clear(self._name)
+        self.assertEqual(MockBoto3S3Wrapper('.').exists(self._name), False)
+
+    def test_packed(self):
+        self._setup(4, 15,
+                    key_prefixes=4,
+                    subtree_levels=2,
+                    heap_base=2).close()
+        self.assertTrue(all(os.path.basename(obj).startswith("s")
+                            for obj in self._objects()
+                            if obj != BlockStorageS3._index_name))
+        with self._open() as f:
+            self.assertEqual(f._subtree_levels, 2)
+            f.write_blocks([14, 6, 2, 0], [bytes(bytearray([100])*4)]*4)
+        with self._open() as f:
+            self.assertEqual(
+                [list(bytearray(b)) for b in f.read_blocks(range(15))],
+                [([100]*4 if i in (0, 2, 6, 14) else [i]*4)
+                 for i in range(15)])
+
+class TestClientPool(unittest.TestCase):
+
+    def test_per_thread_clients(self):
+        pool = _ClientPool(object)
+        self.assertEqual(pool.stats, {'requests': 0,
+                                      'clients_created': 0,
+                                      'client_reuses': 0})
+        client = pool.client()
+        self.assertIs(pool.client(), client)
+        clients = []
+        def _worker():
+            clients.append(pool.client())
+            clients.append(pool.client())
+        threads = [threading.Thread(target=_worker) for _ in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(clients), 6)
+        for i in range(0, 6, 2):
+            self.assertIs(clients[i], clients[i+1])
+            self.assertIsNot(clients[i], client)
+        self.assertEqual(len(set(id(c) for c in clients)), 3)
+        self.assertEqual(pool.stats, {'requests': 8,
+                                      'clients_created': 4,
+                                      'client_reuses': 4})
+
+class TestCallWithBackoff(unittest.TestCase):
+
+    class _Error(Exception):
+        def __init__(self, code=None, status=None):
+            self.response = {'Error': {'Code': code},
+                             'ResponseMetadata': {'HTTPStatusCode': status}}
+
+    def _failing(self, errors):
+        errors = list(errors)
+        def func():
+            if len(errors):
+                raise errors.pop(0)
+            return "done"
+        return func
+
+    def test_retry_throttled(self):
+        delays = []
+        self.assertEqual(
+            _call_with_backoff(self._failing([self._Error("SlowDown"),
+                                              self._Error(status=503),
+                                              self._Error("SlowDown")]),
+                               5, 1.0, 3.0,
+                               _sleep=delays.append,
+                               _random=lambda: 1.0),
+            "done")
+        # exponential backoff capped at the maximum
+        self.assertEqual(delays, [1.0, 2.0, 3.0])
+
+    def test_max_retries(self):
+        delays = []
+        with self.assertRaises(self._Error):
+            _call_with_backoff(self._failing([self._Error("SlowDown")]*3),
+                               2, 1.0, 3.0,
+                               _sleep=delays.append,
+                               _random=lambda: 0.5)
+        self.assertEqual(delays, [0.5, 1.0])
+
+    def test_other_errors(self):
+        delays = []
+        with self.assertRaises(self._Error):
+            _call_with_backoff(self._failing([self._Error("NoSuchKey", 404)]),
+                               2, 1.0, 3.0,
+                               _sleep=delays.append)
+        with self.assertRaises(ValueError):
+            _call_with_backoff(self._failing([ValueError()]),
+                               2, 1.0, 3.0,
+                               _sleep=delays.append)
+        self.assertEqual(delays, [])
 
 @unittest.skipIf((os.environ.get('PYORAM_AWS_TEST_BUCKET') is None) or \
                  (not has_boto3),
@@ -981,6 +2563,7 @@ class TestBlockStorageS3(_TestBlockStorage,
                          unittest.TestCase):
     _type = BlockStorageS3
     _type_kwds = {'bucket_name': os.environ.get('PYORAM_AWS_TEST_BUCKET')}
+    _can_grow = False
 
     @classmethod
     def _read_storage(cls, storage):
@@ -988,8 +2571,8 @@ class TestBlockStorageS3(_TestBlockStorage,
         name = storage.storage_name
         s3 = Boto3S3Wrapper(cls._type_kwds['bucket_name'])
         prefix_len = len(name+"/b")
-        nblocks = 1 + max(int(obj.key[prefix_len:]) for obj
-                          in s3._bucket.objects.filter(Prefix=name+"/b"))
+        nblocks = 1 + max(int(key[prefix_len:]) for key
+                          in s3._keys(name+"/b"))
         data.extend(s3.download(name+"/"+BlockStorageS3._index_name))
         for i in range(nblocks):
             data.extend(s3.download(name+"/b"+str(i)))
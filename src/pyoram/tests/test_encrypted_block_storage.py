@@ -533,6 +533,44 @@ class _TestEncryptedBlockStorage(object):
             self.assertEqual(f.header_data, new_header_data)
         os.remove(fname)
 
+    def test_grow(self):
+        fname = ".".join(self.id().split(".")[1:])
+        fname += ".bin"
+        fname = os.path.join(thisdir, fname)
+        if os.path.exists(fname):
+            os.remove(fname)                           # pragma: no cover
+        bsize = 10
+        bcount = 11
+        header_data = bytes(bytearray([0,1,2]))
+        with EncryptedBlockStorage.setup(
+                fname,
+                block_size=bsize,
+                block_count=bcount,
+                key=self._test_key,
+                key_size=self._test_key_size,
+                storage_type=self._type_name,
+                aes_mode=self._aes_mode,
+                initialize=lambda i: bytes(bytearray([i])*bsize),
+                header_data=header_data) as f:
+            key = f.key
+            f.grow(bcount + 2,
+                   initialize=lambda i: bytes(bytearray([i])*bsize))
+            f.grow(bcount + 3)
+            self.assertEqual(f.block_count, bcount + 3)
+            self.assertEqual(f.read_block(bcount + 1),
+                             bytes(bytearray([bcount + 1])*bsize))
+        with EncryptedBlockStorage(fname,
+                                   key=key,
+                                   storage_type=self._type_name) as f:
+            self.assertEqual(f.header_data, header_data)
+            self.assertEqual(f.block_count, bcount + 3)
+            for i in xrange(bcount + 2):
+                self.assertEqual(f.read_block(i),
+                                 bytes(bytearray([i])*bsize))
+            self.assertEqual(f.read_block(bcount + 2),
+                             bytes(bytearray(bsize)))
+        os.remove(fname)
+
     def test_locked_flag(self):
         with EncryptedBlockStorage(self._testfname,
                                    key=self._key,
@@ -812,5 +850,39 @@ class TestEncryptedBlockStorageMMapFileGCM32(_TestEncryptedBlockStorage,
     _aes_mode = 'gcm'
     _test_key_size = 32
 
+class TestEncryptedBlockStorageZeroCopy(unittest.TestCase):
+
+    def test_zero_copy(self):
+        fd, name = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            for aes_mode in ('ctr', 'gcm'):
+                with EncryptedBlockStorage.setup(
+                        name,
+                        25,
+                        5,
+                        key_size=16,
+                        storage_type='mmap',
+                        aes_mode=aes_mode,
+                        initialize=lambda i: bytes(bytearray([i])*25),
+                        ignore_existing=True) as f:
+                    key = f.key
+                with EncryptedBlockStorage(name,
+                                           key=key,
+                                           storage_type='mmap',
+                                           zero_copy=True) as f:
+                    self.assertIs(type(f._storage.read_block(0)),
+                                  memoryview)
+                    block = f.read_block(3)
+                    self.assertEqual(block, bytes(bytearray([3])*25))
+                    f.write_block(3, bytes(bytearray([7])*25))
+                    # decrypted blocks are not views into storage
+                    self.assertEqual(block, bytes(bytearray([3])*25))
+                    self.assertEqual(f.read_blocks([3, 4]),
+                                     [bytes(bytearray([7])*25),
+                                      bytes(bytearray([4])*25)])
+        finally:
+            os.remove(name)
+
 if __name__ == "__main__":
     unittest.main()                                    # pragma: no cover
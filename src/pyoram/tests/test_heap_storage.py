@@ -1,15 +1,19 @@
 import os
+import shutil
 import unittest
 import tempfile
 
 from pyoram.util.virtual_heap import \
-    SizedVirtualHeap
+    (SizedVirtualHeap,
+     calculate_blocked_bucket_index)
 from pyoram.storage.block_storage import \
     BlockStorageTypeFactory
 from pyoram.storage.block_storage_file import \
     BlockStorageFile
 from pyoram.storage.heap_storage import \
     HeapStorage
+from pyoram.storage.boto3_s3_wrapper import \
+    MockBoto3S3Wrapper
 
 from six.moves import xrange
 
@@ -17,6 +21,8 @@ thisdir = os.path.dirname(os.path.abspath(__file__))
 
 class TestHeapStorage(unittest.TestCase):
 
+    _layout_subtree_levels = None
+
     @classmethod
     def setUpClass(cls):
         fd, cls._dummy_name = tempfile.mkstemp()
@@ -43,6 +49,7 @@ class TestHeapStorage(unittest.TestCase):
             heap_base=cls._heap_base,
             blocks_per_bucket=cls._blocks_per_bucket,
             storage_type=cls._type_name,
+            layout_subtree_levels=cls._layout_subtree_levels,
             initialize=lambda i: bytes(bytearray([i]) * \
                                        cls._block_size * \
                                        cls._blocks_per_bucket),
@@ -381,6 +388,39 @@ class TestHeapStorage(unittest.TestCase):
             self.assertEqual(f.bytes_received,
                              total_buckets*f.bucket_storage.block_size*3)
 
+    def test_s3_subtree_levels(self):
+        fname = self.__class__.__name__ + "_s3_subtree_levels"
+        try:
+            HeapStorage.setup(
+                fname,
+                block_size=self._block_size,
+                heap_height=self._heap_height,
+                heap_base=self._heap_base,
+                blocks_per_bucket=self._blocks_per_bucket,
+                storage_type='s3',
+                bucket_name='.',
+                s3_wrapper=MockBoto3S3Wrapper,
+                subtree_levels=2,
+                initialize=lambda i: bytes(bytearray([i]) * \
+                                           self._block_size * \
+                                           self._blocks_per_bucket),
+                ignore_existing=True).close()
+            with HeapStorage(fname,
+                             storage_type='s3',
+                             bucket_name='.',
+                             s3_wrapper=MockBoto3S3Wrapper) as f:
+                self.assertEqual(f.bucket_storage._subtree_levels, 2)
+                self.assertEqual(f.bucket_storage._heap_base,
+                                 self._heap_base)
+                b = f.virtual_heap.last_leaf_bucket()
+                bucket_path = f.virtual_heap.Node(b).\
+                              bucket_path_from_root()
+                for i, bucket in zip(bucket_path, f.read_path(b)):
+                    self.assertEqual(list(bytearray(bucket)),
+                                     list(self._buckets[i]))
+        finally:
+            shutil.rmtree(fname, ignore_errors=True)
+
     def test_update_header_data(self):
         fname = ".".join(self.id().split(".")[1:])
         fname += ".bin"
@@ -425,6 +465,47 @@ class TestHeapStorage(unittest.TestCase):
             self.assertEqual(f.header_data, new_header_data)
         os.remove(fname)
 
+    def test_grow(self):
+        fname = ".".join(self.id().split(".")[1:])
+        fname += ".bin"
+        fname = os.path.join(thisdir, fname)
+        shutil.copyfile(self._testfname, fname)
+        bucket_size = self._block_size * self._blocks_per_bucket
+        try:
+            with HeapStorage(fname, storage_type=self._type_name) as f:
+                # move buckets one subtree at a time when the
+                # layout is blocked
+                f._max_grow_chunk_bytes = 1
+                with self.assertRaises(ValueError):
+                    f.grow(self._heap_height - 1)
+                f.grow(self._heap_height)
+                self.assertEqual(f.bucket_count, self._bucket_count)
+                f.grow(self._heap_height + 1,
+                       initialize=lambda b: bytes(bytearray([b % 256]) * \
+                                                  bucket_size))
+                f.grow(self._heap_height + 2)
+            with HeapStorage(fname, storage_type=self._type_name) as f:
+                vheap = f.virtual_heap
+                self.assertEqual(vheap.height, self._heap_height + 2)
+                self.assertEqual(f.bucket_count, vheap.bucket_count())
+                self.assertEqual(f.bucket_storage.block_count,
+                                 vheap.bucket_count())
+                self.assertEqual(f.header_data, bytes())
+                first_empty = vheap.first_bucket_at_level(vheap.last_level)
+                for b in xrange(vheap.bucket_count()):
+                    bucket = f.read_path(b)[-1]
+                    if b < self._bucket_count:
+                        self.assertEqual(list(bytearray(bucket)),
+                                         list(self._buckets[b]))
+                    elif b < first_empty:
+                        self.assertEqual(list(bytearray(bucket)),
+                                         [b % 256] * bucket_size)
+                    else:
+                        self.assertEqual(list(bytearray(bucket)),
+                                         [0] * bucket_size)
+        finally:
+            os.remove(fname)
+
     def test_locked_flag(self):
         with HeapStorage(self._testfname,
                                   storage_type=self._type_name) as f:
@@ -456,6 +537,64 @@ class TestHeapStorage(unittest.TestCase):
                                   storage_type=self._type_name) as f:
             pass
 
+    def test_read_paths(self):
+        with HeapStorage(
+                self._testfname,
+                storage_type=self._type_name) as f:
+            leaves = [f.virtual_heap.last_leaf_bucket(),
+                      f.virtual_heap.first_leaf_bucket(),
+                      f.virtual_heap.last_leaf_bucket(),
+                      0]
+            paths = f.read_paths(leaves)
+            self.assertEqual(len(paths), len(leaves))
+            buckets = set()
+            for b, data in zip(leaves, paths):
+                bucket_path = f.virtual_heap.Node(b).\
+                              bucket_path_from_root()
+                buckets.update(bucket_path)
+                self.assertEqual(len(data), len(bucket_path))
+                for i, bucket in zip(bucket_path, data):
+                    self.assertEqual(list(bytearray(bucket)),
+                                     list(self._buckets[i]))
+            # shared buckets are read once
+            self.assertEqual(f.bytes_received,
+                             len(buckets)*f.bucket_storage.block_size)
+            self.assertEqual(
+                [len(data) for data
+                 in f.read_paths(leaves[:-1], level_start=1)],
+                [f.virtual_heap.Node(b).level for b in leaves[:-1]])
+
+    def test_write_paths(self):
+        with HeapStorage(
+                self._testfname,
+                storage_type=self._type_name) as f:
+            vheap = f.virtual_heap
+            leaves = [vheap.first_leaf_bucket(),
+                      vheap.first_leaf_bucket() + 1]
+            paths = [vheap.Node(b).bucket_path_from_root()
+                     for b in leaves]
+            f.write_paths(leaves,
+                          [[bytes(bytearray([200+n]) * \
+                                  len(self._buckets[i]))
+                            for i in path]
+                           for n, path in enumerate(paths)])
+            # the last path wins for shared buckets
+            for n, path in enumerate(paths):
+                for i, bucket in zip(path, f.read_path(leaves[n])):
+                    if i in paths[1]:
+                        self.assertEqual(list(bytearray(bucket)),
+                                         [201]*len(bucket))
+                    else:
+                        self.assertEqual(list(bytearray(bucket)),
+                                         [200]*len(bucket))
+            f.write_paths(leaves,
+                          [[bytes(self._buckets[i]) for i in path]
+                           for path in paths])
+            for path, data in zip(paths, f.read_paths(leaves)):
+                for i, bucket in zip(path, data):
+                    self.assertEqual(list(bytearray(bucket)),
+                                     list(self._buckets[i]))
+
     def test_read_path_cloned(self):
 
         with HeapStorage(
@@ -551,5 +690,62 @@ class TestHeapStorage(unittest.TestCase):
             self.assertEqual(forig.bytes_sent, 0)
             self.assertEqual(forig.bytes_received, 0)
 
+    def test_layout(self):
+        bucket_size = self._block_size * self._blocks_per_bucket
+        with HeapStorage(self._testfname,
+                         storage_type=self._type_name) as f:
+            self.assertEqual(f.layout_subtree_levels,
+                             self._layout_subtree_levels)
+            vheap = f.virtual_heap
+            if self._layout_subtree_levels is None:
+                positions = list(xrange(vheap.bucket_count()))
+            else:
+                positions = [calculate_blocked_bucket_index(
+                                 vheap.k,
+                                 vheap.levels,
+                                 self._layout_subtree_levels,
+                                 b)
+                             for b in xrange(vheap.bucket_count())]
+        with BlockStorageFile(self._testfname) as f:
+            for b, i in enumerate(positions):
+                self.assertEqual(list(bytearray(f.read_block(i))),
+                                 list(self._buckets[b]))
+
+    def test_layout_fails(self):
+        for layout_subtree_levels in (0, 1.5):
+            with self.assertRaises(ValueError):
+                HeapStorage.setup(
+                    self._dummy_name,
+                    block_size=1,
+                    heap_height=1,
+                    storage_type=self._type_name,
+                    layout_subtree_levels=layout_subtree_levels)
+            self.assertEqual(os.path.exists(self._dummy_name), False)
+        with self.assertRaises(ValueError):
+            HeapStorage.setup(
+                self._dummy_name,
+                block_size=1,
+                heap_height=1,
+                heap_base=2**16,
+                storage_type=self._type_name)
+        self.assertEqual(os.path.exists(self._dummy_name), False)
+        with self.assertRaises(ValueError):
+            HeapStorage.setup(
+                self._dummy_name,
+                block_size=1,
+                heap_height=1,
+                storage_type='s3',
+                bucket_name='.',
+                s3_wrapper=MockBoto3S3Wrapper,
+                subtree_levels=2,
+                layout_subtree_levels=2)
+        self.assertEqual(os.path.exists(self._dummy_name), False)
+
+class TestHeapStorageBlockedLayout2(TestHeapStorage):
+    _layout_subtree_levels = 2
+
+class TestHeapStorageBlockedLayout5(TestHeapStorage):
+    _layout_subtree_levels = 5
+
 if __name__ == "__main__":
     unittest.main()                                    # pragma: no cover
@@ -0,0 +1,265 @@
+import os
+import random
+import unittest
+import tempfile
+
+from pyoram.encrypted_storage.lru_cached_encrypted_heap_storage import \
+    LRUCachedEncryptedHeapStorage
+from pyoram.encrypted_storage.encrypted_heap_storage import \
+    EncryptedHeapStorage
+from pyoram.oblivious_storage.tree.path_oram import \
+    PathORAM
+from pyoram.util.misc import MemorySize
+
+from six.moves import xrange
+
+class _TestLRUCachedEncryptedHeapStorage(object):
+
+    _cache_size = None
+    _storage_type = 'file'
+    _heap_base = 2
+    _heap_height = 4
+
+    def setUp(self):
+        assert self._cache_size is not None
+        fd, self._testfname = tempfile.mkstemp()
+        os.close(fd)
+        self._block_size = 10
+        self._blocks_per_bucket = 2
+        self._bucket_size = self._block_size * self._blocks_per_bucket
+        self._bucket_count = \
+            ((self._heap_base**(self._heap_height+1)) - 1)//(self._heap_base-1)
+        self._buckets = [bytes(bytearray([i]) * self._bucket_size)
+                         for i in xrange(self._bucket_count)]
+        f = EncryptedHeapStorage.setup(
+            self._testfname,
+            self._block_size,
+            self._heap_height,
+            heap_base=self._heap_base,
+            blocks_per_bucket=self._blocks_per_bucket,
+            storage_type=self._storage_type,
+            initialize=lambda i: self._buckets[i],
+            header_data=b"user",
+            ignore_existing=True)
+        f.close()
+        self._key = f.key
+
+    def tearDown(self):
+        os.remove(self._testfname)
+
+    def _open(self):
+        return LRUCachedEncryptedHeapStorage(
+            EncryptedHeapStorage(self._testfname,
+                                 key=self._key,
+                                 storage_type=self._storage_type),
+            cache_size=self._cache_size)
+
+    def test_init(self):
+        with self._open() as f:
+            self.assertEqual(f.cache_size,
+                             min(self._cache_size, self._bucket_count))
+            self.assertEqual(f.cached_bucket_count, 0)
+            self.assertEqual(f.header_data, b"user")
+            self.assertEqual(f.key, self._key)
+            self.assertEqual(f.bucket_count, self._bucket_count)
+            self.assertEqual(f.bucket_size, self._bucket_size)
+            self.assertEqual(f.blocks_per_bucket, self._blocks_per_bucket)
+            self.assertEqual(f.storage_name, self._testfname)
+            self.assertEqual(f.virtual_heap.k, self._heap_base)
+            self.assertEqual(f.raw_storage, f.bucket_storage.raw_storage)
+            f.update_header_data(b"resu")
+        with self._open() as f:
+            self.assertEqual(f.header_data, b"resu")
+
+    def test_read_path(self):
+        with self._open() as f:
+            vheap = f.virtual_heap
+            bs = list(xrange(self._bucket_count))
+            random.shuffle(bs)
+            for b in bs:
+                bucket_list = vheap.Node(b).bucket_path_from_root()
+                for level_start in xrange(len(bucket_list)):
+                    self.assertEqual(
+                        f.read_path(b, level_start=level_start),
+                        [self._buckets[bb]
+                         for bb in bucket_list[level_start:]])
+                    self.assertTrue(f.cached_bucket_count <= f.cache_size)
+            self.assertTrue(f.miss_count > 0)
+            if f.cache_size > 1:
+                self.assertTrue(f.hit_count > 0)
+            self.assertEqual(f.dirty_cached_bucket_count, 0)
+            self.assertEqual(f.bytes_sent, 0)
+
+    def test_read_path_hits(self):
+        with self._open() as f:
+            b = f.virtual_heap.last_leaf_bucket()
+            f.read_path(b)
+            bytes_received = f.bytes_received
+            misses = f.miss_count
+            f.read_path(b)
+            path_length = f.virtual_heap.levels
+            if f.cache_size >= path_length:
+                self.assertEqual(f.bytes_received, bytes_received)
+                self.assertEqual(f.miss_count, misses)
+                self.assertEqual(f.hit_count, path_length)
+            else:
+                self.assertTrue(f.bytes_received > bytes_received)
+
+    def test_write_path(self):
+        vheap = None
+        new_buckets = {}
+        with self._open() as f:
+            vheap = f.virtual_heap
+            bs = list(xrange(self._bucket_count))
+            random.shuffle(bs)
+            for i, b in enumerate(bs):
+                bucket_list = vheap.Node(b).bucket_path_from_root()
+                buckets = f.read_path(b)
+                level_start = i % len(bucket_list)
+                buckets = [bytes(bytearray([i % 256]) * self._bucket_size)
+                           for bb in bucket_list[level_start:]]
+                f.write_path(b, buckets, level_start=level_start)
+                new_buckets.update(zip(bucket_list[level_start:], buckets))
+                self.assertTrue(f.cached_bucket_count <= f.cache_size)
+                self.assertTrue(f.dirty_cached_bucket_count <= f.cache_size)
+                self.assertEqual(f.read_path(b, level_start=level_start),
+                                 buckets)
+        with EncryptedHeapStorage(self._testfname,
+                                  key=self._key,
+                                  storage_type=self._storage_type) as f:
+            for b in xrange(self._bucket_count):
+                self.assertEqual(
+                    f.read_path(b)[-1],
+                    new_buckets.get(b, self._buckets[b]))
+
+    def test_flush(self):
+        with self._open() as f:
+            b = f.virtual_heap.last_leaf_bucket()
+            buckets = list(reversed(f.read_path(b)))
+            bytes_sent = f.bytes_sent
+            f.write_path(b, buckets)
+            self.assertEqual(f.dirty_cached_bucket_count,
+                             min(f.cache_size, len(buckets)))
+            f.flush()
+            self.assertEqual(f.dirty_cached_bucket_count, 0)
+            self.assertEqual(f.bytes_sent - bytes_sent,
+                             len(buckets) * \
+                             f.bucket_storage.raw_storage.block_size)
+            self.assertEqual(f.read_path(b), buckets)
+            # nothing more to write back
+            bytes_sent = f.bytes_sent
+            f.flush()
+            self.assertEqual(f.bytes_sent, bytes_sent)
+
+    def test_read_write_paths(self):
+        with self._open() as f:
+            vheap = f.virtual_heap
+            bs = [vheap.first_leaf_bucket(),
+                  vheap.last_leaf_bucket(),
+                  vheap.first_bucket_at_level(2),
+                  vheap.first_leaf_bucket()]
+            for level_start in (0, 1, 2):
+                self.assertEqual(
+                    f.read_paths(bs, level_start=level_start),
+                    [[self._buckets[bb] for bb in
+                      vheap.Node(b).bucket_path_from_root()[level_start:]]
+                     for b in bs])
+            buckets_list = []
+            for i, b in enumerate(bs):
+                buckets_list.append(
+                    [bytes(bytearray([i]) * self._bucket_size)
+                     for bb in vheap.Node(b).bucket_path_from_root()])
+            f.write_paths(bs, buckets_list)
+            self.assertEqual(f.read_path(bs[-1]), buckets_list[-1])
+            self.assertEqual(f.read_path(bs[1])[-1], buckets_list[1][-1])
+
+class TestLRUCachedEncryptedHeapStorage1(
+        _TestLRUCachedEncryptedHeapStorage,
+        unittest.TestCase):
+    _cache_size = 1
+
+class TestLRUCachedEncryptedHeapStorage7(
+        _TestLRUCachedEncryptedHeapStorage,
+        unittest.TestCase):
+    _cache_size = 7
+
+class TestLRUCachedEncryptedHeapStorage7MMapBase3(
+        _TestLRUCachedEncryptedHeapStorage,
+        unittest.TestCase):
+    _cache_size = 7
+    _storage_type = 'mmap'
+    _heap_base = 3
+    _heap_height = 3
+
+class TestLRUCachedEncryptedHeapStorageAll(
+        _TestLRUCachedEncryptedHeapStorage,
+        unittest.TestCase):
+    _cache_size = 1000
+
+class TestLRUCachedEncryptedHeapStorageBudget(unittest.TestCase):
+
+    def test_cache_memory_budget(self):
+        fd, name = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            heap = EncryptedHeapStorage.setup(name,
+                                              100,
+                                              3,
+                                              ignore_existing=True)
+            with self.assertRaises(ValueError):
+                LRUCachedEncryptedHeapStorage(heap)
+            with self.assertRaises(ValueError):
+                LRUCachedEncryptedHeapStorage(heap,
+                                              cache_size=1,
+                                              cache_memory_budget=100)
+            with self.assertRaises(ValueError):
+                LRUCachedEncryptedHeapStorage(heap, cache_size=0)
+            with self.assertRaises(ValueError):
+                LRUCachedEncryptedHeapStorage(heap, cache_memory_budget=-1)
+            with self.assertRaises(ValueError):
+                LRUCachedEncryptedHeapStorage(heap, cache_memory_budget=99)
+            f = LRUCachedEncryptedHeapStorage(heap, cache_memory_budget=450)
+            self.assertEqual(f.cache_size, 4)
+            f = LRUCachedEncryptedHeapStorage(
+                heap,
+                cache_memory_budget=MemorySize(1, unit='KB'))
+            self.assertEqual(f.cache_size, 10)
+            f.close()
+        finally:
+            os.remove(name)
+
+    def test_path_oram(self):
+        fd, name = tempfile.mkstemp()
+        os.close(fd)
+        block_size = 16
+        block_count = 50
+        try:
+            with PathORAM.setup(name,
+                                block_size,
+                                block_count,
+                                ignore_existing=True) as f:
+                stash = f.stash
+                position_map = f.position_map
+                key = f.key
+            heap = LRUCachedEncryptedHeapStorage(
+                EncryptedHeapStorage(name, key=key),
+                cache_size=20)
+            with PathORAM(heap, stash, position_map) as f:
+                for i in xrange(block_count):
+                    f.write_block(i, bytes(bytearray([i]) * block_size))
+                for i in xrange(block_count):
+                    self.assertEqual(f.read_block(i),
+                                     bytes(bytearray([i]) * block_size))
+                stash = f.stash
+                position_map = f.position_map
+            self.assertTrue(heap.hit_count > 0)
+            heap.close()
+            with PathORAM(name, stash, position_map, key=key) as f:
+                for i in xrange(block_count):
+                    self.assertEqual(f.read_block(i),
+                                     bytes(bytearray([i]) * block_size))
+        finally:
+            os.remove(name)
+
+if __name__ == "__main__":
+    unittest.main()                                    # pragma: no cover
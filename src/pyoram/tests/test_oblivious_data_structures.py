@@ -0,0 +1,317 @@
+import os
+import struct
+import random
+import unittest
+
+from pyoram.oblivious_data_structures.avl_map import \
+    (ObliviousAVLMap,
+     calculate_max_avl_height)
+from pyoram.oblivious_data_structures.priority_queue import \
+    ObliviousPriorityQueue
+from pyoram.oblivious_storage.tree.pointer_tree_oram import \
+    PointerTreeORAM
+from pyoram.storage.block_storage_ram import \
+    BlockStorageRAM
+
+from six.moves import xrange
+
+def _key(i):
+    return struct.pack("!L", i)
+
+class TestCalculateMaxAVLHeight(unittest.TestCase):
+
+    def test_values(self):
+        self.assertEqual(calculate_max_avl_height(0), 0)
+        self.assertEqual(calculate_max_avl_height(1), 1)
+        self.assertEqual(calculate_max_avl_height(2), 2)
+        self.assertEqual(calculate_max_avl_height(3), 2)
+        self.assertEqual(calculate_max_avl_height(4), 3)
+        self.assertEqual(calculate_max_avl_height(6), 3)
+        self.assertEqual(calculate_max_avl_height(7), 4)
+        self.assertEqual(calculate_max_avl_height(12), 5)
+        self.assertEqual(calculate_max_avl_height(53), 7)
+        self.assertEqual(calculate_max_avl_height(54), 8)
+        # bounded by 1.44*log2(n+2)
+        self.assertEqual(calculate_max_avl_height(2**32-1), 45)
+
+class _TestObliviousAVLMapBase(object):
+
+    _type_name = None
+    _capacity = None
+    _kwds = None
+
+    @classmethod
+    def setUpClass(cls):
+        assert cls._type_name is not None
+        assert cls._capacity is not None
+        assert cls._kwds is not None
+        cls._testfname = cls.__name__ + "_testfile.bin"
+
+    @classmethod
+    def tearDownClass(cls):
+        try:
+            os.remove(cls._testfname)
+        except OSError:                                # pragma: no cover
+            pass                                       # pragma: no cover
+
+    def _setup(self, **kwds):
+        return ObliviousAVLMap.setup(self._testfname,
+                                     4,
+                                     3,
+                                     self._capacity,
+                                     storage_type=self._type_name,
+                                     ignore_existing=True,
+                                     **dict(self._kwds, **kwds))
+
+    def _open(self, m, stash):
+        if self._type_name == 'ram':
+            m.raw_storage.tofile(self._testfname)
+            return ObliviousAVLMap(BlockStorageRAM.fromfile(self._testfname),
+                                   stash,
+                                   key=m.key,
+                                   cached_levels=self._kwds['cached_levels'])
+        return ObliviousAVLMap(self._testfname,
+                               stash,
+                               key=m.key,
+                               storage_type=self._type_name,
+                               cached_levels=self._kwds['cached_levels'])
+
+    def _check_tree(self, m, items):
+        # read every node of the tree and check the ordering,
+        # the heights, and the balance of each node
+        max_reads, max_writes = m._max_reads, m._max_writes
+        m._max_reads = m._max_writes = m.capacity
+        found = []
+        def walk(id_, leaf):
+            if id_ == PointerTreeORAM.null_id:
+                return 0
+            node = m._fetch(id_, leaf)
+            left = walk(node.child[0], node.child_leaf[0])
+            found.append((node.key, node.value))
+            right = walk(node.child[1], node.child_leaf[1])
+            self.assertEqual(node.child_height, [left, right])
+            self.assertTrue(abs(left - right) <= 1)
+            return node.height
+        try:
+            self.assertEqual(m._run(walk, m._root, m._root_leaf),
+                             m._root_height)
+        finally:
+            m._max_reads, m._max_writes = max_reads, max_writes
+        self.assertEqual(found, sorted(items.items()))
+        self.assertEqual(len(m), len(items))
+
+    def test_setup_fails(self):
+        with self.assertRaises(ValueError):
+            ObliviousAVLMap.setup(self._testfname, 0, 1, 10,
+                                  storage_type='ram')
+        with self.assertRaises(ValueError):
+            ObliviousAVLMap.setup(self._testfname, 1, -1, 10,
+                                  storage_type='ram')
+        with self.assertRaises(TypeError):
+            ObliviousAVLMap.setup(self._testfname, 1, 1, 10,
+                                  header_data=2,
+                                  storage_type='ram')
+
+    def test_setup(self):
+        with self._setup(header_data=b"user") as m:
+            self.assertEqual(m.key_size, 4)
+            self.assertEqual(m.value_size, 3)
+            self.assertEqual(m.capacity, self._capacity)
+            self.assertEqual(len(m), 0)
+            self.assertEqual(m.header_data, b"user")
+            m.update_header_data(b"USER")
+            self.assertEqual(m.header_data, b"USER")
+            self.assertEqual(
+                m.accesses_per_operation,
+                6 * calculate_max_avl_height(self._capacity) + 1)
+            if self._type_name != 'ram':
+                self.assertEqual(m.storage_name, self._testfname)
+        if self._type_name != 'ram':
+            self.assertEqual(
+                os.path.getsize(self._testfname),
+                ObliviousAVLMap.compute_storage_size(
+                    4, 3, self._capacity,
+                    bucket_capacity=self._kwds.get('bucket_capacity', 4),
+                    heap_base=self._kwds.get('heap_base', 2),
+                    storage_type=self._type_name,
+                    header_data=b"USER"))
+
+    def test_operations(self):
+        rng = random.Random(1)
+        items = {}
+        m = self._setup()
+        try:
+            for t in xrange(8 * self._capacity):
+                key = _key(rng.randint(0, 2 * self._capacity))
+                value = bytes(bytearray([t % 256] * 3))
+                r = rng.random()
+                count = m.oram.access_count
+                if r < 0.4:
+                    if (len(items) < self._capacity) or (key in items):
+                        m[key] = value
+                        items[key] = value
+                    else:
+                        with self.assertRaises(ValueError):
+                            m[key] = value
+                elif r < 0.55:
+                    self.assertEqual(m.get(key), items.get(key))
+                elif r < 0.65:
+                    self.assertEqual(key in m, key in items)
+                elif r < 0.85:
+                    if key in items:
+                        self.assertEqual(m.pop(key), items.pop(key))
+                    else:
+                        with self.assertRaises(KeyError):
+                            del m[key]
+                elif len(items):
+                    key = min(items)
+                    self.assertEqual(m.min_item(), (key, items[key]))
+                    self.assertEqual(m.pop_min(), (key, items.pop(key)))
+                    count += m.accesses_per_operation
+                else:
+                    with self.assertRaises(KeyError):
+                        m.pop_min()
+                self.assertEqual(m.oram.access_count - count,
+                                 m.accesses_per_operation)
+                self.assertEqual(len(m), len(items))
+            self._check_tree(m, items)
+            stash = m.stash
+        finally:
+            m.close()
+        with self._open(m, stash) as m:
+            self.assertEqual(len(m), len(items))
+            self._check_tree(m, items)
+            for key in items:
+                self.assertEqual(m[key], items[key])
+
+    def test_sequential(self):
+        # inserting and deleting keys in order requires the
+        # most rotations
+        items = {}
+        with self._setup() as m:
+            for i in xrange(self._capacity):
+                m[_key(i)] = b"abc"
+                items[_key(i)] = b"abc"
+            self._check_tree(m, items)
+            with self.assertRaises(ValueError):
+                m[_key(self._capacity)] = b"abc"
+            m[_key(0)] = b"xyz"
+            items[_key(0)] = b"xyz"
+            for i in xrange(self._capacity - 1, self._capacity // 2, -1):
+                del m[_key(i)]
+                del items[_key(i)]
+            self._check_tree(m, items)
+            for i in xrange(len(items)):
+                self.assertEqual(m.pop_min(), (_key(i), items.pop(_key(i))))
+            self.assertEqual(len(m), 0)
+            with self.assertRaises(KeyError):
+                m.min_item()
+            self._check_tree(m, items)
+
+    def test_fails(self):
+        with self._setup() as m:
+            with self.assertRaises(ValueError):
+                m[b"abc"] = b"abc"
+            with self.assertRaises(ValueError):
+                m[b"abcd"] = b"ab"
+            with self.assertRaises(ValueError):
+                m.get(b"abcde")
+            with self.assertRaises(KeyError):
+                m[b"abcd"]
+            self.assertEqual(m.get(b"abcd", 1), 1)
+            self.assertEqual(m.oram.access_count,
+                             2 * m.accesses_per_operation)
+
+class TestObliviousAVLMapRAM(_TestObliviousAVLMapBase,
+                             unittest.TestCase):
+    _type_name = 'ram'
+    _capacity = 20
+    _kwds = {'cached_levels': 2}
+
+class TestObliviousAVLMapFile(_TestObliviousAVLMapBase,
+                              unittest.TestCase):
+    _type_name = 'file'
+    _capacity = 13
+    _kwds = {'cached_levels': 0,
+             'bucket_capacity': 2,
+             'heap_base': 3}
+
+class TestObliviousPriorityQueue(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls._testfname = cls.__name__ + "_testfile.bin"
+
+    @classmethod
+    def tearDownClass(cls):
+        try:
+            os.remove(cls._testfname)
+        except OSError:                                # pragma: no cover
+            pass                                       # pragma: no cover
+
+    def test_setup_fails(self):
+        with self.assertRaises(ValueError):
+            ObliviousPriorityQueue.setup(self._testfname, 0, 1, 10,
+                                         storage_type='ram')
+        with self.assertRaises(TypeError):
+            ObliviousPriorityQueue.setup(self._testfname, 1, 1, 10,
+                                         header_data=2,
+                                         storage_type='ram')
+
+    def test_queue(self):
+        rng = random.Random(2)
+        q = ObliviousPriorityQueue.setup(self._testfname,
+                                         2,
+                                         1,
+                                         15,
+                                         header_data=b"user",
+                                         storage_type='file',
+                                         ignore_existing=True)
+        try:
+            self.assertEqual(q.priority_size, 2)
+            self.assertEqual(q.value_size, 1)
+            self.assertEqual(q.capacity, 15)
+            self.assertEqual(q.header_data, b"user")
+            self.assertEqual(q.map.key_size, 10)
+            self.assertEqual(q.storage_name, self._testfname)
+            with self.assertRaises(ValueError):
+                q.push(b"abc", b"a")
+            with self.assertRaises(KeyError):
+                q.pop()
+            items = []
+            for i in xrange(10):
+                priority = struct.pack("!H", rng.randint(0, 4))
+                q.push(priority, bytes(bytearray([i])))
+                items.append((priority, i))
+            self.assertEqual(len(q), 10)
+            # items with equal priorities come out in the order
+            # they were pushed
+            items.sort()
+            self.assertEqual(q.peek(), (items[0][0],
+                                        bytes(bytearray([items[0][1]]))))
+            for priority, i in items[:5]:
+                self.assertEqual(q.pop(), (priority,
+                                           bytes(bytearray([i]))))
+            del items[:5]
+            self.assertEqual(q.accesses_per_operation,
+                             q.map.accesses_per_operation)
+            stash = q.stash
+        finally:
+            q.close()
+        with ObliviousPriorityQueue(self._testfname,
+                                    stash,
+                                    key=q.key,
+                                    storage_type='file') as q:
+            self.assertEqual(len(q), 5)
+            self.assertEqual(q.header_data, b"user")
+            q.update_header_data(b"USER")
+            self.assertEqual(q.header_data, b"USER")
+            q.push(items[-1][0], b"z")
+            items.append((items[-1][0], ord(b"z")))
+            for priority, i in items:
+                self.assertEqual(q.pop(), (priority,
+                                           bytes(bytearray([i]))))
+            self.assertEqual(len(q), 0)
+
+if __name__ == "__main__":
+    unittest.main()                                    # pragma: no cover
@@ -1,4 +1,6 @@
 import os
+import shutil
+import array
 import unittest
 import tempfile
 
@@ -9,6 +11,7 @@ from pyoram.storage.block_storage import \
 from pyoram.encrypted_storage.encrypted_heap_storage import \
     EncryptedHeapStorage
 from pyoram.crypto.aes import AES
+from pyoram.util.misc import MemorySize
 
 from six.moves import xrange
 
@@ -23,6 +26,7 @@ class _TestPathORAMBase(object):
     _bucket_capacity = None
     _heap_base = None
     _kwds = None
+    _layout_subtree_levels = None
 
     @classmethod
     def setUpClass(cls):
@@ -55,6 +59,7 @@ class _TestPathORAMBase(object):
             aes_mode=cls._aes_mode,
             initialize=lambda i: bytes(bytearray([i])*cls._block_size),
             ignore_existing=True,
+            layout_subtree_levels=cls._layout_subtree_levels,
             **cls._kwds)
         f.close()
         cls._key = f.key
@@ -641,6 +646,61 @@ class _TestPathORAMBase(object):
                 self.assertEqual(list(bytearray(block)),
                                  list(self._blocks[i]))
 
+    def test_grow(self):
+        fname = ".".join(self.id().split(".")[1:])
+        fname += ".bin"
+        fname = os.path.join(thisdir, fname)
+        shutil.copyfile(self._testfname, fname)
+        kwds = dict(self._kwds)
+        kwds.pop('cache_file', None)
+        stash = dict((id_, bytearray(block))
+                     for id_, block in self._stash.items())
+        position_map = array.array(self._position_map.typecode,
+                                   self._position_map)
+        new_block = lambda i: bytes(bytearray([i % 256])*self._block_size)
+        block_count = 3 * self._block_count
+        try:
+            with PathORAM(fname,
+                          stash,
+                          position_map,
+                          key=self._key,
+                          storage_type=self._type_name,
+                          **kwds) as f:
+                with self.assertRaises(ValueError):
+                    f.grow(self._block_count - 1)
+                height = f.heap_storage.virtual_heap.height
+                f.grow(block_count, initialize=new_block)
+                self.assertEqual(f.block_count, block_count)
+                self.assertTrue(f.heap_storage.virtual_heap.height > height)
+                self.assertEqual(len(f.position_map), block_count)
+                height = f.heap_storage.virtual_heap.height
+                f.grow(block_count + 1)
+                self.assertEqual(f.heap_storage.virtual_heap.height, height)
+                self.assertEqual(list(bytearray(f.read_block(block_count))),
+                                 list(bytearray(self._block_size)))
+                for i in xrange(block_count):
+                    self.assertEqual(list(bytearray(f.read_block(i))),
+                                     list(bytearray(new_block(i))))
+                # every block has now been moved to the new leaf level
+                vheap = f.heap_storage.virtual_heap
+                for bucket in f.position_map:
+                    self.assertEqual(vheap.Node(bucket).level,
+                                     vheap.last_level)
+                stash = f.stash
+                position_map = f.position_map
+            with PathORAM(fname,
+                          stash,
+                          position_map,
+                          key=self._key,
+                          storage_type=self._type_name,
+                          **kwds) as f:
+                self.assertEqual(f.block_count, block_count + 1)
+                for i in xrange(block_count):
+                    self.assertEqual(list(bytearray(f.read_block(i))),
+                                     list(bytearray(new_block(i))))
+        finally:
+            os.remove(fname)
+
     def test_update_header_data(self):
         fname = ".".join(self.id().split(".")[1:])
         fname += ".bin"
@@ -848,5 +908,70 @@ class TestPathORAMB3Z5(_TestPathORAMBase,
     _heap_base = 3
     _kwds = {}
 
+class TestPathORAMB2Z3MemoryBudget(_TestPathORAMBase,
+                                   unittest.TestCase):
+    _type_name = 'mmap'
+    _aes_mode = 'ctr'
+    _bucket_capacity = 3
+    _heap_base = 2
+    _kwds = {'cache_memory_budget': MemorySize(1, unit='KB')}
+
+class TestPathORAMB2Z4CacheFile(_TestPathORAMBase,
+                                unittest.TestCase):
+    _type_name = 'file'
+    _aes_mode = 'gcm'
+    _bucket_capacity = 4
+    _heap_base = 2
+    _kwds = {'cached_levels': 3,
+             'cache_file': "TestPathORAMB2Z4CacheFile.cache"}
+
+    @classmethod
+    def tearDownClass(cls):
+        super(TestPathORAMB2Z4CacheFile, cls).tearDownClass()
+        try:
+            os.remove(cls._kwds['cache_file'])
+        except OSError:                                # pragma: no cover
+            pass                                       # pragma: no cover
+
+class TestPathORAMB2Z4BlockedLayout(_TestPathORAMBase,
+                                    unittest.TestCase):
+    _type_name = 'file'
+    _aes_mode = 'ctr'
+    _bucket_capacity = 4
+    _heap_base = 2
+    _kwds = {'cached_levels': 1}
+    _layout_subtree_levels = 3
+
+class TestPathORAMB3Z2BlockedLayout(_TestPathORAMBase,
+                                    unittest.TestCase):
+    _type_name = 'mmap'
+    _aes_mode = 'gcm'
+    _bucket_capacity = 2
+    _heap_base = 3
+    _kwds = {}
+    _layout_subtree_levels = 2
+
+class TestPathORAMRAMZeroCopy(unittest.TestCase):
+
+    def test_grow(self):
+        # the top cached heap storage closes its clones of the
+        # RAM device before the bytearray is resized
+        block_size = 25
+        new_block = lambda i: bytes(bytearray([i % 256])*block_size)
+        with PathORAM.setup(None,
+                            block_size,
+                            30,
+                            storage_type='ram',
+                            zero_copy=True,
+                            cached_levels=2,
+                            concurrency_level=4,
+                            initialize=new_block) as f:
+            height = f.heap_storage.virtual_heap.height
+            f.grow(60, initialize=new_block)
+            self.assertEqual(f.block_count, 60)
+            self.assertTrue(f.heap_storage.virtual_heap.height > height)
+            for i in xrange(60):
+                self.assertEqual(f.read_block(i), new_block(i))
+
 if __name__ == "__main__":
     unittest.main()                                    # pragma: no cover
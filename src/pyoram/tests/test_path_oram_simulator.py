@@ -0,0 +1,294 @@
+import random
+import unittest
+import collections
+
+from pyoram.simulation.path_oram_simulator import \
+    (PathORAMSimulator,
+     parameter_study,
+     _clib)
+from pyoram.oblivious_storage.tree.tree_oram_helper import \
+    TreeORAMStorageManagerExplicitAddressing
+from pyoram.storage.heap_storage import \
+    HeapStorage
+
+from six.moves import xrange
+
+def _check_placement(test, sim):
+    # every block is either in the stash or in a
+    # bucket on the path to its leaf
+    vheap = sim.virtual_heap
+    stash = sim.stash
+    test.assertEqual(len(stash), sim.stash_size)
+    found = dict((id_, None) for id_ in stash)
+    for b in xrange(vheap.bucket_count()):
+        bucket = sim.bucket(b)
+        test.assertTrue(len(bucket) <= sim.bucket_capacity)
+        for id_ in bucket:
+            test.assertEqual(id_ in found, False)
+            found[id_] = b
+            test.assertTrue(
+                b in vheap.Node(sim.position(id_)).\
+                bucket_path_from_root())
+    test.assertEqual(sorted(found), list(xrange(sim.block_count)))
+    for id_ in xrange(sim.block_count):
+        test.assertEqual(vheap.Node(sim.position(id_)).level,
+                         vheap.last_level)
+
+class _TestPathORAMSimulator(object):
+
+    _block_count = None
+    _bucket_capacity = None
+    _heap_base = None
+
+    def _create(self, **kwds):
+        return PathORAMSimulator(self._block_count,
+                                 bucket_capacity=self._bucket_capacity,
+                                 heap_base=self._heap_base,
+                                 **kwds)
+
+    def test_init(self):
+        sim = self._create(seed=1)
+        self.assertEqual(sim.block_count, self._block_count)
+        self.assertEqual(sim.bucket_capacity, self._bucket_capacity)
+        self.assertEqual(sim.heap_base, self._heap_base)
+        self.assertEqual(sim.access_count, 0)
+        self.assertEqual(sim.virtual_heap.bucket_count() >= \
+                         self._block_count, True)
+        _check_placement(self, sim)
+
+    def test_run(self):
+        sim = self._create(seed=1)
+        sim.run(500)
+        self.assertEqual(sim.access_count, 500)
+        _check_placement(self, sim)
+        sim.run(self._block_count + 3, workload='sequential')
+        self.assertEqual(sim.access_count, 500 + self._block_count + 3)
+        _check_placement(self, sim)
+        sim.access([0, self._block_count // 2, 0, self._block_count - 1])
+        self.assertEqual(sim.access_count, 504 + self._block_count + 3)
+        _check_placement(self, sim)
+        histogram = sim.stash_size_histogram
+        self.assertEqual(sum(histogram), sim.access_count)
+        self.assertEqual(len(histogram), sim.max_stash_size + 1)
+        self.assertTrue(histogram[-1] > 0)
+        self.assertTrue(0 <= sim.mean_stash_size <= sim.max_stash_size)
+        self.assertEqual(sim.stash_size_quantile(1), sim.max_stash_size)
+        self.assertTrue(sim.stash_size_quantile(0.5) <= \
+                        sim.stash_size_quantile(0.99))
+        self.assertTrue(sim.blocks_moved_per_access > 0)
+        levels = sim.virtual_heap.levels
+        self.assertEqual(sim.buckets_written_per_access, levels)
+        self.assertTrue(1 <= sim.buckets_read_per_access <= levels)
+        occupancy = sim.bucket_occupancy_by_level()
+        self.assertEqual(len(occupancy), levels)
+        for l, x in enumerate(occupancy):
+            self.assertTrue(0 <= x <= self._bucket_capacity)
+        self.assertEqual(
+            sum(x * sim.virtual_heap.bucket_count_at_level(l)
+                for l, x in enumerate(occupancy)) + sim.stash_size,
+            self._block_count)
+        sim.reset_statistics()
+        self.assertEqual(sim.access_count, 0)
+        self.assertEqual(sim.blocks_moved_per_access, 0)
+        self.assertEqual(sim.buckets_read_per_access, 0)
+        self.assertEqual(sim.mean_stash_size, 0)
+        self.assertEqual(sim.max_stash_size, sim.stash_size)
+
+    def test_matches_tree_oram_storage(self):
+        # starting from the same position map, bucket
+        # contents, and stash, each access places blocks
+        # exactly as TreeORAMStorage does
+        sim = self._create(seed=3)
+        sim.run(2 * self._block_count)
+        vheap = sim.virtual_heap
+        Z = self._bucket_capacity
+        block_size = \
+            TreeORAMStorageManagerExplicitAddressing.block_info_storage_size
+        def _block(id_):
+            block = bytearray(block_size)
+            if id_ != _clib.PATH_ORAM_SIM_EMPTY:
+                TreeORAMStorageManagerExplicitAddressing.\
+                    tag_block_with_id(block, id_)
+            return bytes(block)
+        heap = HeapStorage.setup(
+            None,
+            block_size,
+            vheap.height,
+            blocks_per_bucket=Z,
+            heap_base=vheap.k,
+            storage_type='ram',
+            initialize=lambda b: b"".join(_block(sim._buckets[b*Z + j])
+                                          for j in xrange(Z)))
+        position_map = [sim.position(id_)
+                        for id_ in xrange(self._block_count)]
+        stash = collections.OrderedDict((id_, _block(id_))
+                                        for id_ in sim.stash)
+        oram = TreeORAMStorageManagerExplicitAddressing(heap,
+                                                        stash,
+                                                        position_map)
+        rng = random.Random(4)
+        try:
+            for t in xrange(100):
+                id_ = rng.randrange(self._block_count)
+                # follow PathORAM.access, using the leaf
+                # chosen by the simulator
+                leaf = position_map[id_]
+                sim.access([id_])
+                position_map[id_] = sim.position(id_)
+                oram.load_path(leaf)
+                block = oram.extract_block_from_path(id_)
+                if block is None:
+                    block = stash[id_]
+                stash[id_] = block
+                oram.push_down_path()
+                oram.fill_path_from_stash()
+                oram.evict_path()
+                self.assertEqual(list(stash), sim.stash)
+                for b, bucket in enumerate(
+                        heap.bucket_storage.read_blocks(
+                            xrange(vheap.bucket_count()))):
+                    for j in xrange(Z):
+                        id_, _ = oram.get_block_info(
+                            bucket[j*block_size:(j+1)*block_size])
+                        if id_ == oram.empty_block_id:
+                            id_ = _clib.PATH_ORAM_SIM_EMPTY
+                        self.assertEqual(sim._buckets[b*Z + j], id_)
+        finally:
+            heap.close()
+
+    def test_seed(self):
+        sim1 = self._create(seed=5)
+        sim2 = self._create(seed=5)
+        sim1.run(300)
+        sim2.run(300)
+        self.assertEqual(sim1.stash, sim2.stash)
+        self.assertEqual(sim1.stash_size_histogram,
+                         sim2.stash_size_histogram)
+        self.assertEqual(sim1.bucket_occupancy_by_level(),
+                         sim2.bucket_occupancy_by_level())
+
+    def test_cached_levels(self):
+        sim = self._create(seed=1, cached_levels=2)
+        levels = sim.virtual_heap.levels
+        cached_levels = min(2, levels)
+        self.assertEqual(sim.cached_levels, cached_levels)
+        sim.run(200)
+        self.assertEqual(sim.buckets_written_per_access,
+                         levels - cached_levels)
+        self.assertTrue(sim.buckets_read_per_access <= \
+                        levels - cached_levels)
+        sim = self._create(cached_levels=100)
+        sim.run(10)
+        self.assertEqual(sim.buckets_written_per_access, 0)
+        self.assertEqual(sim.buckets_read_per_access, 0)
+
+class TestPathORAMSimulatorB2Z1(_TestPathORAMSimulator,
+                                unittest.TestCase):
+    _block_count = 63
+    _bucket_capacity = 1
+    _heap_base = 2
+
+class TestPathORAMSimulatorB2Z4(_TestPathORAMSimulator,
+                                unittest.TestCase):
+    _block_count = 100
+    _bucket_capacity = 4
+    _heap_base = 2
+
+class TestPathORAMSimulatorB3Z2(_TestPathORAMSimulator,
+                                unittest.TestCase):
+    _block_count = 81
+    _bucket_capacity = 2
+    _heap_base = 3
+
+class TestPathORAMSimulatorB5Z3(_TestPathORAMSimulator,
+                                unittest.TestCase):
+    _block_count = 1
+    _bucket_capacity = 3
+    _heap_base = 5
+
+class TestPathORAMSimulatorMisc(unittest.TestCase):
+
+    def test_init_fails(self):
+        with self.assertRaises(ValueError):
+            PathORAMSimulator(0)
+        with self.assertRaises(ValueError):
+            PathORAMSimulator(2**32)
+        with self.assertRaises(ValueError):
+            PathORAMSimulator(10, bucket_capacity=0)
+        with self.assertRaises(ValueError):
+            PathORAMSimulator(10, heap_base=1)
+        with self.assertRaises(ValueError):
+            PathORAMSimulator(10, cached_levels=-1)
+        with self.assertRaises(ValueError):
+            PathORAMSimulator(10, stash_capacity=0)
+
+    def test_access_fails(self):
+        sim = PathORAMSimulator(10)
+        with self.assertRaises(ValueError):
+            sim.access([10])
+        with self.assertRaises(ValueError):
+            sim.run(10, workload='zipf')
+
+    def test_stash_overflow(self):
+        # with one block per bucket and as many blocks as
+        # buckets, the stash grows quickly
+        with self.assertRaises(RuntimeError):
+            sim = PathORAMSimulator(2**8-1,
+                                    bucket_capacity=1,
+                                    stash_capacity=2,
+                                    seed=1)
+            sim.run(10000)
+        sim = PathORAMSimulator(2**8-1,
+                                bucket_capacity=1,
+                                stash_capacity=68,
+                                seed=1)
+        rng = random.Random(1)
+        while True:
+            count = sim.access_count
+            positions = [sim.position(id_)
+                         for id_ in xrange(sim.block_count)]
+            buckets = [sim.bucket(b)
+                       for b in xrange(sim.virtual_heap.bucket_count())]
+            stash = sim.stash
+            try:
+                sim.access([rng.randrange(sim.block_count)])
+            except RuntimeError:
+                break
+        # the failed access left the simulator unchanged
+        self.assertEqual(sim.access_count, count)
+        self.assertEqual(sim.stash, stash)
+        self.assertEqual(sim.stash_size, 68)
+        self.assertEqual([sim.position(id_)
+                          for id_ in xrange(sim.block_count)],
+                         positions)
+        self.assertEqual([sim.bucket(b)
+                          for b in xrange(sim.virtual_heap.bucket_count())],
+                         buckets)
+        _check_placement(self, sim)
+        # blocks in the stash can still be accessed
+        sim.access([stash[0]])
+        self.assertEqual(sim.access_count, count + 1)
+        _check_placement(self, sim)
+
+    def test_parameter_study(self):
+        results = list(parameter_study(50,
+                                       100,
+                                       bucket_capacity=(2, 4),
+                                       heap_base=(2, 3),
+                                       workload=('uniform', 'sequential'),
+                                       seed=1))
+        self.assertEqual(len(results), 8)
+        for result in results:
+            self.assertEqual(result['access_count'], 100)
+            self.assertEqual(sum(result['stash_size_histogram']), 100)
+            self.assertEqual(len(result['bucket_occupancy_by_level']),
+                             result['heap_levels'])
+        self.assertEqual(
+            sorted(set((r['bucket_capacity'],
+                        r['heap_base'],
+                        r['workload']) for r in results)),
+            sorted([(Z, k, w) for Z in (2, 4) for k in (2, 3)
+                    for w in ('sequential', 'uniform')]))
+
+if __name__ == "__main__":
+    unittest.main()                                    # pragma: no cover
@@ -0,0 +1,254 @@
+import os
+import unittest
+import tempfile
+
+from pyoram.oblivious_storage.tree.pointer_tree_oram import \
+    PointerTreeORAM
+from pyoram.storage.block_storage_ram import \
+    BlockStorageRAM
+
+from six.moves import xrange
+
+thisdir = os.path.dirname(os.path.abspath(__file__))
+
+class _TestPointerTreeORAMBase(object):
+
+    _type_name = None
+    _aes_mode = None
+    _bucket_capacity = None
+    _heap_base = None
+    _kwds = None
+
+    @classmethod
+    def setUpClass(cls):
+        assert cls._type_name is not None
+        assert cls._aes_mode is not None
+        assert cls._bucket_capacity is not None
+        assert cls._heap_base is not None
+        assert cls._kwds is not None
+        fd, cls._dummy_name = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            os.remove(cls._dummy_name)
+        except OSError:                                # pragma: no cover
+            pass                                       # pragma: no cover
+        cls._block_size = 7
+        cls._block_count = 40
+        cls._testfname = cls.__name__ + "_testfile.bin"
+
+    @classmethod
+    def tearDownClass(cls):
+        try:
+            os.remove(cls._testfname)
+        except OSError:                                # pragma: no cover
+            pass                                       # pragma: no cover
+        try:
+            os.remove(cls._dummy_name)
+        except OSError:                                # pragma: no cover
+            pass                                       # pragma: no cover
+
+    def _setup(self, **kwds):
+        return PointerTreeORAM.setup(
+            self._testfname,
+            self._block_size,
+            self._block_count,
+            bucket_capacity=self._bucket_capacity,
+            heap_base=self._heap_base,
+            storage_type=self._type_name,
+            aes_mode=self._aes_mode,
+            ignore_existing=True,
+            **dict(self._kwds, **kwds))
+
+    def _open(self, f, stash):
+        if self._type_name == 'ram':
+            f.raw_storage.tofile(self._testfname)
+            return PointerTreeORAM(BlockStorageRAM.fromfile(self._testfname),
+                                   stash,
+                                   key=f.key,
+                                   **self._kwds)
+        return PointerTreeORAM(self._testfname,
+                               stash,
+                               key=f.key,
+                               storage_type=self._type_name,
+                               **self._kwds)
+
+    def test_setup_fails(self):
+        self.assertEqual(os.path.exists(self._dummy_name), False)
+        with self.assertRaises(ValueError):
+            PointerTreeORAM.setup(self._dummy_name, 0, 10,
+                                  storage_type=self._type_name)
+        with self.assertRaises(ValueError):
+            PointerTreeORAM.setup(self._dummy_name, 10, 0,
+                                  storage_type=self._type_name)
+        with self.assertRaises(ValueError):
+            PointerTreeORAM.setup(self._dummy_name, 10, 10,
+                                  bucket_capacity=0,
+                                  storage_type=self._type_name)
+        with self.assertRaises(ValueError):
+            PointerTreeORAM.setup(self._dummy_name, 10, 10,
+                                  heap_base=1,
+                                  storage_type=self._type_name)
+        with self.assertRaises(ValueError):
+            PointerTreeORAM.setup(self._dummy_name, 10, 10,
+                                  heap_height=2,
+                                  storage_type=self._type_name)
+        with self.assertRaises(ValueError):
+            PointerTreeORAM.setup(self._dummy_name, 10, 10,
+                                  initialize=lambda i: None,
+                                  storage_type=self._type_name)
+        with self.assertRaises(TypeError):
+            PointerTreeORAM.setup(self._dummy_name, 10, 10,
+                                  header_data=2,
+                                  storage_type=self._type_name)
+        self.assertEqual(os.path.exists(self._dummy_name), False)
+
+    def test_setup(self):
+        with self._setup(header_data=b"user") as f:
+            self.assertEqual(f.block_size, self._block_size)
+            self.assertEqual(f.block_count, self._block_count)
+            self.assertEqual(f.header_data, b"user")
+            self.assertEqual(f.next_id, PointerTreeORAM.null_id + 1)
+            self.assertEqual(f.stash, {})
+            self.assertEqual(f.access_count, 0)
+            if self._type_name != 'ram':
+                self.assertEqual(f.storage_name, self._testfname)
+            vheap = f.heap_storage.virtual_heap
+            self.assertEqual(vheap.k, self._heap_base)
+            self.assertEqual(vheap.blocks_per_bucket, self._bucket_capacity)
+            self.assertTrue(vheap.bucket_count() * self._bucket_capacity >= \
+                            self._block_count)
+            f.update_header_data(b"USER")
+            self.assertEqual(f.header_data, b"USER")
+        if self._type_name != 'ram':
+            self.assertEqual(
+                os.path.getsize(self._testfname),
+                PointerTreeORAM.compute_storage_size(
+                    self._block_size,
+                    self._block_count,
+                    bucket_capacity=self._bucket_capacity,
+                    heap_base=self._heap_base,
+                    aes_mode=self._aes_mode,
+                    storage_type=self._type_name,
+                    header_data=b"USER"))
+        self.assertTrue(
+            PointerTreeORAM.compute_storage_size(
+                self._block_size,
+                self._block_count,
+                bucket_capacity=self._bucket_capacity,
+                heap_base=self._heap_base,
+                aes_mode=self._aes_mode,
+                storage_type=self._type_name) > \
+            PointerTreeORAM.compute_storage_size(
+                self._block_size,
+                self._block_count,
+                bucket_capacity=self._bucket_capacity,
+                heap_base=self._heap_base,
+                aes_mode=self._aes_mode,
+                storage_type=self._type_name,
+                ignore_header=True))
+
+    def test_read_write(self):
+        f = self._setup()
+        try:
+            leaves = {}
+            for i in xrange(self._block_count):
+                id_ = f.allocate_id()
+                self.assertEqual(id_, i + 1)
+                leaves[id_] = f.random_leaf()
+                f.write_block(id_,
+                              leaves[id_],
+                              bytes(bytearray([i])*self._block_size))
+            self.assertEqual(f.access_count, self._block_count)
+            for t in xrange(3):
+                for id_ in sorted(leaves):
+                    count = f.access_count
+                    block = f.read_block(id_, leaves[id_])
+                    self.assertEqual(f.access_count, count + 1)
+                    self.assertEqual(list(bytearray(block)),
+                                     [id_ - 1]*self._block_size)
+                    # the block is no longer stored
+                    with self.assertRaises(KeyError):
+                        f.read_block(id_, leaves[id_])
+                    leaves[id_] = f.random_leaf()
+                    f.write_block(id_, leaves[id_], block)
+                    self.assertEqual(f.access_count, count + 3)
+                    f.dummy_access()
+                    self.assertEqual(f.access_count, count + 4)
+            stash = f.stash
+            next_id = f.next_id
+        finally:
+            f.close()
+        with self._open(f, stash) as f:
+            self.assertEqual(f.next_id, next_id)
+            self.assertEqual(f.access_count, 0)
+            for id_ in sorted(leaves):
+                block = f.read_block(id_, leaves[id_])
+                self.assertEqual(list(bytearray(block)),
+                                 [id_ - 1]*self._block_size)
+
+    def test_read_write_fails(self):
+        with self._setup() as f:
+            id_ = f.allocate_id()
+            leaf = f.random_leaf()
+            vheap = f.heap_storage.virtual_heap
+            block = bytes(bytearray(self._block_size))
+            with self.assertRaises(ValueError):
+                f.write_block(id_ + 1, leaf, block)
+            with self.assertRaises(ValueError):
+                f.write_block(PointerTreeORAM.null_id, leaf, block)
+            with self.assertRaises(ValueError):
+                f.write_block(id_, vheap.first_leaf_bucket() - 1, block)
+            with self.assertRaises(ValueError):
+                f.write_block(id_, vheap.bucket_count(), block)
+            with self.assertRaises(ValueError):
+                f.write_block(id_, leaf, block + b"0")
+            with self.assertRaises(ValueError):
+                f.read_block(id_, vheap.bucket_count())
+            with self.assertRaises(KeyError):
+                f.read_block(id_, leaf)
+            self.assertEqual(f.access_count, 1)
+            f._next_id = f._max_id + 1
+            with self.assertRaises(RuntimeError):
+                f.allocate_id()
+            f._next_id = id_ + 1
+
+    def test_stash_digest_fails(self):
+        f = self._setup()
+        try:
+            id_ = f.allocate_id()
+            f.write_block(id_,
+                          f.random_leaf(),
+                          bytes(bytearray(self._block_size)))
+            stash = dict(f.stash)
+        finally:
+            f.close()
+        stash[len(stash) + 100] = bytearray(b"bad")
+        with self.assertRaises(ValueError):
+            self._open(f, stash)
+
+class TestPointerTreeORAMB2Z4(_TestPointerTreeORAMBase,
+                              unittest.TestCase):
+    _type_name = 'file'
+    _aes_mode = 'ctr'
+    _bucket_capacity = 4
+    _heap_base = 2
+    _kwds = {'cached_levels': 0}
+
+class TestPointerTreeORAMB2Z2Cached(_TestPointerTreeORAMBase,
+                                    unittest.TestCase):
+    _type_name = 'ram'
+    _aes_mode = 'gcm'
+    _bucket_capacity = 2
+    _heap_base = 2
+    _kwds = {'cached_levels': 2}
+
+class TestPointerTreeORAMB3Z3(_TestPointerTreeORAMBase,
+                              unittest.TestCase):
+    _type_name = 'mmap'
+    _aes_mode = 'ctr'
+    _bucket_capacity = 3
+    _heap_base = 3
+    _kwds = {'cached_levels': 1}
+
+if __name__ == "__main__":
+    unittest.main()                                    # pragma: no cover
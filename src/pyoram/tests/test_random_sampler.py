@@ -0,0 +1,122 @@
+import os
+import array
+import unittest
+
+from pyoram.util.random_sampler import \
+    BufferedRandomSampler
+from pyoram.util.misc import max_unsigned_typecode
+from pyoram.util._virtual_heap_helper import \
+    (ffi as _ffi,
+     lib as _clib)
+
+from six.moves import xrange
+
+class TestSampleUniformIntegers(unittest.TestCase):
+
+    def _sample(self, random_bytes, a, max_offset, count, out_size=8):
+        out = _ffi.new({4: "unsigned int[]",
+                        8: "unsigned long long[]"}[out_size], count)
+        bytes_used = _ffi.new("size_t *")
+        produced = _clib.sample_uniform_integers(
+            _ffi.from_buffer(random_bytes),
+            0,
+            len(random_bytes),
+            a,
+            max_offset,
+            out,
+            out_size,
+            count,
+            bytes_used)
+        return [out[i] for i in xrange(produced)], bytes_used[0]
+
+    def test_rejection(self):
+        # the range [0, 4] uses 3 bits per sample, and
+        # values 5, 6, and 7 are rejected (not reduced)
+        random_bytes = bytes(bytearray([5, 6, 7, 0, 0xF9, 4, 3]))
+        self.assertEqual(self._sample(random_bytes, 0, 4, 10),
+                         ([0, 1, 4, 3], 7))
+        self.assertEqual(self._sample(random_bytes, 10, 4, 2),
+                         ([10, 11], 5))
+        self.assertEqual(self._sample(random_bytes, 10, 4, 2, out_size=4),
+                         ([10, 11], 5))
+
+    def test_width(self):
+        random_bytes = bytes(bytearray([1, 2, 3, 4]))
+        # two bytes per sample
+        self.assertEqual(self._sample(random_bytes, 0, 2**16-1, 10),
+                         ([0x0102, 0x0304], 4))
+        # partial samples are not used
+        self.assertEqual(self._sample(random_bytes[:3], 0, 2**16-1, 10),
+                         ([0x0102], 2))
+        # no bytes are needed for a single value
+        self.assertEqual(self._sample(random_bytes, 7, 0, 3),
+                         ([7, 7, 7], 0))
+        # the full 64-bit range
+        random_bytes = bytes(bytearray([0xFF] * 8))
+        self.assertEqual(self._sample(random_bytes, 0, 2**64-1, 1),
+                         ([2**64-1], 8))
+
+class TestBufferedRandomSampler(unittest.TestCase):
+
+    def test_randint(self):
+        sampler = BufferedRandomSampler(batch_size=16)
+        self.assertEqual(sampler.batch_size, 16)
+        counts = {}
+        for i in xrange(6000):
+            x = sampler.randint(3, 8)
+            self.assertTrue(3 <= x <= 8)
+            counts[x] = counts.get(x, 0) + 1
+        self.assertEqual(sorted(counts), [3, 4, 5, 6, 7, 8])
+        for x in counts:
+            self.assertTrue(700 < counts[x] < 1300)
+        self.assertEqual(sampler.randint(5, 5), 5)
+        x = sampler.randint(0, 2**64-1)
+        self.assertTrue(0 <= x < 2**64)
+        x = sampler.randint(-10, -5)
+        self.assertTrue(-10 <= x <= -5)
+        x = sampler.randint(2**64, 2**65)
+        self.assertTrue(2**64 <= x <= 2**65)
+        with self.assertRaises(ValueError):
+            sampler.randint(2, 1)
+
+    def test_many_ranges(self):
+        sampler = BufferedRandomSampler(batch_size=4)
+        for t in xrange(3):
+            for i in xrange(2 * sampler._max_cached_ranges):
+                self.assertTrue(i <= sampler.randint(i, 2 * i) <= 2 * i)
+                self.assertTrue(len(sampler._batches) <= \
+                                sampler._max_cached_ranges)
+
+    def test_fork(self):
+        sampler = BufferedRandomSampler()
+        sampler.randint(0, 10)
+        batch = sampler._batches[(0, 10)]
+        sampler.randint(0, 10)
+        self.assertIs(sampler._batches[(0, 10)], batch)
+        # pretend that the process has forked
+        sampler._pid = os.getpid() + 1
+        sampler.randint(0, 10)
+        self.assertIsNot(sampler._batches[(0, 10)], batch)
+        self.assertEqual(sampler._pid, os.getpid())
+
+    def test_randint_array(self):
+        sampler = BufferedRandomSampler()
+        for typecode in ('I', 'L', max_unsigned_typecode):
+            for a, b in ((0, 0), (5, 9), (100, 2**20), (2**31, 2**32-1)):
+                out = sampler.randint_array(a, b, 1000, typecode=typecode)
+                self.assertEqual(out.typecode, typecode)
+                self.assertEqual(len(out), 1000)
+                self.assertTrue(a <= min(out))
+                self.assertTrue(max(out) <= b)
+        self.assertEqual(len(sampler.randint_array(0, 1, 0)), 0)
+        out = sampler.randint_array(0, 2, 30000)
+        for x in (0, 1, 2):
+            self.assertTrue(9000 < out.count(x) < 11000)
+        with self.assertRaises(ValueError):
+            sampler.randint_array(
+                0, 2**(8*array.array('I').itemsize), 1, typecode='I')
+        with self.assertRaises(ValueError):
+            sampler.randint_array(3, 2, 1)
+
+if __name__ == "__main__":
+    unittest.main()                                    # pragma: no cover
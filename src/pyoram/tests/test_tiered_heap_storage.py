@@ -0,0 +1,393 @@
+import os
+import time
+import unittest
+import tempfile
+
+from pyoram.storage.block_storage_file import \
+    BlockStorageFile
+from pyoram.encrypted_storage.encrypted_block_storage import \
+    EncryptedBlockStorage
+from pyoram.encrypted_storage.encrypted_heap_storage import \
+    EncryptedHeapStorage
+from pyoram.encrypted_storage.tiered_heap_storage import \
+    TieredHeapStorage
+from pyoram.oblivious_storage.tree.path_oram import \
+    PathORAM
+from pyoram.crypto.aes import AES
+
+from six.moves import xrange
+
+class TestTieredHeapStorage(unittest.TestCase):
+
+    def setUp(self):
+        self._block_size = 25
+        self._blocks_per_bucket = 2
+        self._heap_base = 3
+        self._heap_height = 3
+        self._bucket_count = \
+            ((self._heap_base**(self._heap_height+1)) - 1)//(self._heap_base-1)
+        self._bucket_size = self._block_size * self._blocks_per_bucket
+        self._names = []
+        for i in xrange(2):
+            fd, name = tempfile.mkstemp()
+            os.close(fd)
+            os.remove(name)
+            self._names.append(name)
+        self._tiers = [((0, 2), None, {'storage_type': 'ram'}),
+                       ((2, 3), self._names[0], {'storage_type': 'mmap'}),
+                       ((3, 4), self._names[1], {'storage_type': 'file'})]
+        self._buckets = [bytes(bytearray([i]) * self._bucket_size)
+                         for i in xrange(self._bucket_count)]
+
+    def tearDown(self):
+        for name in self._names:
+            try:
+                os.remove(name)
+            except OSError:                            # pragma: no cover
+                pass                                   # pragma: no cover
+
+    def _setup(self, **kwds):
+        return TieredHeapStorage.setup(
+            self._tiers,
+            self._block_size,
+            self._heap_height,
+            blocks_per_bucket=self._blocks_per_bucket,
+            heap_base=self._heap_base,
+            initialize=lambda b: self._buckets[b],
+            ignore_existing=True,
+            **kwds)
+
+    def test_setup(self):
+        with self._setup(key_size=AES.key_sizes[0],
+                         header_data=b"user") as f:
+            self.assertEqual(f.header_data, b"user")
+            self.assertEqual(len(f.key), AES.key_sizes[0])
+            self.assertEqual(f.bucket_count, self._bucket_count)
+            self.assertEqual(f.bucket_size, self._bucket_size)
+            self.assertEqual(f.blocks_per_bucket, self._blocks_per_bucket)
+            self.assertEqual(f.virtual_heap.k, self._heap_base)
+            self.assertEqual(f.virtual_heap.height, self._heap_height)
+            self.assertEqual(f.storage_name, None)
+            self.assertIs(f.raw_storage, f.tiers[0][1].raw_storage)
+            self.assertEqual([levels for levels, device in f.tiers],
+                             [(0, 2), (2, 3), (3, 4)])
+            self.assertEqual(
+                [device.block_count for levels, device in f.tiers],
+                [1 + 3, 9, 27])
+            for levels, device in f.tiers:
+                self.assertEqual(
+                    type(device.raw_storage).__name__,
+                    {(0, 2): 'BlockStorageRAM',
+                     (2, 3): 'BlockStorageMMap',
+                     (3, 4): 'BlockStorageFile'}[levels])
+        sizes = TieredHeapStorage.compute_storage_size(
+            self._tiers,
+            self._block_size,
+            self._heap_height,
+            blocks_per_bucket=self._blocks_per_bucket,
+            heap_base=self._heap_base,
+            header_data=b"user")
+        self.assertEqual(len(sizes), 3)
+        self.assertEqual(sizes[2], os.path.getsize(self._names[1]))
+
+    def test_setup_fails(self):
+        for tiers in ([],
+                      [((0, 2), None, {'storage_type': 'ram'})],
+                      [((0, 2), None, {'storage_type': 'ram'}),
+                       ((1, 4), None, {'storage_type': 'ram'})],
+                      [((0, 2), None, {'storage_type': 'ram'}),
+                       ((2, 2), None, {'storage_type': 'ram'}),
+                       ((2, 4), None, {'storage_type': 'ram'})]):
+            with self.assertRaises(ValueError):
+                TieredHeapStorage.setup(tiers,
+                                        self._block_size,
+                                        self._heap_height)
+        with self.assertRaises(ValueError):
+            self._setup(key=AES.KeyGen(16), key_size=16)
+        with self.assertRaises(TypeError):
+            self._setup(header_data=2)
+
+    def test_init(self):
+        f = self._setup(header_data=b"user")
+        key = f.key
+        ram_device = f.tiers[0][1]
+        f.tiers[1][1].close()
+        f.tiers[2][1].close()
+        f = TieredHeapStorage(
+            [((3, 4), BlockStorageFile(self._names[1])),
+             ((0, 2), ram_device.raw_storage),
+             ((2, 3), EncryptedBlockStorage(self._names[0],
+                                            key=key,
+                                            storage_type='mmap'))],
+            key=key)
+        self.assertEqual(f.header_data, b"user")
+        self.assertEqual([levels for levels, device in f.tiers],
+                         [(0, 2), (2, 3), (3, 4)])
+        for b in xrange(self._bucket_count):
+            self.assertEqual(f.read_path(b)[-1], self._buckets[b])
+        f.close()
+
+    def test_init_fails(self):
+        f = self._setup()
+        key = f.key
+        ram = f.tiers[0][1].raw_storage
+        f.tiers[1][1].close()
+        f.tiers[2][1].close()
+        # wrong level range
+        with self.assertRaises(ValueError):
+            TieredHeapStorage(
+                [((0, 3), BlockStorageFile(self._names[1]))],
+                key=key)
+        # missing levels
+        with self.assertRaises(ValueError):
+            TieredHeapStorage(
+                [((0, 2), ram.clone_device()),
+                 ((3, 4), BlockStorageFile(self._names[1]))],
+                key=key)
+        with self.assertRaises(TypeError):
+            TieredHeapStorage([((0, 4), self._names[1])], key=key)
+        with self.assertRaises(ValueError):
+            TieredHeapStorage([])
+        # the devices were closed, so the file tier is
+        # not locked
+        with BlockStorageFile(self._names[1]) as f:
+            pass
+
+    def test_read_write_path(self):
+        with self._setup() as f:
+            vheap = f.virtual_heap
+            for b in xrange(self._bucket_count):
+                bucket_list = vheap.Node(b).bucket_path_from_root()
+                for level_start in xrange(len(bucket_list)):
+                    self.assertEqual(
+                        f.read_path(b, level_start=level_start),
+                        [self._buckets[bb]
+                         for bb in bucket_list[level_start:]])
+            b = vheap.last_leaf_bucket()
+            bucket_list = vheap.Node(b).bucket_path_from_root()
+            new_buckets = [bytes(bytearray([0xFF - bb]) * self._bucket_size)
+                           for bb in bucket_list]
+            f.write_path(b, new_buckets[1:], level_start=1)
+            self.assertEqual(f.read_path(b), [self._buckets[0]] + \
+                             new_buckets[1:])
+            f.write_path(b, new_buckets)
+            self.assertEqual(f.read_path(b), new_buckets)
+            for bb, bucket in zip(bucket_list, new_buckets):
+                self.assertEqual(f.read_path(bb)[-1], bucket)
+            bytes_sent = f.bytes_sent
+            bytes_received = f.bytes_received
+            self.assertTrue(bytes_sent > 0)
+            self.assertTrue(bytes_received > 0)
+
+    def test_read_write_paths(self):
+        with self._setup() as f:
+            vheap = f.virtual_heap
+            bs = [vheap.first_leaf_bucket(),
+                  vheap.last_leaf_bucket(),
+                  vheap.first_bucket_at_level(2),
+                  vheap.first_leaf_bucket()]
+            for level_start in (0, 1, 2):
+                self.assertEqual(
+                    f.read_paths(bs, level_start=level_start),
+                    [f.read_path(b, level_start=level_start) for b in bs])
+            buckets_list = []
+            for i, b in enumerate(bs):
+                buckets_list.append(
+                    [bytes(bytearray([i]) * self._bucket_size)
+                     for bb in vheap.Node(b).bucket_path_from_root()])
+            f.write_paths(bs, buckets_list)
+            # the last path wins for shared buckets
+            self.assertEqual(f.read_path(bs[-1]), buckets_list[-1])
+            self.assertEqual(f.read_path(bs[1])[-1], buckets_list[1][-1])
+            self.assertEqual(f.read_path(bs[2])[-1], buckets_list[3][2])
+
+    def test_bucket_storage(self):
+        with self._setup() as f:
+            bucket_storage = f.bucket_storage
+            self.assertEqual(bucket_storage.block_count, self._bucket_count)
+            self.assertEqual(bucket_storage.block_size, self._bucket_size)
+            self.assertEqual(bucket_storage.storage_name, None)
+            indices = list(reversed(xrange(self._bucket_count))) + [0, 5]
+            self.assertEqual(bucket_storage.read_blocks(indices),
+                             [self._buckets[b] for b in indices])
+            self.assertEqual(list(bucket_storage.yield_blocks(indices)),
+                             [self._buckets[b] for b in indices])
+            self.assertEqual(bucket_storage.read_block(20),
+                             self._buckets[20])
+            new_buckets = [bytes(bytearray([255 - b]) * self._bucket_size)
+                           for b in xrange(self._bucket_count)]
+            written = []
+            bucket_storage.write_blocks(
+                xrange(2, self._bucket_count),
+                (new_buckets[b] for b in xrange(2, self._bucket_count)),
+                callback=written.append)
+            bucket_storage.write_block(1, new_buckets[1])
+            bucket_storage.flush()
+            self.assertEqual(sorted(written),
+                             list(xrange(2, self._bucket_count)))
+            self.assertEqual(
+                bucket_storage.read_blocks(xrange(self._bucket_count)),
+                [self._buckets[0]] + new_buckets[1:])
+            b = f.virtual_heap.last_leaf_bucket()
+            self.assertEqual(f.read_path(b),
+                             [([self._buckets[0]] + new_buckets[1:])[bb]
+                              for bb in f.virtual_heap.path_buckets(b)])
+            # migrating reads the buckets of every tier
+            fd, name = tempfile.mkstemp()
+            os.close(fd)
+            try:
+                with TieredHeapStorage.migrate(
+                        f,
+                        [((0, 1), None, {'storage_type': 'ram'}),
+                         ((1, 4), name, {'storage_type': 'file'})],
+                        ignore_existing=True) as f1:
+                    self.assertEqual(f1.storage_name, None)
+                    self.assertEqual(f1.tiers[1][1].storage_name, name)
+                    for b in xrange(self._bucket_count):
+                        self.assertEqual(f1.read_path(b), f.read_path(b))
+            finally:
+                os.remove(name)
+
+    def test_update_header_data(self):
+        with self._setup(header_data=b"user") as f:
+            f.update_header_data(b"resu")
+            self.assertEqual(f.header_data, b"resu")
+            for levels, device in f.tiers:
+                self.assertEqual(
+                    device.header_data[TieredHeapStorage._header_offset:],
+                    b"resu")
+
+    def test_grow(self):
+        with self._setup(header_data=b"user") as f:
+            key = f.key
+            ram_device = f.tiers[0][1]
+            new_bucket = bytes(bytearray([0xFF]) * self._bucket_size)
+            f.grow(self._heap_height + 1, initialize=lambda b: new_bucket)
+            vheap = f.virtual_heap
+            self.assertEqual(vheap.height, self._heap_height + 1)
+            self.assertEqual([levels for levels, device in f.tiers],
+                             [(0, 2), (2, 3), (3, 5)])
+            for b in xrange(vheap.bucket_count()):
+                if b < self._bucket_count:
+                    self.assertEqual(f.read_path(b)[-1], self._buckets[b])
+                else:
+                    self.assertEqual(f.read_path(b)[-1], new_bucket)
+            for levels, device in f.tiers[1:]:
+                device.close()
+        f = TieredHeapStorage(
+            [((0, 2), ram_device.raw_storage),
+             ((2, 3), EncryptedBlockStorage(self._names[0],
+                                            key=key,
+                                            storage_type='mmap')),
+             ((3, 5), BlockStorageFile(self._names[1]))],
+            key=key)
+        self.assertEqual(f.header_data, b"user")
+        self.assertEqual(f.virtual_heap.height, self._heap_height + 1)
+        self.assertEqual(f.read_path(f.virtual_heap.last_leaf_bucket())[-1],
+                         new_bucket)
+        f.close()
+
+    def test_clone_device(self):
+        with self._setup() as f:
+            with f.clone_device() as f1:
+                b = f.virtual_heap.last_leaf_bucket()
+                buckets = f.read_path(b)
+                f1.write_path(b, list(reversed(buckets)))
+                f1.flush()
+                self.assertEqual(f.read_path(b), list(reversed(buckets)))
+
+    def test_migrate(self):
+        fd, name = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            with EncryptedHeapStorage.setup(
+                    name,
+                    self._block_size,
+                    self._heap_height,
+                    blocks_per_bucket=self._blocks_per_bucket,
+                    heap_base=self._heap_base,
+                    header_data=b"user",
+                    initialize=lambda b: self._buckets[b],
+                    ignore_existing=True) as heap:
+                with self.assertRaises(ValueError):
+                    TieredHeapStorage.migrate(heap,
+                                              self._tiers,
+                                              key=heap.key)
+                with TieredHeapStorage.migrate(
+                        heap,
+                        self._tiers,
+                        ignore_existing=True) as f:
+                    self.assertEqual(f.key, heap.key)
+                    self.assertEqual(f.header_data, b"user")
+                    self.assertEqual(f.bucket_size, heap.bucket_size)
+                    self.assertEqual(f.virtual_heap.k, self._heap_base)
+                    for b in xrange(self._bucket_count):
+                        self.assertEqual(f.read_path(b), heap.read_path(b))
+        finally:
+            os.remove(name)
+
+    def test_path_oram(self):
+        fd, name = tempfile.mkstemp()
+        os.close(fd)
+        block_count = 20
+        try:
+            with PathORAM.setup(name,
+                                self._block_size,
+                                block_count,
+                                bucket_capacity=2,
+                                cached_levels=0,
+                                ignore_existing=True) as f:
+                stash = f.stash
+                position_map = f.position_map
+                heap = f.heap_storage
+                tiers = [((0, 2), None, {'storage_type': 'ram'}),
+                         ((2, heap.virtual_heap.levels),
+                          self._names[0],
+                          {'storage_type': 'mmap'})]
+                for i in xrange(block_count):
+                    f.write_block(i, bytes(bytearray([i]) * \
+                                           self._block_size))
+                key = f.key
+            with EncryptedHeapStorage(name, key=key) as heap:
+                tiered = TieredHeapStorage.migrate(heap,
+                                                   tiers,
+                                                   ignore_existing=True)
+            with PathORAM(tiered, stash, position_map) as f:
+                for i in xrange(block_count):
+                    self.assertEqual(f.read_block(i),
+                                     bytes(bytearray([i]) * \
+                                           self._block_size))
+                    f.write_block(i, bytes(bytearray([i+1]) * \
+                                           self._block_size))
+                for i in xrange(block_count):
+                    self.assertEqual(f.read_block(i),
+                                     bytes(bytearray([i+1]) * \
+                                           self._block_size))
+            tiered.close()
+        finally:
+            os.remove(name)
+
+class TestTieredHeapStorageConcurrency(unittest.TestCase):
+
+    def test_concurrent_tiers(self):
+        latency = 0.05
+        link_kwds = {'storage_type': 'simulated_link',
+                     'wrapped_storage_type': 'ram',
+                     'latency': latency}
+        tiers = [((0, 1), None, dict(link_kwds)),
+                 ((1, 2), None, dict(link_kwds)),
+                 ((2, 3), None, dict(link_kwds))]
+        with TieredHeapStorage.setup(tiers, 10, 2) as f:
+            b = f.virtual_heap.last_leaf_bucket()
+            f.read_path(b)
+            start = time.time()
+            buckets = f.read_path(b)
+            f.write_path(b, buckets)
+            f.flush()
+            stop = time.time()
+            # each tier is accessed concurrently, so this
+            # should take about two round trips rather than six
+            self.assertTrue(stop - start < 4 * latency)
+
+if __name__ == "__main__":
+    unittest.main()                                    # pragma: no cover
@@ -1,4 +1,6 @@
 import os
+import time
+import shutil
 import unittest
 import tempfile
 import random
@@ -12,6 +14,7 @@ from pyoram.encrypted_storage.encrypted_block_storage import \
 from pyoram.encrypted_storage.encrypted_heap_storage import \
     EncryptedHeapStorage
 from pyoram.crypto.aes import AES
+from pyoram.util.misc import MemorySize
 
 from six.moves import xrange
 
@@ -567,6 +570,278 @@ class _TestTopCachedEncryptedHeapStorage(object):
                 f._root_device.bytes_received,
                 cache_bucket_count*f._root_device.bucket_storage._storage.block_size)
 
+    def test_dirty_cached_buckets(self):
+        with TopCachedEncryptedHeapStorage(
+                EncryptedHeapStorage(self._testfname,
+                                     key=self._key,
+                                     storage_type=self._storage_type),
+                **self._init_kwds) as f:
+            root_device = f._root_device
+            vheap = f.virtual_heap
+            f.read_path(vheap.last_leaf_bucket())
+            self.assertEqual(f.dirty_cached_bucket_count, 0)
+        # a read-only session uploads nothing at close
+        self.assertEqual(root_device.bytes_sent, 0)
+
+        with TopCachedEncryptedHeapStorage(
+                EncryptedHeapStorage(self._testfname,
+                                     key=self._key,
+                                     storage_type=self._storage_type),
+                **self._init_kwds) as f:
+            root_device = f._root_device
+            vheap = f.virtual_heap
+            cached_levels = f._external_level
+            block_size = root_device.bucket_storage._storage.block_size
+            for b in (vheap.first_leaf_bucket(), vheap.last_leaf_bucket()):
+                f.write_path(b, f.read_path(b))
+            path1 = vheap.Node(vheap.first_leaf_bucket()).\
+                    bucket_path_from_root()[:cached_levels]
+            path2 = vheap.Node(vheap.last_leaf_bucket()).\
+                    bucket_path_from_root()[:cached_levels]
+            dirty = sorted(set(path1) | set(path2))
+            self.assertEqual(f.dirty_cached_bucket_count, len(dirty))
+            runs = f._dirty_cached_bucket_runs()
+            self.assertEqual(sum(count for _, count in runs), len(dirty))
+            self.assertEqual(
+                [b for first, count in runs
+                 for b in xrange(first, first + count)],
+                dirty)
+            for (first1, count1), (first2, _) in zip(runs, runs[1:]):
+                self.assertTrue(first1 + count1 < first2)
+            written = []
+            f.upload_cached_buckets(callback=written.append)
+            f.flush()
+            self.assertEqual(sorted(written), dirty)
+            self.assertEqual(f.dirty_cached_bucket_count, 0)
+            self.assertEqual(root_device.bytes_sent,
+                             len(dirty) * block_size)
+        # nothing is left to upload at close
+        self.assertEqual(root_device.bytes_sent,
+                         len(dirty) * block_size)
+        with TopCachedEncryptedHeapStorage(
+                EncryptedHeapStorage(self._testfname,
+                                     key=self._key,
+                                     storage_type=self._storage_type),
+                **self._init_kwds) as f:
+            for i, bucket in enumerate(f.read_path(vheap.last_leaf_bucket())):
+                self.assertEqual(
+                    list(bytearray(bucket)),
+                    list(self._buckets[vheap.Node(vheap.last_leaf_bucket()).\
+                                       bucket_path_from_root()[i]]))
+
+    def test_read_write_paths(self):
+        fname = ".".join(self.id().split(".")[1:])
+        fname = os.path.join(thisdir, fname + ".bin")
+        shutil.copyfile(self._testfname, fname)
+        try:
+            with TopCachedEncryptedHeapStorage(
+                    EncryptedHeapStorage(fname,
+                                         key=self._key,
+                                         storage_type=self._storage_type),
+                    **self._init_kwds) as f:
+                vheap = f.virtual_heap
+                leaves = list(xrange(vheap.first_leaf_bucket(),
+                                     vheap.last_leaf_bucket()+1))
+                random.shuffle(leaves)
+                leaves.append(leaves[0])
+                leaves.append(0)
+                paths = [vheap.Node(b).bucket_path_from_root()
+                         for b in leaves]
+                for level_start in (0, 1, vheap.last_level):
+                    if level_start == 0:
+                        bs = leaves
+                    else:
+                        # the path to the root bucket is too short
+                        bs = leaves[:-1]
+                    for b, path, data in zip(
+                            bs,
+                            paths,
+                            f.read_paths(bs, level_start=level_start)):
+                        self.assertEqual(
+                            [list(bytearray(bucket)) for bucket in data],
+                            [list(self._buckets[i])
+                             for i in path[level_start:]])
+
+                new = {}
+                values = []
+                for n, path in enumerate(paths):
+                    values.append([])
+                    for i in path:
+                        new[i] = (n + i) % 256
+                        values[-1].append(
+                            bytes(bytearray([(n + i) % 256]) * \
+                                  len(self._buckets[i])))
+                f.write_paths(leaves, values)
+                if len(set(id(device) for device
+                           in f._subheap_storage.values())) > 1:
+                    self.assertTrue(f._path_pool is not None)
+                for path, data in zip(paths, f.read_paths(leaves)):
+                    self.assertEqual(
+                        [list(bytearray(bucket)) for bucket in data],
+                        [[new[i]]*len(self._buckets[i]) for i in path])
+                for b, path in zip(leaves, paths):
+                    self.assertEqual(
+                        [list(bytearray(bucket))
+                         for bucket in f.read_path(b)],
+                        [[new[i]]*len(self._buckets[i]) for i in path])
+                f.write_paths(leaves[:1],
+                              [[bytes(self._buckets[i])
+                                for i in paths[0][1:]]],
+                              level_start=1)
+                self.assertEqual(
+                    [list(bytearray(bucket))
+                     for bucket in f.read_path(leaves[0])],
+                    [[new[paths[0][0]]]*len(self._buckets[paths[0][0]])] + \
+                    [list(self._buckets[i]) for i in paths[0][1:]])
+            with TopCachedEncryptedHeapStorage(
+                    EncryptedHeapStorage(fname,
+                                         key=self._key,
+                                         storage_type=self._storage_type),
+                    **self._init_kwds) as f:
+                for b, path in zip(leaves[1:], paths[1:]):
+                    if leaves[0] in path:
+                        continue
+                    for i, bucket in zip(path, f.read_path(b)):
+                        if i in paths[0][1:]:
+                            continue
+                        self.assertEqual(list(bytearray(bucket)),
+                                         [new[i]]*len(bucket))
+        finally:
+            os.remove(fname)
+
+    def test_grow(self):
+        fname = ".".join(self.id().split(".")[1:])
+        fname += ".bin"
+        fname = os.path.join(thisdir, fname)
+        shutil.copyfile(self._testfname, fname)
+        bucket_size = self._block_size * self._blocks_per_bucket
+        new_bucket = bytes(bytearray([0xFF]) * bucket_size)
+        try:
+            with TopCachedEncryptedHeapStorage(
+                    EncryptedHeapStorage(fname,
+                                         key=self._key,
+                                         storage_type=self._storage_type),
+                    **self._init_kwds) as f:
+                leaf = f.virtual_heap.last_leaf_bucket()
+                buckets = list(reversed(f.read_path(leaf)))
+                f.write_path(leaf, buckets)
+                bytes_sent = f.bytes_sent
+                f.grow(self._heap_height + 1,
+                       initialize=lambda b: new_bucket)
+                self.assertTrue(f.bytes_sent >= bytes_sent)
+                vheap = f.virtual_heap
+                self.assertEqual(vheap.height, self._heap_height + 1)
+                self.assertEqual(f.bucket_count, vheap.bucket_count())
+                self.assertEqual(f.read_path(leaf), buckets)
+                for b in (vheap.first_leaf_bucket(),
+                          vheap.last_leaf_bucket()):
+                    path = f.read_path(b)
+                    self.assertEqual(path[-1], new_bucket)
+                    f.write_path(b, list(reversed(path)))
+                    self.assertEqual(f.read_path(b),
+                                     list(reversed(path)))
+            with EncryptedHeapStorage(fname, key=self._key) as f:
+                vheap = f.virtual_heap
+                self.assertEqual(vheap.height, self._heap_height + 1)
+                self.assertEqual(f.read_path(b), list(reversed(path)))
+        finally:
+            os.remove(fname)
+
+    def test_cache_file(self):
+        fname = ".".join(self.id().split(".")[1:])
+        cache_file = os.path.join(thisdir, fname + ".cache")
+        fname = os.path.join(thisdir, fname + ".bin")
+        shutil.copyfile(self._testfname, fname)
+        kwds = dict(self._init_kwds)
+        kwds['cache_file'] = cache_file
+
+        def _open(**kwds):
+            return TopCachedEncryptedHeapStorage(
+                EncryptedHeapStorage(fname,
+                                     key=self._key,
+                                     storage_type=self._storage_type),
+                **kwds)
+
+        def _check(f, leaf, value):
+            for bb, bucket in zip(
+                    f.virtual_heap.Node(leaf).bucket_path_from_root(),
+                    f.read_path(leaf)):
+                if value is None:
+                    self.assertEqual(list(bytearray(bucket)),
+                                     list(self._buckets[bb]))
+                else:
+                    self.assertEqual(list(bytearray(bucket)),
+                                     [value]*len(bucket))
+
+        def _write(f, leaf, value):
+            f.write_path(leaf,
+                         [bytes(bytearray([value])*len(bucket))
+                          for bucket in f.read_path(leaf)])
+
+        try:
+            self.assertEqual(os.path.exists(cache_file), False)
+            # no cache file yet, so the cache is downloaded
+            with _open(**kwds) as f:
+                cached_bucket_count = f._cached_bucket_count
+                block_size = \
+                    f._root_device.bucket_storage._storage.block_size
+                leaf = f.virtual_heap.last_leaf_bucket()
+                self.assertEqual(f._root_device.bytes_received,
+                                 cached_bucket_count * block_size)
+                _write(f, leaf, 1)
+            self.assertEqual(os.path.exists(cache_file), True)
+
+            # the cache is loaded from the cache file
+            # (only the root bucket is read for the stamp)
+            with _open(**kwds) as f:
+                root_device = f._root_device
+                self.assertEqual(root_device.bytes_received, block_size)
+                _check(f, leaf, 1)
+            # a read-only session leaves the cache file alone
+            self.assertEqual(root_device.bytes_sent, 0)
+            with _open(**kwds) as f:
+                self.assertEqual(f._root_device.bytes_received,
+                                 block_size)
+
+            # a session without the cache file changes the
+            # epoch, so the cache is downloaded again
+            with _open(**self._init_kwds) as f:
+                _write(f, leaf, 2)
+            with _open(**kwds) as f:
+                self.assertEqual(f._root_device.bytes_received,
+                                 (cached_bucket_count + 1) * block_size)
+                _check(f, leaf, 2)
+
+            # corrupting the cache file triggers a full refresh
+            with open(cache_file, 'r+b') as f:
+                f.seek(TopCachedEncryptedHeapStorage.\
+                       _cache_file_header_size + 1)
+                byte = bytearray(f.read(1))
+                f.seek(-1, os.SEEK_CUR)
+                f.write(bytes(bytearray([byte[0] ^ 1])))
+            with _open(**kwds) as f:
+                self.assertEqual(f._root_device.bytes_received,
+                                 (cached_bucket_count + 1) * block_size)
+                _check(f, leaf, 2)
+                _write(f, leaf, 3)
+            with _open(**kwds) as f:
+                self.assertEqual(f._root_device.bytes_received,
+                                 block_size)
+                _check(f, leaf, 3)
+
+            # so does a different cache file version
+            with open(cache_file, 'r+b') as f:
+                f.seek(8)
+                f.write(bytes(bytearray([0, 0, 0, 0])))
+            with _open(**kwds) as f:
+                self.assertEqual(f._root_device.bytes_received,
+                                 (cached_bucket_count + 1) * block_size)
+                _check(f, leaf, 3)
+        finally:
+            for name in (fname, cache_file):
+                if os.path.exists(name):
+                    os.remove(name)
+
 class TestTopCachedEncryptedHeapStorageCacheMMapDefault(
         _TestTopCachedEncryptedHeapStorage,
         unittest.TestCase):
@@ -615,6 +890,24 @@ class TestTopCachedEncryptedHeapStorageMMapCache5(
     _heap_base = 2
     _heap_height = 7
 
+class TestTopCachedEncryptedHeapStorageMMapCache3Populate(
+        _TestTopCachedEncryptedHeapStorage,
+        unittest.TestCase):
+    _init_kwds = {'cached_levels': 3,
+                  'cache_populate': True}
+    _storage_type = 'mmap'
+    _heap_base = 2
+    _heap_height = 7
+
+class TestTopCachedEncryptedHeapStorageMMapCache3HugePages(
+        _TestTopCachedEncryptedHeapStorage,
+        unittest.TestCase):
+    _init_kwds = {'cached_levels': 3,
+                  'cache_huge_pages': True}
+    _storage_type = 'mmap'
+    _heap_base = 2
+    _heap_height = 7
+
 class TestTopCachedEncryptedHeapStorageCacheFileDefault(
         _TestTopCachedEncryptedHeapStorage,
         unittest.TestCase):
@@ -707,5 +1000,116 @@ class TestTopCachedEncryptedHeapStorageFileCacheAll(
     _heap_base = 2
     _heap_height = 3
 
+class TestTopCachedEncryptedHeapStorageParallelPaths(unittest.TestCase):
+
+    def test_read_paths_parallel(self):
+        fname = self.__class__.__name__ + "_testfile.bin"
+        f = EncryptedHeapStorage.setup(fname,
+                                       50,
+                                       4,
+                                       heap_base=2,
+                                       storage_type='file',
+                                       ignore_existing=True)
+        f.close()
+        key = f.key
+        latency = 0.05
+        try:
+            with TopCachedEncryptedHeapStorage(
+                    EncryptedHeapStorage(fname,
+                                         key=key,
+                                         storage_type='simulated_link',
+                                         latency=latency),
+                    cached_levels=2,
+                    concurrency_level=2) as f:
+                vheap = f.virtual_heap
+                # one leaf in each of the 4 subheaps
+                leaves = [vheap.first_leaf_bucket() + 4*i
+                          for i in xrange(4)]
+                link = f._root_device.raw_storage
+                requests_before = link.request_count
+                start = time.time()
+                paths = f.read_paths(leaves)
+                stop = time.time()
+                self.assertEqual(len(paths), 4)
+                self.assertEqual(link.request_count - requests_before, 4)
+                # the 4 requests overlap
+                self.assertTrue(stop - start < 3*latency)
+        finally:
+            os.remove(fname)
+
+class TestTopCachedEncryptedHeapStorageMemoryBudget(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls._testfname = cls.__name__ + "_testfile.bin"
+        # 8 levels of buckets with 150 bytes each
+        f = EncryptedHeapStorage.setup(
+            cls._testfname,
+            50,
+            7,
+            heap_base=2,
+            blocks_per_bucket=3,
+            storage_type='file',
+            ignore_existing=True)
+        f.close()
+        cls._key = f.key
+        cls._bucket_size = f.bucket_size
+        assert cls._bucket_size == 150
+
+    @classmethod
+    def tearDownClass(cls):
+        try:
+            os.remove(cls._testfname)
+        except OSError:                                # pragma: no cover
+            pass                                       # pragma: no cover
+
+    def _open(self, storage_type='file'):
+        return EncryptedHeapStorage(self._testfname,
+                                    key=self._key,
+                                    storage_type=storage_type)
+
+    def test_choose_cache_levels(self):
+        choose = TopCachedEncryptedHeapStorage.choose_cache_levels
+        with self._open() as f:
+            self.assertEqual(choose(f, 0), (0, 0))
+            self.assertEqual(choose(f, 149), (0, 0))
+            self.assertEqual(choose(f, 150), (1, 0))
+            self.assertEqual(choose(f, 150*3), (2, 0))
+            self.assertEqual(choose(f, 150*7-1), (2, 0))
+            self.assertEqual(choose(f, MemorySize(150*7)), (3, 0))
+            self.assertEqual(choose(f, MemorySize(1, unit='MB')), (8, 0))
+            # the concurrency level has at most 'threads'
+            # buckets and does not go below the cache line
+            self.assertEqual(choose(f, 150*7, threads=4), (3, 2))
+            self.assertEqual(choose(f, 150*7, threads=3), (3, 1))
+            self.assertEqual(choose(f, 150*7, threads=100), (3, 3))
+            self.assertEqual(choose(f, 150*255, threads=1000), (8, 7))
+            with self.assertRaises(ValueError):
+                choose(f, -1)
+        with self._open(storage_type='simulated_link') as f:
+            cached_levels, concurrency_level = choose(f, 150*7)
+            self.assertEqual(cached_levels, 3)
+            # remote storage uses more than one device
+            self.assertTrue(concurrency_level > 0)
+
+    def test_cache_memory_budget(self):
+        f = TopCachedEncryptedHeapStorage(self._open(),
+                                          cache_memory_budget=149)
+        self.assertIs(type(f), EncryptedHeapStorage)
+        f.close()
+        with TopCachedEncryptedHeapStorage(
+                self._open(),
+                cache_memory_budget=MemorySize(150*15)) as f:
+            self.assertEqual(f._external_level, 4)
+            self.assertEqual(len(f.cached_bucket_data), 150*15)
+            self.assertEqual(len(f._concurrent_devices), 1)
+        with TopCachedEncryptedHeapStorage(
+                self._open(),
+                cache_memory_budget=MemorySize(150*15),
+                concurrency_level=2) as f:
+            self.assertEqual(f._external_level, 4)
+            # the root device clone and one per subheap
+            self.assertEqual(len(f._concurrent_devices), 1 + 4)
+
 if __name__ == "__main__":
     unittest.main()                                    # pragma: no cover
@@ -1,4 +1,5 @@
 import os
+import array
 import subprocess
 import unittest
 
@@ -12,9 +13,14 @@ from pyoram.util.virtual_heap import \
      calculate_bucket_level,
      calculate_last_common_level,
      calculate_necessary_heap_height,
+     calculate_subtree_root,
+     calculate_bucket_offset_in_subtree,
+     calculate_bucket_path,
      basek_string_to_base10_integer,
      numerals,
-     _clib)
+     _clib,
+     _ffi)
+from pyoram.util.misc import max_unsigned_typecode
 
 from six.moves import xrange
 
@@ -934,6 +940,22 @@ class TestVirtualHeap(unittest.TestCase):
                 self.assertEqual(root.level, 0)
                 self.assertEqual(root.parent_node(), None)
 
+    def test_bucket_level(self):
+        for k in range(2, 6):
+            heap = VirtualHeap(k)
+            for b in xrange(calculate_bucket_count_in_heap_with_height(k, 3)):
+                self.assertEqual(heap.bucket_level(b), heap.Node(b).level)
+
+    def test_path_buckets(self):
+        for k in range(2, 6):
+            heap = VirtualHeap(k)
+            for b in xrange(calculate_bucket_count_in_heap_with_height(k, 3)):
+                path = list(reversed(list(heap.Node(b).bucket_path_to_root())))
+                self.assertEqual(heap.path_buckets(b), path)
+                for level_start in xrange(len(path) + 1):
+                    self.assertEqual(heap.path_buckets(b, level_start),
+                                     path[level_start:])
+
 class TestSizedVirtualHeap(unittest.TestCase):
 
     def test_init(self):
@@ -1027,6 +1049,32 @@ class TestSizedVirtualHeap(unittest.TestCase):
                 node = heap.random_leaf_node()
                 self.assertEqual(node.level, height)
 
+    def test_random_leaf_buckets(self):
+        for k in xrange(2,6):
+            height = 3
+            heap = SizedVirtualHeap(k, height)
+            buckets = heap.random_leaf_buckets(4 * heap.leaf_bucket_count())
+            self.assertEqual(len(buckets), 4 * heap.leaf_bucket_count())
+            self.assertEqual(buckets.typecode, 'L')
+            for b in buckets:
+                self.assertEqual(heap.Node(b).level, height)
+            self.assertEqual(
+                heap.random_leaf_buckets(
+                    3, typecode=max_unsigned_typecode).typecode,
+                max_unsigned_typecode)
+
+    def test_random_leaf_node_below(self):
+        for k in xrange(2,6):
+            height = 3
+            heap = SizedVirtualHeap(k, height)
+            for b in xrange(heap.bucket_count()):
+                n = heap.Node(b)
+                for t in xrange(2 * k):
+                    node = heap.random_leaf_node_below(n)
+                    self.assertEqual(node.level, height)
+                    self.assertEqual(
+                        node.bucket_path_from_root()[n.level], b)
+
     def _assert_file_equals_baselines(self, fname, bname):
         with open(fname)as f:
             flines = f.readlines()
@@ -1223,5 +1271,58 @@ class TestMisc(unittest.TestCase):
         self.assertEqual(calculate_necessary_heap_height(3, 15), 3)
         self.assertEqual(calculate_necessary_heap_height(3, 16), 3)
 
+    def test_calculate_subtree_root(self):
+        self.assertEqual(calculate_subtree_root(2, 0, 2), (0, 0))
+        self.assertEqual(calculate_subtree_root(2, 1, 2), (0, 1))
+        self.assertEqual(calculate_subtree_root(2, 2, 2), (0, 1))
+        self.assertEqual(calculate_subtree_root(2, 3, 2), (3, 0))
+        self.assertEqual(calculate_subtree_root(2, 6, 2), (6, 0))
+        self.assertEqual(calculate_subtree_root(2, 7, 2), (3, 1))
+        self.assertEqual(calculate_subtree_root(2, 14, 2), (6, 1))
+        self.assertEqual(calculate_subtree_root(2, 14, 1), (14, 0))
+        self.assertEqual(calculate_subtree_root(2, 14, 4), (0, 3))
+        self.assertEqual(calculate_subtree_root(3, 3, 2), (0, 1))
+        self.assertEqual(calculate_subtree_root(3, 13, 2), (4, 1))
+
+    def test_calculate_bucket_offset_in_subtree(self):
+        for k in xrange(2, 5):
+            for subtree_levels in xrange(1, 4):
+                offsets = {}
+                for b in xrange(
+                        calculate_bucket_count_in_heap_with_height(k, 5)):
+                    root, depth = calculate_subtree_root(k, b, subtree_levels)
+                    self.assertTrue(0 <= depth < subtree_levels)
+                    offsets.setdefault(root, []).append(
+                        calculate_bucket_offset_in_subtree(k, root, b, depth))
+                # buckets are numbered in level order within
+                # each subtree
+                for root in offsets:
+                    self.assertEqual(offsets[root],
+                                     list(range(len(offsets[root]))))
+
+    def test_calculate_bucket_path(self):
+        self.assertEqual(calculate_bucket_path(2, 0), [0])
+        self.assertEqual(calculate_bucket_path(2, 13), [0, 2, 6, 13])
+        self.assertEqual(calculate_bucket_path(2, 13, 2), [6, 13])
+        self.assertEqual(calculate_bucket_path(2, 13, 4), [])
+        self.assertEqual(calculate_bucket_path(3, 13), [0, 1, 4, 13])
+        self.assertEqual(calculate_bucket_path(3, 13, 1), [1, 4, 13])
+        # the deepest path that fits in 64 bits
+        path = calculate_bucket_path(2, 2**64-2)
+        self.assertEqual(len(path), 64)
+        self.assertEqual(path[0], 0)
+        self.assertEqual(path[-1], 2**64-2)
+        for typecode in ('I', 'L', max_unsigned_typecode):
+            out = array.array(typecode, [0]) * 5
+            self.assertEqual(calculate_bucket_path(3, 13, 1, out=out), 3)
+            self.assertEqual(list(out), [1, 4, 13, 0, 0])
+        out = _ffi.new("unsigned long long[]", 4)
+        self.assertEqual(calculate_bucket_path(2, 13, out=out), 4)
+        self.assertEqual(list(out), [0, 2, 6, 13])
+        with self.assertRaises(ValueError):
+            calculate_bucket_path(2, 13, out=array.array('L', [0, 0, 0]))
+        with self.assertRaises(ValueError):
+            calculate_bucket_path(2, 2**40, out=array.array('I', [0]) * 64)
+
 if __name__ == "__main__":
     unittest.main()                                    # pragma: no cover
@@ -1,2 +1,3 @@
 import pyoram.util.misc
+import pyoram.util.random_sampler
 import pyoram.util.virtual_heap
@@ -1,7 +1,16 @@
+import array
 import base64
 
 import six
 
+# The array typecode of the largest unsigned integer
+# type ('Q' is not available in Python 2)
+try:
+    array.array('Q')
+    max_unsigned_typecode = 'Q'
+except ValueError:                                     # pragma: no cover
+    max_unsigned_typecode = 'L'                        # pragma: no cover
+
 def log2floor(n):
     """
     Returns the exact value of floor(log2(n)).
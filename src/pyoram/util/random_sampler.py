@@ -0,0 +1,110 @@
+__all__ = ("BufferedRandomSampler",)
+
+import os
+import array
+import random
+import threading
+
+from pyoram.util._virtual_heap_helper import \
+    (ffi as _ffi,
+     lib as _clib)
+from pyoram.util.misc import max_unsigned_typecode
+
+class BufferedRandomSampler(object):
+    """
+    A cryptographically secure source of uniform random
+    integers that reads os.urandom in large chunks (rather
+    than once per sample, as random.SystemRandom does) and
+    turns the bytes into integers in C using rejection
+    sampling, so the integers have no modulo bias.
+
+    The randint method can be used in place of
+    random.SystemRandom().randint. It draws batch_size
+    integers at a time for each range it is called with
+    (keeping the batches for up to _max_cached_ranges
+    ranges), which makes repeated calls with the same range
+    cheap. The randint_array method draws many integers at
+    once. The batches are discarded when the process forks,
+    so that a parent and child process never produce the
+    same integers.
+    """
+
+    _max_chunk_size = 2**24
+    _max_cached_ranges = 64
+    _max_batched = 2**(8 * array.array(max_unsigned_typecode).itemsize)
+
+    def __init__(self, batch_size=1024):
+        assert batch_size >= 1
+        self._batch_size = batch_size
+        self._lock = threading.Lock()
+        self._fallback = random.SystemRandom()
+        self._pid = os.getpid()
+        # maps (a, b) to [array of integers, next position]
+        self._batches = {}
+
+    @property
+    def batch_size(self):
+        return self._batch_size
+
+    def randint(self, a, b):
+        """Return a random integer N such that a <= N <= b."""
+        if b < a:
+            raise ValueError("empty range for randint (%s, %s)" % (a, b))
+        if (a < 0) or (b >= self._max_batched):
+            return self._fallback.randint(a, b)
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._batches.clear()
+            batch = self._batches.get((a, b), None)
+            if (batch is None) or (batch[1] == len(batch[0])):
+                if (batch is None) and \
+                   (len(self._batches) >= self._max_cached_ranges):
+                    self._batches.clear()
+                batch = self._batches[(a, b)] = \
+                    [self.randint_array(a, b, self._batch_size,
+                                        typecode=max_unsigned_typecode),
+                     0]
+            x = batch[0][batch[1]]
+            batch[1] += 1
+            return x
+
+    def randint_array(self, a, b, count, typecode='L'):
+        """
+        Return an array (with the given typecode, which must
+        be an unsigned integer type) of count random integers
+        N such that a <= N <= b.
+        """
+        out = array.array(typecode, [0]) * count
+        out_size = out.itemsize
+        assert typecode in ('I', 'L', max_unsigned_typecode)
+        assert out_size in (4, 8)
+        if not (0 <= a <= b < 2**(8 * out_size)):
+            raise ValueError(
+                "The range [%s, %s] does not fit in an array "
+                "with typecode '%s'" % (a, b, typecode))
+        if count == 0:
+            return out
+        max_offset = b - a
+        width = max(1, (max_offset.bit_length() + 7) // 8)
+        # the probability that a sample is accepted
+        acceptance = (max_offset + 1) / \
+            float(2**max_offset.bit_length())
+        out_ptr = _ffi.cast("unsigned char *", _ffi.from_buffer(out))
+        bytes_used = _ffi.new("size_t *")
+        filled = 0
+        while filled < count:
+            chunk_size = int((count - filled) * width / acceptance * 1.05)
+            chunk_size = min(max(chunk_size, width), self._max_chunk_size)
+            chunk = os.urandom(chunk_size)
+            filled += _clib.sample_uniform_integers(
+                _ffi.from_buffer(chunk),
+                0,
+                len(chunk),
+                a,
+                max_offset,
+                out_ptr + filled * out_size,
+                out_size,
+                count - filled,
+                bytes_used)
+        return out
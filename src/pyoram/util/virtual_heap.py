@@ -3,15 +3,20 @@ __all__ = ("VirtualHeap",
 
 import os
 import sys
+import array
 import subprocess
-import random
 import string
 import tempfile
+import threading
 
 from six.moves import xrange
 
-from pyoram.util._virtual_heap_helper import lib as _clib
-from pyoram.util.misc import log2floor
+from pyoram.util._virtual_heap_helper import \
+    (ffi as _ffi,
+     lib as _clib)
+from pyoram.util.misc import (log2floor,
+                              max_unsigned_typecode)
+from pyoram.util.random_sampler import BufferedRandomSampler
 
 numerals = ''.join([c for c in string.printable \
                   if ((c not in string.whitespace) and \
@@ -74,6 +79,46 @@ def calculate_last_common_level(k, b1, b2):
         l1 -= 1
     return l1
 
+# The longest path in a heap whose buckets fit in 64 bits
+_max_path_length = 64
+# a reusable buffer for each thread
+_path_buffer = threading.local()
+
+def calculate_bucket_path(k, b, level_start=0, out=None):
+    """
+    Calculate the buckets on the path from the root of a
+    k-ary heap to a 0-based bucket, skipping the first
+    level_start levels. Returns a list of buckets unless
+    out is given (an unsigned integer array or cffi array
+    with room for the path), in which case the buckets are
+    stored in out and their number is returned.
+    """
+    if out is None:
+        try:
+            buf, ptr = _path_buffer.buf, _path_buffer.ptr
+        except AttributeError:
+            buf = _path_buffer.buf = \
+                array.array(max_unsigned_typecode, [0]) * _max_path_length
+            ptr = _path_buffer.ptr = _ffi.from_buffer(buf)
+        count = _clib.calculate_bucket_path(k, b, level_start,
+                                            ptr, buf.itemsize,
+                                            _max_path_length)
+    elif isinstance(out, _ffi.CData):
+        count = _clib.calculate_bucket_path(
+            k, b, level_start, out,
+            _ffi.sizeof(_ffi.typeof(out).item), len(out))
+    else:
+        count = _clib.calculate_bucket_path(k, b, level_start,
+                                            _ffi.from_buffer(out),
+                                            out.itemsize, len(out))
+    if count < 0:
+        raise ValueError(
+            "The path to bucket %s does not fit in the output array"
+            % (b))
+    if out is None:
+        return buf[:count].tolist()
+    return count
+
 def calculate_necessary_heap_height(k, n):
     """
     Calculate the necessary k-ary heap height
@@ -105,6 +150,84 @@ def calculate_leaf_bucket_count_in_heap_with_height(k, h):
     """
     return calculate_bucket_count_in_heap_at_level(k, h)
 
+def calculate_subtree_root(k, b, subtree_levels):
+    """
+    Calculate the root bucket of the subtree containing a
+    0-based bucket when a k-ary heap is partitioned into
+    subtrees that each span subtree_levels levels
+    (starting from the root of the heap). Returns the
+    subtree root bucket and the depth of the bucket below
+    the subtree root.
+    """
+    assert subtree_levels >= 1
+    depth = calculate_bucket_level(k, b) % subtree_levels
+    root = b
+    for _ in xrange(depth):
+        root = (root - 1) // k
+    return root, depth
+
+def calculate_bucket_offset_in_subtree(k, root, b, depth):
+    """
+    Calculate the position of a 0-based bucket inside of
+    the subtree rooted at the given bucket, where the
+    subtree buckets are ordered level by level (the
+    same order used by the heap). The bucket must be at
+    the given depth below the subtree root.
+    """
+    assert depth >= 0
+    first = root * (k**depth) + ((k**depth) - 1) // (k - 1)
+    assert first <= b < first + k**depth
+    if depth == 0:
+        return 0
+    return calculate_bucket_count_in_heap_with_height(k, depth-1) + \
+        (b - first)
+
+# _clib defines a faster version of this function
+def calculate_blocked_bucket_index(k, levels, subtree_levels, b):
+    """
+    Calculate the position of a 0-based bucket when a
+    k-ary heap with the given number of levels is stored
+    as blocks of subtrees that each span subtree_levels
+    levels (see calculate_subtree_root). The subtrees in
+    the last band of levels are shorter when subtree_levels
+    does not divide the number of levels. Bands are stored
+    in order from the root, the subtrees of a band in order
+    of their root bucket, and the buckets of a subtree in
+    level order.
+    """
+    root, depth = calculate_subtree_root(k, b, subtree_levels)
+    band_level = calculate_bucket_level(k, b) - depth
+    # the number of buckets above the band
+    band_first = ((k**band_level) - 1) // (k - 1)
+    band_levels = min(subtree_levels, levels - band_level)
+    return band_first + \
+        (root - band_first) * \
+        calculate_bucket_count_in_heap_with_height(k, band_levels-1) + \
+        calculate_bucket_offset_in_subtree(k, root, b, depth)
+
+def calculate_blocked_bucket(k, levels, subtree_levels, i):
+    """
+    Calculate the 0-based bucket stored at position i of
+    a blocked subtree layout (the inverse of
+    calculate_blocked_bucket_index).
+    """
+    assert 0 <= i < calculate_bucket_count_in_heap_with_height(k, levels-1)
+    band_level = 0
+    band_levels = min(subtree_levels, levels)
+    while i >= calculate_bucket_count_in_heap_with_height(
+            k, band_level + band_levels - 1):
+        band_level += band_levels
+        band_levels = min(subtree_levels, levels - band_level)
+    band_first = ((k**band_level) - 1) // (k - 1)
+    root_offset, offset = divmod(
+        i - band_first,
+        calculate_bucket_count_in_heap_with_height(k, band_levels-1))
+    root = band_first + root_offset
+    depth = calculate_bucket_level(k, offset)
+    # the first bucket below the root at this depth
+    first = root * (k**depth) + ((k**depth) - 1) // (k - 1)
+    return first + offset - ((k**depth) - 1) // (k - 1)
+
 def create_node_type(k):
 
     class VirtualHeapNode(object):
@@ -164,7 +287,7 @@ def create_node_type(k):
                 bucket = (bucket - 1)//self.k
                 yield bucket
         def bucket_path_from_root(self):
-            return list(reversed(list(self.bucket_path_to_root())))
+            return calculate_bucket_path(self.k, self.bucket)
 
         #
         # Expensive Functions
@@ -213,7 +336,7 @@ def create_node_type(k):
 class VirtualHeap(object):
 
     clib = _clib
-    random = random.SystemRandom()
+    random = BufferedRandomSampler()
 
     def __init__(self, k, blocks_per_bucket=1):
         assert 1 < k
@@ -245,6 +368,12 @@ class VirtualHeap(object):
 
     def bucket_count_at_level(self, l):
         return calculate_bucket_count_in_heap_at_level(self.k, l)
+    def bucket_level(self, b):
+        return _clib.calculate_bucket_level(self.k, b)
+    def path_buckets(self, b, level_start=0, out=None):
+        return calculate_bucket_path(self.k, b,
+                                     level_start=level_start,
+                                     out=out)
     def first_bucket_at_level(self, l):
         if l > 0:
             return calculate_bucket_count_in_heap_with_height(self.k, l-1)
@@ -339,6 +468,17 @@ class SizedVirtualHeap(VirtualHeap):
                                    self.last_leaf_bucket())
     def random_leaf_bucket(self):
         return self.random_bucket_at_level(self.height)
+    def random_leaf_buckets(self, count, typecode='L'):
+        return self.random.randint_array(self.first_leaf_bucket(),
+                                         self.last_leaf_bucket(),
+                                         count,
+                                         typecode=typecode)
+    def random_leaf_bucket_below(self, b):
+        d = self.height - self.bucket_level(b)
+        assert d >= 0
+        n = self.k**d
+        first = b * n + (n - 1) // (self.k - 1)
+        return self.random.randint(first, first + n - 1)
 
     #
     # Nodes (a class that helps with heap path calculations)
@@ -356,6 +496,8 @@ class SizedVirtualHeap(VirtualHeap):
         return self.Node(self.last_leaf_bucket())
     def random_leaf_node(self):
         return self.Node(self.random_leaf_bucket())
+    def random_leaf_node_below(self, n):
+        return self.Node(self.random_leaf_bucket_below(n.bucket))
     def random_node(self):
         return self.Node(self.random_bucket())
 